@@ -0,0 +1,26 @@
+"""Update download bandwidth limit
+
+Revision ID: 3f3c9c5b2a7e
+Revises: 6dfba265232e
+Create Date: 2026-10-18 12:00:00.000000+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f3c9c5b2a7e'
+down_revision = '6dfba265232e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('system_update', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('upd_bandwidth_limit', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('system_update', schema=None) as batch_op:
+        batch_op.drop_column('upd_bandwidth_limit')
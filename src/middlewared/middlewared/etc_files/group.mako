@@ -1,7 +1,7 @@
 <%
     users_map = {
         i['id']: i
-        for i in middleware.call_sync('user.query')
+        for i in middleware.call_sync('user.query', [], {'select': ['id', 'username', 'group']})
     }
 
     def get_usernames(group):
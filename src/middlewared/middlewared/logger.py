@@ -1,8 +1,13 @@
+import atexit
+import copy
 import logging
 from logging.config import dictConfig
 import logging.handlers
 import os
+import queue
 import sys
+import threading
+import time
 
 import sentry_sdk
 
@@ -31,6 +36,14 @@ ZETTAREPL_LOGFILE = '/var/log/zettarepl.log'
 FAILOVER_LOGFILE = '/root/syslog/failover.log'
 logging.TRACE = 6
 
+LOG_QUEUE_SIZE = 100000
+LOG_BATCH_SIZE = 1000
+# Identical consecutive records are reported at least this often (seconds)
+LOG_REPEAT_INTERVAL = 10
+# Records below WARNING per second per logger
+LOG_RATE_LIMIT = 1000
+LOG_RATE_LIMIT_BURST = 10000
+
 
 def trace(self, message, *args, **kws):
     if self.isEnabledFor(logging.TRACE):
@@ -177,6 +190,16 @@ class LoggerStream(object):
 
 
 class ErrorProneRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # Set when records are written by `LogWriter` which flushes the stream once per batch of records
+    batch_flush = False
+
+    def flush(self):
+        if not self.batch_flush:
+            super().flush()
+
+    def flush_batch(self):
+        super().flush()
+
     def handleError(self, record):
         try:
             super().handleError(record)
@@ -192,6 +215,229 @@ class ErrorProneRotatingFileHandler(logging.handlers.RotatingFileHandler):
         reconfigure_logging()
 
 
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records over to the `LogWriter` thread that writes them to `target` handler.
+    """
+
+    def __init__(self, writer, target):
+        super().__init__(None)
+        self.writer = writer
+        self.target = target
+        self.target.batch_flush = True
+        # Do not format records that the target handler is going to discard anyway
+        self.setLevel(target.level)
+
+    def prepare(self, record):
+        # Arguments might be modified by the caller after the record was queued so the message is formatted here.
+        # The record is copied as other handlers might need the original one.
+        msg = self.format(record)
+        record = copy.copy(record)
+        record.message = msg
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record):
+        self.writer.put(self.target, record)
+
+
+class LogRateLimit:
+    def __init__(self):
+        self.tokens = LOG_RATE_LIMIT_BURST
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self.target = None
+        self.record = None
+
+    def refill(self, now):
+        self.tokens = min(self.tokens + (now - self.updated) * LOG_RATE_LIMIT, LOG_RATE_LIMIT_BURST)
+        self.updated = now
+
+    def allow(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+
+        return False
+
+
+class LogWriter:
+    """
+    Writes log records to files in a dedicated thread so that slow storage does not block threads (and the event
+    loop) that emit them.
+
+    Files are flushed once per batch of records. Identical consecutive records are written once followed by
+    "Last message repeated N times". Each logger can write `LOG_RATE_LIMIT` records below WARNING per second, the
+    rest are counted and reported. If the queue is full, records are dropped and reported too.
+    """
+
+    def __init__(self):
+        self._reset()
+        # The writer thread does not exist in forked processes and the lock might have been held while forking
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.thread = None
+        self.dropped = 0
+
+        self.repeated = {}
+        self.rate_limits = {}
+
+    def attach(self, *loggers):
+        """
+        Replaces file handlers of `loggers` with handlers that pass records to the writer thread.
+        """
+        for logger in loggers:
+            for handler in list(logger.handlers):
+                if isinstance(handler, ErrorProneRotatingFileHandler):
+                    logger.removeHandler(handler)
+                    logger.addHandler(LogQueueHandler(self, handler))
+
+    def put(self, target, record):
+        if self.thread is None:
+            self.start()
+
+        try:
+            self.queue.put_nowait((target, record))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='log_writer', daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Writes all queued records and stops the writer thread.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+
+        if thread is not None:
+            self.queue.put((None, None))
+            thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while True:
+            batch = []
+            if not stopping:
+                try:
+                    batch.append(self.queue.get(timeout=1))
+                except queue.Empty:
+                    pass
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            targets = set()
+            for target, record in batch:
+                if target is None:
+                    stopping = True
+                else:
+                    self._write(target, record, targets)
+
+            self._write_pending(targets, stopping or not batch)
+
+            for target in targets:
+                try:
+                    target.flush_batch()
+                except Exception:
+                    pass
+
+            if stopping and not batch:
+                break
+
+    def _write(self, target, record, targets):
+        now = time.monotonic()
+
+        key = (record.name, record.levelno, record.pathname, record.lineno, record.msg)
+        repeated = self.repeated.get(target)
+        if repeated is not None and repeated[0] == key:
+            repeated[2] += 1
+            return
+
+        self._write_repeated(target, targets)
+
+        if record.levelno < logging.WARNING:
+            rate_limit = self.rate_limits.get(record.name)
+            if rate_limit is None:
+                rate_limit = self.rate_limits[record.name] = LogRateLimit()
+
+            if not rate_limit.allow(now):
+                rate_limit.suppressed += 1
+                rate_limit.target = target
+                rate_limit.record = record
+                return
+
+            self._write_suppressed(rate_limit, targets)
+
+        self.repeated[target] = [key, record, 0, now]
+        self._handle(target, record, targets)
+
+    def _write_pending(self, targets, force):
+        now = time.monotonic()
+
+        if self.dropped and targets:
+            dropped, self.dropped = self.dropped, 0
+            self._handle(next(iter(targets)), self._summary(
+                logging.makeLogRecord({'name': __name__}), logging.WARNING,
+                f'{dropped} messages were dropped because log queue was full',
+            ), targets)
+
+        for target, (key, record, count, since) in list(self.repeated.items()):
+            if count and (force or now - since >= LOG_REPEAT_INTERVAL):
+                self._write_repeated(target, targets)
+                # Keep counting further repeats
+                self.repeated[target] = [key, record, 0, now]
+
+        for rate_limit in self.rate_limits.values():
+            if rate_limit.suppressed:
+                rate_limit.refill(now)
+                if force or rate_limit.tokens >= 1:
+                    self._write_suppressed(rate_limit, targets)
+
+    def _write_repeated(self, target, targets):
+        repeated = self.repeated.pop(target, None)
+        if repeated is not None and repeated[2]:
+            self._handle(target, self._summary(repeated[1], repeated[1].levelno,
+                                               f'Last message repeated {repeated[2]} times'), targets)
+
+    def _write_suppressed(self, rate_limit, targets):
+        if rate_limit.suppressed:
+            self._handle(rate_limit.target, self._summary(
+                rate_limit.record, logging.WARNING,
+                f'{rate_limit.suppressed} messages were suppressed because of rate limit',
+            ), targets)
+            rate_limit.suppressed = 0
+
+    def _summary(self, record, levelno, msg):
+        now = time.time()
+        return logging.makeLogRecord(dict(
+            record.__dict__, levelno=levelno, levelname=logging.getLevelName(levelno), msg=msg, message=msg,
+            args=None, created=now, msecs=(now - int(now)) * 1000,
+        ))
+
+    def _handle(self, target, record, targets):
+        target.handle(record)
+        targets.add(target)
+
+
+log_writer = LogWriter()
+atexit.register(log_writer.stop)
+
+
 class Logger(object):
     """Pseudo-Class for Logger - Wrapper for logging module"""
     def __init__(
@@ -270,6 +516,8 @@ class Logger(object):
 
     def stream(self):
         for handler in logging.root.handlers:
+            if isinstance(handler, LogQueueHandler):
+                handler = handler.target
             if isinstance(handler, ErrorProneRotatingFileHandler):
                 return handler.stream
 
@@ -283,6 +531,7 @@ class Logger(object):
             # [Errno 2] No such file or directory: '/var/log/middlewared.log'"
             # crashing the middleware during startup
             pass
+        log_writer.attach(logging.root, logging.getLogger('zettarepl'), logging.getLogger('failover'))
         # Make sure log file is not readable by everybody.
         # umask could be another approach but chmod was chosen so
         # it affects existing installs.
@@ -345,8 +594,12 @@ def reconfigure_logging():
         if not isinstance(handler, ErrorProneRotatingFileHandler):
             continue
 
-        stream = handler.stream
-        handler.stream = handler._open()
+        handler.acquire()
+        try:
+            stream = handler.stream
+            handler.stream = handler._open()
+        finally:
+            handler.release()
         # We want to reassign stdout/stderr if its not the default one or closed
         # which will happen on log file rotation.
         try:
@@ -360,3 +613,10 @@ def reconfigure_logging():
             stream.close()
         except Exception:
             pass
+
+
+def shutdown_logging():
+    """
+    Writes all queued log records. Must be called before exiting the process without running `atexit` handlers.
+    """
+    log_writer.stop()
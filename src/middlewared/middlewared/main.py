@@ -10,7 +10,8 @@ from .service_exception import adapt_exception, CallError, CallException, Valida
 from .utils import osc, start_daemon_thread, sw_version, LoadPluginsMixin
 from .utils.debug import get_frame_details, get_threads_stacks
 from .utils.lock import SoftHardSemaphore, SoftHardSemaphoreLimit
-from .utils.io_thread_pool_executor import IoThreadPoolExecutor
+from .utils.metrics import MetricsRegistry, timed_call
+from .utils.io_thread_pool_executor import IoThreadPool, IoThreadPoolExecutor, IoThreadPoolFull
 from .utils.profile import profile_wrap
 from .utils.run_in_thread import RunInThreadMixin
 from .utils.service.call import ServiceCallMixin
@@ -20,7 +21,7 @@ from aiohttp import web
 from aiohttp.web_exceptions import HTTPPermanentRedirect
 from aiohttp.web_middlewares import normalize_path_middleware
 from aiohttp_wsgi import WSGIHandler
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 import argparse
 import asyncio
@@ -57,6 +58,93 @@ if osc.IS_LINUX:
     from systemd.daemon import notify as systemd_notify
 
 
+# Loop monitor checks for blocked tasks every `LOOP_MONITOR_INTERVAL` ms and samples loop lag every
+# `LOOP_LAG_SAMPLE_INTERVAL` ms
+LOOP_MONITOR_INTERVAL = 2000
+LOOP_LAG_SAMPLE_INTERVAL = 250
+
+
+def event_message(name, event_type, kwargs):
+    event = {
+        'msg': event_type.lower(),
+        'collection': name,
+    }
+    kwargs = kwargs.copy()
+    if 'id' in kwargs:
+        event['id'] = kwargs.pop('id')
+    if event_type in ('ADDED', 'CHANGED'):
+        if 'fields' in kwargs:
+            event['fields'] = kwargs.pop('fields')
+    if event_type == 'CHANGED':
+        if 'cleared' in kwargs:
+            event['cleared'] = kwargs.pop('cleared')
+    if kwargs:
+        event['extra'] = kwargs
+    return event
+
+
+# Plugins which setup functions run first, one after another, in this order. Other plugins are set up after them.
+CORE_PLUGINS = [
+    'datastore',
+    # Allow internal UNIX socket authentication for plugins that run in separate pools
+    'auth',
+    # We need to register all services because pseudo-services can still be used by plugins setup functions
+    'service',
+    # We need to run pwenc first to ensure we have secret setup to work for encrypted fields which
+    # might be used in the setup functions.
+    'pwenc',
+    # We run boot plugin first to ensure we are able to retrieve
+    # BOOT POOL during system plugin initialization
+    'boot',
+    # We need to run system plugin setup's function first because when system boots, the right
+    # timezone is not configured. See #72131
+    'system',
+    # We also need to load alerts first because other plugins can issue one-shot alerts during their
+    # initialization
+    'alert',
+    # Migrate users and groups ASAP
+    'account',
+]
+
+
+def plugins_setup_waves(setup_funcs):
+    """
+    Groups `(plugin, setup function, dependencies)` into waves of `(plugin, setup function)`. Setup functions
+    in a wave only depend on plugins from the previous waves so they can be run concurrently.
+
+    A plugin module declares names of the plugins that have to be set up before it in `SETUP_DEPENDENCIES`. Every
+    plugin also depends on the preceding `CORE_PLUGINS`.
+    """
+    plugins = {plugin for plugin, f, dependencies in setup_funcs}
+    depends = defaultdict(set)
+    for plugin, f, dependencies in setup_funcs:
+        if plugin in CORE_PLUGINS:
+            depends[plugin].update(CORE_PLUGINS[:CORE_PLUGINS.index(plugin)])
+        else:
+            depends[plugin].update(CORE_PLUGINS)
+        depends[plugin].update(dependencies)
+
+    levels = {}
+
+    def level(plugin, path):
+        if plugin not in levels:
+            if plugin in path:
+                raise RuntimeError(f'Circular plugin setup dependency: {" -> ".join(path + [plugin])}')
+
+            levels[plugin] = max(
+                [level(dependency, path + [plugin]) + 1 for dependency in depends[plugin] & plugins - {plugin}],
+                default=0,
+            )
+
+        return levels[plugin]
+
+    waves = defaultdict(list)
+    for plugin, f, dependencies in setup_funcs:
+        waves[level(plugin, [])].append((plugin, f))
+
+    return [waves[i] for i in sorted(waves)]
+
+
 class Application(object):
 
     def __init__(self, middleware, loop, request, response):
@@ -85,13 +173,18 @@ class Application(object):
         self.__callbacks = defaultdict(list)
         self.__event_sources = {}
         self.__subscribed = {}
+        # Number of subscriptions (including event sources) for each event name
+        self.__subscribed_names = Counter()
 
     def register_callback(self, name, method):
         assert name in ('on_message', 'on_close')
         self.__callbacks[name].append(method)
 
     def _send(self, data):
-        asyncio.run_coroutine_threadsafe(self.response.send_str(json.dumps(data)), loop=self.loop)
+        self._send_str(json.dumps(data))
+
+    def _send_str(self, data):
+        asyncio.run_coroutine_threadsafe(self.response.send_str(data), loop=self.loop)
 
     def _tb_error(self, exc_info):
         klass, exc, trace = exc_info
@@ -152,6 +245,8 @@ class Application(object):
                 errno.ETOOMANYREFS,
                 f'Maximum number of concurrent calls ({e.args[0]}) has exceeded.',
             )
+        except IoThreadPoolFull as e:
+            self.send_error(message, errno.EBUSY, str(e))
         except ValidationError as e:
             self.send_error(message, e.errno, str(e), sys.exc_info(), etype='VALIDATION', extra=[
                 (e.attribute, e.errmsg, e.errno),
@@ -214,10 +309,12 @@ class Application(object):
                 'event_source': es,
                 'name': name,
             }
+            self.__add_subscribed_name(name)
             # Start it after setting __event_sources or it can have a race condition
             start_daemon_thread(target=es.process)
         else:
             self.__subscribed[ident] = name
+            self.__add_subscribed_name(name)
 
         self._send({
             'msg': 'ready',
@@ -226,34 +323,28 @@ class Application(object):
 
     async def unsubscribe(self, ident):
         if ident in self.__subscribed:
-            self.__subscribed.pop(ident)
+            self.__remove_subscribed_name(self.__subscribed.pop(ident))
         elif ident in self.__event_sources:
             event_source = self.__event_sources[ident]['event_source']
             await self.middleware.run_in_thread(event_source.cancel)
-            self.__event_sources.pop(ident)
+            self.__remove_subscribed_name(self.__event_sources.pop(ident)['name'])
+
+    def __add_subscribed_name(self, name):
+        self.__subscribed_names[name] += 1
+        if self.__subscribed_names[name] == 1:
+            self.middleware.register_event_subscriber(self, name)
+
+    def __remove_subscribed_name(self, name):
+        self.__subscribed_names[name] -= 1
+        if self.__subscribed_names[name] == 0:
+            del self.__subscribed_names[name]
+            self.middleware.unregister_event_subscriber(self, name)
 
     def send_event(self, name, event_type, **kwargs):
-        if (
-            not any(i == name or i == '*' for i in self.__subscribed.values()) and
-            not any(i['name'] == name for i in self.__event_sources.values())
-        ):
+        if name not in self.__subscribed_names and '*' not in self.__subscribed_names:
             return
-        event = {
-            'msg': event_type.lower(),
-            'collection': name,
-        }
-        kwargs = kwargs.copy()
-        if 'id' in kwargs:
-            event['id'] = kwargs.pop('id')
-        if event_type in ('ADDED', 'CHANGED'):
-            if 'fields' in kwargs:
-                event['fields'] = kwargs.pop('fields')
-        if event_type == 'CHANGED':
-            if 'cleared' in kwargs:
-                event['cleared'] = kwargs.pop('cleared')
-        if kwargs:
-            event['extra'] = kwargs
-        self._send(event)
+
+        self._send(event_message(name, event_type, kwargs))
 
     def on_open(self):
         self.middleware.register_wsclient(self)
@@ -270,6 +361,10 @@ class Application(object):
             event_source = val['event_source']
             asyncio.ensure_future(self.middleware.run_in_thread(event_source.cancel))
 
+        for name in list(self.__subscribed_names):
+            self.middleware.unregister_event_subscriber(self, name)
+        self.__subscribed_names.clear()
+
         self.middleware.unregister_wsclient(self)
 
     async def on_message(self, message):
@@ -437,7 +532,10 @@ class FileApplication(object):
         await resp.drain()
         return resp
 
-    async def upload(self, request):
+    async def authenticate(self, request):
+        """
+        Checks `Authorization` header (basic auth, auth token or API key) or `auth_token` query parameter.
+        """
         denied = True
         auth = request.headers.get('Authorization')
         if auth:
@@ -469,7 +567,10 @@ class FileApplication(object):
                 if token:
                     denied = False
 
-        if denied:
+        return not denied
+
+    async def upload(self, request):
+        if not await self.authenticate(request):
             resp = web.Response()
             resp.set_status(401)
             return resp
@@ -802,9 +903,11 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
         self.log_format = log_format
         self.startup_seq = 0
         self.startup_seq_path = startup_seq_path
+        self.boot_profile = {'load': None, 'setup': None, 'setup_functions': []}
         self.app = None
         self.loop = None
         self.run_in_thread_executor = IoThreadPoolExecutor('IoThread', 20)
+        self.metrics = MetricsRegistry()
         self.__thread_id = threading.get_ident()
         # Spawn new processes for ProcessPool instead of forking
         multiprocessing.set_start_method('spawn')
@@ -814,6 +917,10 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
         )
         self.__init_procpool()
         self.__wsclients = {}
+        # Websocket clients subscribed to each event name and clients subscribed to all events (`*`)
+        self.__event_subscribers = defaultdict(set)
+        self.__event_wildcard_subscribers = set()
+        self.__event_subscribers_lock = threading.Lock()
         self.__events = Events()
         self.__event_sources = {}
         self.__event_subs = defaultdict(list)
@@ -845,7 +952,7 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
             mod_name = mod.__name__.split('.')
             setup_plugin = mod_name[mod_name.index('plugins') + 1]
 
-            setup_funcs.append((setup_plugin, mod.setup))
+            setup_funcs.append((setup_plugin, mod.setup, getattr(mod, 'SETUP_DEPENDENCIES', [])))
 
         def on_modules_loaded():
             self._console_write('resolving plugins schemas')
@@ -859,52 +966,34 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
         return setup_funcs
 
     async def __plugins_setup(self, setup_funcs):
-
-        # TODO: Rework it when we have order defined for setup functions
-        def sort_key(plugin__function):
-            plugin, function = plugin__function
-
-            beginning = [
-                'datastore',
-                # Allow internal UNIX socket authentication for plugins that run in separate pools
-                'auth',
-                # We need to register all services because pseudo-services can still be used by plugins setup functions
-                'service',
-                # We need to run pwenc first to ensure we have secret setup to work for encrypted fields which
-                # might be used in the setup functions.
-                'pwenc',
-                # We run boot plugin first to ensure we are able to retrieve
-                # BOOT POOL during system plugin initialization
-                'boot',
-                # We need to run system plugin setup's function first because when system boots, the right
-                # timezone is not configured. See #72131
-                'system',
-                # We also need to load alerts first because other plugins can issue one-shot alerts during their
-                # initialization
-                'alert',
-                # Migrate users and groups ASAP
-                'account',
-                # Replication plugin needs to be initialized before zettarepl in order to register network activity
-                'replication',
-            ]
-            try:
-                return beginning.index(plugin)
-            except ValueError:
-                return len(beginning)
-        setup_funcs = sorted(setup_funcs, key=sort_key)
-
         # Only call setup after all schemas have been resolved because
         # they can call methods with schemas defined.
+        waves = plugins_setup_waves(setup_funcs)
         setup_total = len(setup_funcs)
-        for i, setup_func in enumerate(setup_funcs):
-            name, f = setup_func
-            self._console_write(f'setting up plugins ({name}) [{i + 1}/{setup_total}]')
+        setup_count = itertools.count(1)
+        setup_start = time.monotonic()
+
+        async def setup(wave, name, f):
+            self._console_write(f'setting up plugins ({name}) [{next(setup_count)}/{setup_total}]')
             self.__notify_startup_progress()
+            start = time.monotonic()
             call = f(self)
             # Allow setup to be a coroutine
             if asyncio.iscoroutinefunction(f):
                 await call
+            self.boot_profile['setup_functions'].append({
+                'plugin': name,
+                'module': f.__module__,
+                'wave': wave,
+                'start': start - setup_start,
+                'duration': time.monotonic() - start,
+            })
+
+        # Setup functions of independent plugins run concurrently
+        for i, wave in enumerate(waves):
+            await asyncio.gather(*[setup(i, name, f) for name, f in wave])
 
+        self.boot_profile['setup'] = time.monotonic() - setup_start
         self.logger.debug('All plugins loaded')
 
     def _setup_periodic_tasks(self):
@@ -1031,6 +1120,32 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
     def unregister_wsclient(self, client):
         self.__wsclients.pop(client.session_id)
 
+    def register_event_subscriber(self, client, name):
+        with self.__event_subscribers_lock:
+            if name == '*':
+                self.__event_wildcard_subscribers.add(client)
+            else:
+                self.__event_subscribers[name].add(client)
+
+    def unregister_event_subscriber(self, client, name):
+        with self.__event_subscribers_lock:
+            if name == '*':
+                self.__event_wildcard_subscribers.discard(client)
+            else:
+                subscribers = self.__event_subscribers.get(name)
+                if subscribers is not None:
+                    subscribers.discard(client)
+                    if not subscribers:
+                        del self.__event_subscribers[name]
+
+    def _event_subscribers(self, name):
+        with self.__event_subscribers_lock:
+            subscribers = self.__event_subscribers.get(name)
+            if subscribers is None:
+                return list(self.__event_wildcard_subscribers)
+
+            return list(subscribers | self.__event_wildcard_subscribers)
+
     def register_hook(self, name, method, sync=True, inline=False):
         """
         Register a hook under `name`.
@@ -1177,12 +1292,16 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
         elif serviceobj._config.thread_pool:
             executor = serviceobj._config.thread_pool
         elif io_thread:
-            executor = self.run_in_thread_executor
+            # Each service has its own pool so that a flood of calls to one service does not block the others
+            executor = self.run_in_thread_executor.pool(serviceobj._config.namespace)
         else:
             executor = self.__ws_threadpool
 
         return PreparedCall(args=args, executor=executor)
 
+    def _executor_metrics_name(self, executor):
+        return 'ws' if executor is self.__ws_threadpool else 'thread'
+
     async def _call(
         self, name, serviceobj, methodobj, params, **kwargs,
     ):
@@ -1193,21 +1312,28 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
 
         if asyncio.iscoroutinefunction(methodobj):
             self.logger.trace('Calling %r in current IO loop', name)
-            return await methodobj(*prepared_call.args)
+            with self.metrics.call(name, 'loop'):
+                return await methodobj(*prepared_call.args)
 
         if serviceobj._config.process_pool:
             self.logger.trace('Calling %r in process pool', name)
-            if isinstance(serviceobj, middlewared.service.CRUDService):
-                service_name, method_name = name.rsplit('.', 1)
-                if method_name in ['create', 'update', 'delete']:
-                    name = f'{service_name}.do_{method_name}'
-            return await self._call_worker(name, *prepared_call.args)
+            with self.metrics.call(name, 'process') as call:
+                if isinstance(serviceobj, middlewared.service.CRUDService):
+                    service_name, method_name = name.rsplit('.', 1)
+                    if method_name in ['create', 'update', 'delete']:
+                        name = f'{service_name}.do_{method_name}'
+                return await self._call_worker(name, *prepared_call.args, call=call)
 
         self.logger.trace('Calling %r in executor %r', name, prepared_call.executor)
-        return await self.run_in_executor(prepared_call.executor, methodobj, *prepared_call.args)
+        with self.metrics.call(name, self._executor_metrics_name(prepared_call.executor)) as call:
+            return await self.run_in_executor(prepared_call.executor, call.run, methodobj, *prepared_call.args)
+
+    async def _call_worker(self, name, *args, job=None, call=None):
+        if call is None:
+            return await self.run_in_proc(main_worker, name, args, job)
 
-    async def _call_worker(self, name, *args, job=None):
-        return await self.run_in_proc(main_worker, name, args, job)
+        call.started, result = await self.run_in_proc(timed_call, main_worker, name, args, job)
+        return result
 
     def dump_args(self, args, method=None, method_name=None):
         if method is None:
@@ -1251,24 +1377,28 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
 
         if asyncio.iscoroutinefunction(methodobj):
             self.logger.trace('Calling %r in main IO loop', name)
-            return self.run_coroutine(methodobj(*prepared_call.args))
+            with self.metrics.call(name, 'loop'):
+                return self.run_coroutine(methodobj(*prepared_call.args))
 
         if serviceobj._config.process_pool:
             self.logger.trace('Calling %r in process pool', name)
-            return self.run_coroutine(self._call_worker(name, *prepared_call.args))
+            with self.metrics.call(name, 'process') as call:
+                return self.run_coroutine(self._call_worker(name, *prepared_call.args, call=call))
 
-        if not self._in_executor(prepared_call.executor):
-            self.logger.trace('Calling %r in executor %r', name, prepared_call.executor)
-            return self.run_coroutine(self.run_in_executor(prepared_call.executor, methodobj, *prepared_call.args))
+        with self.metrics.call(name, self._executor_metrics_name(prepared_call.executor)) as call:
+            if not self._in_executor(prepared_call.executor):
+                self.logger.trace('Calling %r in executor %r', name, prepared_call.executor)
+                return self.run_coroutine(self.run_in_executor(prepared_call.executor, call.run, methodobj,
+                                                               *prepared_call.args))
 
-        self.logger.trace('Calling %r in current thread', name)
-        return methodobj(*prepared_call.args)
+            self.logger.trace('Calling %r in current thread', name)
+            return methodobj(*prepared_call.args)
 
     def _in_executor(self, executor):
         if isinstance(executor, concurrent.futures.thread.ThreadPoolExecutor):
             return threading.current_thread() in executor._threads
-        elif isinstance(executor, IoThreadPoolExecutor):
-            return any(worker.thread == threading.current_thread() for worker in executor.workers)
+        elif isinstance(executor, (IoThreadPool, IoThreadPoolExecutor)):
+            return executor.in_worker_thread()
         else:
             raise RuntimeError(f"Unknown executor: {executor!r}")
 
@@ -1332,11 +1462,20 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
 
         self.logger.trace(f'Sending event {name!r}:{event_type!r}:{kwargs!r}')
 
-        for session_id, wsclient in list(self.__wsclients.items()):
+        subscribers = self._event_subscribers(name)
+        if subscribers:
+            # Serialize the event once for all subscribed clients
             try:
-                wsclient.send_event(name, event_type, **kwargs)
+                data = json.dumps(event_message(name, event_type, kwargs))
             except Exception:
-                self.logger.warn('Failed to send event {} to {}'.format(name, session_id), exc_info=True)
+                self.logger.warn('Failed to serialize event {}'.format(name), exc_info=True)
+            else:
+                for wsclient in subscribers:
+                    try:
+                        wsclient._send_str(data)
+                    except Exception:
+                        self.logger.warn('Failed to send event {} to {}'.format(name, wsclient.session_id),
+                                         exc_info=True)
 
         # Send event also for internally subscribed plugins
         for handler in self.__event_subs.get(name, []):
@@ -1350,6 +1489,16 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
         for thread_id, stack in get_threads_stacks().items():
             self.logger.debug('Thread %d stack:\n%s', thread_id, ''.join(stack))
 
+    async def metrics_handler(self, request):
+        """
+        Serves `core.metrics` in Prometheus text exposition format.
+        """
+        if not await self.fileapp.authenticate(request):
+            return web.Response(status=401)
+
+        return web.Response(text=self.metrics.prometheus(), content_type='text/plain', charset='utf-8',
+                            headers={'Cache-Control': 'no-cache'})
+
     async def ws_handler(self, request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
@@ -1393,7 +1542,11 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
         osc.set_thread_name('loop_monitor')
         last = None
         while True:
-            time.sleep(2)
+            # Sample event loop lag (time it takes for a scheduled callback to run) while waiting for the next check
+            for i in range(LOOP_MONITOR_INTERVAL // LOOP_LAG_SAMPLE_INTERVAL):
+                time.sleep(LOOP_LAG_SAMPLE_INTERVAL / 1000)
+                self.loop.call_soon_threadsafe(self._sample_loop_lag, time.monotonic())
+
             current = asyncio.current_task(loop=self.loop)
             if current is None:
                 last = None
@@ -1409,6 +1562,9 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
                     self.logger.warn(''.join(['Task seems blocked:\n'] + stack))
             last = current
 
+    def _sample_loop_lag(self, scheduled):
+        self.metrics.record_loop_lag(time.monotonic() - scheduled)
+
     def run(self):
 
         self._console_write('starting')
@@ -1428,6 +1584,9 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
             if e.args[0] != "Event loop is closed":
                 raise
 
+        # `os._exit` does not run `atexit` handlers
+        logger.shutdown_logging()
+
         # As we don't do clean shutdown (which will terminate multiprocessing children gracefully),
         # let's just kill our entire process group
         os.killpg(os.getpgid(os.getpid()), signal.SIGKILL)
@@ -1443,7 +1602,9 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
 
         # Needs to happen after setting debug or may cause race condition
         # http://bugs.python.org/issue30805
+        load_start = time.monotonic()
         setup_funcs = await self.__plugins_load()
+        self.boot_profile['load'] = time.monotonic() - load_start
 
         self._console_write('registering services')
 
@@ -1467,6 +1628,7 @@ class Middleware(LoadPluginsMixin, RunInThreadMixin, ServiceCallMixin):
         self.fileapp = FileApplication(self, self.loop)
         app.router.add_route('*', '/_download{path_info:.*}', self.fileapp.download)
         app.router.add_route('*', '/_upload{path_info:.*}', self.fileapp.upload)
+        app.router.add_route('GET', '/_metrics', self.metrics_handler)
 
         shellapp = ShellApplication(self)
         app.router.add_route('*', '/_shell{path_info:.*}', shellapp.ws_handler)
@@ -4,6 +4,7 @@ from middlewared.service import (
 )
 import middlewared.sqlalchemy as sa
 from middlewared.utils import run, filter_list
+from middlewared.utils.credential_cache import CREDENTIAL_VERIFY_EXECUTOR
 from middlewared.utils.osc import IS_FREEBSD
 from middlewared.validators import Email
 from middlewared.plugins.smb import SMBBuiltin
@@ -96,27 +97,45 @@ class UserService(CRUDService):
     class Config:
         datastore = 'account.bsdusers'
         datastore_extend = 'user.user_extend'
+        datastore_extend_context = 'user.user_extend_context'
         datastore_prefix = 'bsdusr_'
 
     @private
-    async def user_extend(self, user):
+    async def user_extend_context(self, extra):
+        # `groups` of a user and `users` of a group reference datastore row ids, so memberships are indexed by
+        # those. Lookups by uid, gid or name filter the already extended rows and need no index of their own.
+        memberships = {}
+        res = await self.middleware.call(
+            'datastore.query', 'account.bsdgroupmembership', [], {'prefix': 'bsdgrpmember_', 'relationships': False}
+        )
+        for membership in res:
+            memberships.setdefault(membership['user_id'], []).append(membership['group_id'])
+
+        return {
+            'memberships': memberships,
+            'read_sshpubkey': extra.get('read_sshpubkey', True),
+        }
+
+    @private
+    async def user_extend(self, user, ctx):
 
         # Normalize email, empty is really null
         if user['email'] == '':
             user['email'] = None
 
         # Get group membership
-        user['groups'] = [gm['group']['id'] for gm in await self.middleware.call('datastore.query', 'account.bsdgroupmembership', [('user', '=', user['id'])], {'prefix': 'bsdgrpmember_'})]
+        user['groups'] = ctx['memberships'].get(user['id'], [])
 
         # Get authorized keys
-        keysfile = f'{user["home"]}/.ssh/authorized_keys'
         user['sshpubkey'] = None
-        if os.path.exists(keysfile):
-            try:
-                with open(keysfile, 'r') as f:
-                    user['sshpubkey'] = f.read()
-            except Exception:
-                pass
+        if ctx['read_sshpubkey']:
+            keysfile = f'{user["home"]}/.ssh/authorized_keys'
+            if os.path.exists(keysfile):
+                try:
+                    with open(keysfile, 'r') as f:
+                        user['sshpubkey'] = f.read()
+                except Exception:
+                    pass
         return user
 
     @private
@@ -154,6 +173,11 @@ class UserService(CRUDService):
         if dssearch:
             return await self.middleware.call('dscache.query', 'USERS', filters, options)
 
+        # Reading `authorized_keys` from every user home directory is expensive, only do so when it is requested
+        datastore_options['extra'] = dict(
+            extra, read_sshpubkey=not options.get('select') or 'sshpubkey' in options['select'],
+        )
+
         result = await self.middleware.call(
             'datastore.query', self._config.datastore, [], datastore_options
         )
@@ -796,8 +820,11 @@ class UserService(CRUDService):
         if 'password' not in data:
             return
         password = data.pop('password')
+        await self.middleware.call('auth.credential_cache_invalidate', 'user', data['username'])
         if password:
-            data['unixhash'] = crypted_password(password)
+            data['unixhash'] = await self.middleware.run_in_executor(
+                CREDENTIAL_VERIFY_EXECUTOR, crypted_password, password,
+            )
             # See http://samba.org.ru/samba/docs/man/manpages/smbpasswd.5.html
             data['smbhash'] = f'{data["username"]}:{data["uid"]}:{"X" * 32}:{nt_password(password)}:[U         ]:LCT-{int(time.time()):X}:'
         else:
@@ -919,12 +946,30 @@ class GroupService(CRUDService):
         datastore = 'account.bsdgroups'
         datastore_prefix = 'bsdgrp_'
         datastore_extend = 'group.group_extend'
+        datastore_extend_context = 'group.group_extend_context'
+
+    @private
+    async def group_extend_context(self, extra):
+        users = {}
+        res = await self.middleware.call(
+            'datastore.query', 'account.bsdgroupmembership', [], {'prefix': 'bsdgrpmember_', 'relationships': False}
+        )
+        for membership in res:
+            users.setdefault(membership['group_id'], []).append(membership['user_id'])
+
+        primary_users = {}
+        res = await self.middleware.call(
+            'datastore.query', 'account.bsdusers', [], {'prefix': 'bsdusr_', 'relationships': False}
+        )
+        for user in res:
+            primary_users.setdefault(user['group_id'], []).append(user['id'])
+
+        return {'users': users, 'primary_users': primary_users}
 
     @private
-    async def group_extend(self, group):
+    async def group_extend(self, group, ctx):
         # Get group membership
-        group['users'] = [gm['user']['id'] for gm in await self.middleware.call('datastore.query', 'account.bsdgroupmembership', [('group', '=', group['id'])], {'prefix': 'bsdgrpmember_'})]
-        group['users'] += [gmu['id'] for gmu in await self.middleware.call('datastore.query', 'account.bsdusers', [('bsdusr_group_id', '=', group['id'])])]
+        group['users'] = ctx['users'].get(group['id'], []) + ctx['primary_users'].get(group['id'], [])
         return group
 
     @private
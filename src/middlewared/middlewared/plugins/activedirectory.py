@@ -18,6 +18,7 @@ from middlewared.service import job, private, ConfigService, Service, Validation
 from middlewared.service_exception import CallError
 import middlewared.sqlalchemy as sa
 from middlewared.utils import run, Popen
+from middlewared.plugins.cache_.dscache_store import group_entry, user_entry
 from middlewared.plugins.directoryservices import DSStatus
 from middlewared.plugins.idmap import DSType
 import middlewared.utils.osc as osc
@@ -31,6 +32,16 @@ from samba import (ntstatus, NTSTATUSError)
 
 LP_CTX = param.get_context()
 FEATURE_SEAL = 4
+AD_CACHE_ID_BASE = 300000000
+
+
+def gencache_sid(line):
+    """
+    Returns SID from `net cache list` line (`Key: IDMAP/UID2SID/<uid> Timeout: <time> Value: <SID>`).
+    """
+    value = line.partition('Value:')[2].split()
+    if value and value[0].startswith('S-'):
+        return value[0]
 
 
 class neterr(enum.Enum):
@@ -704,7 +715,7 @@ class ActiveDirectoryService(ConfigService):
         if ret == neterr.JOINED:
             await self.set_state(DSStatus['HEALTHY'])
             await self.middleware.call('admonitor.start')
-            await self.middleware.call('activedirectory.get_cache')
+            await self.middleware.call('activedirectory.fill_cache')
             if ad['verbose_logging']:
                 self.logger.debug('Successfully started AD service for [%s].', ad['domainname'])
 
@@ -1202,7 +1213,7 @@ class ActiveDirectoryService(ConfigService):
     @job(lock='fill_ad_cache')
     def fill_cache(self, job, force=False):
         """
-        Use UID2SID and GID2SID entries in Samba's gencache.tdb to populate the AD_cache.
+        Use UID2SID and GID2SID entries in Samba's gencache.tdb to populate the AD cache.
         Since this can include IDs outside of our configured idmap domains (Local accounts
         will also appear here), there is a check to see if the ID is inside the idmap ranges
         configured for domains that are known to us. Some samba idmap backends support
@@ -1212,11 +1223,11 @@ class ActiveDirectoryService(ConfigService):
         GID2SID entries. If it's an actual group, getpwnam will fail. This heuristic
         may be revised in the future, but we want to keep things as simple as possible
         here since the list of entries numbers perhaps in the tens of thousands.
-        """
-        if self.middleware.call_sync('cache.has_key', 'AD_cache') and not force:
-            raise CallError('AD cache already exists. Refusing to generate cache.')
 
-        self.middleware.call_sync('cache.pop', 'AD_cache')
+        Unless `force` is set, only IDs that are not cached yet are looked up and cached
+        entries are kept. With `force`, every ID is looked up again and entries that are
+        no longer in gencache are removed.
+        """
         ad = self.middleware.call_sync('activedirectory.config')
         smb = self.middleware.call_sync('smb.config')
         id_type_both_backends = [
@@ -1242,14 +1253,16 @@ class ActiveDirectoryService(ConfigService):
         if netlist.returncode != 0:
             raise CallError(f'Winbind cache dump failed with error: {netlist.stderr.decode().strip()}')
 
+        full = force or not self.middleware.call_sync('dscache.is_filled', 'activedirectory')
+        cached_uids = {} if full else self.middleware.call_sync('dscache.get_ids', 'activedirectory', 'USERS')
+        cached_gids = {} if full else self.middleware.call_sync('dscache.get_ids', 'activedirectory', 'GROUPS')
+
         known_domains = []
-        local_users = {}
-        local_groups = {}
-        local_users.update({x['uid']: x for x in self.middleware.call_sync('user.query')})
-        local_users.update({x['gid']: x for x in self.middleware.call_sync('group.query')})
-        cache_data = {'users': {}, 'groups': {}}
+        local_uids = {x['uid'] for x in self.middleware.call_sync('user.query')}
+        local_gids = {x['gid'] for x in self.middleware.call_sync('group.query')}
+        users = []
+        groups = []
         configured_domains = self.middleware.call_sync('idmap.query')
-        user_next_index = group_next_index = 300000000
         for d in configured_domains:
             if d['name'] == 'DS_TYPE_ACTIVEDIRECTORY':
                 known_domains.append({
@@ -1273,7 +1286,7 @@ class ActiveDirectoryService(ConfigService):
                 Do not cache local users. This is to avoid problems where a local user
                 may enter into the id range allotted to AD users.
                 """
-                if local_users.get(cached_uid, None):
+                if cached_uid in local_uids or cached_uid in cached_uids:
                     continue
 
                 for d in known_domains:
@@ -1284,36 +1297,15 @@ class ActiveDirectoryService(ConfigService):
                         """
                         try:
                             user_data = pwd.getpwuid(cached_uid)
-                            cache_data['users'].update({user_data.pw_name: {
-                                'id': user_next_index,
-                                'uid': user_data.pw_uid,
-                                'username': user_data.pw_name,
-                                'unixhash': None,
-                                'smbhash': None,
-                                'group': {},
-                                'home': '',
-                                'shell': '',
-                                'full_name': user_data.pw_gecos,
-                                'builtin': False,
-                                'email': '',
-                                'password_disabled': False,
-                                'locked': False,
-                                'sudo': False,
-                                'microsoft_account': False,
-                                'attributes': {},
-                                'groups': [],
-                                'sshpubkey': None,
-                                'local': False,
-                                'id_type_both': d['id_type_both']
-                            }})
-                            user_next_index += 1
-                            break
                         except KeyError:
                             break
 
+                        users.append(user_entry(user_data, sid=gencache_sid(line), id_type_both=d['id_type_both']))
+                        break
+
             if line.startswith('Key: IDMAP/GID2SID'):
                 cached_gid = int((line.split())[1][14:])
-                if local_groups.get(cached_gid, None):
+                if cached_gid in local_gids or cached_gid in cached_gids:
                     continue
 
                 for d in known_domains:
@@ -1330,27 +1322,16 @@ class ActiveDirectoryService(ConfigService):
                         except KeyError:
                             break
 
-                        cache_data['groups'].update({group_data.gr_name: {
-                            'id': group_next_index,
-                            'gid': group_data.gr_gid,
-                            'group': group_data.gr_name,
-                            'builtin': False,
-                            'sudo': False,
-                            'users': [],
-                            'local': False,
-                            'id_type_both': d['id_type_both']
-                        }})
-                        group_next_index += 1
+                        groups.append(group_entry(group_data, sid=gencache_sid(line), id_type_both=d['id_type_both']))
                         break
 
-        if not cache_data.get('users'):
+        if full and not users:
             return
-        sorted_cache = {}
-        sorted_cache['users'] = dict(sorted(cache_data['users'].items()))
-        sorted_cache['groups'] = dict(sorted(cache_data['groups'].items()))
 
-        self.middleware.call_sync('cache.put', 'AD_cache', sorted_cache)
-        self.middleware.call_sync('dscache.backup')
+        for objtype, entries in [('USERS', users), ('GROUPS', groups)]:
+            self.middleware.call_sync('dscache.update_entries', 'activedirectory', objtype, entries, None, full,
+                                      AD_CACHE_ID_BASE)
+        self.middleware.call_sync('dscache.set_meta', 'activedirectory', 'filled', time.time())
 
     @private
     async def get_cache(self):
@@ -1361,11 +1342,11 @@ class ActiveDirectoryService(ConfigService):
         last filled. The cache expires and is refilled every 24 hours, or can be
         manually refreshed by calling fill_cache(True).
         """
-        if not await self.middleware.call('cache.has_key', 'AD_cache'):
+        if not await self.middleware.call('dscache.is_filled', 'activedirectory'):
             await self.middleware.call('activedirectory.fill_cache')
             self.logger.debug('cache fill is in progress.')
             return {'users': {}, 'groups': {}}
-        return await self.middleware.call('cache.get', 'AD_cache')
+        return await self.middleware.call('dscache.get_entries', 'activedirectory')
 
 
 class WBStatusThread(threading.Thread):
@@ -4,10 +4,12 @@ import string
 
 from passlib.hash import pbkdf2_sha256
 
+from middlewared.plugins.auth import credential_cache
 from middlewared.schema import accepts, Bool, Dict, Int, Str, Patch
 from middlewared.service import CRUDService, private, ValidationErrors
 from middlewared.service_exception import MatchNotFound
 import middlewared.sqlalchemy as sa
+from middlewared.utils.credential_cache import CREDENTIAL_VERIFY_EXECUTOR
 
 
 class APIKeyModel(sa.Model):
@@ -47,7 +49,7 @@ class ApiKeyService(CRUDService):
         await self._validate("api_key_create", data)
 
         key = self._generate()
-        data["key"] = pbkdf2_sha256.encrypt(key)
+        data["key"] = await self.middleware.run_in_executor(CREDENTIAL_VERIFY_EXECUTOR, pbkdf2_sha256.encrypt, key)
 
         data["created_at"] = datetime.utcnow()
 
@@ -86,7 +88,8 @@ class ApiKeyService(CRUDService):
         key = None
         if reset:
             key = self._generate()
-            new["key"] = pbkdf2_sha256.encrypt(key)
+            new["key"] = await self.middleware.run_in_executor(CREDENTIAL_VERIFY_EXECUTOR, pbkdf2_sha256.encrypt, key)
+            credential_cache.invalidate("api_key", id)
 
         await self.middleware.call(
             "datastore.update",
@@ -110,6 +113,8 @@ class ApiKeyService(CRUDService):
             id
         )
 
+        credential_cache.invalidate("api_key", id)
+
         return response
 
     @private
@@ -126,9 +131,15 @@ class ApiKeyService(CRUDService):
         except MatchNotFound:
             return None
 
-        if not pbkdf2_sha256.verify(key, db_key["key"]):
+        if credential_cache.get("api_key", key_id, key, db_key["key"]):
+            return db_key
+
+        if not await self.middleware.run_in_executor(
+            CREDENTIAL_VERIFY_EXECUTOR, pbkdf2_sha256.verify, key, db_key["key"],
+        ):
             return None
 
+        credential_cache.put("api_key", key_id, key, db_key["key"])
         return db_key
 
     async def _validate(self, schema_name, data, id=None):
@@ -14,9 +14,13 @@ from middlewared.service import (
 )
 import middlewared.sqlalchemy as sa
 from middlewared.utils import osc, Popen
+from middlewared.utils.credential_cache import CredentialCache, CREDENTIAL_VERIFY_EXECUTOR
 from middlewared.validators import Range
 
 
+credential_cache = CredentialCache()
+
+
 class TokenManager:
     def __init__(self):
         self.tokens = {}
@@ -271,7 +275,23 @@ class AuthService(Service):
             return False
         if user['bsdusr_unixhash'] in ('x', '*'):
             return False
-        return crypt.crypt(password, user['bsdusr_unixhash']) == user['bsdusr_unixhash']
+
+        if credential_cache.get('user', username, password, user['bsdusr_unixhash']):
+            return True
+
+        valid = await self.middleware.run_in_executor(
+            CREDENTIAL_VERIFY_EXECUTOR, crypt.crypt, password, user['bsdusr_unixhash'],
+        ) == user['bsdusr_unixhash']
+        if valid:
+            credential_cache.put('user', username, password, user['bsdusr_unixhash'])
+        return valid
+
+    @private
+    def credential_cache_invalidate(self, kind=None, identity=None):
+        """
+        Forget recently verified credentials of `kind` ("user" or "api_key") for `identity`.
+        """
+        credential_cache.invalidate(kind, identity)
 
     @accepts(Int('ttl', default=600, null=True), Dict('attrs', additional_attrs=True))
     def generate_token(self, ttl=None, attrs=None):
@@ -290,6 +310,18 @@ class AuthService(Service):
 
         return token.token
 
+    @private
+    def check_token(self, token_id):
+        """
+        Returns whether `token_id` is a valid token, refreshing its TTL if it is.
+        """
+        token = self.token_manager.get(token_id)
+        if token is None:
+            return False
+
+        token.notify_used()
+        return True
+
     @private
     def get_token(self, token_id):
         try:
@@ -1,13 +1,17 @@
 from middlewared.schema import Any, Str, accepts, Int
 from middlewared.service import Service, private
-from middlewared.utils import filter_list
+from middlewared.plugins.cache_.dscache_store import DSCacheStore, OBJTYPES
 
 from collections import namedtuple
+import contextlib
+import os
 import time
-import pickle
 import pwd
 import grp
 
+DSCACHE_PATH = '/var/db/system/.dscache.sqlite'
+DS_LIST = ['activedirectory', 'ldap', 'nis']
+
 
 class CacheService(Service):
 
@@ -52,6 +56,17 @@ class CacheService(Service):
         v = self.kv_tuple(value=value, timeout=timeout)
         self.__cache[key] = v
 
+    @private
+    def update(self, key, value):
+        """
+        Replace `value` of `key` keeping its expiration time.
+
+        Raises:
+            KeyError: not found in the cache
+        """
+        self.get(key)
+        self.__cache[key] = self.__cache[key]._replace(value=value)
+
     @accepts(Str('key'))
     def pop(self, key):
         """
@@ -93,6 +108,11 @@ class DSCache(Service):
     class Config:
         private = True
 
+    def __init__(self, *args, **kwargs):
+        super(DSCache, self).__init__(*args, **kwargs)
+        # Entries are only kept in memory until the system dataset is available
+        self.store = DSCacheStore()
+
     def get_uncached_user(self, username=None, uid=None):
         """
         Returns dictionary containing pwd_struct data for
@@ -135,24 +155,67 @@ class DSCache(Service):
         }
 
     def initialize(self):
-        for ds in [('activedirectory', 'AD'), ('ldap', 'LDAP'), ('nis', 'NIS')]:
-            if self.middleware.call_sync(f'{ds[0]}.get_state') != 'DISABLED':
-                try:
-                    with open(f'/var/db/system/.{ds[1]}_cache_backup', 'rb') as f:
-                        pickled_cache = pickle.load(f)
-                    self.middleware.call_sync('cache.put', f'{ds[1]}_cache', pickled_cache)
-                except FileNotFoundError:
-                    self.logger.debug('User cache file for [%s] is not present.', ds[0])
+        """
+        Opens the persistent cache on the system dataset.
+        """
+        store = DSCacheStore(DSCACHE_PATH)
+        old, self.store = self.store, store
+        if old.path == ':memory:' and any(old.is_filled(ds) for ds in DS_LIST):
+            # Cache was filled before the system dataset became available
+            old.copy_to(store)
+        old.close()
+
+        for prefix in ['AD', 'LDAP', 'NIS']:
+            # Replaced by the persistent cache
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(f'/var/db/system/.{prefix}_cache_backup')
+
+    def close(self):
+        """
+        Closes the persistent cache so that the system dataset can be unmounted.
+        """
+        store, self.store = self.store, DSCacheStore()
+        store.checkpoint()
+        store.close()
 
     def backup(self):
-        for ds in [('activedirectory', 'AD'), ('ldap', 'LDAP'), ('nis', 'NIS')]:
-            if self.middleware.call_sync(f'{ds[0]}.get_state') != 'DISABLED':
-                try:
-                    ds_cache = self.middleware.call_sync('cache.get', f'{ds[1]}_cache')
-                    with open(f'/var/db/system/.{ds[1]}_cache_backup', 'wb') as f:
-                        pickle.dump(ds_cache, f)
-                except KeyError:
-                    self.logger.debug('No cache exists for directory service [%s].', ds[0])
+        self.store.checkpoint()
+
+    def is_filled(self, ds):
+        return self.store.is_filled(ds)
+
+    def get_meta(self, ds, key):
+        return self.store.get_meta(ds, key)
+
+    def set_meta(self, ds, key, value):
+        self.store.set_meta(ds, key, value)
+
+    def get_ids(self, ds, objtype):
+        """
+        Returns `{uid or gid: name}` of cached `objtype` entries of directory service `ds`.
+        """
+        return self.store.xids(ds, objtype)
+
+    def update_entries(self, ds, objtype, upsert, delete=None, replace=False, id_base=0):
+        """
+        Stores `upsert` entries and removes entries with names from `delete` (or every entry not in `upsert` if
+        `replace` is set) for directory service `ds`. See `DSCacheStore.update`.
+        """
+        written, deleted = self.store.update(ds, objtype, upsert, delete, replace, id_base)
+        self.logger.debug('[%s] %s cache: %d entries written, %d entries removed', ds, objtype.lower(), written,
+                          deleted)
+
+    def clear(self, ds):
+        self.store.clear(ds)
+
+    def get_entries(self, ds):
+        """
+        Returns `{'users': {username: user}, 'groups': {group: group}}` for directory service `ds`.
+        """
+        return {
+            objtype.lower(): {entry[OBJTYPES[objtype][0]]: entry for entry in self.store.query([ds], objtype)}
+            for objtype in OBJTYPES
+        }
 
     async def query(self, objtype='USERS', filters=None, options=None):
         """
@@ -174,40 +237,32 @@ class DSCache(Service):
         will be populated in UI dropdowns). In the case of other directory services, the
         users and groups will simply not appear in query results (UI features).
 
+        Filters on name, uid/gid and SID are evaluated by the cache indexes.
         """
-        res = []
-        ds_state = await self.middleware.call('directoryservices.get_state')
-
-        is_name_check = bool(filters and len(filters) == 1 and filters[0][0] in ['username', 'groupname'])
-
-        res.extend((await self.middleware.call(f'{objtype.lower()[:-1]}.query', filters, options)))
+        res = await self.middleware.call(f'{objtype.lower()[:-1]}.query', filters, options)
 
-        for dstype, state in ds_state.items():
-            if state != 'DISABLED':
-                """
-                Avoid iteration here if possible.  Use keys if single filter "=" and x in x=y is a
-                username or groupname.
-                """
-                if is_name_check and filters[0][1] == '=':
-                    cache = (await self.middleware.call(f'{dstype}.get_cache'))[objtype.lower()]
-                    name = filters[0][2]
-                    return [cache.get(name)] if cache.get(name) else []
+        enabled = []
+        for dstype, state in (await self.middleware.call('directoryservices.get_state')).items():
+            if state == 'DISABLED':
+                continue
 
-                else:
-                    res.extend(filter_list(
-                        list((await self.middleware.call(f'{dstype}.get_cache'))[objtype.lower()].values()),
-                        filters,
-                        options
-                    ))
+            if await self.middleware.run_in_thread(self.store.is_filled, dstype):
+                enabled.append(dstype)
+            else:
+                await self.middleware.call(f'{dstype}.fill_cache')
+                self.logger.debug('[%s] cache fill is in progress.', dstype)
 
-        return res
+        # Either both are lists or, with `count` option, both are numbers
+        return res + await self.middleware.run_in_thread(self.store.query, enabled, objtype, filters, options)
 
     async def refresh(self):
         """
         This is called from a cronjob every 24 hours and when a user clicks on the
-        UI button to 'rebuild directory service cache'.
+        UI button to 'rebuild directory service cache'. Unlike the incremental updates
+        made when directory service starts, this also removes users and groups that
+        no longer exist.
         """
-        for ds in ['activedirectory', 'ldap', 'nis']:
+        for ds in DS_LIST:
             ds_state = await self.middleware.call(f'{ds}.get_state')
             if ds_state == 'HEALTHY':
                 await self.middleware.call(f'{ds}.fill_cache', True)
@@ -0,0 +1,306 @@
+# -*- coding=utf-8 -*-
+import contextlib
+import json
+import logging
+import sqlite3
+import threading
+
+from middlewared.utils import filter_list
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["DSCacheStore", "OBJTYPES", "user_entry", "group_entry"]
+
+# objtype: (name field, id field)
+OBJTYPES = {
+    "USERS": ("username", "uid"),
+    "GROUPS": ("group", "gid"),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    objtype TEXT NOT NULL,
+    name TEXT NOT NULL,
+    ds TEXT NOT NULL,
+    xid INTEGER,
+    sid TEXT,
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (objtype, name, ds)
+);
+CREATE INDEX IF NOT EXISTS entries_xid ON entries (objtype, xid);
+CREATE INDEX IF NOT EXISTS entries_sid ON entries (objtype, sid);
+CREATE TABLE IF NOT EXISTS meta (
+    ds TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (ds, key)
+);
+"""
+
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER
+MAX_IN_PUSHDOWN = 500
+
+ANALYZE_THRESHOLD = 1000
+
+
+def user_entry(pw, **kwargs):
+    """
+    Builds `user.query`-like entry from `pwd.struct_passwd`.
+    """
+    return {
+        "uid": pw.pw_uid,
+        "username": pw.pw_name,
+        "unixhash": None,
+        "smbhash": None,
+        "group": {},
+        "home": "",
+        "shell": "",
+        "full_name": pw.pw_gecos,
+        "builtin": False,
+        "email": "",
+        "password_disabled": False,
+        "locked": False,
+        "sudo": False,
+        "microsoft_account": False,
+        "attributes": {},
+        "groups": [],
+        "sshpubkey": None,
+        "local": False,
+        **kwargs,
+    }
+
+
+def group_entry(gr, **kwargs):
+    """
+    Builds `group.query`-like entry from `grp.struct_group`.
+    """
+    return {
+        "gid": gr.gr_gid,
+        "group": gr.gr_name,
+        "builtin": False,
+        "sudo": False,
+        "users": [],
+        "local": False,
+        **kwargs,
+    }
+
+
+class DSCacheStore:
+    """
+    Directory services users and groups, indexed by name, uid/gid and SID.
+
+    Entries are kept in an SQLite database so they survive middlewared restarts and do not have to be held in
+    memory. Only entries that actually changed are written when the cache is refreshed.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def checkpoint(self):
+        """
+        Moves write-ahead log contents to the database file so it can be copied consistently.
+        """
+        if self.path != ":memory:":
+            with self.lock:
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def copy_to(self, other):
+        with self.lock, other.lock:
+            self.conn.backup(other.conn)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            else:
+                self.conn.execute("COMMIT")
+
+    def get_meta(self, ds, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE ds = ? AND key = ?", (ds, key)).fetchone()
+
+        return None if row is None else json.loads(row[0])
+
+    def set_meta(self, ds, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (ds, key, value) VALUES (?, ?, ?)",
+                              (ds, key, json.dumps(value)))
+
+    def is_filled(self, ds):
+        return self.get_meta(ds, "filled") is not None
+
+    def clear(self, ds):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM entries WHERE ds = ?", (ds,))
+            conn.execute("DELETE FROM meta WHERE ds = ?", (ds,))
+
+    def xids(self, ds, objtype):
+        """
+        Returns `{uid or gid: name}` of all `objtype` entries of `ds`.
+        """
+        with self.lock:
+            return dict(self.conn.execute("SELECT xid, name FROM entries WHERE objtype = ? AND ds = ?",
+                                          (objtype, ds)))
+
+    def update(self, ds, objtype, upsert=None, delete=None, replace=False, id_base=0):
+        """
+        Inserts or updates `upsert` entries and removes entries with names from `delete`. With `replace`, every
+        entry of `ds` that is not in `upsert` is removed. Entry that takes over uid/gid of an existing entry
+        replaces it (the user or group was renamed).
+
+        Entries keep their `id` across updates; new entries are numbered starting with `id_base`.
+
+        Returns number of entries written and number of entries removed.
+        """
+        name_field, id_field = OBJTYPES[objtype]
+        upsert = upsert or []
+        delete = set(delete or [])
+
+        with self._transaction() as conn:
+            existing = {}
+            names_by_xid = {}
+            for name, xid, id, data in conn.execute(
+                "SELECT name, xid, id, data FROM entries WHERE objtype = ? AND ds = ?", (objtype, ds),
+            ):
+                existing[name] = (id, data)
+                names_by_xid[xid] = name
+            next_id = max([id_base - 1] + [id for id, data in existing.values()]) + 1
+
+            rows = []
+            names = set()
+            for entry in upsert:
+                name = entry[name_field]
+                names.add(name)
+                if names_by_xid.get(entry[id_field], name) != name:
+                    # Renamed
+                    delete.add(names_by_xid[entry[id_field]])
+                if name in existing:
+                    id = existing[name][0]
+                else:
+                    id = next_id
+                    next_id += 1
+
+                data = json.dumps(dict(entry, id=id), sort_keys=True)
+                if name in existing and existing[name][1] == data:
+                    continue
+
+                rows.append((objtype, name, ds, entry[id_field], entry.get("sid"), id, data))
+
+            if replace:
+                delete |= existing.keys() - names
+            delete = (delete & existing.keys()) - names
+
+            conn.executemany("INSERT OR REPLACE INTO entries (objtype, name, ds, xid, sid, id, data) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.executemany("DELETE FROM entries WHERE objtype = ? AND name = ? AND ds = ?",
+                             [(objtype, name, ds) for name in delete])
+            if len(rows) + len(delete) >= ANALYZE_THRESHOLD:
+                # Without statistics the query planner prefers the primary key index over uid/gid and SID indexes
+                conn.execute("ANALYZE")
+
+        return len(rows), len(delete)
+
+    def query(self, ds_list, objtype, filters=None, options=None):
+        """
+        `query-filters` and `query-options` over `objtype` entries of directory services `ds_list`.
+
+        Filters on name, uid/gid and SID are evaluated by SQLite using its indexes. If these are the only
+        filters, `order_by`, `offset`, `limit` and `count` are evaluated by SQLite too, otherwise remaining
+        filters and options are applied to the matching entries.
+        """
+        filters = filters or []
+        options = options or {}
+        if not ds_list:
+            return 0 if options.get("count") else []
+
+        name_field, id_field = OBJTYPES[objtype]
+        columns = {name_field: ("name", str), id_field: ("xid", int), "sid": ("sid", str)}
+
+        where = ["objtype = ?", f"ds IN ({', '.join(['?'] * len(ds_list))})"]
+        params = [objtype] + list(ds_list)
+        residual = []
+        for f in filters:
+            pushed = self._pushdown(columns, f)
+            if pushed is None:
+                residual.append(f)
+            else:
+                where.append(pushed[0])
+                params.extend(pushed[1])
+
+        order_by = []
+        for o in options.get("order_by") or []:
+            column = columns.get(o.lstrip("-"))
+            if column is None:
+                break
+            order_by.append(f"{column[0]} {'DESC' if o.startswith('-') else 'ASC'}")
+        else:
+            if not residual and not (set(options) - {"order_by", "offset", "limit", "count", "select"}):
+                return self._query_pushed(where, params, order_by, options)
+
+        with self.lock:
+            rows = self.conn.execute(f"SELECT data FROM entries WHERE {' AND '.join(where)} ORDER BY name",
+                                     params).fetchall()
+
+        return filter_list([json.loads(row[0]) for row in rows], residual, options)
+
+    def _query_pushed(self, where, params, order_by, options):
+        sql_where = " AND ".join(where)
+        if options.get("count"):
+            with self.lock:
+                return self.conn.execute(f"SELECT COUNT(*) FROM entries WHERE {sql_where}", params).fetchone()[0]
+
+        # `filter_list` sorts by each `order_by` field in turn, so the last one is the primary sort key
+        sql = f"SELECT data FROM entries WHERE {sql_where} ORDER BY {', '.join(order_by[::-1] + ['name ASC'])}"
+        if options.get("limit") or options.get("offset"):
+            sql += " LIMIT ? OFFSET ?"
+            params = params + [options.get("limit") or -1, options.get("offset") or 0]
+
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+
+        result = [json.loads(row[0]) for row in rows]
+        if options.get("select"):
+            result = filter_list(result, [], {"select": options["select"]})
+
+        return result
+
+    def _pushdown(self, columns, f):
+        if len(f) != 3 or f[0] not in columns:
+            return None
+
+        field, op, value = f
+        column, type_ = columns[field]
+
+        def valid(v):
+            # Values SQLite would coerce (i.e. `"1000"` for an integer column) do not match in `filter_list`
+            return isinstance(v, type_) and not isinstance(v, bool)
+
+        if op == "=" and valid(value):
+            return f"{column} = ?", [value]
+
+        if op == "in" and isinstance(value, (list, tuple, set)) and len(value) <= MAX_IN_PUSHDOWN:
+            value = list(value)
+            if all(valid(v) for v in value):
+                return f"{column} IN ({', '.join(['?'] * len(value))})", value
+
+        if op == "^" and type_ is str and valid(value) and value and ord(value[-1]) < 0x10ffff:
+            # Prefix match as a range so that the index is used
+            return f"{column} >= ? AND {column} < ?", [value, value[:-1] + chr(ord(value[-1]) + 1)]
+
+        return None
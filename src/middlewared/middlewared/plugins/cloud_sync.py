@@ -1,12 +1,13 @@
 from middlewared.alert.base import Alert, AlertCategory, AlertClass, AlertLevel, OneShotAlertClass
 from middlewared.common.attachment import LockableFSAttachmentDelegate
 from middlewared.rclone.base import BaseRcloneRemote
+from middlewared.rclone.rc import connection_string, RcloneRc, RcloneRcd, RcloneRcError
 from middlewared.schema import accepts, Bool, Cron, Dict, Int, List, Patch, Str
 from middlewared.service import (
     CallError, CRUDService, ValidationErrors, filterable, item_method, job, private, TaskPathService,
 )
 import middlewared.sqlalchemy as sa
-from middlewared.utils import load_modules, load_classes, Popen, run
+from middlewared.utils import load_modules, load_classes, Popen
 from middlewared.utils.python import get_middlewared_dir
 from middlewared.validators import Range, Time
 from middlewared.validators import validate_attributes
@@ -17,11 +18,13 @@ import base64
 import codecs
 from collections import namedtuple
 import configparser
+import copy
 from Crypto import Random
 from Crypto.Cipher import AES
 from Crypto.Util import Counter
 from datetime import datetime
 import enum
+import humanfriendly
 import json
 import logging
 import os
@@ -30,11 +33,13 @@ import shlex
 import subprocess
 import tempfile
 import textwrap
-
-RE_TRANSF = re.compile(r"Transferred:\s*(?P<progress_1>.+, )(?P<progress>[0-9]+)%, (?P<progress_2>.+)$", re.S)
+import time
 
 REMOTES = {}
 
+RCLONE_STATS_INTERVAL = 1
+LS_CACHE_TTL = 30
+
 OAUTH_URL = "https://freenas.org/oauth"
 
 RcloneConfigTuple = namedtuple("RcloneConfigTuple", ["config_path", "remote_path", "extra_args"])
@@ -49,6 +54,8 @@ class RcloneConfig:
         self.provider = REMOTES[self.cloud_sync["credentials"]["provider"]]
 
         self.config = None
+        self.crypt_config = None
+        self.remote_path = None
         self.tmp_file = None
         self.tmp_file_exclude = None
 
@@ -69,20 +76,22 @@ class RcloneConfig:
         if "attributes" in self.cloud_sync:
             config.update(dict(self.cloud_sync["attributes"], **await self.provider.get_task_extra(self.cloud_sync)))
 
-            remote_path = get_remote_path(self.provider, self.cloud_sync["attributes"])
-            remote_path = f"remote:{remote_path}"
+            self.remote_path = get_remote_path(self.provider, self.cloud_sync["attributes"])
+            remote_path = f"remote:{self.remote_path}"
 
             if self.cloud_sync["encryption"]:
-                self.tmp_file.write("[encrypted]\n")
-                self.tmp_file.write("type = crypt\n")
-                self.tmp_file.write(f"remote = {remote_path}\n")
-                self.tmp_file.write("filename_encryption = {}\n".format(
-                    "standard" if self.cloud_sync["filename_encryption"] else "off"))
-                self.tmp_file.write("password = {}\n".format(
-                    rclone_encrypt_password(self.cloud_sync["encryption_password"])))
+                self.crypt_config = {
+                    "type": "crypt",
+                    "remote": remote_path,
+                    "filename_encryption": "standard" if self.cloud_sync["filename_encryption"] else "off",
+                    "password": rclone_encrypt_password(self.cloud_sync["encryption_password"]),
+                }
                 if self.cloud_sync["encryption_salt"]:
-                    self.tmp_file.write("password2 = {}\n".format(
-                        rclone_encrypt_password(self.cloud_sync["encryption_salt"])))
+                    self.crypt_config["password2"] = rclone_encrypt_password(self.cloud_sync["encryption_salt"])
+
+                self.tmp_file.write("[encrypted]\n")
+                for k, v in self.crypt_config.items():
+                    self.tmp_file.write(f"{k} = {v}\n")
 
                 remote_path = "encrypted:/"
 
@@ -104,6 +113,18 @@ class RcloneConfig:
 
         return RcloneConfigTuple(self.tmp_file.name, remote_path, extra_args)
 
+    def remote_fs(self, path):
+        """
+        `path` on the remote for `RcloneRcd`.
+        """
+        return connection_string(self.config, path)
+
+    def encrypted_fs(self, path=""):
+        """
+        `path` on the encrypted remote for `RcloneRcd`.
+        """
+        return connection_string(dict(self.crypt_config, remote=self.remote_fs(self.remote_path)), path)
+
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if self.config is not None:
             await self.provider.cleanup(self.cloud_sync, self.config)
@@ -138,14 +159,17 @@ async def rclone(middleware, job, cloud_sync, dry_run=False):
 
     await middleware.run_in_thread(check_local_path, cloud_sync["path"])
 
+    # Progress is read from the remote control API of this rclone process
+    rc = RcloneRc.create()
+
     # Use a temporary file to store rclone file
     async with RcloneConfig(cloud_sync) as config:
         args = [
             "rclone",
             "--config", config.config_path,
             "-v",
-            "--stats", "1s",
-        ]
+            "--rc",
+        ] + rc.args()
 
         if cloud_sync["attributes"].get("fast_list"):
             args.append("--fast-list")
@@ -210,8 +234,10 @@ async def rclone(middleware, job, cloud_sync, dry_run=False):
             args,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
+            env=dict(os.environ, **rc.env()),
         )
-        check_cloud_sync = asyncio.ensure_future(rclone_check_progress(job, proc))
+        check_cloud_sync = asyncio.ensure_future(rclone_check_output(job, proc, rc))
+        check_stats = asyncio.ensure_future(rclone_check_stats(job, proc, rc))
         cancelled_error = None
         try:
             try:
@@ -224,6 +250,8 @@ async def rclone(middleware, job, cloud_sync, dry_run=False):
                     job.middleware.logger.warning(f"Error terminating rclone on cloud sync abort: {e!r}")
         finally:
             await asyncio.wait_for(check_cloud_sync, None)
+            check_stats.cancel()
+            await rc.close()
 
         if snapshot:
             await middleware.call("zfs.snapshot.remove", snapshot)
@@ -377,8 +405,9 @@ class RcloneVerboseLogCutter:
             self.buffer = []
 
 
-async def rclone_check_progress(job, proc):
-    cutter = RcloneVerboseLogCutter(300)
+async def rclone_check_output(job, proc, rc):
+    # rclone logs transfer statistics every minute
+    cutter = RcloneVerboseLogCutter(5)
     dropbox__restricted_content = False
     try:
         while True:
@@ -386,6 +415,8 @@ async def rclone_check_progress(job, proc):
             if read == "":
                 break
 
+            rc.parse_address(read)
+
             if "failed to open source object: path/restricted_content/" in read:
                 job.internal_data["dropbox__restricted_content"] = True
                 dropbox__restricted_content = True
@@ -393,10 +424,6 @@ async def rclone_check_progress(job, proc):
             result = cutter.notify(read)
             if result:
                 job.logs_fd.write(result.encode("utf-8", "ignore"))
-
-            reg = RE_TRANSF.search(read)
-            if reg:
-                job.set_progress(int(reg.group("progress")), reg.group("progress_1") + reg.group("progress_2"))
     finally:
         result = cutter.flush()
         if result:
@@ -414,6 +441,40 @@ async def rclone_check_progress(job, proc):
         job.logs_fd.write(message.encode("utf-8", "ignore"))
 
 
+async def rclone_check_stats(job, proc, rc):
+    while proc.returncode is None:
+        await asyncio.sleep(RCLONE_STATS_INTERVAL)
+
+        try:
+            stats = await rc.call("core/stats")
+        except Exception:
+            # Remote control server is not started yet or rclone is exiting
+            continue
+
+        job.set_progress(*rclone_stats_progress(stats))
+
+
+def rclone_stats_progress(stats):
+    """
+    Job progress and description from rclone `core/stats`.
+    """
+    if stats["totalBytes"]:
+        percent = int(100 * stats["bytes"] / stats["totalBytes"])
+    else:
+        percent = 0
+
+    if stats.get("eta") is not None:
+        eta = humanfriendly.format_timespan(stats["eta"])
+    else:
+        eta = "-"
+
+    return percent, (
+        f"{humanfriendly.format_size(stats['bytes'], binary=True)} / "
+        f"{humanfriendly.format_size(stats['totalBytes'], binary=True)}, "
+        f"{humanfriendly.format_size(stats['speed'], binary=True)}/s, ETA {eta}"
+    )
+
+
 def rclone_encrypt_password(password):
     key = bytes([0x9c, 0x93, 0x5b, 0x48, 0x73, 0x0a, 0x55, 0x4d,
                  0x6b, 0xfd, 0x7c, 0x63, 0xc8, 0x86, 0xa9, 0x2b,
@@ -517,6 +578,7 @@ def lsjson_error_excerpt(error):
     excerpt = error.split("\n")[0]
     excerpt = re.sub(r"^[0-9]{4}/[0-9]{2}/[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2} ", "", excerpt)
     excerpt = excerpt.replace("Failed to create file system for \"remote:\": ", "")
+    excerpt = excerpt.replace("failed to create file system for \"remote:\": ", "")
     excerpt = excerpt.replace("ERROR : : error listing: ", "")
     return excerpt
 
@@ -551,13 +613,15 @@ class CredentialsService(CRUDService):
         data = dict(data, name="")
         await self._validate("cloud_sync_credentials_create", data)
 
-        async with RcloneConfig({"credentials": data}) as config:
-            proc = await run(["rclone", "--config", config.config_path, "lsjson", "remote:"],
-                             check=False, encoding="utf8")
-            if proc.returncode == 0:
-                return {"valid": True}
+        rclone_config = RcloneConfig({"credentials": data})
+        async with rclone_config:
+            fs = rclone_config.remote_fs("")
+            try:
+                await CloudSyncService.rcd.call("operations/list", {"fs": fs, "remote": ""}, secret=fs)
+            except RcloneRcError as e:
+                return {"valid": False, "error": e.error, "excerpt": lsjson_error_excerpt(e.error)}
             else:
-                return {"valid": False, "error": proc.stderr, "excerpt": lsjson_error_excerpt(proc.stderr)}
+                return {"valid": True}
 
     @accepts(Dict(
         "cloud_sync_credentials_create",
@@ -677,6 +741,8 @@ class CloudSyncService(TaskPathService):
 
     local_fs_lock_manager = FsLockManager()
     remote_fs_lock_manager = FsLockManager()
+    rcd = RcloneRcd()
+    ls_cache = {}
     share_task_type = 'CloudSync'
 
     class Config:
@@ -1012,35 +1078,48 @@ class CloudSyncService(TaskPathService):
     async def ls(self, config, path):
         await self.middleware.call("network.general.will_perform_activity", "cloud_sync")
 
+        # Browsing a remote in the UI lists the same directories over and over again
+        cache_key = json.dumps([config, path], sort_keys=True, default=str)
+        now = time.monotonic()
+        for key, (expires, result) in list(self.ls_cache.items()):
+            if expires < now:
+                self.ls_cache.pop(key)
+        if cache_key in self.ls_cache:
+            return copy.deepcopy(self.ls_cache[cache_key][1])
+
         decrypt_filenames = config.get("encryption") and config.get("filename_encryption")
-        async with RcloneConfig(config) as config:
-            proc = await run(["rclone", "--config", config.config_path, "lsjson", "remote:" + path],
-                             check=False, encoding="utf8", errors="ignore")
-            if proc.returncode == 0:
-                result = json.loads(proc.stdout)
-
-                if decrypt_filenames:
-                    if result:
-                        decrypted_names = {}
-                        proc = await run((["rclone", "--config", config.config_path, "cryptdecode", "encrypted:"] +
-                                         [item["Name"] for item in result]),
-                                         check=False, encoding="utf8", errors="ignore")
-                        for line in proc.stdout.splitlines():
-                            try:
-                                encrypted, decrypted = line.rstrip("\r\n").split(" \t ", 1)
-                            except ValueError:
-                                continue
-
-                            if decrypted != "Failed to decrypt":
-                                decrypted_names[encrypted] = decrypted
-
-                        for item in result:
-                            if item["Name"] in decrypted_names:
-                                item["Decrypted"] = decrypted_names[item["Name"]]
-
-                return result
-            else:
-                raise CallError(proc.stderr, extra={"excerpt": lsjson_error_excerpt(proc.stderr)})
+        rclone_config = RcloneConfig(config)
+        async with rclone_config:
+            fs = rclone_config.remote_fs(path)
+            try:
+                result = (await self.rcd.call("operations/list", {"fs": fs, "remote": ""}, secret=fs))["list"]
+            except RcloneRcError as e:
+                raise CallError(e.error, extra={"excerpt": lsjson_error_excerpt(e.error)})
+
+            if decrypt_filenames and result:
+                try:
+                    decrypted_names = await self._decrypt_names(rclone_config.encrypted_fs())
+                except RcloneRcError as e:
+                    self.logger.debug("Error decrypting file names: %s", e.error)
+                else:
+                    for item in result:
+                        if item["Name"] in decrypted_names:
+                            item["Decrypted"] = decrypted_names[item["Name"]]
+
+        self.ls_cache[cache_key] = (now + LS_CACHE_TTL, copy.deepcopy(result))
+        return result
+
+    async def _decrypt_names(self, fs):
+        # Names that can't be decrypted are not listed by the crypt remote. Encrypting the names it lists is the
+        # only way to match them to the encrypted names.
+        names = [item["Name"] for item in (await self.rcd.call("operations/list", {"fs": fs, "remote": ""},
+                                                                secret=fs))["list"]]
+        if not names:
+            return {}
+
+        encrypted_names = (await self.rcd.call("backend/command", {"command": "encode", "fs": fs, "arg": names},
+                                               secret=fs))["result"]
+        return dict(zip(encrypted_names, names))
 
     @item_method
     @accepts(
@@ -1109,7 +1188,11 @@ class CloudSyncService(TaskPathService):
             async with self.remote_fs_lock_manager.lock(f"{credentials['id']}/{remote_path}", remote_direction):
                 job.set_progress(0, "Starting")
                 try:
-                    await rclone(self.middleware, job, cloud_sync, options["dry_run"])
+                    try:
+                        await rclone(self.middleware, job, cloud_sync, options["dry_run"])
+                    finally:
+                        # Remote contents have changed
+                        self.ls_cache.clear()
                     if "id" in cloud_sync:
                         await self.middleware.call("alert.oneshot_delete", "CloudSyncTaskFailed", cloud_sync["id"])
                 except Exception:
@@ -1138,6 +1221,10 @@ class CloudSyncService(TaskPathService):
         await self.middleware.call("core.job_abort", cloud_sync["job"]["id"])
         return True
 
+    @private
+    async def terminate(self):
+        await self.rcd.stop()
+
     @accepts()
     async def providers(self):
         """
@@ -49,6 +49,19 @@ class DatastoreService(Service):
 
     @private
     async def execute_write(self, stmt):
+        return await self.middleware.run_in_executor(self.thread_pool, self._execute_write, *self._compile(stmt))
+
+    @private
+    async def execute_write_many(self, stmts, expected_rowcount=None):
+        """
+        Executes `stmts` in a single transaction. If `expected_rowcount` is specified and any of the statements
+        affects a different number of rows, the transaction is rolled back.
+        """
+        return await self.middleware.run_in_executor(
+            self.thread_pool, self._execute_write_many, [self._compile(stmt) for stmt in stmts], expected_rowcount,
+        )
+
+    def _compile(self, stmt):
         compiled = stmt.compile(self.engine)
 
         sql = compiled.string
@@ -62,13 +75,28 @@ class DatastoreService(Service):
             else:
                 binds.append(value)
 
-        return await self.middleware.run_in_executor(self.thread_pool, self._execute_write, sql, binds)
+        return sql, binds
 
     def _execute_write(self, sql, binds):
         result = self.connection.execute(sql, binds)
         self.middleware.call_hook_inline('datastore.post_execute_write', sql, binds)
         return result
 
+    def _execute_write_many(self, queries, expected_rowcount=None):
+        results = []
+        with self.connection.begin():
+            for sql, binds in queries:
+                result = self.connection.execute(sql, binds)
+                if expected_rowcount is not None and result.rowcount != expected_rowcount:
+                    raise RuntimeError(f'{result.rowcount} rows were affected instead of {expected_rowcount}')
+
+                results.append(result)
+
+        for sql, binds in queries:
+            self.middleware.call_hook_inline('datastore.post_execute_write', sql, binds)
+
+        return results
+
     @private
     async def fetchall(self, *args):
         return await self.middleware.run_in_executor(self.thread_pool, self._fetchall, *args)
@@ -1,7 +1,7 @@
 from sqlalchemy import and_, types
 from sqlalchemy.sql import sqltypes
 
-from middlewared.schema import accepts, Any, Dict, Str
+from middlewared.schema import accepts, Any, Dict, List, Str
 from middlewared.service import Service
 
 from .filter import FilterMixin
@@ -59,12 +59,7 @@ class DatastoreService(Service, FilterMixin, SchemaMixin):
         else:
             id = id_or_filters
 
-        for column in table.c:
-            if column.foreign_keys:
-                if column.name[:-3] in data:
-                    data[column.name] = data.pop(column.name[:-3])
-
-        update, relationships = self._extract_relationships(table, options['prefix'], data)
+        update, relationships = self._extract_update(table, options['prefix'], data)
 
         if update:
             result = await self.middleware.call(
@@ -80,6 +75,39 @@ class DatastoreService(Service, FilterMixin, SchemaMixin):
 
         return id
 
+    @accepts(Str('name'), List('updates'), Dict('options', Str('prefix', default='')))
+    async def update_many(self, name, updates, options):
+        """
+        Update entries `[[id, data], ...]` in `name` in a single transaction.
+        """
+        table = self._get_table(name)
+
+        stmts = []
+        for id, data in updates:
+            update, relationships = self._extract_update(table, options['prefix'], data)
+            if relationships:
+                raise RuntimeError('Updating relationships is not supported')
+
+            if update:
+                stmts.append(table.update().values(**update).where(self._get_pk(table) == id))
+
+        if not stmts:
+            return
+
+        await self.middleware.call('datastore.execute_write_many', stmts, 1)
+
+        for id, data in updates:
+            await self.middleware.call('datastore.send_update_events', name, id)
+
+    def _extract_update(self, table, prefix, data):
+        data = data.copy()
+        for column in table.c:
+            if column.foreign_keys:
+                if column.name[:-3] in data:
+                    data[column.name] = data.pop(column.name[:-3])
+
+        return self._extract_relationships(table, prefix, data)
+
     def _extract_relationships(self, table, prefix, data):
         relationships = self._get_relationships(table)
 
@@ -1,6 +1,7 @@
 import asyncio
 import re
 
+from middlewared.service import private, Service
 from middlewared.utils import osc
 
 
@@ -9,23 +10,127 @@ if osc.IS_FREEBSD:
     RE_ISDISK = re.compile(r'^(da|ada|vtbd|mfid|nvd|pmem)[0-9]+$')
 
 
+class DiskHotplugCoalescer:
+    """
+    Collects disk add/remove events and processes them in batches.
+
+    Attaching or detaching an enclosure yields an event per disk. Instead of running a disk sync,
+    restarting dependent services and reconfiguring swap for each one of them we wait until no new
+    events have arrived for `quiet_period` seconds (but no longer than `max_delay` seconds since
+    the first event of the burst) and then process the whole burst at once.
+    """
+
+    def __init__(self, middleware, quiet_period=2, max_delay=10):
+        self.middleware = middleware
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+
+        self.added = set()
+        self.removed = set()
+        self.burst_started = None
+        self.timer = None
+        self.lock = asyncio.Lock()
+
+        self.stats = {
+            'events': 0,
+            'bursts': 0,
+            'coalesced': 0,
+            'last_burst_size': 0,
+        }
+
+    def add(self, disk_name):
+        self.removed.discard(disk_name)
+        self.added.add(disk_name)
+        self._schedule()
+
+    def remove(self, disk_name):
+        self.added.discard(disk_name)
+        self.removed.add(disk_name)
+        self._schedule()
+
+    def _schedule(self):
+        self.stats['events'] += 1
+
+        loop = self.middleware.loop
+        now = loop.time()
+        if self.burst_started is None:
+            self.burst_started = now
+
+        if self.timer is not None:
+            self.timer.cancel()
+
+        delay = min(self.quiet_period, max(self.burst_started + self.max_delay - now, 0))
+        self.timer = loop.call_later(delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        added, self.added = self.added, set()
+        removed, self.removed = self.removed, set()
+        self.burst_started = None
+
+        if not added and not removed:
+            return
+
+        async with self.lock:
+            self.stats['bursts'] += 1
+            self.stats['last_burst_size'] = len(added) + len(removed)
+            self.stats['coalesced'] += len(added) + len(removed) - 1
+            try:
+                await self.process(added, removed)
+            except Exception:
+                self.middleware.logger.error(
+                    'Failed to process disk hotplug events (added: %r, removed: %r)', added, removed, exc_info=True,
+                )
+
+    async def process(self, added, removed):
+        if removed:
+            # A full sync is required to expire removed disks, it will pick up added disks as well
+            await (await self.middleware.call('disk.sync_all')).wait()
+        else:
+            await self.middleware.call('disk.sync_batch', sorted(added))
+
+        for disk_name in sorted(added):
+            await self.middleware.call('disk.sed_unlock', disk_name)
+
+        if osc.IS_FREEBSD:
+            # TODO: Add support for multipath
+            await self.middleware.call('disk.multipath_sync')
+
+        for disk_name in sorted(added | removed):
+            await self.middleware.call('alert.oneshot_delete', 'SMART', disk_name)
+            # Disk name might have been reused for a different disk
+            await self.middleware.call('disk.smart_data_invalidate', disk_name)
+
+        if removed:
+            # If a disk dies we need to reconfigure swaps so we are not left
+            # with a single disk mirror swap, which may be a point of failure.
+            asyncio.ensure_future(self.middleware.call('disk.swaps_configure'))
+
+
+coalescer = None
+
+
+class DiskService(Service):
+
+    @private
+    async def hotplug_stats(self):
+        """
+        Returns counters of the disk hotplug events coalescing.
+        """
+        stats = dict(coalescer.stats)
+        stats['pending'] = len(coalescer.added) + len(coalescer.removed)
+        return stats
+
+
 async def added_disk(middleware, disk_name):
-    await middleware.call('disk.sync', disk_name)
-    await middleware.call('disk.sed_unlock', disk_name)
-    if osc.IS_FREEBSD:
-        # TODO: Add support for multipath
-        await middleware.call('disk.multipath_sync')
-    await middleware.call('alert.oneshot_delete', 'SMART', disk_name)
+    coalescer.add(disk_name)
 
 
 async def remove_disk(middleware, disk_name):
-    await (await middleware.call('disk.sync_all')).wait()
-    if osc.IS_FREEBSD:
-        await middleware.call('disk.multipath_sync')
-    await middleware.call('alert.oneshot_delete', 'SMART', disk_name)
-    # If a disk dies we need to reconfigure swaps so we are not left
-    # with a single disk mirror swap, which may be a point of failure.
-    asyncio.ensure_future(middleware.call('disk.swaps_configure'))
+    coalescer.remove(disk_name)
 
 
 async def devd_devfs_hook(middleware, data):
@@ -59,6 +164,9 @@ async def udev_block_devices_hook(middleware, data):
 
 
 def setup(middleware):
+    global coalescer
+    coalescer = DiskHotplugCoalescer(middleware)
+
     if osc.IS_LINUX:
         middleware.register_hook('udev.block', udev_block_devices_hook)
     else:
@@ -43,3 +43,13 @@ class DiskInfoBase(ServicePartBase):
     @private
     async def get_disk_from_partition(self, part_name):
         raise NotImplementedError()
+
+    @private
+    async def label_to_dev_disk_cache(self, labels):
+        """
+        Returns a `{label: {"dev": dev, "disk": disk}}` mapping for all `labels`.
+
+        This is equivalent to calling `disk.label_to_dev` and `disk.label_to_disk` for each label
+        but system devices are only scanned once.
+        """
+        raise NotImplementedError()
@@ -99,3 +99,22 @@ class DiskService(Service, DiskInfoBase):
 
     def get_disk_from_partition(self, part_name):
         return self.label_to_disk(part_name, True)
+
+    def label_to_dev_disk_cache(self, labels):
+        geom.scan()
+        label_to_dev = self._geom_providers_map('LABEL')
+        part_to_disk = self._geom_providers_map('PART')
+
+        result = {}
+        for label in labels:
+            stripped = label[:-4] if label.endswith(('.nop', '.eli')) else label
+            dev = label_to_dev.get(stripped)
+            result[label] = {'dev': dev, 'disk': part_to_disk.get(dev or label)}
+        return result
+
+    def _geom_providers_map(self, klass):
+        providers = {}
+        for g in geom.class_by_name(klass).xml.findall('.//geom'):
+            for provider in g.findall('provider'):
+                providers[provider.find('name').text] = g.find('name').text
+        return providers
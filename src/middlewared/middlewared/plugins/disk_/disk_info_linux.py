@@ -128,3 +128,16 @@ class DiskService(Service, DiskInfoBase):
             # nvme partitions would be like nvmen1p1 where disk is nvmen1
             part_num = f'p{part_num}'
         return part_name.rsplit(part_num, 1)[0].strip()
+
+    def label_to_dev_disk_cache(self, labels):
+        part_to_disk = {}
+        for part_name in os.listdir('/sys/class/block'):
+            path = os.path.realpath(os.path.join('/sys/class/block', part_name))
+            if os.path.exists(os.path.join(path, 'partition')):
+                part_to_disk[part_name] = os.path.basename(os.path.dirname(path))
+
+        result = {}
+        for label in labels:
+            dev = self.label_to_dev(label)
+            result[label] = {'dev': dev, 'disk': part_to_disk.get(dev) if dev else None}
+        return result
@@ -0,0 +1,79 @@
+import asyncio
+import collections
+import json
+import time
+
+from middlewared.common.smart.smartctl import SMARTCTL_POWERMODES, smartctl
+from middlewared.service import accepts, Dict, Int, private, Service, Str
+
+# By default smartctl is run at most once per this many seconds for each disk
+SMART_DATA_MAX_AGE = 300
+
+
+class DiskService(Service):
+    smart_data_cache = {}
+    smart_data_locks = collections.defaultdict(asyncio.Lock)
+
+    @accepts(
+        Str('disk'),
+        Dict(
+            'options',
+            Str('powermode', enum=SMARTCTL_POWERMODES, default=SMARTCTL_POWERMODES[0]),
+            Int('max_age', null=True, default=None),
+        ),
+    )
+    @private
+    async def smart_data(self, disk, options):
+        """
+        Returns parsed `smartctl -j -a` output for `disk` or `None` if S.M.A.R.T. is unavailable for it or if the
+        disk is in the low-power mode specified by `powermode` (it is not woken up then).
+
+        smartctl is run at most once per `max_age` seconds for each disk, the result is shared between all the
+        callers (temperature monitoring, S.M.A.R.T. tests results, attributes, alerts).
+        """
+        max_age = SMART_DATA_MAX_AGE if options['max_age'] is None else options['max_age']
+
+        async with self.smart_data_locks[disk]:
+            entry = self.smart_data_cache.get(disk)
+            if entry is not None and time.monotonic() - entry['time'] <= max_age and (
+                entry['data'] is not None or
+                # Disk that was not queried because it was sleeping must be queried if the caller wants to wake it
+                entry['powermode'] == 'NEVER' or
+                options['powermode'] != 'NEVER'
+            ):
+                return entry['data']
+
+            data = await self._smart_data(disk, options['powermode'])
+            self.smart_data_cache[disk] = {
+                'time': time.monotonic(),
+                'powermode': options['powermode'],
+                'data': data,
+            }
+            return data
+
+    async def _smart_data(self, disk, powermode):
+        smartctl_args = await self.middleware.call('disk.smartctl_args', disk)
+        if smartctl_args is None:
+            return None
+
+        cp = await smartctl(smartctl_args + ['-j', '-a', '-n', powermode.lower()], check=False, encoding='utf8',
+                            errors='ignore')
+        # Bit 0: command line did not parse, bit 1: device open failed or device is in a low-power mode
+        if cp.returncode & 0b11:
+            return None
+
+        try:
+            return json.loads(cp.stdout)
+        except ValueError:
+            self.logger.warning('Unable to parse smartctl output for disk %r', disk, exc_info=True)
+            return None
+
+    @private
+    async def smart_data_invalidate(self, disk=None):
+        """
+        Drops cached S.M.A.R.T. data for `disk` (or for all disks) so that next `disk.smart_data` call runs smartctl.
+        """
+        if disk is None:
+            self.smart_data_cache.clear()
+        else:
+            self.smart_data_cache.pop(disk, None)
@@ -2,7 +2,7 @@ import asyncio
 
 from datetime import datetime, timedelta
 
-from middlewared.schema import accepts, Str
+from middlewared.schema import accepts, List, Str
 from middlewared.service import job, private, Service, ServiceChangeMixin
 from middlewared.utils import osc
 
@@ -17,21 +17,48 @@ class DiskService(Service, ServiceChangeMixin):
         """
         Syncs a disk `name` with the database cache.
         """
-        if (
+        if await self._is_standby_node():
+            return
+
+        disks = await self.middleware.call('device.get_disks')
+        if await self._sync_disk(name, disks):
+            await self.restart_services_after_sync()
+
+    @private
+    @accepts(List('names', items=[Str('name')]))
+    async def sync_batch(self, names):
+        """
+        Syncs disks `names` with the database cache.
+
+        Unlike calling `disk.sync` for each disk this will only retrieve system disks once
+        and restart dependent services once for the whole batch.
+        """
+        if await self._is_standby_node():
+            return
+
+        disks = await self.middleware.call('device.get_disks')
+        synced = False
+        for name in names:
+            synced |= await self._sync_disk(name, disks)
+
+        if synced:
+            await self.restart_services_after_sync()
+
+    async def _is_standby_node(self):
+        return (
             not await self.middleware.call('system.is_freenas') and
             await self.middleware.call('failover.licensed') and
             await self.middleware.call('failover.status') == 'BACKUP'
-        ):
-            return
+        )
 
+    async def _sync_disk(self, name, disks):
         # Do not sync geom classes like multipath/hast/etc
         if name.find('/') != -1:
-            return
+            return False
 
-        disks = await self.middleware.call('device.get_disks')
         # Abort if the disk is not recognized as an available disk
         if name not in disks:
-            return
+            return False
         ident = await self.middleware.call('disk.device_to_identifier', name, disks)
         qs = await self.middleware.call(
             'datastore.query', 'storage.disk', [('disk_identifier', '=', ident)], {'order_by': ['disk_expiretime']}
@@ -56,10 +83,10 @@ class DiskService(Service, ServiceChangeMixin):
         else:
             disk['disk_identifier'] = await self.middleware.call('datastore.insert', 'storage.disk', disk)
 
-        await self.restart_services_after_sync()
-
         await self.middleware.call('enclosure.sync_disk', disk['disk_identifier'])
 
+        return True
+
     @private
     @accepts()
     @job(lock='disk.sync_all')
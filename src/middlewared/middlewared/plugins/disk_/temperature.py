@@ -1,5 +1,3 @@
-import re
-
 try:
     import cam
 except ImportError:
@@ -10,40 +8,26 @@ from middlewared.service import accepts, List, private, Service, Str
 from middlewared.utils.asyncio_ import asyncio_map
 
 
-def get_temperature(stdout):
-    # ataprint.cpp
-
-    data = {}
-    for s in re.findall(r'^((190|194) .+)', stdout, re.M):
-        s = s[0].split()
-        try:
-            data[s[1]] = int(s[9])
-        except (IndexError, ValueError):
-            pass
+def get_temperature(data):
+    """
+    Returns temperature from parsed `smartctl -j -a` output.
+    """
+    temperature = data.get('temperature', {}).get('current')
+    if temperature is not None:
+        return temperature
+
+    # Not every smartctl version reports all the vendor-specific ATA temperature attributes as current temperature
+    attributes = {}
+    for attribute in data.get('ata_smart_attributes', {}).get('table', []):
+        if attribute['id'] in (190, 194):
+            try:
+                attributes[attribute['name']] = int(attribute['raw']['string'].split()[0])
+            except (IndexError, KeyError, ValueError):
+                pass
     for k in ['Temperature_Celsius', 'Temperature_Internal', 'Drive_Temperature',
               'Temperature_Case', 'Case_Temperature', 'Airflow_Temperature_Cel']:
-        if k in data:
-            return data[k]
-
-    reg = re.search(r'194\s+Temperature_Celsius[^\n]*', stdout, re.M)
-    if reg:
-        return int(reg.group(0).split()[9])
-
-    # nvmeprint.cpp
-
-    reg = re.search(r'Temperature:\s+([0-9]+) Celsius', stdout, re.M)
-    if reg:
-        return int(reg.group(1))
-
-    reg = re.search(r'Temperature Sensor [0-9]+:\s+([0-9]+) Celsius', stdout, re.M)
-    if reg:
-        return int(reg.group(1))
-
-    # scsiprint.cpp
-
-    reg = re.search(r'Current Drive Temperature:\s+([0-9]+) C', stdout, re.M)
-    if reg:
-        return int(reg.group(1))
+        if k in attributes:
+            return attributes[k]
 
 
 class DiskService(Service):
@@ -86,12 +70,11 @@ class DiskService(Service):
                 except Exception:
                     pass
 
-        output = await self.middleware.call('disk.smartctl', name, ['-a', '-n', powermode.lower()],
-                                            {'silent': True})
-        if output is None:
+        data = await self.middleware.call('disk.smart_data', name, {'powermode': powermode})
+        if data is None:
             return None
 
-        return get_temperature(output)
+        return get_temperature(data)
 
     @accepts(
         List('names', items=[Str('name')]),
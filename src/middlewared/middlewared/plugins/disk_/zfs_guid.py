@@ -19,6 +19,21 @@ class DiskService(Service):
         except MatchNotFound:
             return None
 
+    @private
+    async def disks_by_zfs_guids(self, guids):
+        """
+        Returns a `{guid: disk}` mapping for all disks that have one of `guids` zfs_guid.
+        """
+        if not guids:
+            return {}
+
+        result = {}
+        for disk in await self.middleware.call(
+            "disk.query", [["zfs_guid", "in", list(guids)]], {"extra": {"include_expired": True}},
+        ):
+            result.setdefault(disk["zfs_guid"], disk)
+        return result
+
     @private
     async def sync_zfs_guid(self, pool_id_or_pool):
         if isinstance(pool_id_or_pool, dict):
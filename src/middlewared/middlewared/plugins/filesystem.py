@@ -7,6 +7,7 @@ except ImportError:
 import errno
 import enum
 import grp
+import itertools
 import os
 import pwd
 import select
@@ -14,10 +15,14 @@ import shutil
 import subprocess
 import stat as pystat
 
+from middlewared.job import State
 from middlewared.main import EventSource
 from middlewared.schema import Bool, Dict, Int, Ref, List, Str, UnixPerm, accepts
 from middlewared.service import private, CallError, Service, job
-from middlewared.utils import filter_list, osc
+from middlewared.utils import filter_getattrs, filter_list, osc
+from middlewared.plugins.filesystem_ import posix1e_acl
+from middlewared.plugins.filesystem_.recursive import RecursiveApply, RecursiveApplyAborted
+from middlewared.plugins.filesystem_.tail_follow import TailFollowRegistry
 from middlewared.plugins.smb import SMBBuiltin
 
 OS_TYPE_FREEBSD = 0x01
@@ -161,6 +166,10 @@ class FilesystemService(Service):
           uid(int): user id of entry owner
           gid(int): group id of entry onwer
           acl(bool): extended ACL is present on file
+
+        Large directories should be listed in pages using `offset` and `limit` query options. Unless `order_by`
+        is specified, directory scan stops as soon as the requested page is filled. If `select` is specified,
+        only selected attributes are gathered (e.g. ACL is not read unless `acl` is selected).
         """
         if not os.path.exists(path):
             raise CallError(f'Directory {path} does not exist', errno.ENOENT)
@@ -168,36 +177,68 @@ class FilesystemService(Service):
         if not os.path.isdir(path):
             raise CallError(f'Path {path} is not a directory', errno.ENOTDIR)
 
-        rv = []
-        for entry in os.scandir(path):
-            if entry.is_symlink():
-                etype = 'SYMLINK'
-            elif entry.is_dir():
-                etype = 'DIRECTORY'
-            elif entry.is_file():
-                etype = 'FILE'
-            else:
-                etype = 'OTHER'
+        filters = filters or []
+        options = options or {}
 
-            data = {
-                'name': entry.name,
-                'path': entry.path,
-                'realpath': os.path.realpath(entry.path) if etype == 'SYMLINK' else entry.path,
-                'type': etype,
+        # Only gather attributes which are requested, either explicitly or implicitly (by filtering or ordering)
+        select = options.get('select') or []
+        if select:
+            attrs = set(select) | filter_getattrs(filters) | {
+                o.lstrip('-') for o in options.get('order_by') or []
             }
-            try:
-                stat = entry.stat()
-                data.update({
-                    'size': stat.st_size,
-                    'mode': stat.st_mode,
-                    'acl': False if self.acl_is_trivial(data["realpath"]) else True,
-                    'uid': stat.st_uid,
-                    'gid': stat.st_gid,
-                })
-            except FileNotFoundError:
-                data.update({'size': None, 'mode': None, 'acl': None, 'uid': None, 'gid': None})
-            rv.append(data)
-        return filter_list(rv, filters=filters or [], options=options or {})
+        else:
+            attrs = None
+
+        entries = self._listdir_iter(path, attrs)
+
+        if options.get('order_by') or options.get('count') or options.get('get'):
+            return filter_list(list(entries), filters=filters, options=options)
+
+        # Results can be streamed: stop scanning the directory once the requested page has been filled
+        if filters:
+            entries = (entry for entry in entries if filter_list([entry], filters=filters))
+
+        offset = options.get('offset') or 0
+        limit = options.get('limit') or 0
+        page = list(itertools.islice(entries, offset, offset + limit if limit else None))
+
+        return filter_list(page, options={'select': select})
+
+    def _listdir_iter(self, path, attrs=None):
+        def requested(*names):
+            return attrs is None or any(name in attrs for name in names)
+
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    etype = 'SYMLINK'
+                elif entry.is_dir():
+                    etype = 'DIRECTORY'
+                elif entry.is_file():
+                    etype = 'FILE'
+                else:
+                    etype = 'OTHER'
+
+                data = {
+                    'name': entry.name,
+                    'path': entry.path,
+                    'realpath': os.path.realpath(entry.path) if etype == 'SYMLINK' else entry.path,
+                    'type': etype,
+                }
+                if requested('size', 'mode', 'uid', 'gid', 'acl'):
+                    try:
+                        stat = entry.stat()
+                        data.update({
+                            'size': stat.st_size,
+                            'mode': stat.st_mode,
+                            'uid': stat.st_uid,
+                            'gid': stat.st_gid,
+                        })
+                        if requested('acl'):
+                            data['acl'] = False if self.acl_is_trivial(data['realpath']) else True
+                    except FileNotFoundError:
+                        data.update({'size': None, 'mode': None, 'acl': None, 'uid': None, 'gid': None})
+                yield data
 
     @accepts(Str('path'))
     def stat(self, path):
@@ -426,6 +467,22 @@ class FilesystemService(Service):
         if winacl.returncode != 0:
             raise CallError(f"Winacl {action} on path {path} failed with error: [{winacl.stderr.decode().strip()}]")
 
+    def _apply_recursive(self, job, path, callback, options, operation):
+        """
+        Apply `callback` to `path` and everything beneath it using a pool of worker threads. Progress is
+        reported as the number of processed files. The job can be aborted; the same operation started again on
+        the same path with `resume` option resumes where the interrupted one stopped.
+        """
+        try:
+            return RecursiveApply(
+                path, callback, traverse=options['traverse'], operation=operation,
+                resume=options.get('resume', False), job_id=job.id,
+                progress=lambda processed, description: job.set_progress(None, description, {'processed': processed}),
+                aborted=lambda: job.state == State.ABORTED,
+            ).run()
+        except RecursiveApplyAborted:
+            raise CallError(f'Permission change on [{path}] aborted', errno.EINTR)
+
     def _common_perm_path_validate(self, path):
         if not os.path.exists(path):
             raise CallError(f"Path not found: {path}",
@@ -450,8 +507,7 @@ class FilesystemService(Service):
             raise CallError(f'Path not found [{path}].', errno.ENOENT)
 
         if osc.IS_LINUX:
-            posix1e_acl = self.getacl_posix1e(path, True)
-            return True if len(posix1e_acl['acl']) == 3 else False
+            return posix1e_acl.acl_is_trivial(path)
 
         if not os.pathconf(path, 64):
             return True
@@ -467,7 +523,8 @@ class FilesystemService(Service):
             Dict(
                 'options',
                 Bool('recursive', default=False),
-                Bool('traverse', default=False)
+                Bool('traverse', default=False),
+                Bool('resume', default=False),
             )
         )
     )
@@ -485,6 +542,9 @@ class FilesystemService(Service):
 
         If `traverse` and `recursive` are specified, then the chown
         operation will traverse filesystem mount points.
+
+        `resume` continues the same recursive operation on the same path
+        that was interrupted, skipping directories it has already processed.
         """
         job.set_progress(0, 'Preparing to change owner.')
 
@@ -499,7 +559,12 @@ class FilesystemService(Service):
             os.chown(data['path'], uid, gid)
         else:
             job.set_progress(10, f'Recursively changing owner of {data["path"]}.')
-            self._winacl(data['path'], 'chown', uid, gid, options)
+            if osc.IS_LINUX:
+                self._apply_recursive(
+                    job, data['path'], lambda path, is_dir: os.chown(path, uid, gid), options, ['chown', uid, gid],
+                )
+            else:
+                self._winacl(data['path'], 'chown', uid, gid, options)
             job.set_progress(100, 'Finished changing owner.')
 
     @accepts(
@@ -514,6 +579,7 @@ class FilesystemService(Service):
                 Bool('stripacl', default=False),
                 Bool('recursive', default=False),
                 Bool('traverse', default=False),
+                Bool('resume', default=False),
             )
         )
     )
@@ -539,6 +605,9 @@ class FilesystemService(Service):
 
         `traverse` remove ACLs from child datasets.
 
+        `resume` continues the same recursive operation on the same path
+        that was interrupted, skipping directories it has already processed.
+
         If no `mode` is set, and `stripacl` is True, then non-trivial ACLs
         will be converted to trivial ACLs. An ACL is trivial if it can be
         expressed as a file mode without losing any access rules.
@@ -563,22 +632,34 @@ class FilesystemService(Service):
         if mode is not None:
             mode = int(mode, 8)
 
-        a = acl.ACL(file=data['path'])
-        a.strip()
-        a.apply(data['path'])
+        if osc.IS_LINUX:
+            def apply(path, is_dir):
+                posix1e_acl.stripacl(path)
+                if mode:
+                    os.chmod(path, mode)
+                os.chown(path, uid, gid)
 
-        if mode:
-            os.chmod(data['path'], mode)
+            apply(data['path'], True)
+        else:
+            a = acl.ACL(file=data['path'])
+            a.strip()
+            a.apply(data['path'])
+
+            if mode:
+                os.chmod(data['path'], mode)
 
-        os.chown(data['path'], uid, gid)
+            os.chown(data['path'], uid, gid)
 
         if not options['recursive']:
             job.set_progress(100, 'Finished setting permissions.')
             return
 
-        action = 'clone' if mode else 'strip'
         job.set_progress(10, f'Recursively setting permissions on {data["path"]}.')
-        self._winacl(data['path'], action, uid, gid, options)
+        if osc.IS_LINUX:
+            self._apply_recursive(job, data['path'], apply, options, ['setperm', mode, uid, gid])
+        else:
+            action = 'clone' if mode else 'strip'
+            self._winacl(data['path'], action, uid, gid, options)
         job.set_progress(100, 'Finished setting permissions.')
 
     @accepts()
@@ -701,6 +782,10 @@ class FilesystemService(Service):
         ret['uid'] = st.st_uid
         ret['gid'] = st.st_gid
 
+        if osc.IS_LINUX:
+            ret['acl'] = posix1e_acl.getacl(path, st)
+            return ret
+
         gfacl = subprocess.run(['getfacl', '-c' if osc.IS_LINUX else '-q', '-n', path],
                                check=False, capture_output=True)
         if gfacl.returncode != 0:
@@ -843,42 +928,27 @@ class FilesystemService(Service):
         if not aclcheck['is_valid']:
             raise CallError(f"POSIX1e ACL is invalid: {' '.join(aclcheck['errors'])}")
 
-        stripacl = subprocess.run(['setfacl', '-bR' if recursive else '-b', path],
-                                  check=False, capture_output=True)
-        if stripacl.returncode != 0:
-            raise CallError(f"Failed to remove POSIX1e ACL from [{path}]: "
-                            f"{stripacl.stderr.decode()}")
-
-        if options['stripacl']:
-            job.set_progress(100, "Finished removing POSIX1e ACL")
-            return
-
-        job.set_progress(50, 'Reticulating splines.')
+        # Default ACL can only be set on directories
+        access_acl = [ace for ace in dacl if not ace['default']]
 
-        for idx, ace in enumerate(dacl):
-            if idx == 0:
-                aclstring = ""
+        def apply(path, is_dir):
+            if options['stripacl']:
+                posix1e_acl.stripacl(path)
             else:
-                aclstring += ","
+                posix1e_acl.setacl(path, dacl if is_dir else access_acl)
 
-            if ace['id'] == -1:
-                ace['id'] = ''
-
-            ace['tag'] = ace['tag'].rstrip('_OBJ').lower()
-
-            if ace['default']:
-                aclstring += "default:"
-
-            aclstring += f"{ace['tag']}:{ace['id']}:"
-            aclstring += 'r' if ace['perms']['READ'] else '-'
-            aclstring += 'w' if ace['perms']['WRITE'] else '-'
-            aclstring += 'x' if ace['perms']['EXECUTE'] else '-'
+        job.set_progress(10, f'{"Removing" if options["stripacl"] else "Setting"} POSIX1e ACL on {path}.')
+        try:
+            if recursive:
+                self._apply_recursive(job, path, apply, options, ['setacl_posix1e', dacl, options['stripacl']])
+            else:
+                apply(path, os.path.isdir(path))
+        except OSError as e:
+            raise CallError(f'Failed to set ACL on path [{path}]: {e}')
 
-        setacl = subprocess.run(['setfacl', '-mR' if recursive else '-m', aclstring, path],
-                                check=False, capture_output=True)
-        if setacl.returncode != 0:
-            return CallError(f'Failed to set ACL on path [{path}]: ',
-                             f'{setacl.stderr.decode()}')
+        if options['stripacl']:
+            job.set_progress(100, "Finished removing POSIX1e ACL")
+            return
 
         job.set_progress(100, 'Finished setting POSIX1e ACL.')
 
@@ -1023,7 +1093,8 @@ class FilesystemService(Service):
                 Bool('stripacl', default=False),
                 Bool('recursive', default=False),
                 Bool('traverse', default=False),
-                Bool('canonicalize', default=True)
+                Bool('canonicalize', default=True),
+                Bool('resume', default=False),
             )
         )
     )
@@ -1043,6 +1114,9 @@ class FilesystemService(Service):
 
         `traverse` traverse filestem boundaries (ZFS datasets)
 
+        `resume` continue the same recursive operation on the same path that was interrupted, skipping
+        directories it has already processed
+
         `strip` convert ACL to trivial. ACL is trivial if it can be expressed as a file mode without
         losing any access rules.
 
@@ -1064,6 +1138,9 @@ class FilesystemService(Service):
             return self.setacl_posix1e(job, data)
 
 
+tail_follow_registry = TailFollowRegistry()
+
+
 class FileFollowTailEventSource(EventSource):
 
     """
@@ -1086,6 +1163,23 @@ class FileFollowTailEventSource(EventSource):
             # FIXME: Error?
             return
 
+        if osc.IS_LINUX:
+            self._run_inotify(path, lines)
+        else:
+            self._run_kqueue(path, lines)
+
+    def _run_inotify(self, path, lines):
+        # All subscribers of the same file share a single inotify watch and read cursor
+        def callback(data):
+            self.send_event('ADDED', fields={'data': data})
+
+        tail_follow_registry.subscribe(path, callback, lines)
+        try:
+            self._cancel.wait()
+        finally:
+            tail_follow_registry.unsubscribe(path, callback)
+
+    def _run_kqueue(self, path, lines):
         bufsize = 8192
         fsize = os.stat(path).st_size
         if fsize < bufsize:
@@ -0,0 +1,213 @@
+# -*- coding=utf-8 -*-
+import enum
+import errno
+import os
+import struct
+
+__all__ = ["ACL_XATTR_ACCESS", "ACL_XATTR_DEFAULT", "POSIX1ETag", "complete_acl", "decode_acl", "encode_acl", "getacl",
+           "setacl", "stripacl", "acl_is_trivial"]
+
+# See linux/include/uapi/linux/posix_acl_xattr.h
+ACL_XATTR_ACCESS = "system.posix_acl_access"
+ACL_XATTR_DEFAULT = "system.posix_acl_default"
+ACL_XATTR_VERSION = 0x0002
+ACL_UNDEFINED_ID = 0xFFFFFFFF
+
+HEADER = struct.Struct("<I")
+ENTRY = struct.Struct("<HHI")
+
+PERM_READ = 0x04
+PERM_WRITE = 0x02
+PERM_EXECUTE = 0x01
+
+
+class POSIX1ETag(enum.IntEnum):
+    USER_OBJ = 0x01
+    USER = 0x02
+    GROUP_OBJ = 0x04
+    GROUP = 0x08
+    MASK = 0x10
+    OTHER = 0x20
+
+
+# `getfacl` does not distinguish USER_OBJ from USER (and GROUP_OBJ from GROUP) other than by the lack of `id`
+TAG_TO_NAME = {
+    POSIX1ETag.USER_OBJ: "USER",
+    POSIX1ETag.USER: "USER",
+    POSIX1ETag.GROUP_OBJ: "GROUP",
+    POSIX1ETag.GROUP: "GROUP",
+    POSIX1ETag.MASK: "MASK",
+    POSIX1ETag.OTHER: "OTHER",
+}
+
+
+def _ace(tag, perm, id_, default):
+    return {
+        "default": default,
+        "tag": TAG_TO_NAME[tag],
+        "id": -1 if id_ == ACL_UNDEFINED_ID or tag not in (POSIX1ETag.USER, POSIX1ETag.GROUP) else id_,
+        "perms": {
+            "READ": bool(perm & PERM_READ),
+            "WRITE": bool(perm & PERM_WRITE),
+            "EXECUTE": bool(perm & PERM_EXECUTE),
+        },
+    }
+
+
+def decode_acl(data, default=False):
+    """
+    Decode `system.posix_acl_*` xattr value into a list of ACEs in the format returned by `filesystem.getacl`.
+    """
+    if len(data) < HEADER.size or (len(data) - HEADER.size) % ENTRY.size:
+        raise ValueError("Invalid POSIX1e ACL xattr length")
+
+    version, = HEADER.unpack_from(data)
+    if version != ACL_XATTR_VERSION:
+        raise ValueError(f"Unsupported POSIX1e ACL xattr version: {version}")
+
+    return [
+        _ace(POSIX1ETag(tag), perm, id_, default)
+        for tag, perm, id_ in ENTRY.iter_unpack(data[HEADER.size:])
+    ]
+
+
+def _ace_tag(ace):
+    if ace["tag"] in ("USER", "GROUP") and ace["id"] in (None, -1):
+        return POSIX1ETag[f"{ace['tag']}_OBJ"]
+
+    return POSIX1ETag[ace["tag"]]
+
+
+def encode_acl(acl):
+    """
+    Encode list of ACEs in the format accepted by `filesystem.setacl` into `system.posix_acl_*` xattr value.
+    Entries are sorted the way the kernel expects them to be.
+    """
+    entries = []
+    for ace in acl:
+        tag = _ace_tag(ace)
+        perm = (
+            (PERM_READ if ace["perms"]["READ"] else 0) |
+            (PERM_WRITE if ace["perms"]["WRITE"] else 0) |
+            (PERM_EXECUTE if ace["perms"]["EXECUTE"] else 0)
+        )
+        id_ = ace["id"] if tag in (POSIX1ETag.USER, POSIX1ETag.GROUP) else ACL_UNDEFINED_ID
+        entries.append((tag, perm, id_))
+
+    entries.sort(key=lambda e: (e[0], e[2]))
+    return HEADER.pack(ACL_XATTR_VERSION) + b"".join(ENTRY.pack(*entry) for entry in entries)
+
+
+BASE_TAGS = (POSIX1ETag.USER_OBJ, POSIX1ETag.GROUP_OBJ, POSIX1ETag.OTHER)
+# Entries whose permissions are limited by MASK
+GROUP_CLASS_TAGS = (POSIX1ETag.USER, POSIX1ETag.GROUP_OBJ, POSIX1ETag.GROUP)
+
+
+def _complete_acl(acl, base, default):
+    tags = {_ace_tag(ace) for ace in acl}
+    acl = acl + [dict(ace, default=default) for ace in base if _ace_tag(ace) not in tags]
+
+    if tags & {POSIX1ETag.USER, POSIX1ETag.GROUP} and POSIX1ETag.MASK not in tags:
+        group_class = [ace for ace in acl if _ace_tag(ace) in GROUP_CLASS_TAGS]
+        acl.append({
+            "default": default,
+            "tag": "MASK",
+            "id": -1,
+            "perms": {perm: any(ace["perms"][perm] for ace in group_class) for perm in ("READ", "WRITE", "EXECUTE")},
+        })
+
+    return acl
+
+
+def complete_acl(acl, mode):
+    """
+    Complete `acl` the way `setfacl -m` does when applied over the ACL equivalent to `mode`: missing USER_OBJ,
+    GROUP_OBJ and OTHER entries are taken from `mode` (default ACL takes them from the access ACL) and, unless
+    specified, MASK is computed as the union of permissions of the entries it applies to.
+    """
+    access = _complete_acl([ace for ace in acl if not ace["default"]], _mode_acl(mode), False)
+    default = [ace for ace in acl if ace["default"]]
+    if default:
+        default = _complete_acl(default, [ace for ace in access if _ace_tag(ace) in BASE_TAGS], True)
+
+    return access + default
+
+
+def _getxattr(path, name, follow_symlinks=True):
+    try:
+        return os.getxattr(path, name, follow_symlinks=follow_symlinks)
+    except OSError as e:
+        if e.errno in (errno.ENODATA, errno.EOPNOTSUPP):
+            return None
+        raise
+
+
+def _mode_acl(mode):
+    return [
+        _ace(POSIX1ETag.USER_OBJ, (mode >> 6) & 0o7, ACL_UNDEFINED_ID, False),
+        _ace(POSIX1ETag.GROUP_OBJ, (mode >> 3) & 0o7, ACL_UNDEFINED_ID, False),
+        _ace(POSIX1ETag.OTHER, mode & 0o7, ACL_UNDEFINED_ID, False),
+    ]
+
+
+def getacl(path, st=None):
+    """
+    Returns POSIX1e access and default ACL entries of `path` (same as `getfacl -n` does, without forking).
+    If no access ACL is set, the one equivalent to the file mode is returned.
+    """
+    access = _getxattr(path, ACL_XATTR_ACCESS)
+    if access is None:
+        if st is None:
+            st = os.stat(path)
+        acl = _mode_acl(st.st_mode)
+    else:
+        acl = decode_acl(access)
+
+    default = _getxattr(path, ACL_XATTR_DEFAULT)
+    if default:
+        acl.extend(decode_acl(default, True))
+
+    return acl
+
+
+def setacl(path, acl, follow_symlinks=True):
+    """
+    Replace POSIX1e access and default ACL of `path` with `acl` entries. `acl` is completed with the entries
+    required by the kernel (see `complete_acl`).
+    """
+    acl = complete_acl(acl, os.stat(path, follow_symlinks=follow_symlinks).st_mode)
+    access = [ace for ace in acl if not ace["default"]]
+    default = [ace for ace in acl if ace["default"]]
+
+    os.setxattr(path, ACL_XATTR_ACCESS, encode_acl(access), follow_symlinks=follow_symlinks)
+    if default:
+        os.setxattr(path, ACL_XATTR_DEFAULT, encode_acl(default), follow_symlinks=follow_symlinks)
+    else:
+        _removexattr(path, ACL_XATTR_DEFAULT, follow_symlinks)
+
+
+def stripacl(path, follow_symlinks=True):
+    """
+    Remove extended POSIX1e ACL from `path` (same as `setfacl -b` does). File mode is left intact.
+    """
+    _removexattr(path, ACL_XATTR_ACCESS, follow_symlinks)
+    _removexattr(path, ACL_XATTR_DEFAULT, follow_symlinks)
+
+
+def _removexattr(path, name, follow_symlinks):
+    try:
+        os.removexattr(path, name, follow_symlinks=follow_symlinks)
+    except OSError as e:
+        if e.errno not in (errno.ENODATA, errno.EOPNOTSUPP):
+            raise
+
+
+def acl_is_trivial(path):
+    """
+    Returns True if POSIX1e ACL of `path` is fully expressed by its mode.
+    """
+    if _getxattr(path, ACL_XATTR_DEFAULT):
+        return False
+
+    access = _getxattr(path, ACL_XATTR_ACCESS)
+    return access is None or len(decode_acl(access)) <= 3
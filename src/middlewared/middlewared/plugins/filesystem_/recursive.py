@@ -0,0 +1,229 @@
+# -*- coding=utf-8 -*-
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["RecursiveApply", "RecursiveApplyAborted"]
+
+JOURNAL_DIR = "/var/db/system/perm_change"
+# Directories modified less than this many nanoseconds before they were scanned are not journaled: an entry could
+# be added later within the same timestamp granularity without changing the directory modification time.
+JOURNAL_RACY_NS = 1000000000
+
+
+class RecursiveApplyAborted(Exception):
+    pass
+
+
+class RecursiveApplyJournal:
+    """
+    List of directories whose entries have already been processed by an interrupted operation.
+
+    Journal is identified by the operation parameters and the path. It starts with a header that records the job that
+    wrote it and the device and inode of the root directory so that it is not applied to a different tree created at
+    the same path. Each directory is journaled with its modification time: directories whose entries were added,
+    removed or renamed since are processed again when the operation is resumed.
+    """
+
+    def __init__(self, path, operation, job_id=None):
+        key = hashlib.sha256(json.dumps([path, operation], sort_keys=True).encode()).hexdigest()
+        self.path = os.path.join(JOURNAL_DIR, key)
+        self.job_id = job_id
+        self.done = {}
+        self.lock = threading.Lock()
+        self.f = None
+
+    def open(self, root_stat, resume):
+        """
+        Start journaling. Unless `resume` is set, the journal left by a previous run is discarded.
+        """
+        root = [root_stat.st_dev, root_stat.st_ino]
+        try:
+            os.makedirs(JOURNAL_DIR, mode=0o700, exist_ok=True)
+            if resume:
+                self.done = self._load(root)
+
+            self.f = open(self.path, "w")
+            self.f.write(json.dumps({"job_id": self.job_id, "root": root}) + "\n")
+            for directory, mtime in self.done.items():
+                self.f.write(json.dumps([directory, mtime]) + "\n")
+            self.f.flush()
+        except OSError:
+            logger.warning("Unable to open permission change journal %r, interrupted operation will not be resumed",
+                           self.path, exc_info=True)
+            self.done = {}
+
+    def _load(self, root):
+        try:
+            with open(self.path) as f:
+                header = json.loads(f.readline())
+                if header["root"] != root:
+                    logger.warning("Permission change journal %r was written for a different directory, "
+                                   "starting from scratch", self.path)
+                    return {}
+
+                done = {}
+                for line in f:
+                    # Last line might be incomplete if the middleware crashed
+                    if line.endswith("\n"):
+                        directory, mtime = json.loads(line)
+                        done[directory] = mtime
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Permission change journal %r is corrupted, starting from scratch", self.path,
+                           exc_info=True)
+            return {}
+
+        logger.info("Resuming permission change interrupted in job %r (%d directories already processed)",
+                    header.get("job_id"), len(done))
+        return done
+
+    def is_done(self, directory, mtime):
+        return self.done.get(directory) == mtime
+
+    def mark_done(self, directory, mtime):
+        if self.f is None:
+            return
+
+        with self.lock:
+            self.f.write(json.dumps([directory, mtime]) + "\n")
+            self.f.flush()
+
+    def close(self, completed):
+        if self.f is None:
+            return
+
+        self.f.close()
+        self.f = None
+        if completed:
+            os.unlink(self.path)
+
+
+class RecursiveApply:
+    """
+    Calls `callback(path, is_dir)` for `path` and every file and directory beneath it.
+
+    Directories are scanned with `os.scandir` by a bounded pool of worker threads, each worker processes all
+    entries of the directory it scans. Filesystem (dataset) boundaries are not crossed unless `traverse` is set
+    and symbolic links are never followed.
+
+    `progress(processed, description)` is called at most once per `progress_interval` seconds,
+    `aborted()` is polled between directories. If `operation` is specified, processed directories are journaled
+    (on behalf of `job_id`) so that an interrupted (aborted or crashed) run of the same operation on the same path can
+    be resumed by a run with `resume` set. The journal is removed once the operation completes.
+    """
+
+    def __init__(self, path, callback, traverse=False, workers=8, operation=None, progress=None, aborted=None,
+                 progress_interval=1, resume=False, job_id=None):
+        self.path = path
+        self.callback = callback
+        self.traverse = traverse
+        self.workers = workers
+        self.journal = RecursiveApplyJournal(path, operation, job_id) if operation is not None else None
+        self.resume = resume
+        self.progress = progress
+        self.aborted = aborted
+        self.progress_interval = progress_interval
+
+        self.root_dev = None
+        self.processed = 0
+        self.lock = threading.Lock()
+        self.last_progress_at = 0
+
+    def run(self):
+        """
+        Returns the number of files and directories processed.
+        """
+        root_stat = os.stat(self.path)
+        self.root_dev = root_stat.st_dev
+
+        if self.journal:
+            self.journal.open(root_stat, self.resume)
+
+        completed = False
+        try:
+            self.callback(self.path, True)
+            self._count(1)
+
+            with ThreadPoolExecutor(self.workers) as executor:
+                pending = {executor.submit(self._process_dir, self.path)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            subdirs = future.result()
+                        except Exception:
+                            for f in pending:
+                                f.cancel()
+                            raise
+
+                        for subdir in subdirs:
+                            pending.add(executor.submit(self._process_dir, subdir))
+
+            completed = True
+        finally:
+            if self.journal:
+                self.journal.close(completed)
+
+        self._report_progress(True)
+        return self.processed
+
+    def _process_dir(self, directory):
+        if self.aborted is not None and self.aborted():
+            raise RecursiveApplyAborted()
+
+        # Taken before scanning so that entries added meanwhile are not missed on resume
+        if self.journal:
+            scanned_at = time.time_ns()
+            mtime = os.stat(directory).st_mtime_ns
+        done = self.journal is not None and self.journal.is_done(directory, mtime)
+
+        subdirs = []
+        count = 0
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    continue
+
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if is_dir:
+                    if not self.traverse and entry.stat(follow_symlinks=False).st_dev != self.root_dev:
+                        continue
+
+                    subdirs.append(entry.path)
+
+                if not done:
+                    self.callback(entry.path, is_dir)
+                count += 1
+
+        if self.journal and not done and mtime < scanned_at - JOURNAL_RACY_NS:
+            self.journal.mark_done(directory, mtime)
+
+        self._count(count)
+        return subdirs
+
+    def _count(self, count):
+        with self.lock:
+            self.processed += count
+
+        self._report_progress()
+
+    def _report_progress(self, force=False):
+        if self.progress is None:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.last_progress_at < self.progress_interval:
+                return
+            self.last_progress_at = now
+            processed = self.processed
+
+        self.progress(processed, f"{processed} files processed")
@@ -0,0 +1,311 @@
+# -*- coding=utf-8 -*-
+import codecs
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["Inotify", "TailFollower", "TailFollowRegistry", "tail"]
+
+# See linux/include/uapi/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT = struct.Struct("iIII")
+
+BUFSIZE = 8192
+
+
+class Inotify:
+    """
+    Minimal `inotify(7)` binding.
+    """
+
+    libc = None
+
+    def __init__(self):
+        if Inotify.libc is None:
+            Inotify.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = self._check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def _check(self, result):
+        if result == -1:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        return result
+
+    def add_watch(self, path, mask):
+        return self._check(self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask))
+
+    def rm_watch(self, wd):
+        try:
+            self._check(self.libc.inotify_rm_watch(self.fd, wd))
+        except OSError as e:
+            # Watch is removed automatically when the file is deleted
+            if e.errno != errno.EINVAL:
+                raise
+
+    def read(self, timeout):
+        """
+        Returns a list of `(wd, mask, name)` tuples, waiting for at most `timeout` seconds for them to arrive.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += length
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def tail(f, end, lines):
+    """
+    Returns last `lines` lines of binary file `f` before `end` offset.
+    """
+    if lines <= 0:
+        return b""
+
+    data = b""
+    position = end
+    while position > 0 and data.count(b"\n") <= lines:
+        size = min(BUFSIZE, position)
+        position -= size
+        f.seek(position)
+        data = f.read(size) + data
+
+    return b"".join(data.splitlines(keepends=True)[-lines:])
+
+
+class TailFollower:
+    """
+    Follows a single file and fans out appended data to any number of subscribers.
+
+    File is opened and watched once regardless of the number of subscribers. When the file is rotated (moved
+    or deleted), remaining data is drained from the old file and the follower waits for a new file to appear
+    at the same path, following it from its beginning. Truncated files are followed from their beginning too.
+    """
+
+    def __init__(self, path, timeout=1):
+        self.path = path
+        self.timeout = timeout
+
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.inotify = None
+        self.f = None
+        self.wd = None
+        self.dir_wd = None
+        self.cursor = 0
+        self.decoder = None
+
+    def start(self):
+        self.inotify = Inotify()
+        try:
+            self._open(end=True)
+        except Exception:
+            self.inotify.close()
+            raise
+
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"tail_follow:{self.path}")
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def subscribe(self, callback, lines):
+        """
+        Sends last `lines` lines to `callback` and then calls it with each new chunk of data.
+        """
+        with self.lock:
+            if self.f is not None:
+                initial = tail(self.f, self.cursor, lines)
+                self._seek_cursor()
+                callback(initial.decode(errors="replace"))
+            else:
+                callback("")
+
+            self.subscribers[id(callback)] = callback
+
+    def unsubscribe(self, callback):
+        """
+        Returns number of subscribers left.
+        """
+        with self.lock:
+            self.subscribers.pop(id(callback), None)
+            return len(self.subscribers)
+
+    def _open(self, end):
+        f = open(self.path, "rb")
+        try:
+            wd = self.inotify.add_watch(self.path, IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF)
+        except Exception:
+            f.close()
+            raise
+
+        self.f = f
+        self.wd = wd
+        self.cursor = os.fstat(f.fileno()).st_size if end else 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def _unlinked(self):
+        st = os.fstat(self.f.fileno())
+        try:
+            path_st = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+
+        return (st.st_dev, st.st_ino) != (path_st.st_dev, path_st.st_ino)
+
+    def _seek_cursor(self):
+        self.f.seek(self.cursor)
+
+    def _close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if self.wd is not None:
+            self.inotify.rm_watch(self.wd)
+            self.wd = None
+
+    def _read(self):
+        if self.f is None:
+            return
+
+        if os.fstat(self.f.fileno()).st_size < self.cursor:
+            # File was truncated
+            self.cursor = 0
+
+        self._seek_cursor()
+        data = self.f.read()
+        self.cursor = self.f.tell()
+        if data:
+            self._send(self.decoder.decode(data))
+
+    def _send(self, data):
+        if not data:
+            return
+
+        for callback in list(self.subscribers.values()):
+            try:
+                callback(data)
+            except Exception:
+                logger.warning("Unhandled exception in tail follower callback", exc_info=True)
+
+    def _rotated(self):
+        self._read()
+        self._close()
+
+        if self.dir_wd is None:
+            self.dir_wd = self.inotify.add_watch(os.path.dirname(self.path), IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+
+        self._reopen()
+
+    def _reopen(self):
+        try:
+            self._open(end=False)
+        except FileNotFoundError:
+            return
+
+        if self.dir_wd is not None:
+            self.inotify.rm_watch(self.dir_wd)
+            self.dir_wd = None
+
+        # Data might have been written to the new file before we started watching it
+        self._read()
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                events = self.inotify.read(self.timeout)
+                with self.lock:
+                    rotated = False
+                    reopen = False
+                    for wd, mask, name in events:
+                        if wd == self.wd:
+                            # Unlinking an open file only yields `IN_ATTRIB` (link count change)
+                            if mask & (IN_MOVE_SELF | IN_DELETE_SELF | IN_IGNORED) or (
+                                mask & IN_ATTRIB and self._unlinked()
+                            ):
+                                rotated = True
+                        elif wd == self.dir_wd and name == os.path.basename(self.path):
+                            reopen = True
+
+                    if rotated:
+                        self._rotated()
+                    elif self.f is None and reopen:
+                        self._reopen()
+                    elif events:
+                        self._read()
+        except Exception:
+            logger.error("Failed to follow %r", self.path, exc_info=True)
+        finally:
+            self.stopped.set()
+            with self.lock:
+                self._close()
+                self.inotify.close()
+
+
+class TailFollowRegistry:
+    """
+    Shares `TailFollower` instances between all subscribers of the same path.
+    """
+
+    def __init__(self, follower_factory=TailFollower):
+        self.follower_factory = follower_factory
+        self.followers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, path, callback, lines):
+        with self.lock:
+            follower = self.followers.get(path)
+            if follower is None or follower.stopped.is_set():
+                follower = self.follower_factory(path)
+                follower.start()
+                self.followers[path] = follower
+
+            follower.subscribe(callback, lines)
+
+    def unsubscribe(self, path, callback):
+        with self.lock:
+            follower = self.followers.get(path)
+            if follower is None:
+                return
+
+            if follower.unsubscribe(callback) == 0:
+                self.followers.pop(path)
+                follower.stop()
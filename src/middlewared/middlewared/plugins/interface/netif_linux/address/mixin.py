@@ -4,6 +4,7 @@ import logging
 
 import netifaces
 
+from middlewared.plugins.interface.netif_linux import netlink
 from middlewared.plugins.interface.netif_linux.utils import run
 
 from .ipv6 import ipv6_netmask_to_prefixlen
@@ -32,10 +33,19 @@ class AddressMixin:
         if isinstance(address.address, ipaddress.IPv6Address):
             netmask = ipv6_netmask_to_prefixlen(netmask)
 
+        if netlink.available():
+            prefixlen = ipaddress.ip_network(f"{address.address}/{netmask}", strict=False).prefixlen
+            netlink.address_op("delete" if op == "del" else op, self.name, address.address, prefixlen)
+            self._invalidate()
+            return
+
         run(["ip", "addr", op, f"{address.address}/{netmask}", "dev", self.name])
 
     @property
     def addresses(self):
+        if self._netlink is not None:
+            return list(self._netlink.addresses)
+
         addresses = []
 
         for family, family_addresses in netifaces.ifaddresses(self.name).items():
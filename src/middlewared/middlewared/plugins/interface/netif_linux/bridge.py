@@ -4,6 +4,7 @@ import logging
 
 import middlewared.plugins.interface.netif_linux.interface as interface
 
+from . import netlink
 from .utils import run
 
 logger = logging.getLogger(__name__)
@@ -12,19 +13,33 @@ __all__ = ["create_bridge", "BridgeMixin"]
 
 
 def create_bridge(name):
-    run(["ip", "link", "add", name, "type", "bridge"])
+    if netlink.available():
+        netlink.link_add(name, "bridge")
+    else:
+        run(["ip", "link", "add", name, "type", "bridge"])
     interface.Interface(name).up()
 
 
 class BridgeMixin:
     def add_member(self, name):
-        run(["ip", "link", "set", name, "master", self.name])
+        if netlink.available():
+            netlink.link_set(name, master=self.name)
+            self._invalidate()
+        else:
+            run(["ip", "link", "set", name, "master", self.name])
 
     def delete_member(self, name):
-        run(["ip", "link", "set", name, "nomaster"])
+        if netlink.available():
+            netlink.link_set(name, master=0)
+            self._invalidate()
+        else:
+            run(["ip", "link", "set", name, "nomaster"])
 
     @property
     def members(self):
+        if self._netlink is not None:
+            return list(self._netlink.members)
+
         return [
             link["ifname"]
             for link in json.loads(run(["bridge", "-json", "link"]).stdout)
@@ -2,6 +2,7 @@
 import logging
 import subprocess
 
+from . import netlink
 from .address import AddressFamily, AddressMixin
 from .bridge import BridgeMixin
 from .bits import InterfaceFlags, InterfaceLinkState
@@ -19,8 +20,22 @@ CLONED_PREFIXES = [
 
 
 class Interface(AddressMixin, BridgeMixin, LaggMixin, VlanMixin):
-    def __init__(self, name):
+    def __init__(self, name, link=None):
         self.name = name
+        self._link = link
+
+    @property
+    def _netlink(self):
+        """
+        `netlink.Link` state of the interface or `None` if netlink is not available.
+        """
+        if self._link is None and netlink.available():
+            self._link = netlink.dump(self.name)[self.name]
+
+        return self._link
+
+    def _invalidate(self):
+        self._link = None
 
     def _read(self, name, type=str):
         return self._sysfs_read(f"/sys/class/net/{self.name}/{name}", type)
@@ -45,11 +60,18 @@ class Interface(AddressMixin, BridgeMixin, LaggMixin, VlanMixin):
 
     @property
     def mtu(self):
+        if self._netlink is not None:
+            return self._netlink.mtu
+
         return self._read("mtu", int)
 
     @mtu.setter
     def mtu(self, mtu):
-        run(["ip", "link", "set", "dev", self.name, "mtu", str(mtu)])
+        if netlink.available():
+            netlink.link_set(self.name, mtu=mtu)
+            self._invalidate()
+        else:
+            run(["ip", "link", "set", "dev", self.name, "mtu", str(mtu)])
 
     @property
     def cloned(self):
@@ -61,6 +83,9 @@ class Interface(AddressMixin, BridgeMixin, LaggMixin, VlanMixin):
 
     @property
     def flags(self):
+        if self._netlink is not None:
+            return bitmask_to_set(self._netlink.flags, InterfaceFlags)
+
         return bitmask_to_set(self._read("flags", lambda s: int(s, base=16)), InterfaceFlags)
 
     @property
@@ -77,7 +102,10 @@ class Interface(AddressMixin, BridgeMixin, LaggMixin, VlanMixin):
 
     @property
     def link_state(self):
-        operstate = self._read("operstate")
+        if self._netlink is not None:
+            operstate = (self._netlink.operstate or "").lower()
+        else:
+            operstate = self._read("operstate")
 
         return {
             "down": InterfaceLinkState.LINK_STATE_DOWN,
@@ -114,25 +142,7 @@ class Interface(AddressMixin, BridgeMixin, LaggMixin, VlanMixin):
         }
 
         if media:
-            p = subprocess.run(["ethtool", self.name], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                               encoding="utf-8", errors="ignore")
-            if p.returncode == 0:
-                ethtool = {
-                    k.strip(): v.strip()
-                    for k, v in map(lambda s: s.split(":", 1), [line for line in p.stdout.splitlines() if ":" in line])
-                }
-                if "Speed" in ethtool:
-                    bits = [ethtool["Speed"]]
-                    if "Port" in ethtool:
-                        bits.append(ethtool["Port"])
-                    media_subtype = " ".join(bits)
-
-                    state.update({
-                        "media_type": "Ethernet",
-                        "media_subtype": "autoselect" if ethtool.get("Auto-negotiation") == "on" else media_subtype,
-                        "active_media_type": "Ethernet",
-                        "active_media_subtype": media_subtype,
-                    })
+            state.update(self._media())
 
         if self.name.startswith('bond'):
             state.update({
@@ -149,8 +159,56 @@ class Interface(AddressMixin, BridgeMixin, LaggMixin, VlanMixin):
 
         return state
 
+    def _media(self):
+        if self._netlink is not None:
+            settings = self._netlink.settings()
+            if settings is None:
+                return {}
+
+            bits = [f"{settings['speed']}Mb/s" if settings["speed"] else "Unknown!"]
+            if settings["port"]:
+                bits.append(settings["port"])
+            media_subtype = " ".join(bits)
+
+            return {
+                "media_type": "Ethernet",
+                "media_subtype": "autoselect" if settings["autoneg"] else media_subtype,
+                "active_media_type": "Ethernet",
+                "active_media_subtype": media_subtype,
+            }
+
+        p = subprocess.run(["ethtool", self.name], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                           encoding="utf-8", errors="ignore")
+        if p.returncode == 0:
+            ethtool = {
+                k.strip(): v.strip()
+                for k, v in map(lambda s: s.split(":", 1), [line for line in p.stdout.splitlines() if ":" in line])
+            }
+            if "Speed" in ethtool:
+                bits = [ethtool["Speed"]]
+                if "Port" in ethtool:
+                    bits.append(ethtool["Port"])
+                media_subtype = " ".join(bits)
+
+                return {
+                    "media_type": "Ethernet",
+                    "media_subtype": "autoselect" if ethtool.get("Auto-negotiation") == "on" else media_subtype,
+                    "active_media_type": "Ethernet",
+                    "active_media_subtype": media_subtype,
+                }
+
+        return {}
+
     def up(self):
-        run(["ip", "link", "set", self.name, "up"])
+        if netlink.available():
+            netlink.link_set(self.name, state="up")
+            self._invalidate()
+        else:
+            run(["ip", "link", "set", self.name, "up"])
 
     def down(self):
-        run(["ip", "link", "set", self.name, "down"])
+        if netlink.available():
+            netlink.link_set(self.name, state="down")
+            self._invalidate()
+        else:
+            run(["ip", "link", "set", self.name, "down"])
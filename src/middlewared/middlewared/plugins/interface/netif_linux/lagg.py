@@ -4,6 +4,7 @@ import logging
 
 import middlewared.plugins.interface.netif_linux.interface as interface
 
+from . import netlink
 from .utils import run
 
 logger = logging.getLogger(__name__)
@@ -18,14 +19,20 @@ class AggregationProtocol(enum.Enum):
 
 
 def create_lagg(name):
-    run(["ip", "link", "add", name, "type", "bond"])
+    if netlink.available():
+        netlink.link_add(name, "bond")
+    else:
+        run(["ip", "link", "add", name, "type", "bond"])
     interface.Interface(name).up()
 
 
 class LaggMixin:
     @property
     def protocol(self):
-        value = self._sysfs_read(f"/sys/devices/virtual/net/{self.name}/bonding/mode").split()[0]
+        if self._netlink is not None:
+            value = self._netlink.bond_mode
+        else:
+            value = self._sysfs_read(f"/sys/devices/virtual/net/{self.name}/bonding/mode").split()[0]
         for protocol in AggregationProtocol:
             if protocol.value == value:
                 return protocol
@@ -34,14 +41,21 @@ class LaggMixin:
 
     @protocol.setter
     def protocol(self, value):
-        run(["ip", "link", "set", self.name, "down"])
+        self.down()
         for port in self.ports:
             self.delete_port(port[0])
-        run(["ip", "link", "set", self.name, "type", "bond", "mode", value.value])
-        run(["ip", "link", "set", self.name, "up"])
+        if netlink.available():
+            netlink.link_set(self.name, kind="bond", bond_mode=netlink.BOND_MODES[value.value])
+            self._invalidate()
+        else:
+            run(["ip", "link", "set", self.name, "type", "bond", "mode", value.value])
+        self.up()
 
     @property
     def ports(self):
+        if self._netlink is not None:
+            return [(port, set()) for port in self._netlink.members]
+
         return [
             (port, set())
             for port in self._sysfs_read(f"/sys/devices/virtual/net/{self.name}/bonding/slaves").split()
@@ -49,7 +63,15 @@ class LaggMixin:
 
     def add_port(self, name):
         interface.Interface(name).down()
-        run(["ip", "link", "set", name, "master", self.name])
+        if netlink.available():
+            netlink.link_set(name, master=self.name)
+            self._invalidate()
+        else:
+            run(["ip", "link", "set", name, "master", self.name])
 
     def delete_port(self, name):
-        run(["ip", "link", "set", name, "nomaster"])
+        if netlink.available():
+            netlink.link_set(name, master=0)
+            self._invalidate()
+        else:
+            run(["ip", "link", "set", name, "nomaster"])
@@ -2,6 +2,7 @@
 import logging
 import os
 
+from . import netlink
 from .bridge import create_bridge
 from .interface import Interface
 from .lagg import AggregationProtocol, create_lagg
@@ -27,17 +28,31 @@ def create_interface(name):
 
 
 def destroy_interface(name):
-    if name.startswith(("bond", "br", "vlan")):
+    if netlink.available():
+        if name.startswith(("bond", "br", "vlan")):
+            netlink.link_del(name)
+        else:
+            netlink.link_set(name, state="down")
+    elif name.startswith(("bond", "br", "vlan")):
         run(["ip", "link", "delete", name])
     else:
         run(["ip", "link", "set", name, "down"])
 
 
 def get_interface(name):
+    if netlink.available():
+        try:
+            return Interface(name, netlink.dump(name)[name])
+        except FileNotFoundError:
+            raise KeyError(name) from None
+
     return list_interfaces()[name]
 
 
 def list_interfaces():
+    if netlink.available():
+        return {name: Interface(name, link) for name, link in netlink.dump().items()}
+
     return {name: Interface(name)
             for name in os.listdir("/sys/class/net")
             if os.path.isdir(os.path.join("/sys/class/net", name))}
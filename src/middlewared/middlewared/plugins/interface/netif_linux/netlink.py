@@ -0,0 +1,374 @@
+# -*- coding=utf-8 -*-
+import contextlib
+import copy
+import errno
+import ipaddress
+import logging
+import socket
+import threading
+
+from pyroute2 import IPRoute
+from pyroute2.ethtool import Ethtool
+from pyroute2.netlink.rtnl import (
+    RTMGRP_IPV4_IFADDR, RTMGRP_IPV4_ROUTE, RTMGRP_IPV6_IFADDR, RTMGRP_IPV6_ROUTE, RTMGRP_LINK,
+)
+from pyroute2.netlink.rtnl.marshal import MarshalRtnl
+
+from .address.types import AddressFamily, InterfaceAddress, LinkAddress
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["Link", "NetlinkStateCache", "available", "iproute", "ethtool", "index", "dump", "routes", "link_add",
+           "link_set", "link_del", "address_op", "link_settings"]
+
+# include/uapi/linux/if_bonding.h
+BOND_MODES = {
+    "balance-xor": 2,
+    "active-backup": 1,
+    "802.3ad": 4,
+}
+BOND_MODE_NAMES = {v: k for k, v in BOND_MODES.items()}
+
+IFF_UP = 0x1
+
+MONITOR_RCVBUF = 4 * 1024 * 1024
+SO_RCVBUFFORCE = 33
+
+_lock = threading.RLock()
+_iproute = None
+_ethtool = None
+_available = None
+
+
+def available():
+    """
+    Returns `False` if a NETLINK_ROUTE socket can't be opened, callers should fall back to `ip` and friends then.
+    """
+    global _available, _iproute
+
+    if _available is None:
+        with _lock:
+            if _available is None:
+                try:
+                    _iproute = IPRoute()
+                except Exception:
+                    logger.warning("Unable to open NETLINK_ROUTE socket, falling back to iproute2", exc_info=True)
+                    _available = False
+                else:
+                    _available = True
+
+    return _available
+
+
+@contextlib.contextmanager
+def iproute():
+    """
+    Yields the shared NETLINK_ROUTE socket. Requests are serialized, so a series of requests made within a
+    single context is consistent.
+    """
+    if not available():
+        raise RuntimeError("NETLINK_ROUTE socket is not available")
+
+    with _lock:
+        yield _iproute
+
+
+@contextlib.contextmanager
+def ethtool():
+    """
+    Yields the shared ethtool generic netlink socket (pyroute2 falls back to ioctl on kernels without it).
+    """
+    global _ethtool
+
+    with _lock:
+        if _ethtool is None:
+            _ethtool = Ethtool()
+
+        yield _ethtool
+
+
+class Link:
+    """
+    Interface state decoded from a single RTM_NEWLINK message.
+    """
+
+    def __init__(self, msg):
+        self.index = msg["index"]
+        self.flags = msg["flags"]
+        self.name = msg.get_attr("IFLA_IFNAME")
+        self.mtu = msg.get_attr("IFLA_MTU")
+        self.operstate = msg.get_attr("IFLA_OPERSTATE")
+        self.address = msg.get_attr("IFLA_ADDRESS")
+        self.master = msg.get_attr("IFLA_MASTER")
+        self.link = msg.get_attr("IFLA_LINK")
+
+        self.kind = None
+        self.vlan_id = None
+        self.bond_mode = None
+        linkinfo = msg.get_attr("IFLA_LINKINFO")
+        if linkinfo is not None:
+            self.kind = linkinfo.get_attr("IFLA_INFO_KIND")
+            data = linkinfo.get_attr("IFLA_INFO_DATA")
+            if data is not None and not isinstance(data, (str, bytes)):
+                if self.kind == "vlan":
+                    self.vlan_id = data.get_attr("IFLA_VLAN_ID")
+                elif self.kind == "bond":
+                    self.bond_mode = BOND_MODE_NAMES.get(data.get_attr("IFLA_BOND_MODE"))
+
+        # Filled in by `dump` as they require knowledge of other links
+        self.parent = None
+        self.members = []
+        self.addresses = []
+
+        # Shared between copies of the same RTM_NEWLINK state, so it is re-read when the link changes
+        self._settings = {}
+
+    def copy(self):
+        link = copy.copy(self)
+        link.parent = None
+        link.members = []
+        link.addresses = []
+        return link
+
+    def settings(self):
+        """
+        Memoized `link_settings`.
+        """
+        if "value" not in self._settings:
+            self._settings["value"] = link_settings(self.name)
+
+        return self._settings["value"]
+
+
+def _address(msg):
+    prefixlen = msg["prefixlen"]
+    # For point-to-point links IFA_ADDRESS is the peer address
+    address = msg.get_attr("IFA_LOCAL") or msg.get_attr("IFA_ADDRESS")
+    if msg["family"] == socket.AF_INET:
+        return InterfaceAddress(AddressFamily.INET, ipaddress.IPv4Interface(f"{address}/{prefixlen}"))
+    if msg["family"] == socket.AF_INET6:
+        return InterfaceAddress(AddressFamily.INET6, ipaddress.IPv6Interface(f"{address}/{prefixlen}"))
+
+
+def _address_key(msg):
+    return msg["family"], msg.get_attr("IFA_LOCAL") or msg.get_attr("IFA_ADDRESS"), msg["prefixlen"]
+
+
+def _route_key(msg):
+    return (
+        msg["family"], msg.get_attr("RTA_TABLE") or msg["table"], msg["tos"], msg["type"], msg["dst_len"],
+        msg.get_attr("RTA_DST"), msg.get_attr("RTA_PRIORITY"), msg.get_attr("RTA_OIF"), msg.get_attr("RTA_GATEWAY"),
+    )
+
+
+class NetlinkStateCache:
+    """
+    In-memory model of links, addresses and routes.
+
+    It is seeded with a single dump and then kept current by RTNLGRP_LINK, RTNLGRP_IPV4_IFADDR,
+    RTNLGRP_IPV6_IFADDR, RTNLGRP_IPV4_ROUTE and RTNLGRP_IPV6_ROUTE notifications. Notifications are applied
+    before each read: the kernel queues them before acknowledging a change, so every change that has completed
+    (whether made by us or by another process) is visible.
+    """
+
+    GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_ROUTE
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.monitor = None
+        self.marshal = MarshalRtnl()
+        self.links = {}
+        self.addresses = {}
+        self.routes = {}
+        # IPv4 routes removed along with their link or address are not notified about
+        self.routes_stale = True
+        self.stats = {"seeds": 0, "events": 0}
+
+    def _seed(self):
+        if self.monitor is not None:
+            self.monitor.close()
+
+        # Subscribe before dumping, so nothing happening in between is missed. Replaying notifications that
+        # preceded the dump is harmless as long as their order is kept.
+        # A plain non-blocking socket is used as pyroute2 sockets buffer received messages internally which makes
+        # it impossible to tell whether there is anything left to read without blocking.
+        self.monitor = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC, socket.NETLINK_ROUTE,
+        )
+        try:
+            self.monitor.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, MONITOR_RCVBUF)
+        except OSError:
+            self.monitor.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MONITOR_RCVBUF)
+        self.monitor.bind((0, self.GROUPS))
+
+        with iproute() as ip:
+            links = ip.get_links()
+            addresses = ip.get_addr()
+
+        self.links = {}
+        self.addresses = {}
+        for msg in links:
+            self._apply(msg)
+        for msg in addresses:
+            self._apply(msg)
+        self._seed_routes()
+
+        self.stats["seeds"] += 1
+
+    def _seed_routes(self):
+        with iproute() as ip:
+            self.routes = {_route_key(msg): msg for msg in ip.get_routes()}
+
+        self.routes_stale = False
+
+    def _apply(self, msg):
+        event = msg["event"]
+        if event in ("RTM_NEWLINK", "RTM_DELLINK"):
+            if msg["family"] == socket.AF_BRIDGE:
+                # Bridge port state, the link itself did not change
+                return
+
+            if event == "RTM_NEWLINK":
+                self.links[msg["index"]] = Link(msg)
+                if not msg["flags"] & IFF_UP:
+                    self.routes_stale = True
+            else:
+                self.links.pop(msg["index"], None)
+                self.addresses.pop(msg["index"], None)
+                self.routes_stale = True
+        elif event == "RTM_NEWADDR":
+            self.addresses.setdefault(msg["index"], {})[_address_key(msg)] = msg
+        elif event == "RTM_DELADDR":
+            self.addresses.get(msg["index"], {}).pop(_address_key(msg), None)
+            self.routes_stale = True
+        elif event == "RTM_NEWROUTE":
+            self.routes[_route_key(msg)] = msg
+        elif event == "RTM_DELROUTE":
+            self.routes.pop(_route_key(msg), None)
+
+    def _update(self):
+        if self.monitor is None:
+            self._seed()
+            return
+
+        try:
+            while True:
+                try:
+                    data = self.monitor.recv(65536)
+                except BlockingIOError:
+                    break
+
+                for msg in self.marshal.parse(data):
+                    self.stats["events"] += 1
+                    self._apply(msg)
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+
+            logger.debug("Netlink notifications were lost, re-seeding interface state")
+            self._seed()
+
+    def dump(self, name=None):
+        """
+        Returns `{name: Link}` of all interfaces (or of interface `name` only) with their addresses, bridge/bond
+        members and VLAN parents resolved. Returned objects are copies, caller is free to keep them.
+        """
+        with self.lock:
+            self._update()
+
+            links = {idx: link.copy() for idx, link in self.links.items()}
+            addresses = [msg for link_addresses in self.addresses.values() for msg in link_addresses.values()]
+
+        for link in links.values():
+            if link.address:
+                link.addresses.append(InterfaceAddress(AddressFamily.LINK, LinkAddress(link.name, link.address)))
+            if link.master in links:
+                links[link.master].members.append(link.name)
+            if link.kind == "vlan" and link.link in links:
+                link.parent = links[link.link].name
+
+        inet = {}
+        for msg in addresses:
+            address = _address(msg)
+            if address is not None and msg["index"] in links:
+                inet.setdefault(msg["index"], []).append(address)
+        for idx, link_addresses in inet.items():
+            # Keep the ordering `netifaces` had: link address, IPv4 addresses, IPv6 addresses
+            links[idx].addresses.extend(sorted(link_addresses, key=lambda a: a.af != AddressFamily.INET))
+
+        if name is not None:
+            result = {link.name: link for link in links.values() if link.name == name}
+            if not result:
+                raise FileNotFoundError(f"Cannot find device {name!r}")
+
+            return result
+
+        return {link.name: link for link in links.values()}
+
+    def routes_with_interfaces(self):
+        """
+        Returns a list of RTM_NEWROUTE messages and `{index: name}` of all interfaces.
+        """
+        with self.lock:
+            self._update()
+            if self.routes_stale:
+                self._seed_routes()
+
+            return list(self.routes.values()), {idx: link.name for idx, link in self.links.items()}
+
+
+cache = NetlinkStateCache()
+
+
+def dump(name=None):
+    return cache.dump(name)
+
+
+def routes():
+    return cache.routes_with_interfaces()
+
+
+def index(ip, name):
+    try:
+        return ip.link_lookup(ifname=name)[0]
+    except IndexError:
+        raise FileNotFoundError(f"Cannot find device {name!r}") from None
+
+
+def link_add(name, kind, **kwargs):
+    with iproute() as ip:
+        if "link" in kwargs:
+            kwargs["link"] = index(ip, kwargs["link"])
+        ip.link("add", ifname=name, kind=kind, **kwargs)
+
+
+def link_set(name, **kwargs):
+    with iproute() as ip:
+        if kwargs.get("master"):
+            kwargs["master"] = index(ip, kwargs["master"])
+        ip.link("set", index=index(ip, name), **kwargs)
+
+
+def link_del(name):
+    with iproute() as ip:
+        ip.link("del", index=index(ip, name))
+
+
+def address_op(op, name, address, prefixlen):
+    with iproute() as ip:
+        ip.addr(op, index=index(ip, name), address=str(address), prefixlen=prefixlen)
+
+
+def link_settings(name):
+    """
+    Returns `{"speed": int or None, "autoneg": bool, "port": str or None}` or `None` if the driver does not
+    report link settings.
+    """
+    try:
+        with ethtool() as eth:
+            mode = eth.get_link_mode(name)
+            info = eth.get_link_info(name)
+    except Exception:
+        return None
+
+    return {"speed": mode.speed, "autoneg": mode.autoneg, "port": info.port}
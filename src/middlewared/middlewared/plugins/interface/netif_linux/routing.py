@@ -5,8 +5,8 @@ import logging
 import socket
 
 import bidict
-from pyroute2 import IPRoute
 
+from . import netlink
 from .address.ipv6 import ipv6_netmask_to_prefixlen
 from .address.types import AddressFamily
 
@@ -14,8 +14,6 @@ logger = logging.getLogger(__name__)
 
 __all__ = ["Route", "RouteFlags", "RoutingTable"]
 
-ip = IPRoute()
-
 
 class Route:
     def __init__(self, network, netmask, gateway=None, interface=None, flags=None):
@@ -89,10 +87,10 @@ RTM_F_CLONED = 0x200
 class RoutingTable:
     @property
     def routes(self):
-        interfaces = self._interfaces()
+        routes, interfaces = netlink.routes()
 
         result = []
-        for r in ip.get_routes():
+        for r in routes:
             if r["flags"] & RTM_F_CLONED:
                 continue
 
@@ -137,7 +135,7 @@ class RoutingTable:
     def delete(self, route):
         self._op("delete", route)
 
-    def _interfaces(self):
+    def _interfaces(self, ip):
         return bidict.bidict({i["index"]: dict(i["attrs"]).get("IFLA_IFNAME") for i in ip.get_links()})
 
     def _op(self, op, route):
@@ -150,7 +148,8 @@ class RoutingTable:
 
         kwargs = dict(dst=f"{route.network}/{prefixlen}",
                       gateway=str(route.gateway))
-        if route.interface is not None:
-            kwargs["oif"] = self._interfaces().inv[route.interface]
+        with netlink.iproute() as ip:
+            if route.interface is not None:
+                kwargs["oif"] = self._interfaces(ip).inv[route.interface]
 
-        ip.route(op, **kwargs)
+            ip.route(op, **kwargs)
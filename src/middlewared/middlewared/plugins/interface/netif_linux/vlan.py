@@ -7,6 +7,7 @@ import subprocess
 
 import middlewared.plugins.interface.netif_linux.interface as interface
 
+from . import netlink
 from .utils import run
 
 logger = logging.getLogger(__name__)
@@ -15,6 +16,11 @@ __all__ = ["create_vlan", "VlanMixin"]
 
 
 def create_vlan(name, parent, tag):
+    if netlink.available():
+        netlink.link_add(name, "vlan", link=parent, vlan_id=tag)
+        interface.Interface(name).up()
+        return
+
     try:
         run(["ip", "link", "add", "link", parent, "name", name, "type", "vlan", "id", str(tag)])
     except subprocess.CalledProcessError as e:
@@ -29,10 +35,16 @@ def create_vlan(name, parent, tag):
 class VlanMixin:
     @property
     def parent(self):
+        if self._netlink is not None:
+            return self._netlink.parent
+
         return os.path.basename(os.readlink(glob.glob(f"/sys/devices/virtual/net/{self.name}/lower_*")[0]))
 
     @property
     def tag(self):
+        if self._netlink is not None:
+            return self._netlink.vlan_id
+
         with open(f"/proc/net/vlan/{self.name}") as f:
             return int(re.search(r"VID: ([0-9]+)", f.read()).group(1))
 
@@ -44,4 +56,7 @@ class VlanMixin:
         create_vlan(self.name, parent, tag)
 
     def unconfigure(self):
-        run(["ip", "link", "delete", self.name])
+        if netlink.available():
+            netlink.link_del(self.name)
+        else:
+            run(["ip", "link", "delete", self.name])
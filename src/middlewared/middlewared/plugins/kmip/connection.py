@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
+import queue
 import socket
 import uuid
 
@@ -9,6 +11,40 @@ from kmip.pie.objects import SecretData
 
 from middlewared.service import CallError
 
+# Maximum number of connections opened to the KMIP server by a single key synchronization
+MAX_CONNECTIONS = 4
+
+
+class KMIPConnectionPool:
+    """
+    Runs KMIP operations concurrently over a fixed set of connections. A connection is only used by one operation
+    at a time.
+    """
+
+    def __init__(self, connections):
+        self.connections = queue.SimpleQueue()
+        for conn in connections:
+            self.connections.put(conn)
+        self.executor = ThreadPoolExecutor(len(connections))
+
+    def map(self, func, items):
+        """
+        Calls `func(item, conn)` for each of the `items`. Returns a list of `(result, exception)` in the same order.
+        """
+        return list(self.executor.map(lambda item: self._call(func, item), items))
+
+    def _call(self, func, item):
+        conn = self.connections.get()
+        try:
+            return func(item, conn), None
+        except Exception as e:
+            return None, e
+        finally:
+            self.connections.put(conn)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
 
 class KMIPServerMixin:
 
@@ -24,6 +60,15 @@ class KMIPServerMixin:
         except (ClientConnectionFailure, ClientConnectionNotOpen, socket.timeout) as e:
             raise CallError(f'Failed to connect to KMIP Server: {e}')
 
+    @contextlib.contextmanager
+    def _connection_pool(self, data=None, size=MAX_CONNECTIONS):
+        with contextlib.ExitStack() as stack:
+            pool = KMIPConnectionPool([stack.enter_context(self._connection(data)) for i in range(size)])
+            try:
+                yield pool
+            finally:
+                pool.shutdown()
+
     def _test_connection(self, data=None):
         # Test if we are able to connect to the KMIP Server
         try:
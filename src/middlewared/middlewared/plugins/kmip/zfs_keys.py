@@ -1,6 +1,30 @@
+import contextlib
+
 from middlewared.service import job, private, Service
 
-from .connection import KMIPServerMixin
+from .connection import KMIPServerMixin, MAX_CONNECTIONS
+
+# Number of datasets whose keys are synchronized before the progress is reported
+BATCH_SIZE = 100
+
+
+def batches(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class BatchProgress:
+    def __init__(self, job, total):
+        self.job = job
+        self.total = total
+        self.done = 0
+
+    def batch_done(self, batch):
+        self.done += len(batch)
+        if self.job:
+            self.job.set_progress(
+                int(self.done / self.total * 100), f'Processed {self.done}/{self.total} ZFS key operations'
+            )
 
 
 class KMIPService(Service, KMIPServerMixin):
@@ -22,75 +46,145 @@ class KMIPService(Service, KMIPServerMixin):
         return False
 
     @private
-    def push_zfs_keys(self, ids=None):
+    def zfs_dataset_names(self):
+        return {
+            ds['name'] for ds in self.middleware.call_sync(
+                'zfs.dataset.query', [], {'extra': {'retrieve_properties': False}, 'select': ['name']}
+            )
+        }
+
+    @private
+    def push_zfs_keys(self, ids=None, job=None):
         datasets = self.middleware.call_sync(
             'datastore.query', 'storage.encrypteddataset', [['id', 'in', ids]] if ids else []
         )
-        existing_datasets = {ds['name']: ds for ds in self.middleware.call_sync('pool.dataset.query')}
+        existing_datasets = self.zfs_dataset_names()
+        to_retrieve = []
+        to_register = []
+        for ds in filter(lambda d: d['name'] in existing_datasets, datasets):
+            if ds['encryption_key']:
+                self.zfs_keys[ds['name']] = ds['encryption_key']
+                to_register.append(ds)
+                continue
+
+            # We want to make sure we have the KMIP server's keys and in-memory keys in sync
+            try:
+                if ds['name'] in self.zfs_keys and self.middleware.call_sync(
+                    'zfs.dataset.check_key', ds['name'], {'key': self.zfs_keys[ds['name']]}
+                ):
+                    continue
+            except Exception as e:
+                self.middleware.logger.debug(f'Failed to retrieve key for {ds["name"]}: {e}')
+            else:
+                to_retrieve.append(ds)
+
         failed = []
-        with self._connection(self.middleware.call_sync('kmip.connection_config')) as conn:
-            for ds in filter(lambda d: d['name'] in existing_datasets, datasets):
-                if not ds['encryption_key']:
-                    # We want to make sure we have the KMIP server's keys and in-memory keys in sync
-                    try:
-                        if ds['name'] in self.zfs_keys and self.middleware.call_sync(
-                            'zfs.dataset.check_key', ds['name'], {'key': self.zfs_keys[ds['name']]}
-                        ):
-                            continue
+        updates = []
+        if to_retrieve or to_register:
+            progress = BatchProgress(job, len(to_retrieve) + len(to_register))
+            with self._connection_pool(
+                self.middleware.call_sync('kmip.connection_config'),
+                min(MAX_CONNECTIONS, len(to_retrieve) + len(to_register)),
+            ) as pool:
+                for batch in batches(to_retrieve):
+                    for ds, (key, error) in zip(
+                        batch, pool.map(lambda ds, conn: self._retrieve_secret_data(ds['kmip_uid'], conn), batch)
+                    ):
+                        if error:
+                            self.middleware.logger.debug(f'Failed to retrieve key for {ds["name"]}: {error}')
                         else:
-                            key = self._retrieve_secret_data(ds['kmip_uid'], conn)
-                    except Exception as e:
-                        self.middleware.logger.debug(f'Failed to retrieve key for {ds["name"]}: {e}')
-                    else:
-                        self.zfs_keys[ds['name']] = key
-                    continue
+                            self.zfs_keys[ds['name']] = key
+                    progress.batch_done(batch)
 
-                self.zfs_keys[ds['name']] = ds['encryption_key']
-                destroy_successful = False
-                if ds['kmip_uid']:
-                    # This needs to be revoked and destroyed
-                    destroy_successful = self._revoke_and_destroy_key(ds['kmip_uid'], conn, self.middleware.logger)
-                    if not destroy_successful:
-                        self.middleware.logger.debug(f'Failed to destroy key from KMIP Server for {ds["name"]}')
-                try:
-                    uid = self._register_secret_data(ds['name'], self.zfs_keys[ds['name']], conn)
-                except Exception:
-                    failed.append(ds['name'])
-                    update_data = {'kmip_uid': None} if destroy_successful else {}
-                else:
-                    update_data = {'encryption_key': None, 'kmip_uid': uid}
-                if update_data:
-                    self.middleware.call_sync('datastore.update', 'storage.encrypteddataset', ds['id'], update_data)
+                for batch in batches(to_register):
+                    for ds, (result, error) in zip(batch, pool.map(self._push_zfs_key, batch)):
+                        destroy_successful, uid = result or (False, None)
+                        if uid is None:
+                            failed.append(ds['name'])
+                            update_data = {'kmip_uid': None} if destroy_successful else {}
+                        else:
+                            update_data = {'encryption_key': None, 'kmip_uid': uid}
+                        if update_data:
+                            updates.append([ds['id'], update_data])
+                    progress.batch_done(batch)
+
+        if updates:
+            self.middleware.call_sync('datastore.update_many', 'storage.encrypteddataset', updates)
         self.zfs_keys = {k: v for k, v in self.zfs_keys.items() if k in existing_datasets}
         return failed
 
+    def _push_zfs_key(self, ds, conn):
+        destroy_successful = False
+        if ds['kmip_uid']:
+            # This needs to be revoked and destroyed
+            destroy_successful = self._revoke_and_destroy_key(ds['kmip_uid'], conn, self.middleware.logger)
+            if not destroy_successful:
+                self.middleware.logger.debug(f'Failed to destroy key from KMIP Server for {ds["name"]}')
+        try:
+            uid = self._register_secret_data(ds['name'], ds['encryption_key'], conn)
+        except Exception:
+            uid = None
+        return destroy_successful, uid
+
     @private
-    def pull_zfs_keys(self):
+    def pull_zfs_keys(self, job=None):
         datasets = self.middleware.call_sync('datastore.query', 'storage.encrypteddataset', [['kmip_uid', '!=', None]])
-        existing_datasets = {ds['name']: ds for ds in self.middleware.call_sync('pool.dataset.query')}
+        existing_datasets = self.zfs_dataset_names()
         failed = []
         connection_successful = self.middleware.call_sync('kmip.test_connection')
+        keys = {}
+        to_retrieve = []
         for ds in filter(lambda d: d['name'] in existing_datasets, datasets):
             try:
                 if ds['encryption_key']:
-                    key = ds['encryption_key']
+                    keys[ds['name']] = ds['encryption_key']
                 elif ds['name'] in self.zfs_keys and self.middleware.call_sync(
                     'zfs.dataset.check_key', ds['name'], {'key': self.zfs_keys[ds['name']]}
                 ):
-                    key = self.zfs_keys[ds['name']]
+                    keys[ds['name']] = self.zfs_keys[ds['name']]
                 elif connection_successful:
-                    with self._connection(self.middleware.call_sync('kmip.connection_config')) as conn:
-                        key = self._retrieve_secret_data(ds['kmip_uid'], conn)
+                    to_retrieve.append(ds)
                 else:
                     raise Exception('Failed to sync dataset')
             except Exception:
                 failed.append(ds['name'])
-            else:
-                update_data = {'encryption_key': key, 'kmip_uid': None}
-                self.middleware.call_sync('datastore.update', 'storage.encrypteddataset', ds['id'], update_data)
+
+        pulled = [ds for ds in datasets if ds['name'] in keys] + to_retrieve
+        with contextlib.ExitStack() as stack:
+            if connection_successful and pulled:
+                # Keys are retrieved and then destroyed
+                progress = BatchProgress(job, len(to_retrieve) + len(pulled))
+                pool = stack.enter_context(self._connection_pool(
+                    self.middleware.call_sync('kmip.connection_config'), min(MAX_CONNECTIONS, len(pulled)),
+                ))
+                for batch in batches(to_retrieve):
+                    for ds, (key, error) in zip(
+                        batch, pool.map(lambda ds, conn: self._retrieve_secret_data(ds['kmip_uid'], conn), batch)
+                    ):
+                        if error:
+                            failed.append(ds['name'])
+                        else:
+                            keys[ds['name']] = key
+                    progress.batch_done(batch)
+
+            pulled = [ds for ds in pulled if ds['name'] in keys]
+            if pulled:
+                self.middleware.call_sync('datastore.update_many', 'storage.encrypteddataset', [
+                    [ds['id'], {'encryption_key': keys[ds['name']], 'kmip_uid': None}] for ds in pulled
+                ])
+            for ds in pulled:
                 self.zfs_keys.pop(ds['name'], None)
-                if connection_successful:
-                    self.middleware.call_sync('kmip.delete_kmip_secret_data', ds['kmip_uid'])
+
+            if connection_successful and pulled:
+                # Keys that failed to be retrieved are not destroyed
+                progress.total = progress.done + len(pulled)
+                for batch in batches(pulled):
+                    pool.map(
+                        lambda ds, conn: self._revoke_and_destroy_key(ds['kmip_uid'], conn, self.middleware.logger),
+                        batch,
+                    )
+                    progress.batch_done(batch)
+
         self.zfs_keys = {k: v for k, v in self.zfs_keys.items() if k in existing_datasets}
         return failed
 
@@ -103,11 +197,11 @@ class KMIPService(Service, KMIPServerMixin):
         conn_successful = self.middleware.call_sync('kmip.test_connection', None, True)
         if config['enabled'] and config['manage_zfs_keys']:
             if conn_successful:
-                failed = self.push_zfs_keys(ids)
+                failed = self.push_zfs_keys(ids, job)
             else:
                 return
         else:
-            failed = self.pull_zfs_keys()
+            failed = self.pull_zfs_keys(job)
         if failed:
             self.middleware.call_sync(
                 'alert.oneshot_create', 'KMIPZFSDatasetsSyncFailure', {'datasets': ','.join(failed)}
@@ -131,17 +225,31 @@ class KMIPService(Service, KMIPServerMixin):
     @private
     def initialize_zfs_keys(self, connection_success):
         locked_datasets = [ds['id'] for ds in self.middleware.call_sync('zfs.dataset.locked_datasets')]
-        for ds in self.middleware.call_sync('datastore.query', 'storage.encrypteddataset',):
+        datasets = self.middleware.call_sync('datastore.query', 'storage.encrypteddataset')
+        to_retrieve = []
+        for ds in datasets:
             if ds['encryption_key']:
                 self.zfs_keys[ds['name']] = ds['encryption_key']
             elif ds['kmip_uid'] and connection_success:
-                try:
-                    with self._connection(self.middleware.call_sync('kmip.connection_config')) as conn:
-                        key = self._retrieve_secret_data(ds['kmip_uid'], conn)
-                except Exception:
-                    self.middleware.logger.debug(f'Failed to retrieve key for {ds["name"]}')
-                else:
-                    self.zfs_keys[ds['name']] = key
+                to_retrieve.append(ds)
+
+        if to_retrieve:
+            try:
+                with self._connection_pool(
+                    self.middleware.call_sync('kmip.connection_config'), min(MAX_CONNECTIONS, len(to_retrieve)),
+                ) as pool:
+                    for batch in batches(to_retrieve):
+                        for ds, (key, error) in zip(
+                            batch, pool.map(lambda ds, conn: self._retrieve_secret_data(ds['kmip_uid'], conn), batch)
+                        ):
+                            if error:
+                                self.middleware.logger.debug(f'Failed to retrieve key for {ds["name"]}')
+                            else:
+                                self.zfs_keys[ds['name']] = key
+            except Exception as e:
+                self.middleware.logger.debug(f'Failed to retrieve ZFS keys from KMIP server: {e}')
+
+        for ds in datasets:
             if ds['name'] in self.zfs_keys and ds['name'] in locked_datasets:
                 self.middleware.call_sync('pool.dataset.unlock', ds['name'])
 
@@ -1,4 +1,5 @@
 import asyncio
+import datetime
 import enum
 import errno
 import fcntl
@@ -10,6 +11,7 @@ import pwd
 import socket
 import struct
 import sys
+import time
 
 from ldap.controls import SimplePagedResultsControl
 from urllib.parse import urlparse
@@ -18,11 +20,16 @@ from middlewared.service import job, private, ConfigService, ValidationErrors
 from middlewared.service_exception import CallError
 import middlewared.sqlalchemy as sa
 from middlewared.utils import run
+from middlewared.plugins.cache_.dscache_store import group_entry, user_entry
 from middlewared.plugins.directoryservices import DSStatus, SSL
 
 
 _int32 = struct.Struct('!i')
 
+LDAP_GENERALIZED_TIME = '%Y%m%d%H%M%SZ'
+LDAP_CLOCK_SKEW = datetime.timedelta(minutes=10)
+LDAP_CACHE_ID_BASE = 100000000
+
 
 class NlscdConst(enum.Enum):
     NSLCD_CONF_PATH = '/usr/local/etc/nslcd.conf'
@@ -271,7 +278,7 @@ class LDAPQuery(object):
             self._handle.unbind()
             self._handle = None
 
-    def _search(self, basedn='', scope=pyldap.SCOPE_SUBTREE, filter='', timeout=-1, sizelimit=0):
+    def _search(self, basedn='', scope=pyldap.SCOPE_SUBTREE, filter='', timeout=-1, sizelimit=0, attrlist=None):
         if not self._handle:
             self._open()
 
@@ -293,7 +300,7 @@ class LDAPQuery(object):
                 basedn,
                 scope,
                 filterstr=filter,
-                attrlist=None,
+                attrlist=attrlist,
                 attrsonly=0,
                 serverctrls=serverctrls,
                 clientctrls=clientctrls,
@@ -384,6 +391,17 @@ class LDAPQuery(object):
         results = self._search(dn, pyldap.SCOPE_SUBTREE, filter)
         return self.parse_results(results)
 
+    def get_modified_accounts(self, since):
+        """
+        Returns posixAccount and posixGroup entries modified at or after `since` (LDAP GeneralizedTime).
+        """
+        if not self._handle:
+            self._open()
+        filter = f'(&(|(objectclass=posixAccount)(objectclass=posixGroup))(modifyTimestamp>={since}))'
+        results = self._search(self.ldap['basedn'], pyldap.SCOPE_SUBTREE, filter,
+                               attrlist=['objectClass', 'uid', 'cn', 'modifyTimestamp'])
+        return self.parse_results(results)
+
 
 class LDAPModel(sa.Model):
     __tablename__ = 'directoryservice_ldap'
@@ -943,83 +961,89 @@ class LDAPService(ConfigService):
             await self.middleware.call('service.restart', 'cifs')
             await self.middleware.call('smb.synchronize_passdb')
             await self.middleware.call('smb.synchronize_group_mappings')
-        await self.middleware.call('cache.pop', 'LDAP_cache')
+        await self.middleware.call('dscache.clear', 'ldap')
         await self.nslcd_cmd('onestop')
         await self.set_state(DSStatus['DISABLED'])
 
     @private
     @job(lock='fill_ldap_cache')
     def fill_cache(self, job, force=False):
-        user_next_index = group_next_index = 100000000
-        cache_data = {'users': {}, 'groups': {}}
-
-        if self.middleware.call_sync('cache.has_key', 'LDAP_cache') and not force:
-            raise CallError('LDAP cache already exists. Refusing to generate cache.')
-
-        self.middleware.call_sync('cache.pop', 'LDAP_cache')
-
+        """
+        Updates users and groups cache with entries modified since the last update. Full refresh (that also
+        removes users and groups that no longer exist) is done if `force` is set or if the cache is empty.
+        """
         if (self.middleware.call_sync('ldap.config'))['disable_freenas_cache']:
-            self.middleware.call_sync('cache.put', 'LDAP_cache', cache_data)
+            self.middleware.call_sync('dscache.clear', 'ldap')
+            self.middleware.call_sync('dscache.set_meta', 'ldap', 'filled', time.time())
             self.logger.debug('LDAP cache is disabled. Bypassing cache fill.')
             return
 
-        pwd_list = pwd.getpwall()
-        grp_list = grp.getgrall()
-
-        local_uid_list = list(u['uid'] for u in self.middleware.call_sync('user.query'))
-        local_gid_list = list(g['gid'] for g in self.middleware.call_sync('group.query'))
-
-        for u in pwd_list:
-            is_local_user = True if u.pw_uid in local_uid_list else False
-            if is_local_user:
-                continue
-
-            cache_data['users'].update({u.pw_name: {
-                'id': user_next_index,
-                'uid': u.pw_uid,
-                'username': u.pw_name,
-                'unixhash': None,
-                'smbhash': None,
-                'group': {},
-                'home': '',
-                'shell': '',
-                'full_name': u.pw_gecos,
-                'builtin': False,
-                'email': '',
-                'password_disabled': False,
-                'locked': False,
-                'sudo': False,
-                'microsoft_account': False,
-                'attributes': {},
-                'groups': [],
-                'sshpubkey': None,
-                'local': False
-            }})
-            user_next_index += 1
-
-        for g in grp_list:
-            is_local_user = True if g.gr_gid in local_gid_list else False
-            if is_local_user:
-                continue
-
-            cache_data['groups'].update({g.gr_name: {
-                'id': group_next_index,
-                'gid': g.gr_gid,
-                'group': g.gr_name,
-                'builtin': False,
-                'sudo': False,
-                'users': [],
-                'local': False
-            }})
-            group_next_index += 1
-
-        self.middleware.call_sync('cache.put', 'LDAP_cache', cache_data)
-        self.middleware.call_sync('dscache.backup')
+        since = self.middleware.call_sync('dscache.get_meta', 'ldap', 'modify_timestamp')
+        if not force and since is not None and self.middleware.call_sync('dscache.is_filled', 'ldap'):
+            try:
+                self.update_cache(since)
+                return
+            except Exception:
+                self.logger.warning('Incremental LDAP cache update failed, refreshing the whole cache.',
+                                    exc_info=True)
+
+        # Entries modified while the cache is being filled will be re-read by the next incremental update.
+        # Allow for some clock skew between us and LDAP server.
+        since = (datetime.datetime.utcnow() - LDAP_CLOCK_SKEW).strftime(LDAP_GENERALIZED_TIME)
+
+        local_uids = {u['uid'] for u in self.middleware.call_sync('user.query')}
+        local_gids = {g['gid'] for g in self.middleware.call_sync('group.query')}
+
+        users = [user_entry(u) for u in pwd.getpwall() if u.pw_uid not in local_uids]
+        groups = [group_entry(g) for g in grp.getgrall() if g.gr_gid not in local_gids]
+
+        self.middleware.call_sync('dscache.update_entries', 'ldap', 'USERS', users, None, True, LDAP_CACHE_ID_BASE)
+        self.middleware.call_sync('dscache.update_entries', 'ldap', 'GROUPS', groups, None, True, LDAP_CACHE_ID_BASE)
+        self.middleware.call_sync('dscache.set_meta', 'ldap', 'modify_timestamp', since)
+        self.middleware.call_sync('dscache.set_meta', 'ldap', 'filled', time.time())
+
+    @private
+    def update_cache(self, since):
+        ldap = self.middleware.call_sync('ldap.config')
+        with LDAPQuery(conf=ldap, logger=self.logger, hosts=ldap['uri_list']) as LDAP:
+            modified = LDAP.get_modified_accounts(since)
+
+        local_uids = {u['uid'] for u in self.middleware.call_sync('user.query')}
+        local_gids = {g['gid'] for g in self.middleware.call_sync('group.query')}
+
+        users, deleted_users, groups, deleted_groups = [], [], [], []
+        for entry in modified:
+            data = entry['data']
+            object_classes = {oc.lower() for oc in data.get('objectClass', [])}
+            since = max([since] + data.get('modifyTimestamp', []))
+
+            if 'posixaccount' in object_classes and data.get('uid'):
+                try:
+                    u = pwd.getpwnam(data['uid'][0])
+                except KeyError:
+                    deleted_users.append(data['uid'][0])
+                else:
+                    if u.pw_uid not in local_uids:
+                        users.append(user_entry(u))
+
+            if 'posixgroup' in object_classes and data.get('cn'):
+                try:
+                    g = grp.getgrnam(data['cn'][0])
+                except KeyError:
+                    deleted_groups.append(data['cn'][0])
+                else:
+                    if g.gr_gid not in local_gids:
+                        groups.append(group_entry(g))
+
+        self.middleware.call_sync('dscache.update_entries', 'ldap', 'USERS', users, deleted_users, False, LDAP_CACHE_ID_BASE)
+        self.middleware.call_sync('dscache.update_entries', 'ldap', 'GROUPS', groups, deleted_groups, False,
+                                  LDAP_CACHE_ID_BASE)
+        self.middleware.call_sync('dscache.set_meta', 'ldap', 'modify_timestamp', since)
 
     @private
     async def get_cache(self):
-        if not await self.middleware.call('cache.has_key', 'LDAP_cache'):
+        if not await self.middleware.call('dscache.is_filled', 'ldap'):
             await self.middleware.call('ldap.fill_cache')
             self.logger.debug('cache fill is in progress.')
             return {'users': {}, 'groups': {}}
-        return await self.middleware.call('cache.get', 'LDAP_cache')
+        return await self.middleware.call('dscache.get_entries', 'ldap')
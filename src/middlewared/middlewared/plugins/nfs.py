@@ -263,7 +263,7 @@ class SharingNFSService(SharingService):
     @private
     async def sharing_task_determine_locked(self, data, locked_datasets):
         for path in data[self.path_field]:
-            if await self.middleware.call('pool.dataset.path_in_locked_datasets', path, locked_datasets):
+            if await self.middleware.call('pool.dataset.path_in_locked_datasets', path):
                 return True
         else:
             return False
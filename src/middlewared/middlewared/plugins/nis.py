@@ -2,14 +2,18 @@ import asyncio
 import errno
 import pwd
 import grp
+import time
 
 from middlewared.schema import accepts, Bool, Dict, List, Str
 from middlewared.service import job, private, ConfigService
 from middlewared.service_exception import CallError
 import middlewared.sqlalchemy as sa
 from middlewared.utils import run
+from middlewared.plugins.cache_.dscache_store import group_entry, user_entry
 from middlewared.plugins.directoryservices import DSStatus
 
+NIS_CACHE_ID_BASE = 200000000
+
 
 class NISModel(sa.Model):
     __tablename__ = 'directoryservice_nis'
@@ -198,69 +202,24 @@ class NISService(ConfigService):
     @private
     @job(lock=lambda args: 'fill_nis_cache')
     def fill_cache(self, job, force=False):
-        user_next_index = group_next_index = 200000000
-        if self.middleware.call_sync('cache.has_key', 'NIS_cache') and not force:
-            raise CallError('NIS cache already exists. Refusing to generate cache.')
-
-        self.middleware.call_sync('cache.pop', 'NIS_cache')
-        pwd_list = pwd.getpwall()
-        grp_list = grp.getgrall()
-
-        local_uid_list = list(u['uid'] for u in self.middleware.call_sync('user.query'))
-        local_gid_list = list(g['gid'] for g in self.middleware.call_sync('group.query'))
-        cache_data = {'users': [], 'groups': []}
-
-        for u in pwd_list:
-            is_local_user = True if u.pw_uid in local_uid_list else False
-            if is_local_user:
-                continue
-
-            cache_data['users'].append({u.pw_name: {
-                'id': user_next_index,
-                'uid': u.pw_uid,
-                'username': u.pw_name,
-                'unixhash': None,
-                'smbhash': None,
-                'group': {},
-                'home': '',
-                'shell': '',
-                'full_name': u.pw_gecos,
-                'builtin': False,
-                'email': '',
-                'password_disabled': False,
-                'locked': False,
-                'sudo': False,
-                'microsoft_account': False,
-                'attributes': {},
-                'groups': [],
-                'sshpubkey': None,
-                'local': False
-            }})
-            user_next_index += 1
-
-        for g in grp_list:
-            is_local_user = True if g.gr_gid in local_gid_list else False
-            if is_local_user:
-                continue
-
-            cache_data['groups'].append({g.gr_name: {
-                'id': group_next_index,
-                'gid': g.gr_gid,
-                'group': g.gr_name,
-                'builtin': False,
-                'sudo': False,
-                'users': [],
-                'local': False
-            }})
-            group_next_index += 1
-
-        self.middleware.call_sync('cache.put', 'NIS_cache', cache_data)
-        self.middleware.call_sync('dscache.backup')
+        """
+        NIS maps have no modification timestamps so the cache is always compared with the whole maps, only the
+        entries that changed are written.
+        """
+        local_uids = {u['uid'] for u in self.middleware.call_sync('user.query')}
+        local_gids = {g['gid'] for g in self.middleware.call_sync('group.query')}
+
+        users = [user_entry(u) for u in pwd.getpwall() if u.pw_uid not in local_uids]
+        groups = [group_entry(g) for g in grp.getgrall() if g.gr_gid not in local_gids]
+
+        self.middleware.call_sync('dscache.update_entries', 'nis', 'USERS', users, None, True, NIS_CACHE_ID_BASE)
+        self.middleware.call_sync('dscache.update_entries', 'nis', 'GROUPS', groups, None, True, NIS_CACHE_ID_BASE)
+        self.middleware.call_sync('dscache.set_meta', 'nis', 'filled', time.time())
 
     @private
     async def get_cache(self):
-        if not await self.middleware.call('cache.has_key', 'NIS_cache'):
+        if not await self.middleware.call('dscache.is_filled', 'nis'):
             await self.middleware.call('nis.fill_cache')
             self.logger.debug('cache fill is in progress.')
-            return {'users': [], 'groups': []}
-        return await self.middleware.call('cache.get', 'nis_cache')
+            return {'users': {}, 'groups': {}}
+        return await self.middleware.call('dscache.get_entries', 'nis')
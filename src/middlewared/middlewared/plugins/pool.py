@@ -31,7 +31,6 @@ from middlewared.service_exception import ValidationError
 import middlewared.sqlalchemy as sa
 from middlewared.utils import osc, Popen, filter_list, run, start_daemon_thread
 from middlewared.utils.asyncio_ import asyncio_map
-from middlewared.utils.path import is_child
 from middlewared.utils.shell import join_commandline
 from middlewared.validators import Exact, Match, Or, Range, Time
 
@@ -249,6 +248,7 @@ class PoolService(CRUDService):
     class Config:
         datastore = 'storage.volume'
         datastore_extend = 'pool.pool_extend'
+        datastore_extend_context = 'pool.pool_extend_context'
         datastore_prefix = 'vol_'
 
     @item_method
@@ -393,19 +393,18 @@ class PoolService(CRUDService):
         )
         return True
 
-    def _topology(self, x, options=None):
+    def _topology(self, x, context):
         """
         Transform topology output from libzfs to add `device` and make `type` uppercase.
         """
-        options = options or {}
         if isinstance(x, dict):
             path = x.get('path')
             if path is not None:
                 device = disk = None
                 if path.startswith('/dev/'):
-                    args = [path[5:]] + ([] if osc.IS_LINUX else [options.get('geom_scan', True)])
-                    device = self.middleware.call_sync('disk.label_to_dev', *args)
-                    disk = self.middleware.call_sync('disk.label_to_disk', *args)
+                    label = context['labels'].get(path[5:]) or {}
+                    device = label.get('dev')
+                    disk = label.get('disk')
                 x['device'] = device
                 x['disk'] = disk
 
@@ -413,19 +412,36 @@ class PoolService(CRUDService):
             if guid is not None:
                 unavail_disk = None
                 if x.get('status') == 'UNAVAIL':
-                    unavail_disk = self.middleware.call_sync('disk.disk_by_zfs_guid', guid)
+                    unavail_disk = context['unavail_disks'].get(guid)
                 x['unavail_disk'] = unavail_disk
 
             for key in x:
                 if key == 'type' and isinstance(x[key], str):
                     x[key] = x[key].upper()
                 else:
-                    x[key] = self._topology(x[key], {'geom_scan': False})
+                    x[key] = self._topology(x[key], context)
         elif isinstance(x, list):
             for i, entry in enumerate(x):
-                x[i] = self._topology(x[i], {'geom_scan': False})
+                x[i] = self._topology(x[i], context)
         return x
 
+    def _topology_collect(self, x, labels, unavail_guids):
+        """
+        Collect device labels and UNAVAIL vdev guids from libzfs topology output so they can be
+        resolved in bulk.
+        """
+        if isinstance(x, dict):
+            path = x.get('path')
+            if isinstance(path, str) and path.startswith('/dev/'):
+                labels.add(path[5:])
+            if x.get('guid') is not None and x.get('status') == 'UNAVAIL':
+                unavail_guids.add(x['guid'])
+            for v in x.values():
+                self._topology_collect(v, labels, unavail_guids)
+        elif isinstance(x, list):
+            for entry in x:
+                self._topology_collect(entry, labels, unavail_guids)
+
     @private
     def flatten_topology(self, topology):
         d = deque(sum(topology.values(), []))
@@ -437,23 +453,43 @@ class PoolService(CRUDService):
         return result
 
     @private
-    def pool_extend(self, pool):
+    def pool_extend_context(self, extra):
+        """
+        Retrieve the state of all imported pools at once and resolve all their vdevs labels and
+        UNAVAIL vdevs guids with a single bulk lookup each.
+        """
+        try:
+            zpools = {zpool['name']: zpool for zpool in self.middleware.call_sync('zfs.pool.query')}
+        except Exception:
+            self.logger.warning('Failed to query imported pools', exc_info=True)
+            zpools = {}
+
+        labels = set()
+        unavail_guids = set()
+        for zpool in zpools.values():
+            self._topology_collect(zpool['groups'], labels, unavail_guids)
+
+        return {
+            'zpools': zpools,
+            'labels': self.middleware.call_sync('disk.label_to_dev_disk_cache', list(labels)) if labels else {},
+            'unavail_disks': self.middleware.call_sync('disk.disks_by_zfs_guids', list(unavail_guids)),
+        }
+
+    @private
+    def pool_extend(self, pool, context):
 
         """
         If pool is encrypted we need to check if the pool is imported
         or if all geli providers exist.
         """
         pool['path'] = f'/mnt/{pool["name"]}'
-        try:
-            zpool = self.middleware.call_sync('zfs.pool.query', [('id', '=', pool['name'])])[0]
-        except Exception:
-            zpool = None
+        zpool = context['zpools'].get(pool['name'])
 
         if zpool:
             pool.update({
                 'status': zpool['status'],
                 'scan': zpool['scan'],
-                'topology': self._topology(zpool['groups']),
+                'topology': self._topology(zpool['groups'], context),
                 'healthy': zpool['healthy'],
                 'status_detail': zpool['status_detail'],
             })
@@ -2123,6 +2159,7 @@ class PoolDatasetService(CRUDService):
 
         try:
             await self.middleware.call('cache.put', 'about_to_lock_dataset', id)
+            await self.middleware.call('pool.dataset.locked_index_rebuild')
 
             coroutines = [detach(dg) for dg in self.attachment_delegates]
             await asyncio.gather(*coroutines)
@@ -2134,6 +2171,7 @@ class PoolDatasetService(CRUDService):
             )
         finally:
             await self.middleware.call('cache.pop', 'about_to_lock_dataset')
+            await self.middleware.call('pool.dataset.locked_index_rebuild')
 
         await self.middleware.call_hook('dataset.post_lock', id)
 
@@ -2225,6 +2263,7 @@ class PoolDatasetService(CRUDService):
 
         failed = defaultdict(lambda: dict({'error': None, 'skipped': []}))
         unlocked = []
+        key_loaded = []
         for name in sorted(
             filter(
                 lambda n: n and f'{n}/'.startswith(f'{id}/') and datasets[n]['locked'],
@@ -2254,6 +2293,8 @@ class PoolDatasetService(CRUDService):
             except CallError as e:
                 failed[name]['error'] = 'Invalid Key' if 'incorrect key provided' in str(e).lower() else str(e)
             else:
+                key_loaded.append(name)
+
                 # Before we mount the dataset in question, we should ensure that the path where it will be mounted
                 # is not already being used by some other service/share. In this case, we should simply rename the
                 # directory where it will be mounted
@@ -2271,6 +2312,10 @@ class PoolDatasetService(CRUDService):
                 else:
                     unlocked.append(name)
 
+        if key_loaded:
+            # Attachments are looked up by their locked state, so the index must not list these datasets anymore
+            self.middleware.call_sync('pool.dataset.locked_index_remove', key_loaded)
+
         if options['toggle_attachments']:
             self.middleware.call_sync(
                 'pool.dataset.restart_attachment_services_on_unlock',
@@ -2605,12 +2650,6 @@ class PoolDatasetService(CRUDService):
 
         return data
 
-    @private
-    def path_in_locked_datasets(self, path, locked_datasets=None):
-        if locked_datasets is None:
-            locked_datasets = self.middleware.call_sync('zfs.dataset.locked_datasets')
-        return any(is_child(path, d['mountpoint']) for d in locked_datasets if d['mountpoint'])
-
     @filterable
     def query(self, filters=None, options=None):
         """
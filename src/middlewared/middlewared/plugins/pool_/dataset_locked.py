@@ -0,0 +1,115 @@
+import asyncio
+import os
+
+from middlewared.service import private, Service
+from middlewared.utils.path import is_child
+
+
+class LockedPathTrie:
+    """
+    Mountpoint prefix trie of locked datasets.
+
+    Answers whether a path resides within a locked dataset in O(path depth).
+    """
+
+    def __init__(self, locked_datasets=None):
+        self.root = {}
+        self.datasets = []
+        for ds in (locked_datasets or []):
+            self.insert(ds)
+
+    @staticmethod
+    def _components(path):
+        return [c for c in os.path.normpath(path).split('/') if c]
+
+    def insert(self, ds):
+        self.datasets.append(ds)
+        if not ds['mountpoint']:
+            return
+
+        node = self.root
+        for component in self._components(ds['mountpoint']):
+            node = node.setdefault(component, {})
+        node[None] = ds['id']
+
+    def lookup(self, path):
+        """
+        Returns the name of the locked dataset `path` resides in or `None`.
+        """
+        node = self.root
+        if None in node:
+            return node[None]
+
+        for component in self._components(path):
+            node = node.get(component)
+            if node is None:
+                return None
+            if None in node:
+                return node[None]
+
+        return None
+
+
+class PoolDatasetService(Service):
+
+    locked_index = LockedPathTrie()
+    locked_index_lock = None
+
+    class Config:
+        namespace = 'pool.dataset'
+
+    @private
+    async def locked_index_rebuild(self):
+        """
+        Re-seed locked datasets index from libzfs. Called on dataset lock/unlock, key change, dataset
+        deletion and pool import/export.
+        """
+        async with self._locked_index_lock():
+            PoolDatasetService.locked_index = LockedPathTrie(
+                await self.middleware.call('zfs.dataset.locked_datasets')
+            )
+
+    @private
+    async def locked_index_remove(self, names):
+        """
+        Remove datasets whose keys have been loaded from the index. Called on unlock before the attachments of
+        unlocked datasets are started, regardless of whether the datasets could be mounted.
+        """
+        async with self._locked_index_lock():
+            PoolDatasetService.locked_index = LockedPathTrie([
+                ds for ds in self.locked_index.datasets if ds['id'] not in names
+            ])
+
+    def _locked_index_lock(self):
+        if PoolDatasetService.locked_index_lock is None:
+            PoolDatasetService.locked_index_lock = asyncio.Lock()
+
+        return PoolDatasetService.locked_index_lock
+
+    @private
+    def locked_datasets_cached(self):
+        """
+        Returns the same data as `zfs.dataset.locked_datasets` without querying libzfs.
+        """
+        return list(self.locked_index.datasets)
+
+    @private
+    def path_in_locked_datasets(self, path, locked_datasets=None):
+        if locked_datasets is None:
+            return self.locked_index.lookup(path) is not None
+
+        return any(is_child(path, d['mountpoint']) for d in locked_datasets if d['mountpoint'])
+
+
+async def rebuild_hook(middleware, *args, **kwargs):
+    await middleware.call('pool.dataset.locked_index_rebuild')
+
+
+async def setup(middleware):
+    # `pool.dataset.lock` rebuilds the index itself as it needs to account for the dataset being locked
+    for hook in (
+        'dataset.post_unlock', 'dataset.post_delete', 'dataset.change_key', 'pool.post_import', 'pool.post_export',
+    ):
+        middleware.register_hook(hook, rebuild_hook)
+
+    asyncio.ensure_future(middleware.call('pool.dataset.locked_index_rebuild'))
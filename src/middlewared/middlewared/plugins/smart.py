@@ -6,7 +6,7 @@ from itertools import chain
 
 import asyncio
 
-from middlewared.common.smart.smartctl import SMARTCTL_POWERMODES, get_smartctl_args, smartctl
+from middlewared.common.smart.smartctl import SMARTCTL_POWERMODES
 from middlewared.schema import accepts, Bool, Cron, Dict, Int, List, Patch, Str
 from middlewared.validators import Range
 from middlewared.service import (
@@ -20,85 +20,71 @@ from middlewared.utils.asyncio_ import asyncio_map
 RE_TIME_DETAILS = re.compile(r'test will complete after(.*)', re.IGNORECASE)
 
 
-async def annotate_disk_smart_tests(middleware, devices, disk):
+async def annotate_disk_smart_tests(middleware, disk):
     if disk["disk"] is None:
         return
 
-    args = await get_smartctl_args(middleware, devices, disk["disk"])
-    if args:
-        p = await smartctl(args + ["-l", "selftest"], check=False, encoding="utf8")
-        tests = parse_smart_selftest_results(p.stdout)
+    data = await middleware.call("disk.smart_data", disk["disk"])
+    if data is not None:
+        tests = parse_smart_selftest_results(data)
         if tests is not None:
             return dict(tests=tests, **disk)
 
 
-def parse_smart_selftest_results(stdout):
+def parse_smart_selftest_results(data):
+    """
+    Returns self-test log from parsed `smartctl -j -a` output or `None` if it does not contain one.
+    """
     tests = []
 
     # ataprint.cpp
-    if "LBA_of_first_error" in stdout:
-        for line in stdout.split("\n"):
-            if not line.startswith("#"):
-                continue
-
+    if "ata_smart_self_test_log" in data:
+        for i, entry in enumerate(data["ata_smart_self_test_log"].get("standard", {}).get("table", [])):
             test = {
-                "num": int(line[1:3].strip()),
-                "description": line[5:24].strip(),
-                "status_verbose": line[25:54].strip(),
-                "remaining": int(line[55:57]) / 100,
-                "lifetime": int(line[60:68].strip()),
-                "lba_of_first_error": line[77:].strip(),
+                "num": i + 1,
+                "description": entry["type"]["string"],
+                "status_verbose": entry["status"]["string"],
+                "remaining": entry["status"].get("remaining_percent", 0) / 100,
+                "lifetime": entry["lifetime_hours"],
+                "lba_of_first_error": str(entry["lba"]) if "lba" in entry else None,
             }
 
-            if test["status_verbose"] == "Completed without error":
+            if entry["status"].get("passed"):
                 test["status"] = "SUCCESS"
-            elif test["status_verbose"] == "Self-test routine in progress":
+            elif entry["status"]["value"] >> 4 == 0xf:
                 test["status"] = "RUNNING"
             else:
                 test["status"] = "FAILED"
 
-            if test["lba_of_first_error"] == "-":
-                test["lba_of_first_error"] = None
-
             tests.append(test)
 
         return tests
 
     # scsiprint.cpp
-    if "LBA_first_err" in stdout:
-        for line in stdout.split("\n"):
-            if not line.startswith("#"):
-                continue
+    if "scsi_self_test_0" in data:
+        i = 0
+        while f"scsi_self_test_{i}" in data:
+            entry = data[f"scsi_self_test_{i}"]
+            i += 1
 
             test = {
-                "num": int(line[1:3].strip()),
-                "description": line[5:20].strip(),
-                "status_verbose": line[23:48].strip(),
-                "segment_number": line[49:52].strip(),
-                "lifetime": line[55:60].strip(),
-                "lba_of_first_error": line[60:78].strip(),
+                "num": i,
+                "description": entry["code"]["string"],
+                "status_verbose": entry["result"]["string"],
+                "segment_number": entry.get("failed_segment", {}).get("value"),
+                "lifetime": entry.get("power_on_time", {}).get("hours"),
+                "lba_of_first_error": (
+                    str(entry["lba_first_failure"]["value"]) if "lba_first_failure" in entry else None
+                ),
             }
 
-            if test["status_verbose"] == "Completed":
+            if entry["result"]["value"] == 0:
                 test["status"] = "SUCCESS"
-            elif test["status_verbose"] == "Self test in progress ...":
+            elif entry["result"]["value"] == 15:
                 test["status"] = "RUNNING"
             else:
                 test["status"] = "FAILED"
 
-            if test["segment_number"] == "-":
-                test["segment_number"] = None
-            else:
-                test["segment_number"] = int(test["segment_number"])
-
-            if test["lifetime"] == "NOW":
-                test["lifetime"] = None
-            else:
-                test["lifetime"] = int(test["lifetime"])
-
-            if test["lba_of_first_error"] == "-":
-                test["lba_of_first_error"] = None
-
             tests.append(test)
 
         return tests
@@ -402,6 +388,7 @@ class SMARTTestService(CRUDService):
     async def __manual_test(self, disk):
         output = {}
 
+        await self.middleware.call('disk.smart_data_invalidate', disk['disk'])
         try:
             new_test_num = max(
                 test['num']
@@ -422,6 +409,7 @@ class SMARTTestService(CRUDService):
         except CallError as e:
             output['error'] = e.errmsg
         else:
+            await self.middleware.call('disk.smart_data_invalidate', disk['disk'])
             expected_result_time = None
             time_details = re.findall(RE_TIME_DETAILS, result)
             if time_details:
@@ -541,11 +529,10 @@ class SMARTTestService(CRUDService):
             options,
         )
 
-        devices = await self.middleware.call('device.get_storage_devices_topology')
         return filter_list(
             list(filter(
                 None,
-                await asyncio_map(functools.partial(annotate_disk_smart_tests, self.middleware, devices), disks, 16)
+                await asyncio_map(functools.partial(annotate_disk_smart_tests, self.middleware), disks, 16)
             )),
             [],
             {"get": get},
@@ -571,6 +558,7 @@ class SMARTTestService(CRUDService):
                 ) * 100,
             )
 
+            await self.middleware.call('disk.smart_data_invalidate', disk['disk'])
             try:
                 tests = (await self.middleware.call(
                     'smart.test.results',
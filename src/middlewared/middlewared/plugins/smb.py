@@ -343,7 +343,10 @@ class SMBService(SystemServiceService):
             raise CallError(f'Attempt to query smb4.conf parameter [{parm}] failed with error: {e}')
 
     @private
-    async def get_next_rid(self):
+    async def get_next_rid(self, count=1):
+        """
+        Allocates `count` consecutive RIDs and returns the first one.
+        """
         next_rid = (await self.config())['next_rid']
         if next_rid == 0:
             try:
@@ -355,7 +358,7 @@ class SMBService(SystemServiceService):
                 next_rid = 5000
 
         await self.middleware.call('datastore.update', 'services.cifs', 1,
-                                   {'next_rid': next_rid + 1},
+                                   {'next_rid': next_rid + count},
                                    {'prefix': 'cifs_srv_'})
         return next_rid
 
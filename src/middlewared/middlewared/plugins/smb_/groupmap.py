@@ -3,10 +3,34 @@ from middlewared.service_exception import CallError
 from middlewared.utils import run
 from middlewared.plugins.smb import SMBCmd, SMBBuiltin, SMBPath
 
+import grp
 import os
-import re
 
-RE_NETGROUPMAP = re.compile(r"^(?P<ntgroup>.+) \((?P<SID>S-[0-9\-]+)\) -> (?P<unixgroup>.+)$")
+try:
+    from samba.dcerpc import lsa, security
+    from samba.samba3 import passdb
+except ImportError:
+    lsa = security = passdb = None
+
+
+def groupmap_builtin_entry(group):
+    ntgroup = group[8:].capitalize()
+    return {
+        'unixgroup': group,
+        'ntgroup': ntgroup,
+        'SID': SMBBuiltin[ntgroup.upper()].value[1],
+        'type': 'builtin',
+    }
+
+
+def groupmap_local_entry(group):
+    # SID is allocated when the entry is added
+    return {
+        'unixgroup': group,
+        'ntgroup': group,
+        'SID': None,
+        'type': 'local',
+    }
 
 
 class SMBService(Service):
@@ -16,33 +40,63 @@ class SMBService(Service):
         service_verb = 'restart'
 
     @private
-    async def groupmap_list(self):
+    def groupmap_list(self):
         groupmap = {}
-        out = await run([SMBCmd.NET.value, 'groupmap', 'list'], check=False)
-        if out.returncode != 0:
-            raise CallError(f'groupmap list failed with error {out.stderr.decode()}')
-        for line in (out.stdout.decode()).splitlines():
-            m = RE_NETGROUPMAP.match(line)
-            if m:
-                entry = m.groupdict()
-                groupmap[entry['unixgroup']] = entry
+        pdb = self.middleware.call_sync('smb.passdb_open')
+        try:
+            mappings = pdb.enum_group_mapping()
+        except Exception as e:
+            raise CallError(f'groupmap list failed with error {e}')
+
+        for mapping in mappings:
+            try:
+                unixgroup = grp.getgrgid(mapping.gid).gr_name
+            except KeyError:
+                unixgroup = str(mapping.gid)
+
+            groupmap[unixgroup] = {
+                'ntgroup': mapping.nt_name,
+                'SID': str(mapping.sid),
+                'unixgroup': unixgroup,
+            }
 
         return groupmap
 
+    @private
+    def groupmap_add_entries(self, entries):
+        """
+        Adds group mapping `entries` (see `groupmap_builtin_entry` and `groupmap_local_entry`). RIDs for entries
+        without SID are allocated in a single block.
+        """
+        pdb = self.middleware.call_sync('smb.passdb_open')
+
+        without_sid = [entry for entry in entries if entry['SID'] is None]
+        if without_sid:
+            sam_sid = str(passdb.get_global_sam_sid())
+            next_rid = self.middleware.call_sync('smb.get_next_rid', len(without_sid))
+            for i, entry in enumerate(without_sid):
+                entry['SID'] = f'{sam_sid}-{next_rid + i}'
+
+        for entry in entries:
+            try:
+                gid = grp.getgrnam(entry['unixgroup']).gr_gid
+            except KeyError:
+                raise CallError(f'Failed to generate groupmap for [{entry["unixgroup"]}]: (Unix group does not exist)')
+
+            mapping = passdb.GroupMapping()
+            mapping.gid = gid
+            mapping.sid = security.dom_sid(entry['SID'])
+            mapping.sid_name_use = lsa.SID_NAME_WKN_GRP if entry['type'] == 'builtin' else lsa.SID_NAME_ALIAS
+            mapping.nt_name = entry['ntgroup']
+            mapping.comment = ''
+            try:
+                pdb.add_group_mapping_entry(mapping)
+            except Exception as e:
+                raise CallError(f'Failed to generate groupmap for [{entry["unixgroup"]}]: ({e})')
+
     @private
     async def add_builtin_group(self, group):
-        unixgroup = group
-        ntgroup = group[8:].capitalize()
-        sid = SMBBuiltin[ntgroup.upper()].value[1]
-        gm_add = await run([
-            SMBCmd.NET.value, '-d', '0', 'groupmap', 'add', f'sid={sid}',
-            'type=builtin', f'unixgroup={unixgroup}', f'ntgroup={ntgroup}'],
-            check=False
-        )
-        if gm_add.returncode != 0:
-            raise CallError(
-                f'Failed to generate groupmap for [{group}]: ({gm_add.stderr.decode()})'
-            )
+        await self.middleware.call('smb.groupmap_add_entries', [groupmap_builtin_entry(group)])
 
     @private
     async def groupmap_add(self, group, passdb_backend=None):
@@ -62,7 +116,7 @@ class SMBService(Service):
             return await self.add_builtin_group(group)
 
         disallowed_list = ['USERS', 'ADMINISTRATORS', 'GUESTS']
-        existing_groupmap = await self.groupmap_list()
+        existing_groupmap = await self.middleware.call('smb.groupmap_list')
 
         if existing_groupmap.get(group):
             self.logger.debug('Setting group map for %s is not permitted. '
@@ -74,18 +128,10 @@ class SMBService(Service):
                               'Entry mirrors existing builtin groupmap.', group)
             return False
 
-        next_rid = str(await self.middleware.call("smb.get_next_rid"))
-        gm_add = await run(
-            [SMBCmd.NET.value, '-d', '0', 'groupmap', 'add', 'type=local', f'rid={next_rid}', f'unixgroup={group}', f'ntgroup={group}'],
-            check=False
-        )
-        if gm_add.returncode != 0:
-            raise CallError(
-                f'Failed to generate groupmap for [{group}]: ({gm_add.stderr.decode()})'
-            )
+        await self.middleware.call('smb.groupmap_add_entries', [groupmap_local_entry(group)])
 
     @private
-    async def groupmap_delete(self, data):
+    def groupmap_delete(self, data):
         ntgroup = data.get("ntgroup")
         sid = data.get("sid")
         if not ntgroup and not sid:
@@ -100,12 +146,14 @@ class SMBService(Service):
 
             target = f"sid={sid}"
 
-        gm_delete = await run(
-            [SMBCmd.NET.value, '-d' '0', 'groupmap', 'delete', target], check=False
-        )
+        pdb = self.middleware.call_sync('smb.passdb_open')
+        try:
+            if ntgroup:
+                sid = next(str(mapping.sid) for mapping in pdb.enum_group_mapping() if mapping.nt_name == ntgroup)
 
-        if gm_delete.returncode != 0:
-            self.logger.debug(f'Failed to delete groupmap for [{target}]: ({gm_delete.stderr.decode()})')
+            pdb.delete_group_mapping_entry(security.dom_sid(sid))
+        except Exception as e:
+            self.logger.debug(f'Failed to delete groupmap for [{target}]: ({e!r})')
 
     @private
     @job(lock="groupmap_sync")
@@ -113,15 +161,20 @@ class SMBService(Service):
         if await self.middleware.call('ldap.get_state') != "DISABLED":
             return
 
-        groupmap = await self.groupmap_list()
+        groupmap = await self.middleware.call('smb.groupmap_list')
         must_remove_cache = False
         passdb_backend = await self.middleware.call('smb.getparm', 'passdb backend', 'global')
 
+        if passdb_backend != 'tdbsam':
+            return
+
         if groupmap:
             sids_fixed = await self.middleware.call('smb.fixsid', groupmap.values())
             if not sids_fixed:
-                groupmap = []
+                groupmap = {}
 
+        ntgroups = {entry['ntgroup'] for entry in groupmap.values()}
+        entries = []
         for b in SMBBuiltin:
             entry = groupmap.get(b.value[0])
             if b.name == 'ADMINISTRATORS':
@@ -132,17 +185,19 @@ class SMBService(Service):
                     continue
 
             if not entry:
-                stale_entry = list(filter(lambda x: b.name.lower().capitalize() == x['ntgroup'], groupmap.values()))
-                if stale_entry:
+                if b.name.lower().capitalize() in ntgroups:
                     must_remove_cache = True
-                    await self.groupmap_delete({"ntgroup": b.name.lower().capitalize()})
+                    await self.middleware.call('smb.groupmap_delete', {"ntgroup": b.name.lower().capitalize()})
 
-                await self.groupmap_add(b.value[0], passdb_backend)
+                entries.append(groupmap_builtin_entry(b.value[0]))
 
         groups = await self.middleware.call('group.query', [('builtin', '=', False), ('smb', '=', True)])
         for g in groups:
-            if not groupmap.get(g['group']):
-                await self.groupmap_add(g['group'], passdb_backend)
+            if not groupmap.get(g['group']) and g['group'].upper() not in ['USERS', 'ADMINISTRATORS', 'GUESTS']:
+                entries.append(groupmap_local_entry(g['group']))
+
+        if entries:
+            await self.middleware.call('smb.groupmap_add_entries', entries)
 
         if must_remove_cache:
             if os.path.exists(f'{SMBPath.STATEDIR.platform()}/winbindd_cache.tdb'):
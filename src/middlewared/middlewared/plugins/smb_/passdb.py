@@ -1,10 +1,76 @@
 from middlewared.service import Service, job, private
 from middlewared.service_exception import CallError
-from middlewared.utils import Popen, run
+from middlewared.utils import run
 from middlewared.plugins.smb import SMBCmd
 
 import os
-import subprocess
+import time
+
+try:
+    from samba.dcerpc import security
+    from samba.samba3 import passdb
+except ImportError:
+    security = passdb = None
+
+# samr account control bits
+ACB_DISABLED = 0x00000001
+ACB_NORMAL = 0x00000010
+
+
+def passdb_expected_entry(user):
+    """
+    passdb entry (`{"nt_hash": ..., "disabled": ...}`) that matches middleware `user` or None if the user's SMB hash
+    is invalid.
+    """
+    smbpasswd = user['smbhash'].split(':')
+    if len(smbpasswd) != 7:
+        return None
+
+    return {'nt_hash': smbpasswd[3].upper(), 'disabled': user['locked']}
+
+
+def passdb_diff(expected, current, remove_stale=True):
+    """
+    Compares `expected` passdb entries (`{username: entry}`, entry being None if it should be left as it is) with
+    `current` ones. Returns lists of usernames that should be added, updated and removed.
+    """
+    add = []
+    update = []
+    for username, entry in expected.items():
+        if entry is None:
+            continue
+
+        if username not in current:
+            add.append(username)
+        elif current[username] != entry:
+            update.append(username)
+
+    remove = [username for username in current if username not in expected] if remove_stale else []
+
+    return add, update, remove
+
+
+def samu_entry(samu):
+    return {
+        'nt_hash': samu.nt_passwd.hex().upper() if samu.nt_passwd else None,
+        'disabled': bool(samu.acct_ctrl & ACB_DISABLED),
+    }
+
+
+def samu_update(samu, entry):
+    acct_ctrl = samu.acct_ctrl or ACB_NORMAL
+    if entry['disabled']:
+        acct_ctrl |= ACB_DISABLED
+    else:
+        acct_ctrl &= ~ACB_DISABLED
+
+    samu.acct_ctrl = acct_ctrl
+
+    nt_passwd = bytes.fromhex(entry['nt_hash'])
+    if samu.nt_passwd != nt_passwd:
+        samu.nt_passwd = nt_passwd
+        # Left unset it is 0 and samba considers the password expired (NT_STATUS_PASSWORD_MUST_CHANGE)
+        samu.pass_last_set_time = int(time.time())
 
 
 class SMBService(Service):
@@ -62,6 +128,66 @@ class SMBService(Service):
 
         return pdbentries
 
+    @private
+    def passdb_open(self):
+        # This also loads smb4.conf into the loadparm context used by passdb
+        private_dir = self.middleware.call_sync('smb.getparm', 'privatedir', 'global')
+        return passdb.PDB(f'tdbsam:{private_dir}/passdb.tdb')
+
+    @private
+    def passdb_sync(self, expected, remove_stale=True):
+        """
+        Brings passdb.tdb entries in line with `expected` ones (see `passdb_diff`). Only entries that differ are
+        written.
+        """
+        pdb = self.passdb_open()
+
+        current = {}
+        if remove_stale:
+            for user in pdb.search_users(0):
+                current[user['account_name']] = samu_entry(pdb.getsampwnam(user['account_name']))
+        else:
+            for username in expected:
+                try:
+                    current[username] = samu_entry(pdb.getsampwnam(username))
+                except Exception:
+                    # No such user
+                    pass
+
+        add, update, remove = passdb_diff(expected, current, remove_stale)
+
+        if add:
+            sam_sid = str(passdb.get_global_sam_sid())
+            next_rid = self.middleware.call_sync('smb.get_next_rid', len(add))
+            for i, username in enumerate(add):
+                self.logger.debug('User [%s] does not exist in the passdb.tdb file. Creating entry with rid [%d].',
+                                  username, next_rid + i)
+                samu = passdb.samu()
+                samu.username = username
+                samu.user_sid = security.dom_sid(f'{sam_sid}-{next_rid + i}')
+                samu_update(samu, expected[username])
+                try:
+                    pdb.add_sam_account(samu)
+                except Exception as e:
+                    raise CallError(f'Failed to create passdb entry for {username}: {e}')
+
+        for username in update:
+            samu = pdb.getsampwnam(username)
+            samu_update(samu, expected[username])
+            try:
+                pdb.update_sam_account(samu)
+            except Exception as e:
+                raise CallError(f'Failed to update passdb entry for {username}: {e}')
+
+        for username in remove:
+            self.logger.debug('Synchronizing passdb with config file: deleting user [%s] from passdb.tdb', username)
+            try:
+                pdb.delete_sam_account(pdb.getsampwnam(username))
+            except Exception as e:
+                raise CallError(f'Failed to delete user [{username}]: {e}')
+
+        return {'added': len(add), 'updated': len(update), 'removed': len(remove)}
+
     @private
     async def update_passdb_user(self, username, passdb_backend=None):
         """
@@ -85,59 +211,23 @@ class SMBService(Service):
             self.logger.debug(f'{username} is not an SMB user, bypassing passdb import')
             return
 
-        smbpasswd_string = bsduser[0]['smbhash'].split(':')
-        if len(smbpasswd_string) != 7:
+        entry = passdb_expected_entry(bsduser[0])
+        if entry is None:
             self.logger.warning("SMB hash for user [%s] is invalid. Authentication for SMB "
                                 "sessions for this user will fail until this is repaired. "
                                 "This may indicate that configuration was restored without a secret "
                                 "seed, and may be repaired by resetting the user password.", username)
             return
 
-        p = await run([SMBCmd.PDBEDIT.value, '-d', '0', '-Lw', username], check=False)
-        if p.returncode != 0:
-            CallError(f'Failed to retrieve passdb entry for {username}: {p.stderr.decode()}')
-        entry = p.stdout.decode()
-        if not entry:
-            next_rid = str(await self.middleware.call('smb.get_next_rid'))
-            self.logger.debug("User [%s] does not exist in the passdb.tdb file. "
-                              "Creating entry with rid [%s].", username, next_rid)
-            pdbcreate = await Popen(
-                [SMBCmd.PDBEDIT.value, '-d', '0', '-a', username, '-U', next_rid, '-t'],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE
-            )
-            await pdbcreate.communicate(input=" \n \n".encode())
-            setntpass = await run([SMBCmd.PDBEDIT.value, '-d', '0', '--set-nt-hash', smbpasswd_string[3], username], check=False)
-            if setntpass.returncode != 0:
-                raise CallError(f'Failed to set NT password for {username}: {setntpass.stderr.decode()}')
-            if bsduser[0]['locked']:
-                disableacct = await run([SMBCmd.SMBPASSWD.value, '-d', username], check=False)
-                if disableacct.returncode != 0:
-                    raise CallError(f'Failed to disable {username}: {disableacct.stderr.decode()}')
-            return
-
-        if entry == bsduser[0]['smbhash']:
-            return
-
-        entry = entry.split(':')
-
-        if smbpasswd_string[3] != entry[3]:
-            setntpass = await run([SMBCmd.PDBEDIT.value, '-d', '0', '--set-nt-hash', smbpasswd_string[3], username], check=False)
-            if setntpass.returncode != 0:
-                raise CallError(f'Failed to set NT password for {username}: {setntpass.stderr.decode()}')
-        if bsduser[0]['locked'] and 'D' not in entry[4]:
-            disableacct = await run([SMBCmd.SMBPASSWD.value, '-d', username], check=False)
-            if disableacct.returncode != 0:
-                raise CallError(f'Failed to disable {username}: {disableacct.stderr.decode()}')
-        elif not bsduser[0]['locked'] and 'D' in entry[4]:
-            enableacct = await run([SMBCmd.SMBPASSWD.value, '-e', username], check=False)
-            if enableacct.returncode != 0:
-                raise CallError(f'Failed to enable {username}: {enableacct.stderr.decode()}')
+        await self.middleware.call('smb.passdb_sync', {username: entry}, False)
 
     @private
-    async def remove_passdb_user(self, username):
-        deluser = await run([SMBCmd.PDBEDIT.value, '-d', '0', '-x', username], check=False)
-        if deluser.returncode != 0:
-            raise CallError(f'Failed to delete user [{username}]: {deluser.stderr.decode()}')
+    def remove_passdb_user(self, username):
+        pdb = self.passdb_open()
+        try:
+            pdb.delete_sam_account(pdb.getsampwnam(username))
+        except Exception as e:
+            raise CallError(f'Failed to delete user [{username}]: {e}')
 
     @private
     @job(lock="passdb_sync")
@@ -155,13 +245,14 @@ class SMBService(Service):
         if passdb_backend != 'tdbsam':
             return
 
-        conf_users = await self.middleware.call('user.query', [("smb", "=", True)])
-        for u in conf_users:
-            await self.middleware.call('smb.update_passdb_user', u['username'], passdb_backend)
+        expected = {}
+        for u in await self.middleware.call('user.query', [("smb", "=", True)]):
+            expected[u['username']] = passdb_expected_entry(u)
+            if expected[u['username']] is None:
+                self.logger.warning("SMB hash for user [%s] is invalid. Authentication for SMB "
+                                    "sessions for this user will fail until this is repaired. "
+                                    "This may indicate that configuration was restored without a secret "
+                                    "seed, and may be repaired by resetting the user password.", u['username'])
 
-        pdb_users = await self.passdb_list()
-        if len(pdb_users) > len(conf_users):
-            for entry in pdb_users:
-                if not any(filter(lambda x: entry['username'] == x['username'], conf_users)):
-                    self.logger.debug('Synchronizing passdb with config file: deleting user [%s] from passdb.tdb', entry['username'])
-                    await self.remove_passdb_user(entry['username'])
+        result = await self.middleware.call('smb.passdb_sync', expected)
+        self.logger.debug('Synchronized passdb: %r', result)
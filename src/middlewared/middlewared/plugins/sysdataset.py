@@ -1,7 +1,7 @@
 from middlewared.schema import accepts, Bool, Dict, Str
 from middlewared.service import CallError, ConfigService, ValidationErrors, job, private
 import middlewared.sqlalchemy as sa
-from middlewared.utils import osc, Popen, run
+from middlewared.utils import osc, run
 
 import asyncio
 import errno
@@ -13,6 +13,46 @@ import uuid
 SYSDATASET_PATH = '/var/db/system'
 
 
+def list_snapshots(dataset):
+    """
+    Returns a dict that maps snapshot names of `dataset` and its children to the sets of datasets that have them.
+    """
+    cp = subprocess.run(
+        ['zfs', 'list', '-H', '-o', 'name', '-t', 'snapshot', '-r', dataset], capture_output=True, text=True,
+    )
+    if cp.returncode != 0:
+        raise CallError(f'Failed to list snapshots of {dataset!r}: {cp.stderr.strip()}')
+
+    snapshots = {}
+    for name in cp.stdout.splitlines():
+        dataset, snapshot = name.split('@', 1)
+        snapshots.setdefault(snapshot, set()).add(dataset)
+    return snapshots
+
+
+def zfs_send_recv(snapshot, target, incremental_base=None):
+    """
+    Pipe `zfs send` of `snapshot` (incremental from `incremental_base` snapshot of the same dataset if specified)
+    to `zfs recv` into `target` dataset. Received dataset is not mounted.
+    """
+    send = ['zfs', 'send'] + (['-i', f'@{incremental_base}'] if incremental_base else []) + [snapshot]
+    sender = subprocess.Popen(send, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    receiver = subprocess.Popen(
+        ['zfs', 'recv', '-F', '-u', target], stdin=sender.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    # So that `zfs send` gets SIGPIPE if `zfs recv` exits prematurely
+    sender.stdout.close()
+    recv_stderr = receiver.communicate()[1]
+    send_stderr = sender.stderr.read()
+    sender.stderr.close()
+    sender.wait()
+
+    if sender.returncode != 0 or receiver.returncode != 0:
+        # Failure of either of these commands will also make the other one fail
+        error = '\n'.join(filter(None, [send_stderr.decode().strip(), recv_stderr.decode().strip()]))
+        raise CallError(f'Failed to replicate {snapshot!r} to {target!r}: {error}')
+
+
 class SystemDatasetModel(sa.Model):
     __tablename__ = 'system_systemdataset'
 
@@ -162,7 +202,7 @@ class SystemDatasetService(ConfigService):
         new = await self.config()
 
         if config['pool'] != new['pool']:
-            await self.migrate(config['pool'], new['pool'])
+            await self.migrate(config['pool'], new['pool'], job)
 
         await self.setup(True, data.get('pool_exclude'))
 
@@ -395,56 +435,129 @@ class SystemDatasetService(ConfigService):
             open(path, 'w').close()
         os.symlink(path, item)
 
+    async def __replicate(self, job, _from, target, snapshot, incremental_base, progress):
+        """
+        Snapshot `{_from}/.system` recursively and send the snapshot to the matching datasets under `target`.
+        If `incremental_base` is specified, only the changes made since that snapshot are sent.
+        """
+        await self.middleware.call(
+            'zfs.snapshot.create', {'dataset': f'{_from}/.system', 'name': snapshot, 'recursive': True},
+        )
+
+        snapshots = await self.middleware.run_in_thread(list_snapshots, f'{_from}/.system')
+        datasets = sorted(snapshots[snapshot])
+        start, end = progress
+        for i, dataset in enumerate(datasets):
+            job.set_progress(
+                start + (end - start) * i / len(datasets),
+                f'Replicating {dataset!r} to {target!r}' + (' (incremental)' if incremental_base else ''),
+            )
+            await self.middleware.run_in_thread(
+                zfs_send_recv,
+                f'{dataset}@{snapshot}',
+                f'{target}{dataset[len(f"{_from}/.system"):]}',
+                # Datasets that were created after the base snapshot was taken need to be sent in full
+                incremental_base if dataset in snapshots.get(incremental_base, set()) else None,
+            )
+
+    async def __rename_into_place(self, pool, dataset):
+        """
+        Rename replicated system `dataset` to `{pool}/.system`. Existing `{pool}/.system` (i.e. the one used by
+        another system this pool was attached to) might hold data of other systems so it is renamed aside.
+        """
+        if await self.middleware.call('zfs.dataset.query', [('id', '=', f'{pool}/.system')]):
+            aside = f'{dataset}-previous'
+            self.logger.warning('Renaming existing system dataset %r to %r', f'{pool}/.system', aside)
+            await self.middleware.call('zfs.dataset.rename', f'{pool}/.system', {'new_name': aside})
+
+        await self.middleware.call('zfs.dataset.rename', dataset, {'new_name': f'{pool}/.system'})
+
+    async def __destroy_snapshots(self, pool, snapshots):
+        for snapshot in snapshots:
+            cp = await run('zfs', 'destroy', '-r', f'{pool}/.system@{snapshot}', check=False)
+            if cp.returncode != 0:
+                self.logger.warning(
+                    'Unable to destroy %r snapshot of %r: %s', snapshot, f'{pool}/.system', cp.stderr.decode().strip(),
+                )
+
     @private
-    async def migrate(self, _from, _to):
+    async def migrate(self, _from, _to, job):
+        """
+        Move the system dataset from `_from` pool to `_to` pool.
 
+        The bulk of the data is replicated while the services that use the system dataset keep running.
+        They are only stopped for the final incremental replication and the remount.
+        """
         config = await self.config()
 
-        await self.__setup_datasets(_to, config['uuid'])
-
-        if _from:
-            path = '/tmp/system.new'
-            if not os.path.exists('/tmp/system.new'):
-                os.mkdir('/tmp/system.new')
-        else:
-            path = SYSDATASET_PATH
-        await self.__mount(_to, config['uuid'], path=path)
+        if _from and not await self.middleware.call('zfs.dataset.query', [('id', '=', f'{_from}/.system')]):
+            # Pool that was hosting the system dataset is gone, there is nothing to replicate
+            _from = None
 
         restart = ['collectd', 'rrdcached', 'syslogd']
 
         if await self.middleware.call('service.started', 'cifs'):
             restart.insert(0, 'cifs')
 
+        snapshot = f'migrate-{uuid.uuid4().hex[:8]}'
+        snapshots = [f'{snapshot}-full', f'{snapshot}-final']
+        # System dataset is received under a temporary name and only renamed into place once fully replicated
+        received = f'{_to}/.system-{snapshot}'
+
         try:
-            if osc.IS_LINUX:
-                await self.middleware.call('cache.put', 'use_syslog_dataset', False)
-                await self.middleware.call('service.restart', 'syslogd')
+            if _from:
+                job.set_progress(0, f'Replicating system dataset to {_to!r}')
+                await self.__replicate(job, _from, received, snapshots[0], None, (0, 70))
+            else:
+                await self.__setup_datasets(_to, config['uuid'])
 
-            for i in restart:
-                await self.middleware.call('service.stop', i)
+            try:
+                if osc.IS_LINUX:
+                    await self.middleware.call('cache.put', 'use_syslog_dataset', False)
+                    await self.middleware.call('service.restart', 'syslogd')
 
-            if _from:
-                cp = await run('rsync', '-az', f'{SYSDATASET_PATH}/', '/tmp/system.new', check=False)
-                if cp.returncode == 0:
-                    await self.__umount(_from, config['uuid'])
-                    await self.__umount(_to, config['uuid'])
-                    await self.__mount(_to, config['uuid'], SYSDATASET_PATH)
-                    proc = await Popen(f'zfs list -H -o name {_from}/.system|xargs zfs destroy -r', shell=True)
-                    await proc.communicate()
+                job.set_progress(70, 'Stopping services using system dataset')
+                for i in restart:
+                    await self.middleware.call('service.stop', i)
 
-                    os.rmdir('/tmp/system.new')
-                else:
-                    raise CallError(f'Failed to rsync from {SYSDATASET_PATH}: {cp.stderr.decode()}')
-        finally:
-            if osc.IS_LINUX:
-                await self.middleware.call('cache.pop', 'use_syslog_dataset')
+                # Directory services cache database is kept open on the system dataset
+                await self.middleware.call('dscache.close')
 
-            restart.reverse()
-            for i in restart:
-                await self.middleware.call('service.start', i)
+                if _from:
+                    await self.__replicate(job, _from, received, snapshots[1], snapshots[0], (75, 90))
+                    await self.__umount(_from, config['uuid'])
+                    await self.__rename_into_place(_to, received)
+                    received = None
+                    await self.__setup_datasets(_to, config['uuid'])
+
+                job.set_progress(90, 'Mounting system dataset')
+                await self.__mount(_to, config['uuid'])
+            finally:
+                if osc.IS_LINUX:
+                    await self.middleware.call('cache.pop', 'use_syslog_dataset')
+
+                job.set_progress(92, 'Starting services using system dataset')
+                restart.reverse()
+                for i in restart:
+                    await self.middleware.call('service.start', i)
+
+                await self.middleware.call('dscache.initialize')
+        except Exception:
+            if _from:
+                await self.__destroy_snapshots(_from, snapshots)
+                if received and await self.middleware.call('zfs.dataset.query', [('id', '=', received)]):
+                    await self.middleware.call('zfs.dataset.delete', received, {'recursive': True})
+            raise
+
+        if _from:
+            job.set_progress(95, f'Removing system dataset from {_from!r}')
+            await self.middleware.call('zfs.dataset.delete', f'{_from}/.system', {'recursive': True})
+            await self.__destroy_snapshots(_to, snapshots)
 
         await self.__nfsv4link(config)
 
+        job.set_progress(100, 'System dataset migrated')
+
 
 async def pool_post_import(middleware, pool):
     """
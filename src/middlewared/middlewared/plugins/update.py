@@ -1,4 +1,5 @@
-from middlewared.schema import accepts, Bool, Dict, Str
+from middlewared.schema import accepts, Bool, Dict, Int, Str
+from middlewared.validators import Range
 from middlewared.service import job, private, CallError, Service
 import middlewared.sqlalchemy as sa
 from middlewared.plugins.update_.utils import UPLOAD_LOCATION
@@ -88,6 +89,7 @@ class UpdateModel(sa.Model):
     id = sa.Column(sa.Integer(), primary_key=True)
     upd_autocheck = sa.Column(sa.Boolean(), default=True)
     upd_train = sa.Column(sa.String(50))
+    upd_bandwidth_limit = sa.Column(sa.Integer(), nullable=True)
 
 
 class UpdateService(Service):
@@ -108,6 +110,23 @@ class UpdateService(Service):
         await self.middleware.call('datastore.update', 'system.update', config['id'], {'upd_autocheck': autocheck})
         await self.middleware.call('service.restart', 'cron')
 
+    @accepts()
+    async def get_download_bandwidth_limit(self):
+        """
+        Returns update download bandwidth limit (in bytes per second) or `null` if it is not limited.
+        """
+        return (await self.middleware.call('datastore.config', 'system.update'))['upd_bandwidth_limit']
+
+    @accepts(Int('bandwidth_limit', validators=[Range(min=1)], null=True))
+    async def set_download_bandwidth_limit(self, bandwidth_limit):
+        """
+        Sets update download bandwidth limit (in bytes per second). `null` removes the limit.
+        """
+        config = await self.middleware.call('datastore.config', 'system.update')
+        await self.middleware.call(
+            'datastore.update', 'system.update', config['id'], {'upd_bandwidth_limit': bandwidth_limit},
+        )
+
     @accepts()
     def get_trains(self):
         """
@@ -1,15 +1,238 @@
 # -*- coding=utf-8 -*-
+import hashlib
+import json
+import logging
 import os
-import subprocess
 import time
 
 import humanfriendly
 import requests
+import urllib3
 
-from middlewared.service import private, Service
+from middlewared.service import CallError, private, Service
 
 from .utils import scale_update_server
 
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_INTERVAL = 5
+# Chunk size is adjusted so that reading one chunk takes about this many seconds
+CHUNK_DURATION = 0.5
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# At most this much data is lost when the connection is interrupted
+READ_SIZE = 64 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+def file_sha256(path, sha256=None):
+    sha256 = sha256 or hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+
+    return sha256
+
+
+def is_retryable(e):
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+
+    return isinstance(e, (
+        requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+        urllib3.exceptions.HTTPError, IncompleteDownload,
+    ))
+
+
+class Download:
+    """
+    Downloads `url` to `dst`, computing its SHA256 checksum while it is being downloaded.
+
+    Data is written to `{dst}.part`. `{dst}.json` holds the state that allows to resume an interrupted download
+    (even after middleware restart) with an HTTP range request and, once the download is complete, to recognize an
+    already verified `dst` without reading it again.
+    """
+
+    def __init__(self, url, dst, checksum, bandwidth_limit=None, progress_callback=None):
+        self.url = url
+        self.dst = dst
+        self.checksum = checksum
+        self.bandwidth_limit = bandwidth_limit
+        self.progress_callback = progress_callback or (lambda progress, total, speed: None)
+
+        self.part = f"{dst}.part"
+        self.state_path = f"{dst}.json"
+
+        self.chunk_size = MIN_CHUNK_SIZE
+        # Checksum of the data in `{dst}.part`
+        self.sha256 = None
+
+    def verify_existing(self):
+        """
+        Returns True if `dst` has already been downloaded and matches `checksum`.
+        """
+        if not os.path.exists(self.dst):
+            return False
+
+        state = self._load_state()
+        if state.get("complete") and state.get("stat") == self._stat():
+            checksum = state["checksum"]
+        else:
+            checksum = file_sha256(self.dst).hexdigest()
+
+        if checksum == self.checksum:
+            self._save_state({"checksum": self.checksum, "complete": True, "stat": self._stat()})
+            return True
+
+        logger.warning("Invalid update file checksum %r, re-downloading", checksum)
+        os.unlink(self.dst)
+        return False
+
+    def run(self):
+        state = self._load_state()
+        if (
+            not state.get("complete") and state.get("url") == self.url and state.get("checksum") == self.checksum and
+            os.path.exists(self.part)
+        ):
+            self.sha256 = file_sha256(self.part)
+            logger.info("Resuming update download from %d bytes", os.path.getsize(self.part))
+        else:
+            state = {"url": self.url, "checksum": self.checksum, "complete": False, "validator": None}
+            self._truncate()
+
+        attempt = 0
+        while True:
+            offset = os.path.getsize(self.part)
+            try:
+                self._download(state, offset)
+                break
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+
+                if os.path.getsize(self.part) > offset:
+                    # Made some progress, the connection is not entirely broken
+                    attempt = 0
+
+                offset = os.path.getsize(self.part)
+                attempt += 1
+                if attempt > DOWNLOAD_RETRIES:
+                    raise CallError(f"Failed to download update: {e}")
+
+                logger.warning("Update download interrupted at %d bytes (%r), retrying", offset, e)
+                time.sleep(DOWNLOAD_RETRY_INTERVAL * attempt)
+
+        checksum = self.sha256.hexdigest()
+        if checksum != self.checksum:
+            os.unlink(self.part)
+            os.unlink(self.state_path)
+            raise CallError(f"Invalid update file checksum {checksum!r}")
+
+        os.rename(self.part, self.dst)
+        self._save_state({"checksum": self.checksum, "complete": True, "stat": self._stat()})
+
+    def _download(self, state, offset):
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if state["validator"]:
+                # Server will send the whole file if it has changed since the previous request
+                headers["If-Range"] = state["validator"]
+
+        with requests.get(self.url, headers=headers, stream=True, timeout=30) as r:
+            if offset and r.status_code == 416:
+                # Partial file is not a prefix of the file on the server
+                self._truncate()
+                return self._download(state, 0)
+
+            r.raise_for_status()
+
+            if r.status_code != 206:
+                offset = 0
+                self._truncate()
+
+            state["validator"] = r.headers.get("ETag") or r.headers.get("Last-Modified")
+            self._save_state(state)
+
+            total = None
+            if "Content-Length" in r.headers:
+                total = offset + int(r.headers["Content-Length"])
+
+            with open(self.part, "ab") as f:
+                start = time.monotonic()
+                received = 0
+                while True:
+                    chunk_start = time.monotonic()
+                    chunk = bytearray()
+                    try:
+                        while len(chunk) < self.chunk_size:
+                            data = r.raw.read(min(READ_SIZE, self.chunk_size - len(chunk)), decode_content=True)
+                            if not data:
+                                break
+
+                            chunk += data
+                    finally:
+                        # Keep the data that was received before the connection was interrupted. It must be in the
+                        # file in case the download is resumed after middleware restart.
+                        f.write(chunk)
+                        f.flush()
+                        self.sha256.update(chunk)
+
+                    if not chunk:
+                        break
+
+                    offset += len(chunk)
+                    received += len(chunk)
+
+                    self._adjust_chunk_size(len(chunk), time.monotonic() - chunk_start)
+                    self._throttle(received, start)
+
+                    self.progress_callback(offset, total, received / max(time.monotonic() - start, 0.001))
+
+            if total is not None and offset < total:
+                raise IncompleteDownload(f"Connection closed after {offset} of {total} bytes")
+
+    def _truncate(self):
+        with open(self.part, "wb"):
+            pass
+
+        self.sha256 = hashlib.sha256()
+
+    def _adjust_chunk_size(self, size, duration):
+        chunk_size = size / max(duration, 0.001) * CHUNK_DURATION
+        if self.bandwidth_limit:
+            chunk_size = min(chunk_size, self.bandwidth_limit * CHUNK_DURATION)
+
+        self.chunk_size = int(max(MIN_CHUNK_SIZE, min((self.chunk_size + chunk_size) / 2, MAX_CHUNK_SIZE)))
+
+    def _throttle(self, received, start):
+        if self.bandwidth_limit:
+            delay = received / self.bandwidth_limit - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _stat(self):
+        st = os.stat(self.dst)
+        return [st.st_size, st.st_mtime_ns]
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        with open(f"{self.state_path}.tmp", "w") as f:
+            json.dump(state, f)
+
+        os.rename(f"{self.state_path}.tmp", self.state_path)
+
 
 class UpdateService(Service):
     @private
@@ -18,37 +241,24 @@ class UpdateService(Service):
 
         train_check = self.middleware.call_sync("update.check_train", train)
         if train_check["status"] == "AVAILABLE":
-            dst = os.path.join(location, "update.sqsh")
-            if os.path.exists(dst):
-                job.set_progress(0, "Verifying existing update")
-                checksum = subprocess.run(
-                    ["sha256sum", dst], stdout=subprocess.PIPE, encoding="utf-8"
-                ).stdout.split()[0]
-                if checksum == train_check["checksum"]:
-                    return True
-
-                self.middleware.logger.warning("Invalid update file checksum %r, re-downloading", checksum)
-                os.unlink(dst)
-
-            with open(dst, "wb") as f:
-                download_start = time.monotonic()
-                with requests.get(
-                    f"{scale_update_server()}/{train}/{train_check['filename']}",
-                    stream=True,
-                    timeout=30,
-                ) as r:
-                    r.raise_for_status()
-                    for i in r.iter_content(chunk_size=8 * 1024 * 1024):
-                        progress = f.tell()
-                        total = int(r.headers["Content-Length"])
-
-                        job.set_progress(
-                            progress / total * progress_proportion,
-                            f'Downloading update: {humanfriendly.format_size(total)} at '
-                            f'{humanfriendly.format_size(progress / (time.monotonic() - download_start))}/s'
-                        )
-
-                        f.write(i)
+            def progress_callback(progress, total, speed):
+                job.set_progress(
+                    progress / total * progress_proportion if total else 0,
+                    f'Downloading update: {humanfriendly.format_size(total or progress)} at '
+                    f'{humanfriendly.format_size(speed)}/s'
+                )
+
+            download = Download(
+                f"{scale_update_server()}/{train}/{train_check['filename']}",
+                os.path.join(location, "update.sqsh"),
+                train_check["checksum"],
+                self.middleware.call_sync("update.get_download_bandwidth_limit"),
+                progress_callback,
+            )
+
+            job.set_progress(0, "Verifying existing update")
+            if not download.verify_existing():
+                download.run()
 
             return True
 
@@ -1,7 +1,10 @@
-from collections import defaultdict
+from collections import ChainMap, defaultdict
 from contextlib import asynccontextmanager
+import copy
 from datetime import datetime, timedelta
 import errno
+import hashlib
+import json
 import logging
 import multiprocessing
 import os
@@ -44,17 +47,22 @@ from zettarepl.zettarepl import Zettarepl
 
 from middlewared.client import Client, ClientException
 from middlewared.logger import reconfigure_logging, setup_logging
-from middlewared.service import CallError, Service
+from middlewared.service import CallError, periodic, Service
 from middlewared.utils import start_daemon_thread
+from middlewared.utils.connection_pool import ConnectionPool
 import middlewared.utils.osc as osc
 from middlewared.utils.string import make_sentence
 
+# Replication plugin needs to be initialized before zettarepl in order to register network activity
+SETUP_DEPENDENCIES = ["replication"]
+
 INVALID_DATASETS = (
     re.compile(r"freenas-boot($|/)"),
     re.compile(r"[^/]+/\.system($|/)")
 )
 SSH_EXCEPTIONS = (socket.timeout, paramiko.ssh_exception.NoValidConnectionsError, paramiko.ssh_exception.SSHException,
                   IOError, OSError)
+SHELL_POOL_IDLE_TIMEOUT = 300
 
 
 def lifetime_timedelta(value, unit):
@@ -102,6 +110,61 @@ def zettarepl_schedule(schedule):
     return schedule
 
 
+DEFINITION_TASKS_KEYS = ("periodic-snapshot-tasks", "replication-tasks")
+OBSERVER_BATCH_SIZE = 1000
+
+
+def definition_diff(old, new):
+    """
+    Returns changes that turn zettarepl definition `old` into `new` or `None` if they are equal.
+    """
+    if old is None:
+        old = {"timezone": None, **{key: {} for key in DEFINITION_TASKS_KEYS}}
+
+    diff = {}
+    if old["timezone"] != new["timezone"]:
+        diff["timezone"] = new["timezone"]
+
+    for key in DEFINITION_TASKS_KEYS:
+        update = {task_id: task for task_id, task in new[key].items() if old[key].get(task_id) != task}
+        delete = [task_id for task_id in old[key] if task_id not in new[key]]
+        if update or delete:
+            diff[key] = {"update": update, "delete": delete}
+
+    return diff or None
+
+
+def apply_definition_diff(definition, diff):
+    definition = dict(definition, timezone=diff.get("timezone", definition["timezone"]))
+    for key in DEFINITION_TASKS_KEYS:
+        if key in diff:
+            tasks = dict(definition[key])
+            for task_id in diff[key]["delete"]:
+                tasks.pop(task_id, None)
+            tasks.update(diff[key]["update"])
+            definition[key] = tasks
+
+    return definition
+
+
+def changed_definition(definition, diff):
+    """
+    Part of `definition` that is affected by `diff`: updated tasks and periodic snapshot tasks they depend on.
+    """
+    replication_tasks = diff.get("replication-tasks", {"update": {}})["update"]
+    periodic_snapshot_tasks = set(diff.get("periodic-snapshot-tasks", {"update": {}})["update"])
+    for replication_task in replication_tasks.values():
+        periodic_snapshot_tasks.update(replication_task["periodic-snapshot-tasks"])
+
+    return {
+        "timezone": definition["timezone"],
+        "periodic-snapshot-tasks": {task_id: definition["periodic-snapshot-tasks"][task_id]
+                                    for task_id in periodic_snapshot_tasks
+                                    if task_id in definition["periodic-snapshot-tasks"]},
+        "replication-tasks": replication_tasks,
+    }
+
+
 class ReplicationTaskLog:
     def __init__(self, task_id, log):
         self.task_id = task_id
@@ -154,7 +217,7 @@ class ZettareplProcess:
         c = Client('ws+unix:///var/run/middlewared-internal.sock', py_exceptions=True)
         c.subscribe('core.reconfigure_logging', lambda *args, **kwargs: reconfigure_logging())
 
-        definition = Definition.from_data(self.definition, raise_on_error=False)
+        definition = Definition.from_data(copy.deepcopy(self.definition), raise_on_error=False)
         self.observer_queue.put(DefinitionErrors(definition.errors))
 
         clock = Clock()
@@ -218,9 +281,12 @@ class ZettareplProcess:
             command, args = self.command_queue.get()
             if command == "timezone":
                 self.zettarepl.scheduler.tz_clock.timezone = pytz.timezone(args)
-            if command == "tasks":
-                definition = Definition.from_data(args, raise_on_error=False)
+            if command == "definition_diff":
+                self.definition = apply_definition_diff(self.definition, args)
+                definition = Definition.from_data(copy.deepcopy(self.definition), raise_on_error=False)
                 self.observer_queue.put(DefinitionErrors(definition.errors))
+                if "timezone" in args:
+                    self.zettarepl.scheduler.tz_clock.timezone = definition.timezone
                 self.zettarepl.set_tasks(definition.tasks)
             if command == "run_task":
                 class_name, task_id = args
@@ -249,8 +315,12 @@ class ZettareplService(Service):
         self.replication_jobs_channels = defaultdict(list)
         self.queue = None
         self.process = None
+        self.definition = None
         self.zettarepl = None
 
+        self.shell_pool = ConnectionPool(lambda shell: shell.exec(["true"]), lambda shell: shell.close(),
+                                         SSH_EXCEPTIONS, idle_timeout=SHELL_POOL_IDLE_TIMEOUT)
+
     def is_running(self):
         return self.process is not None and self.process.is_alive()
 
@@ -277,6 +347,7 @@ class ZettareplService(Service):
                                             self.queue, self.observer_queue)
                 )
                 self.process.start()
+                self.definition = definition
 
                 if self.observer_queue_reader is None:
                     self.observer_queue_reader = start_daemon_thread(target=self._observer_queue_reader)
@@ -294,6 +365,7 @@ class ZettareplService(Service):
                     os.kill(self.process.pid, signal.SIGKILL)
 
                 self.process = None
+                self.definition = None
 
     def update_timezone(self, timezone):
         if self.queue:
@@ -315,9 +387,15 @@ class ZettareplService(Service):
 
         if self._is_empty_definition(definition):
             self.middleware.call_sync("zettarepl.stop")
-        else:
+        elif not self.is_running():
             self.middleware.call_sync("zettarepl.start")
-            self.queue.put(("tasks", definition))
+        else:
+            with self.lock:
+                diff = definition_diff(self.definition, definition)
+                if diff is not None:
+                    # Only changed tasks are sent, zettarepl process keeps the rest of the definition
+                    self.queue.put(("definition_diff", diff))
+                    self.definition = definition
 
         self.middleware.call_sync("zettarepl.notify_definition", definition, hold_tasks)
 
@@ -482,6 +560,10 @@ class ZettareplService(Service):
                 "allow-empty": periodic_snapshot_task["allow_empty"],
             }
 
+        can_perform_network_activity = None
+        # Many tasks usually share a few SSH connections, there is no need to query their credentials for each task
+        transports = {}
+
         replication_tasks = {}
         for replication_task in await self.middleware.call("replication.query", [["enabled", "=", True]]):
             if replication_task["direction"] == "PUSH":
@@ -502,25 +584,35 @@ class ZettareplService(Service):
                     continue
 
             if replication_task["transport"] != "LOCAL":
-                if not await self.middleware.call("network.general.can_perform_activity", "replication"):
+                if can_perform_network_activity is None:
+                    can_perform_network_activity = await self.middleware.call(
+                        "network.general.can_perform_activity", "replication",
+                    )
+                if not can_perform_network_activity:
                     hold_tasks[f"replication_task_{replication_task['id']}"] = (
                         "Replication network activity is disabled"
                     )
                     continue
 
-            try:
-                transport = await self._define_transport(
-                    replication_task["transport"],
-                    (replication_task["ssh_credentials"] or {}).get("id"),
-                    replication_task["netcat_active_side"],
-                    replication_task["netcat_active_side_listen_address"],
-                    replication_task["netcat_active_side_port_min"],
-                    replication_task["netcat_active_side_port_max"],
-                    replication_task["netcat_passive_side_connect_address"],
-                )
-            except CallError as e:
-                hold_tasks[f"replication_task_{replication_task['id']}"] = e.errmsg
+            transport_args = (
+                replication_task["transport"],
+                (replication_task["ssh_credentials"] or {}).get("id"),
+                replication_task["netcat_active_side"],
+                replication_task["netcat_active_side_listen_address"],
+                replication_task["netcat_active_side_port_min"],
+                replication_task["netcat_active_side_port_max"],
+                replication_task["netcat_passive_side_connect_address"],
+            )
+            if transport_args not in transports:
+                try:
+                    transports[transport_args] = await self._define_transport(*transport_args)
+                except CallError as e:
+                    transports[transport_args] = e
+            transport = transports[transport_args]
+            if isinstance(transport, CallError):
+                hold_tasks[f"replication_task_{replication_task['id']}"] = transport.errmsg
                 continue
+            transport = copy.deepcopy(transport)
 
             my_periodic_snapshot_tasks = [f"task_{periodic_snapshot_task['id']}"
                                           for periodic_snapshot_task in replication_task["periodic_snapshot_tasks"]]
@@ -573,8 +665,10 @@ class ZettareplService(Service):
             "replication-tasks": replication_tasks,
         }
 
-        # Test if does not cause exceptions
-        Definition.from_data(definition, raise_on_error=False)
+        # Test if does not cause exceptions. Tasks that did not change since the last time were already tested.
+        diff = definition_diff(self.definition, definition)
+        if diff is not None:
+            Definition.from_data(changed_definition(definition, diff), raise_on_error=False)
 
         hold_tasks = {
             task_id: {
@@ -601,16 +695,43 @@ class ZettareplService(Service):
 
     @asynccontextmanager
     async def _get_zettarepl_shell(self, transport, ssh_credentials):
-        if transport != "LOCAL":
-            await self.middleware.call("network.general.will_perform_activity", "replication")
+        if transport == "LOCAL":
+            transport_definition = await self._define_transport(transport)
+            transport = create_transport(transport_definition)
+            shell = transport.shell(transport)
+            try:
+                yield shell
+            finally:
+                await self.middleware.run_in_thread(shell.close)
+
+            return
+
+        await self.middleware.call("network.general.will_perform_activity", "replication")
 
+        # Remote shells are pooled so that subsequent calls with the same credentials (i.e. made by the UI dialogs)
+        # do not have to connect and authenticate again
         transport_definition = await self._define_transport(transport, ssh_credentials)
-        transport = create_transport(transport_definition)
-        shell = transport.shell(transport)
+        key = hashlib.sha256(json.dumps(transport_definition, sort_keys=True).encode("utf-8")).hexdigest()
+
+        def create():
+            transport = create_transport(transport_definition)
+            return transport.shell(transport)
+
+        shell = await self.middleware.run_in_thread(self.shell_pool.acquire, key, create)
         try:
             yield shell
-        finally:
-            await self.middleware.run_in_thread(shell.close)
+        except SSH_EXCEPTIONS:
+            await self.middleware.run_in_thread(self.shell_pool.discard, shell)
+            raise
+        except BaseException:
+            await self.middleware.run_in_thread(self.shell_pool.release, key, shell)
+            raise
+        else:
+            await self.middleware.run_in_thread(self.shell_pool.release, key, shell)
+
+    @periodic(60, run_on_start=False)
+    def expire_shells(self):
+        self.shell_pool.expire()
 
     async def _define_transport(self, transport, ssh_credentials=None, netcat_active_side=None,
                                 netcat_active_side_listen_address=None, netcat_active_side_port_min=None,
@@ -662,151 +783,187 @@ class ZettareplService(Service):
 
     def _observer_queue_reader(self):
         while True:
-            message = self.observer_queue.get()
-
+            messages = [self.observer_queue.get()]
+            # Busy replications produce lots of progress messages. Process everything that has accumulated meanwhile
+            # at once so that only the latest state of each task is applied.
+            while len(messages) < OBSERVER_BATCH_SIZE:
+                try:
+                    messages.append(self.observer_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._process_observer_messages(messages)
+
+    def _process_observer_messages(self, messages):
+        states = {}
+        last_snapshots = {}
+        for message in messages:
+            message_states = {}
             try:
                 self.logger.trace("Observer queue got %r", message)
+                self._process_observer_message(message, ChainMap(message_states, states), last_snapshots)
+            except Exception:
+                self.logger.warning("Unhandled exception in observer_queue_reader", exc_info=True)
 
-                # Global events
-
-                if isinstance(message, DefinitionErrors):
-                    definition_errors = {}
-                    for error in message.errors:
-                        if isinstance(error, PeriodicSnapshotTaskDefinitionError):
-                            definition_errors[f"periodic_snapshot_{error.task_id}"] = {
-                                "state": "ERROR",
-                                "datetime": datetime.utcnow(),
-                                "error": make_sentence(str(error)),
-                            }
-                        if isinstance(error, ReplicationTaskDefinitionError):
-                            definition_errors[f"replication_{error.task_id}"] = {
-                                "state": "ERROR",
-                                "datetime": datetime.utcnow(),
-                                "error": make_sentence(str(error)),
-                            }
+            # Terminal states (and their errors) must be applied even if the task is re-scheduled or started again
+            # within the same batch
+            if any(
+                states.get(task_id, {}).get("state") in ("ERROR", "FINISHED") for task_id in message_states
+            ):
+                self._set_states(states, last_snapshots)
+                states = {}
+                last_snapshots = {}
 
-                    self.middleware.call_sync("zettarepl.set_definition_errors", definition_errors)
+            states.update(message_states)
 
-                # Periodic snapshot task
+        self._set_states(states, last_snapshots)
 
-                if isinstance(message, PeriodicSnapshotTaskStart):
-                    self.middleware.call_sync("zettarepl.set_state", f"periodic_snapshot_{message.task_id}", {
-                        "state": "RUNNING",
-                        "datetime": datetime.utcnow(),
-                    })
+    def _set_states(self, states, last_snapshots):
+        if states or last_snapshots:
+            try:
+                self.middleware.call_sync("zettarepl.set_states", states, last_snapshots)
+            except Exception:
+                self.logger.warning("Unhandled exception in observer_queue_reader", exc_info=True)
 
-                if isinstance(message, PeriodicSnapshotTaskSuccess):
-                    self.middleware.call_sync("zettarepl.set_state", f"periodic_snapshot_{message.task_id}", {
-                        "state": "FINISHED",
-                        "datetime": datetime.utcnow(),
-                    })
+    def _process_observer_message(self, message, states, last_snapshots):
+        # Global events
 
-                if isinstance(message, PeriodicSnapshotTaskError):
-                    self.middleware.call_sync("zettarepl.set_state", f"periodic_snapshot_{message.task_id}", {
+        if isinstance(message, DefinitionErrors):
+            definition_errors = {}
+            for error in message.errors:
+                if isinstance(error, PeriodicSnapshotTaskDefinitionError):
+                    definition_errors[f"periodic_snapshot_{error.task_id}"] = {
                         "state": "ERROR",
                         "datetime": datetime.utcnow(),
-                        "error": make_sentence(message.error),
-                    })
-
-                # Replication task events
-
-                if isinstance(message, ReplicationTaskScheduled):
-                    if (
-                            (self.middleware.call_sync(
-                                "zettarepl.get_state_internal", f"replication_{message.task_id}"
-                            ) or {}).get("state") != "RUNNING"
-                    ):
-                        self.middleware.call_sync("zettarepl.set_state", f"replication_{message.task_id}", {
-                            "state": "WAITING",
-                            "datetime": datetime.utcnow(),
-                        })
-
-                if isinstance(message, ReplicationTaskStart):
-                    self.middleware.call_sync("zettarepl.set_state", f"replication_{message.task_id}", {
-                        "state": "RUNNING",
+                        "error": make_sentence(str(error)),
+                    }
+                if isinstance(error, ReplicationTaskDefinitionError):
+                    definition_errors[f"replication_{error.task_id}"] = {
+                        "state": "ERROR",
                         "datetime": datetime.utcnow(),
-                    })
+                        "error": make_sentence(str(error)),
+                    }
 
-                    # Start fake job if none are already running
-                    if not self.replication_jobs_channels[message.task_id]:
-                        self.middleware.call_sync("replication.run", int(message.task_id[5:]), False)
+            self.middleware.call_sync("zettarepl.set_definition_errors", definition_errors)
 
-                if isinstance(message, ReplicationTaskLog):
-                    for channel in self.replication_jobs_channels[message.task_id]:
-                        channel.put(message)
+        # Periodic snapshot task
 
-                if isinstance(message, ReplicationTaskSnapshotStart):
-                    self.middleware.call_sync("zettarepl.set_state", f"replication_{message.task_id}", {
-                        "state": "RUNNING",
-                        "datetime": datetime.utcnow(),
-                        "progress": {
-                            "dataset": message.dataset,
-                            "snapshot": message.snapshot,
-                            "snapshots_sent": message.snapshots_sent,
-                            "snapshots_total": message.snapshots_total,
-                            "bytes_sent": 0,
-                            "bytes_total": 0,
-                            # legacy
-                            "current": 0,
-                            "total": 0,
-                        }
-                    })
-
-                    for channel in self.replication_jobs_channels[message.task_id]:
-                        channel.put(message)
+        if isinstance(message, PeriodicSnapshotTaskStart):
+            states[f"periodic_snapshot_{message.task_id}"] = {
+                "state": "RUNNING",
+                "datetime": datetime.utcnow(),
+            }
 
-                if isinstance(message, ReplicationTaskSnapshotProgress):
-                    self.middleware.call_sync("zettarepl.set_state", f"replication_{message.task_id}", {
-                        "state": "RUNNING",
-                        "datetime": datetime.utcnow(),
-                        "progress": {
-                            "dataset": message.dataset,
-                            "snapshot": message.snapshot,
-                            "snapshots_sent": message.snapshots_sent,
-                            "snapshots_total": message.snapshots_total,
-                            "bytes_sent": message.bytes_sent,
-                            "bytes_total": message.bytes_total,
-                            # legacy
-                            "current": message.bytes_sent,
-                            "total": message.bytes_total,
-                        }
-                    })
-
-                    for channel in self.replication_jobs_channels[message.task_id]:
-                        channel.put(message)
-
-                if isinstance(message, ReplicationTaskSnapshotSuccess):
-                    self.middleware.call_sync("zettarepl.set_last_snapshot", f"replication_{message.task_id}",
-                                              f"{message.dataset}@{message.snapshot}")
-
-                    for channel in self.replication_jobs_channels[message.task_id]:
-                        channel.put(message)
+        if isinstance(message, PeriodicSnapshotTaskSuccess):
+            states[f"periodic_snapshot_{message.task_id}"] = {
+                "state": "FINISHED",
+                "datetime": datetime.utcnow(),
+            }
 
-                if isinstance(message, ReplicationTaskSuccess):
-                    self.middleware.call_sync("zettarepl.set_state", f"replication_{message.task_id}", {
-                        "state": "FINISHED",
-                        "datetime": datetime.utcnow(),
-                    })
+        if isinstance(message, PeriodicSnapshotTaskError):
+            states[f"periodic_snapshot_{message.task_id}"] = {
+                "state": "ERROR",
+                "datetime": datetime.utcnow(),
+                "error": make_sentence(message.error),
+            }
 
-                    for channel in self.replication_jobs_channels[message.task_id]:
-                        channel.put(message)
+        # Replication task events
+
+        if isinstance(message, ReplicationTaskScheduled):
+            task_id = f"replication_{message.task_id}"
+            if task_id in states:
+                state = states[task_id]
+            else:
+                state = self.middleware.call_sync("zettarepl.get_state_internal", task_id)
+            if (state or {}).get("state") != "RUNNING":
+                states[task_id] = {
+                    "state": "WAITING",
+                    "datetime": datetime.utcnow(),
+                }
+
+        if isinstance(message, ReplicationTaskStart):
+            states[f"replication_{message.task_id}"] = {
+                "state": "RUNNING",
+                "datetime": datetime.utcnow(),
+            }
 
-                if isinstance(message, ReplicationTaskError):
-                    self.middleware.call_sync("zettarepl.set_state", f"replication_{message.task_id}", {
-                        "state": "ERROR",
-                        "datetime": datetime.utcnow(),
-                        "error": make_sentence(message.error),
-                    })
+            # Start fake job if none are already running
+            if not self.replication_jobs_channels[message.task_id]:
+                self.middleware.call_sync("replication.run", int(message.task_id[5:]), False)
 
-                    for channel in self.replication_jobs_channels[message.task_id]:
-                        channel.put(message)
+        if isinstance(message, ReplicationTaskLog):
+            for channel in self.replication_jobs_channels[message.task_id]:
+                channel.put(message)
 
-            except Exception:
-                self.logger.warning("Unhandled exception in observer_queue_reader", exc_info=True)
+        if isinstance(message, ReplicationTaskSnapshotStart):
+            states[f"replication_{message.task_id}"] = {
+                "state": "RUNNING",
+                "datetime": datetime.utcnow(),
+                "progress": {
+                    "dataset": message.dataset,
+                    "snapshot": message.snapshot,
+                    "snapshots_sent": message.snapshots_sent,
+                    "snapshots_total": message.snapshots_total,
+                    "bytes_sent": 0,
+                    "bytes_total": 0,
+                    # legacy
+                    "current": 0,
+                    "total": 0,
+                }
+            }
+
+            for channel in self.replication_jobs_channels[message.task_id]:
+                channel.put(message)
+
+        if isinstance(message, ReplicationTaskSnapshotProgress):
+            states[f"replication_{message.task_id}"] = {
+                "state": "RUNNING",
+                "datetime": datetime.utcnow(),
+                "progress": {
+                    "dataset": message.dataset,
+                    "snapshot": message.snapshot,
+                    "snapshots_sent": message.snapshots_sent,
+                    "snapshots_total": message.snapshots_total,
+                    "bytes_sent": message.bytes_sent,
+                    "bytes_total": message.bytes_total,
+                    # legacy
+                    "current": message.bytes_sent,
+                    "total": message.bytes_total,
+                }
+            }
+
+            for channel in self.replication_jobs_channels[message.task_id]:
+                channel.put(message)
+
+        if isinstance(message, ReplicationTaskSnapshotSuccess):
+            last_snapshots[f"replication_{message.task_id}"] = f"{message.dataset}@{message.snapshot}"
+
+            for channel in self.replication_jobs_channels[message.task_id]:
+                channel.put(message)
+
+        if isinstance(message, ReplicationTaskSuccess):
+            states[f"replication_{message.task_id}"] = {
+                "state": "FINISHED",
+                "datetime": datetime.utcnow(),
+            }
+
+            for channel in self.replication_jobs_channels[message.task_id]:
+                channel.put(message)
+
+        if isinstance(message, ReplicationTaskError):
+            states[f"replication_{message.task_id}"] = {
+                "state": "ERROR",
+                "datetime": datetime.utcnow(),
+                "error": make_sentence(message.error),
+            }
+
+            for channel in self.replication_jobs_channels[message.task_id]:
+                channel.put(message)
 
     async def terminate(self):
         await self.middleware.call("zettarepl.flush_state")
         await self.middleware.run_in_thread(self.stop)
+        await self.middleware.run_in_thread(self.shell_pool.clear)
 
 
 async def pool_configuration_change(middleware, *args, **kwargs):
@@ -74,20 +74,34 @@ class ZettareplService(Service):
         old_error = self.error
         self.error = error
         if old_error != self.error:
-            for task_id in self._known_tasks_ids():
-                self._notify_state_change(task_id)
+            self._notify_state_changes(self._known_tasks_ids())
 
     def set_definition_errors(self, definition_errors):
         old_definition_errors = self.definition_errors
+        changed = set(old_definition_errors.keys()) ^ set(definition_errors.keys())
+        for task_id, definition_error in definition_errors.items():
+            old_definition_error = old_definition_errors.get(task_id)
+            if old_definition_error is not None:
+                if old_definition_error["error"] == definition_error["error"]:
+                    definition_errors[task_id] = old_definition_error
+                else:
+                    changed.add(task_id)
         self.definition_errors = definition_errors
-        for task_id in set(old_definition_errors.keys()) | set(self.definition_errors.keys()):
-            self._notify_state_change(task_id)
+        self._notify_state_changes(changed)
 
     def notify_definition(self, definition, hold_tasks):
         old_hold_tasks = self.hold_tasks
+        changed = set(old_hold_tasks.keys()) ^ set(hold_tasks.keys())
+        for task_id, hold_task in hold_tasks.items():
+            old_hold_task = old_hold_tasks.get(task_id)
+            if old_hold_task is not None:
+                if old_hold_task["reason"] == hold_task["reason"]:
+                    # Task is still on hold for the same reason, keep the original hold date
+                    hold_tasks[task_id] = old_hold_task
+                else:
+                    changed.add(task_id)
         self.hold_tasks = hold_tasks
-        for task_id in set(old_hold_tasks.keys()) | set(self.hold_tasks.keys()):
-            self._notify_state_change(task_id)
+        self._notify_state_changes(changed)
 
         task_ids = (
             {f"periodic_snapshot_{k}" for k in definition["periodic-snapshot-tasks"]} |
@@ -105,25 +119,39 @@ class ZettareplService(Service):
                 self.serializable_state.pop(task_id, None)
 
     def set_state(self, task_id, state):
-        self.state[task_id] = state
+        self.set_states({task_id: state}, {})
 
-        if task_id.startswith("replication_task_"):
-            if state["state"] in ("ERROR", "FINISHED"):
-                self.serializable_state[int(task_id.split("_")[-1])]["state"] = state
+    def set_last_snapshot(self, task_id, last_snapshot):
+        self.set_states({}, {task_id: last_snapshot})
 
-        self._notify_state_change(task_id)
+    def set_states(self, states, last_snapshots):
+        """
+        Applies a batch of task states and last sent snapshots collected from zettarepl observer messages.
+        Each task is notified about only once per batch.
+        """
+        for task_id, state in states.items():
+            self.state[task_id] = state
 
-    def set_last_snapshot(self, task_id, last_snapshot):
-        self.last_snapshot[task_id] = last_snapshot
+            if task_id.startswith("replication_task_"):
+                if state["state"] in ("ERROR", "FINISHED"):
+                    self.serializable_state[int(task_id.split("_")[-1])]["state"] = state
 
-        if task_id.startswith("replication_task_"):
-            self.serializable_state[int(task_id.split("_")[-1])]["last_snapshot"] = last_snapshot
+        for task_id, last_snapshot in last_snapshots.items():
+            self.last_snapshot[task_id] = last_snapshot
 
-        self._notify_state_change(task_id)
+            if task_id.startswith("replication_task_"):
+                self.serializable_state[int(task_id.split("_")[-1])]["last_snapshot"] = last_snapshot
 
-    def _notify_state_change(self, task_id):
-        state = self._get_task_state(task_id, self._get_state_context())
-        self.middleware.call_hook_sync("zettarepl.state_change", id=task_id, fields=state)
+        self._notify_state_changes(set(states.keys()) | set(last_snapshots.keys()))
+
+    def _notify_state_changes(self, task_ids):
+        if not task_ids:
+            return
+
+        context = self._get_state_context()
+        for task_id in task_ids:
+            state = self._get_task_state(task_id, context)
+            self.middleware.call_hook_sync("zettarepl.state_change", id=task_id, fields=state)
 
     async def load_state(self):
         for replication in await self.middleware.call("datastore.query", "storage.replication"):
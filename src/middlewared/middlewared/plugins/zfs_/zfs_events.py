@@ -117,50 +117,134 @@ async def devd_zfs_hook(middleware, data):
     ):
         asyncio.ensure_future(middleware.call('pool.sync_encrypted'))
 
-deadman_throttle = defaultdict(list)
+# Events of these classes are coalesced within the window (in seconds) and handled in one go
+STATECHANGE_WINDOW = 1
+SWAPS_CONFIGURE_WINDOW = 5
 
 
-async def zfs_events(middleware, data):
-    event_id = data['class']
-    if event_id in ('sysevent.fs.zfs.resilver_start', 'sysevent.fs.zfs.scrub_start'):
-        await resilver_scrub_start(middleware, data.get('pool'))
-    elif event_id in (
-        'sysevent.fs.zfs.resilver_finish', 'sysevent.fs.zfs.scrub_finish', 'sysevent.fs.zfs.scrub_abort'
-    ):
-        await resilver_scrub_stop_abort(middleware, data.get('pool'))
+class ZFSEventHandler:
+    def __init__(self, method, window=0, key=None):
+        self.method = method
+        self.window = window
+        self.key = key
+
+
+class ZFSEventDispatcher:
+    """
+    Dispatches ZFS events to the handlers registered for their classes.
+
+    A handler without a window is called with each event as it arrives.
+
+    A handler with a coalescing window is called with the list of all the events of its classes that arrived within
+    `window` seconds since the first of them, so a burst of events (e.g. a resilver or a flapping vdev) is handled at
+    most once per window. If `key` is specified, events are coalesced separately for each value of `key(event)`.
+    """
+
+    def __init__(self):
+        self.handlers = defaultdict(list)
+        self.pending = {}
+
+    def register(self, classes, method, window=0, key=None):
+        handler = ZFSEventHandler(method, window, key)
+        for event_class in classes:
+            self.handlers[event_class].append(handler)
+
+    async def dispatch(self, middleware, data):
+        for handler in self.handlers.get(data['class'], []):
+            if not handler.window:
+                await handler.method(middleware, data)
+                continue
 
-    if event_id == 'sysevent.fs.zfs.scrub_finish':
+            pending_key = (handler, handler.key(data) if handler.key else None)
+            if pending_key in self.pending:
+                self.pending[pending_key].append(data)
+            else:
+                self.pending[pending_key] = [data]
+                asyncio.get_event_loop().call_later(
+                    handler.window, lambda k=pending_key: asyncio.ensure_future(self.flush(middleware, k)),
+                )
+
+    async def flush(self, middleware, pending_key):
+        handler = pending_key[0]
+        events = self.pending.pop(pending_key)
+        try:
+            await handler.method(middleware, events)
+        except Exception:
+            middleware.logger.error('Failed to handle ZFS events %r', events, exc_info=True)
+
+
+async def scan_start(middleware, data):
+    await resilver_scrub_start(middleware, data.get('pool'))
+
+
+async def scan_stop(middleware, data):
+    await resilver_scrub_stop_abort(middleware, data.get('pool'))
+
+    if data['class'] == 'sysevent.fs.zfs.scrub_finish':
         await scrub_finished(middleware, data.get('pool'))
-    elif event_id == 'ereport.fs.zfs.deadman':
-        vdev = data.get('vdev_path', '<unknown>')
-        pool = data.get('pool', '<unknown>')
-        now = time.monotonic()
-        interval = 300
-        max_items = 5
-        deadman_throttle[pool] = list(filter(lambda t: t > now - interval, deadman_throttle[pool]))
-        if len(deadman_throttle[pool]) < max_items:
-            asyncio.ensure_future(middleware.call('alert.oneshot_create', 'ZfsDeadman', {
-                'vdev': vdev,
-                'pool': pool,
-            }))
-        deadman_throttle[pool].append(now)
-        deadman_throttle[pool] = deadman_throttle[pool][-max_items:]
-    elif event_id == 'resource.fs.zfs.statechange':
-        await middleware.call('cache.pop', CACHE_POOLS_STATUSES)
-    elif event_id in (
-        'sysevent.fs.zfs.config_sync',
-        'sysevent.fs.zfs.pool_destroy',
-        'sysevent.fs.zfs.pool_import',
-    ):
-        # Swap must be configured only on disks being used by some pool,
-        # for this reason we must react to certain types of ZFS events to keep
-        # it in sync every time there is a change.
-        asyncio.ensure_future(middleware.call('disk.swaps_configure'))
-    elif (
-        event_id == 'sysevent.fs.zfs.history_event' and data.get(
-            'history_internal_name'
-        ) == 'destroy' and data.get('history_dsname')
-    ):
+
+
+deadman_throttle = defaultdict(list)
+
+
+async def deadman(middleware, data):
+    vdev = data.get('vdev_path', '<unknown>')
+    pool = data.get('pool', '<unknown>')
+    now = time.monotonic()
+    interval = 300
+    max_items = 5
+    deadman_throttle[pool] = list(filter(lambda t: t > now - interval, deadman_throttle[pool]))
+    if len(deadman_throttle[pool]) < max_items:
+        asyncio.ensure_future(middleware.call('alert.oneshot_create', 'ZfsDeadman', {
+            'vdev': vdev,
+            'pool': pool,
+        }))
+    deadman_throttle[pool].append(now)
+    deadman_throttle[pool] = deadman_throttle[pool][-max_items:]
+
+
+async def update_pool_status(middleware, events):
+    """
+    Update the status of the pool whose vdevs changed state in cached pools statuses.
+    """
+    pool = events[0].get('pool')
+    try:
+        statuses = await middleware.call('cache.get', CACHE_POOLS_STATUSES)
+    except KeyError:
+        # Not cached or expired, will be retrieved from scratch when needed
+        return
+
+    if pool not in statuses and pool == await middleware.call('boot.pool_name'):
+        # Boot pool is not reported
+        return
+
+    zpool = await middleware.call('zfs.pool.query', [['name', '=', pool]])
+    if pool not in statuses or not zpool:
+        # Pool was imported or is gone since the statuses were cached
+        await invalidate_pools_statuses(middleware)
+        return
+
+    try:
+        await middleware.call('cache.update', CACHE_POOLS_STATUSES, {**statuses, pool: {'status': zpool[0]['status']}})
+    except KeyError:
+        # Expired in the meantime
+        pass
+
+
+async def invalidate_pools_statuses(middleware, *args, **kwargs):
+    # Will be retrieved from scratch when needed
+    await middleware.call('cache.pop', CACHE_POOLS_STATUSES)
+
+
+async def swaps_configure(middleware, events):
+    # Swap must be configured only on disks being used by some pool,
+    # for this reason we must react to certain types of ZFS events to keep
+    # it in sync every time there is a change.
+    await middleware.call('disk.swaps_configure')
+
+
+async def history_event(middleware, data):
+    if data.get('history_internal_name') == 'destroy' and data.get('history_dsname'):
         await middleware.call(
             'pool.dataset.delete_encrypted_datasets_from_db', [
                 ['OR', [['name', '=', data['history_dsname']], ['name', '^', f'{data["history_dsname"]}/']]]
@@ -169,8 +253,33 @@ async def zfs_events(middleware, data):
         await middleware.call_hook('dataset.post_delete', data['history_dsname'])
 
 
+def zfs_events_dispatcher():
+    dispatcher = ZFSEventDispatcher()
+    dispatcher.register(['sysevent.fs.zfs.resilver_start', 'sysevent.fs.zfs.scrub_start'], scan_start)
+    dispatcher.register(
+        ['sysevent.fs.zfs.resilver_finish', 'sysevent.fs.zfs.scrub_finish', 'sysevent.fs.zfs.scrub_abort'], scan_stop,
+    )
+    dispatcher.register(['ereport.fs.zfs.deadman'], deadman)
+    dispatcher.register(
+        ['resource.fs.zfs.statechange'], update_pool_status, STATECHANGE_WINDOW, lambda data: data.get('pool'),
+    )
+    dispatcher.register(
+        ['sysevent.fs.zfs.pool_create', 'sysevent.fs.zfs.pool_destroy', 'sysevent.fs.zfs.pool_import'],
+        invalidate_pools_statuses,
+    )
+    dispatcher.register(
+        ['sysevent.fs.zfs.config_sync', 'sysevent.fs.zfs.pool_destroy', 'sysevent.fs.zfs.pool_import'],
+        swaps_configure, SWAPS_CONFIGURE_WINDOW,
+    )
+    dispatcher.register(['sysevent.fs.zfs.history_event'], history_event)
+    return dispatcher
+
+
 def setup(middleware):
     middleware.event_register('zfs.pool.scan', 'Progress of pool resilver/scrub.')
-    middleware.register_hook('zfs.pool.events', zfs_events, sync=False)
+    middleware.register_hook('zfs.pool.events', zfs_events_dispatcher().dispatch, sync=False)
+    # Pools statuses are retrieved from the database so they also need to be refreshed once it is updated
+    for hook in ['pool.post_create_or_update', 'pool.post_export', 'pool.post_import']:
+        middleware.register_hook(hook, invalidate_pools_statuses, sync=False)
     if osc.IS_FREEBSD:
         middleware.register_hook('devd.zfs', devd_zfs_hook)
@@ -0,0 +1,91 @@
+from asynctest import Mock
+import pytest
+
+from middlewared.plugins.account import GroupService, UserService
+from middlewared.pytest.unit.middleware import Middleware
+
+MEMBERSHIPS = [
+    {"id": 1, "user_id": 1, "group_id": 10},
+    {"id": 2, "user_id": 1, "group_id": 11},
+    {"id": 3, "user_id": 2, "group_id": 11},
+]
+USERS = [
+    {"id": 1, "username": "alice", "group_id": 20},
+    {"id": 2, "username": "bob", "group_id": 10},
+    {"id": 3, "username": "carol", "group_id": 10},
+]
+
+
+def datastore_query(name, filters=None, options=None):
+    return {
+        "account.bsdgroupmembership": MEMBERSHIPS,
+        "account.bsdusers": USERS,
+    }[name]
+
+
+def user(id, home="/nonexistent"):
+    return {"id": id, "email": "", "home": home}
+
+
+@pytest.mark.asyncio
+async def test__user_extend__groups():
+    m = Middleware()
+    m["datastore.query"] = Mock(side_effect=datastore_query)
+    service = UserService(m)
+
+    ctx = await service.user_extend_context({})
+    users = [await service.user_extend(user(id), ctx) for id in (1, 2, 3)]
+
+    assert [u["groups"] for u in users] == [[10, 11], [11], []]
+    assert users[0]["email"] is None
+    m["datastore.query"].assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test__group_extend__users():
+    m = Middleware()
+    m["datastore.query"] = Mock(side_effect=datastore_query)
+    service = GroupService(m)
+
+    ctx = await service.group_extend_context({})
+    groups = [await service.group_extend({"id": id}, ctx) for id in (10, 11, 12, 20)]
+
+    # Auxiliary group members followed by users that have this group as primary group
+    assert [g["users"] for g in groups] == [[1, 2, 3], [1, 2], [], [1]]
+    assert m["datastore.query"].call_count == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("read_sshpubkey,sshpubkey", [
+    (True, "ssh-ed25519 AAAA alice\n"),
+    (False, None),
+])
+async def test__user_extend__sshpubkey(tmp_path, read_sshpubkey, sshpubkey):
+    (tmp_path / ".ssh").mkdir()
+    (tmp_path / ".ssh" / "authorized_keys").write_text("ssh-ed25519 AAAA alice\n")
+
+    m = Middleware()
+    m["datastore.query"] = Mock(side_effect=datastore_query)
+    service = UserService(m)
+
+    ctx = await service.user_extend_context({"read_sshpubkey": read_sshpubkey})
+
+    assert (await service.user_extend(user(1, str(tmp_path)), ctx))["sshpubkey"] == sshpubkey
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("options,read_sshpubkey", [
+    ({}, True),
+    ({"select": ["username", "sshpubkey"]}, True),
+    ({"select": ["id", "username", "group"]}, False),
+])
+async def test__user_query__reads_sshpubkey_only_when_selected(options, read_sshpubkey):
+    m = Middleware()
+    m["datastore.query"] = Mock(return_value=[])
+    service = UserService(m)
+
+    await UserService.query.wraps(service, [], options)
+
+    datastore_options = m["datastore.query"].call_args[0][2]
+    assert datastore_options["extend_context"] == "user.user_extend_context"
+    assert datastore_options["extra"]["read_sshpubkey"] is read_sshpubkey
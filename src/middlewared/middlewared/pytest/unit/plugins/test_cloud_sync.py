@@ -1,13 +1,22 @@
 # flake8: noqa
 import io
+import json
+import os
+import shutil
+import sys
 import textwrap
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import pytest
 
+from middlewared.plugins import cloud_sync
 from middlewared.plugins.cloud_sync import (
-    get_dataset_recursive, FsLockManager, lsjson_error_excerpt, RcloneVerboseLogCutter
+    CloudSyncService, get_dataset_recursive, FsLockManager, lsjson_error_excerpt, rclone_stats_progress,
+    RcloneVerboseLogCutter,
 )
+from middlewared.pytest.unit.middleware import Middleware
+from middlewared.rclone.base import BaseRcloneRemote
+from middlewared.rclone.rc import connection_string, RcloneRc, RcloneRcd
 
 
 def test__get_dataset_recursive_1():
@@ -204,7 +213,12 @@ def test__fs_lock_manager_3():
         "data at input byte 0\n",
 
         "Failed to parse credentials: illegal base64 data at input byte 0"
-    )
+    ),
+    (
+        "failed to create file system for \"remote:\": didn't find section in config file",
+
+        "didn't find section in config file"
+    ),
 ])
 def test__lsjson_error_excerpt(error, excerpt):
     assert lsjson_error_excerpt(error) == excerpt
@@ -255,3 +269,165 @@ def test__RcloneVerboseLogCutter(input, output):
         out += result
 
     assert out == output
+
+
+@pytest.mark.parametrize("config,path,result", [
+    ({"type": "local"}, "/mnt/tank", ":local:/mnt/tank"),
+    ({"type": "s3", "access_key_id": "AKIA", "secret_access_key": "a,b:c\"d", "v2_auth": False}, "bucket/dir",
+     ':s3,access_key_id="AKIA",secret_access_key="a,b:c""d",v2_auth="false":bucket/dir'),
+    ({"type": "crypt", "remote": ':s3,access_key_id="AKIA":bucket', "password": "xxx"}, "",
+     ':crypt,remote=":s3,access_key_id=""AKIA"":bucket",password="xxx":'),
+])
+def test__connection_string(config, path, result):
+    assert connection_string(config, path) == result
+
+
+@pytest.mark.parametrize("stats,result", [
+    ({"bytes": 0, "totalBytes": 0, "speed": 0, "eta": None}, (0, "0 bytes / 0 bytes, 0 bytes/s, ETA -")),
+    ({"bytes": 3 * 1024 ** 3, "totalBytes": 12 * 1024 ** 3, "speed": 10 * 1024 ** 2, "eta": 921},
+     (25, "3 GiB / 12 GiB, 10 MiB/s, ETA 15 minutes and 21 seconds")),
+])
+def test__rclone_stats_progress(stats, result):
+    assert rclone_stats_progress(stats) == result
+
+
+class LocalRcloneRemote(BaseRcloneRemote):
+    name = "LOCAL"
+    title = "Local"
+
+    rclone_type = "local"
+
+
+@pytest.fixture
+def cloud_sync_service():
+    m = Middleware()
+    m["network.general.will_perform_activity"] = Mock()
+    with patch.dict("middlewared.plugins.cloud_sync.REMOTES", {"LOCAL": LocalRcloneRemote(m)}):
+        yield CloudSyncService(m)
+
+
+def ls_config(tmp_path, **kwargs):
+    return {
+        "credentials": {"id": 1, "provider": "LOCAL", "attributes": {}},
+        "attributes": {"folder": str(tmp_path)},
+        "encryption": False,
+        "filename_encryption": False,
+        "encryption_password": "",
+        "encryption_salt": "",
+        **kwargs,
+    }
+
+
+@pytest.mark.skipif(shutil.which("rclone") is None, reason="rclone is not installed")
+@pytest.mark.asyncio
+async def test__cloud_sync_ls__rcd(cloud_sync_service, tmp_path):
+    (tmp_path / "file").write_text("Hello")
+    (tmp_path / "dir").mkdir()
+
+    try:
+        result = await cloud_sync_service.ls(ls_config(tmp_path), str(tmp_path))
+        assert sorted((item["Name"], item["IsDir"]) for item in result) == [("dir", True), ("file", False)]
+        assert [item["Size"] for item in result if item["Name"] == "file"] == [5]
+
+        # Served from the listing cache
+        (tmp_path / "new_file").write_text("")
+        with patch.object(cloud_sync_service.rcd, "call") as call:
+            assert await cloud_sync_service.ls(ls_config(tmp_path), str(tmp_path)) == result
+            call.assert_not_called()
+
+        cloud_sync_service.ls_cache.clear()
+        assert len(await cloud_sync_service.ls(ls_config(tmp_path), str(tmp_path))) == 3
+    finally:
+        cloud_sync_service.ls_cache.clear()
+        await cloud_sync_service.rcd.stop()
+
+
+@pytest.mark.skipif(shutil.which("rclone") is None, reason="rclone is not installed")
+@pytest.mark.asyncio
+async def test__cloud_sync_ls__rcd_crypt(cloud_sync_service, tmp_path):
+    config = ls_config(tmp_path, encryption=True, filename_encryption=True, encryption_password="secret")
+    (tmp_path / "not_encrypted").mkdir()
+
+    try:
+        rclone_config = cloud_sync.RcloneConfig(config)
+        async with rclone_config:
+            await cloud_sync_service.rcd.call("operations/mkdir", {"fs": rclone_config.encrypted_fs(),
+                                                                   "remote": "encrypted_dir"})
+
+        result = await cloud_sync_service.ls(config, str(tmp_path))
+
+        assert len(result) == 2
+        assert {item.get("Decrypted") for item in result} == {None, "encrypted_dir"}
+        assert [item["Name"] for item in result if "Decrypted" not in item] == ["not_encrypted"]
+    finally:
+        cloud_sync_service.ls_cache.clear()
+        await cloud_sync_service.rcd.stop()
+
+
+FAKE_RCLONE = textwrap.dedent("""\
+    import base64
+    import http.server
+    import json
+    import os
+    import sys
+
+    with open(os.environ["FAKE_RCLONE_ARGS"], "w") as f:
+        json.dump(sys.argv[1:], f)
+
+    auth = "Basic " + base64.b64encode(
+        f"{os.environ['RCLONE_RC_USER']}:{os.environ['RCLONE_RC_PASS']}".encode()
+    ).decode()
+
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            status = 200 if self.headers["Authorization"] == auth else 401
+            self.send_response(status)
+            self.end_headers()
+            self.wfile.write(json.dumps({"path": self.path, "status": status}).encode())
+
+        def log_message(self, *args):
+            pass
+
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    sys.stderr.write(f"2020/01/01 00:00:00 NOTICE: Serving remote control on http://127.0.0.1:{server.server_port}/\\n")
+    sys.stderr.flush()
+    server.serve_forever()
+""")
+
+
+@pytest.fixture
+def fake_rclone(tmp_path, monkeypatch):
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    (bin / "rclone").write_text(f"#!{sys.executable}\n{FAKE_RCLONE}")
+    (bin / "rclone").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_RCLONE_ARGS", str(tmp_path / "args"))
+    return tmp_path
+
+
+@pytest.mark.asyncio
+async def test__rcd__credentials_and_address(fake_rclone):
+    rcd = RcloneRcd()
+    try:
+        assert await rcd.call("operations/list") == {"path": "/operations/list", "status": 200}
+        assert rcd.rc.address.startswith("127.0.0.1:")
+        assert not rcd.rc.address.endswith(":0")
+
+        args = json.loads((fake_rclone / "args").read_text())
+        assert args[args.index("--rc-addr") + 1] == "127.0.0.1:0"
+        assert rcd.rc.user not in args and rcd.rc.password not in args
+    finally:
+        await rcd.stop()
+
+
+def test__rc__parse_address():
+    rc = RcloneRc.create()
+    rc.parse_address("2020/01/01 00:00:00 INFO  : Starting")
+    assert rc.address is None
+
+    rc.parse_address("2020/01/01 00:00:00 NOTICE: Serving remote control on http://127.0.0.1:43567/")
+    assert rc.address == "127.0.0.1:43567"
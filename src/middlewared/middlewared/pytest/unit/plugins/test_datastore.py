@@ -41,6 +41,7 @@ async def datastore_test():
 
                 m["datastore.execute"] = ds.execute
                 m["datastore.execute_write"] = ds.execute_write
+                m["datastore.execute_write_many"] = ds.execute_write_many
                 m["datastore.fetchall"] = ds.fetchall
 
                 m["datastore.query"] = ds.query
@@ -216,6 +217,45 @@ async def test__update_fk():
         )
 
 
+@pytest.mark.asyncio
+async def test__update_many():
+    async with datastore_test() as ds:
+        await ds.execute("INSERT INTO `account_bsdgroups` VALUES (20, 2020)")
+        await ds.execute("INSERT INTO `account_bsdgroups` VALUES (30, 3030)")
+        await ds.execute("INSERT INTO `account_bsdusers` VALUES (5, 55, 20)")
+
+        await ds.update_many("account_bsdgroups", [[20, {"bsdgrp_gid": 2000}], [30, {"bsdgrp_gid": 3000}]])
+        await ds.update_many("account_bsdusers", [[5, {"bsdusr_group": 30}]])
+
+        assert [tuple(row) for row in await ds.fetchall("SELECT * FROM account_bsdgroups")] == [(20, 2000), (30, 3000)]
+        assert [tuple(row) for row in await ds.fetchall("SELECT * FROM account_bsdusers")] == [(5, 55, 30)]
+        assert ds.middleware.call_hook_inline.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test__update_many__rollback():
+    async with datastore_test() as ds:
+        await ds.execute("INSERT INTO `account_bsdgroups` VALUES (20, 2020)")
+
+        with pytest.raises(IntegrityError):
+            await ds.update_many("account_bsdgroups", [[20, {"bsdgrp_gid": 2000}], [20, {"bsdgrp_gid": None}]])
+
+        assert [tuple(row) for row in await ds.fetchall("SELECT * FROM account_bsdgroups")] == [(20, 2020)]
+        ds.middleware.call_hook_inline.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test__update_many__missing_row_rollback():
+    async with datastore_test() as ds:
+        await ds.execute("INSERT INTO `account_bsdgroups` VALUES (20, 2020)")
+
+        with pytest.raises(RuntimeError):
+            await ds.update_many("account_bsdgroups", [[20, {"bsdgrp_gid": 2000}], [30, {"bsdgrp_gid": 3000}]])
+
+        assert [tuple(row) for row in await ds.fetchall("SELECT * FROM account_bsdgroups")] == [(20, 2020)]
+        ds.middleware.call_hook_inline.assert_not_called()
+
+
 @pytest.mark.asyncio
 async def test__bad_fk_update():
     async with datastore_test() as ds:
@@ -1,57 +1,156 @@
-import textwrap
+import asyncio
+import json
 
-from asynctest import CoroutineMock, Mock
+from asynctest import CoroutineMock, Mock, patch
 import pytest
 
+from middlewared.plugins.disk_.disk_events import DiskHotplugCoalescer
 from middlewared.plugins.disk_.smart_attributes import DiskService as SmartAttributesDiskService
-from middlewared.plugins.disk_.temperature import get_temperature
+from middlewared.plugins.disk_.smart_data import DiskService as SmartDataDiskService
+from middlewared.plugins.disk_.temperature import DiskService as TemperatureDiskService, get_temperature
 from middlewared.pytest.unit.middleware import Middleware
 
 
-@pytest.mark.parametrize("stdout,temperature", [
-    # ataprint.cpp
-    ("190 Airflow_Temperature_Cel 0x0022   073   037   045    Old_age   Always   In_the_past 27 (3 44 30 26 0)", 27),
-    ("194 Temperature_Celsius     0x0022   049   067   ---    Old_age   Always       -       51 (Min/Max 24/67)", 51),
-    ("190 Airflow_Temperature_Cel 0x0022   073   037   045    Old_age   Always   In_the_past 27 (3 44 30 26 0)\n"
-     "194 Temperature_Celsius     0x0022   049   067   ---    Old_age   Always       -       51 (Min/Max 24/67)", 51),
-    ("194 Temperature_Internal    0x0022   100   100   000    Old_age   Always       -       26\n"
-     "190 Temperature_Case        0x0022   100   100   000    Old_age   Always       -       27", 26),
-    ("  7 Seek_Error_Rate         0x000f   081   060   030    Pre-fail  Always       -       126511909\n"
-     "190 Airflow_Temperature_Cel 0x0022   062   053   045    Old_age   Always       -       38 (Min/Max 27/40)", 38),
-    # nvmeprint.cpp
-    ("Temperature:                        40 Celsius", 40),
-    ("Temperature Sensor 1:               30 Celsius", 30),
-    # scsiprint.cpp
-    ("Current Drive Temperature:     31 C", 31),
+def ata_attribute(id, name, raw):
+    return {"id": id, "name": name, "raw": {"value": int(raw.split()[0]), "string": raw}}
+
+
+@pytest.mark.parametrize("data,temperature", [
+    ({"ata_smart_attributes": {"table": [
+        ata_attribute(190, "Airflow_Temperature_Cel", "27 (3 44 30 26 0)"),
+    ]}}, 27),
+    ({"ata_smart_attributes": {"table": [
+        ata_attribute(194, "Temperature_Celsius", "51 (Min/Max 24/67)"),
+    ]}}, 51),
+    ({"ata_smart_attributes": {"table": [
+        ata_attribute(190, "Airflow_Temperature_Cel", "27 (3 44 30 26 0)"),
+        ata_attribute(194, "Temperature_Celsius", "51 (Min/Max 24/67)"),
+    ]}}, 51),
+    ({"ata_smart_attributes": {"table": [
+        ata_attribute(194, "Temperature_Internal", "26"),
+        ata_attribute(190, "Temperature_Case", "27"),
+    ]}}, 26),
+    ({"ata_smart_attributes": {"table": [
+        ata_attribute(7, "Seek_Error_Rate", "126511909"),
+        ata_attribute(190, "Airflow_Temperature_Cel", "38 (Min/Max 27/40)"),
+    ]}}, 38),
+    # Reported by smartctl for ATA, NVMe and SCSI devices alike
+    ({"temperature": {"current": 40}, "ata_smart_attributes": {"table": [
+        ata_attribute(194, "Temperature_Celsius", "39 (Min/Max 24/67)"),
+    ]}}, 40),
+    ({"temperature": {"current": 31}}, 31),
+    ({"ata_smart_attributes": {"table": []}}, None),
 ])
-def test__get_temperature(stdout, temperature):
-    assert get_temperature(stdout) == temperature
+def test__get_temperature(data, temperature):
+    assert get_temperature(data) == temperature
 
 
 @pytest.mark.asyncio
 async def test__disk_service__sata_dom_lifetime_left():
-
     m = Middleware()
-    m["disk.smartctl"] = Mock(return_value=textwrap.dedent("""\
-        smartctl 6.6 2017-11-05 r4594 [FreeBSD 11.2-STABLE amd64] (local build)
-        Copyright (C) 2002-17, Bruce Allen, Christian Franke, www.smartmontools.org
-
-        === START OF READ SMART DATA SECTION ===
-        SMART Attributes Data Structure revision number: 0
-        Vendor Specific SMART Attributes with Thresholds:
-        ID# ATTRIBUTE_NAME          FLAG     VALUE WORST THRESH TYPE      UPDATED  WHEN_FAILED RAW_VALUE
-          9 Power_On_Hours          0x0012   100   100   000    Old_age   Always       -       8693
-         12 Power_Cycle_Count       0x0012   100   100   000    Old_age   Always       -       240
-        163 Unknown_Attribute       0x0000   100   100   001    Old_age   Offline      -       1065
-        164 Unknown_Attribute       0x0000   100   100   001    Old_age   Offline      -       322
-        166 Unknown_Attribute       0x0000   100   100   010    Old_age   Offline      -       0
-        167 Unknown_Attribute       0x0022   100   100   000    Old_age   Always       -       0
-        168 Unknown_Attribute       0x0012   100   100   000    Old_age   Always       -       0
-        175 Program_Fail_Count_Chip 0x0013   100   100   010    Pre-fail  Always       -       0
-        192 Power-Off_Retract_Count 0x0012   100   100   000    Old_age   Always       -       208
-        194 Temperature_Celsius     0x0022   060   060   030    Old_age   Always       -       40 (Min/Max 30/60)
-        241 Total_LBAs_Written      0x0032   100   100   000    Old_age   Always       -       14088053817
-
-    """))
+    m["disk.smart_data"] = CoroutineMock(return_value={"ata_smart_attributes": {"table": [
+        ata_attribute(9, "Power_On_Hours", "8693"),
+        ata_attribute(12, "Power_Cycle_Count", "240"),
+        ata_attribute(163, "Unknown_Attribute", "1065"),
+        ata_attribute(164, "Unknown_Attribute", "322"),
+        ata_attribute(166, "Unknown_Attribute", "0"),
+        ata_attribute(241, "Total_LBAs_Written", "14088053817"),
+    ]}})
 
     assert abs(await SmartAttributesDiskService(m).sata_dom_lifetime_left("ada1") - 0.8926) < 1e-4
+
+
+@pytest.mark.asyncio
+async def test__disk_service__smart_data__shared_between_consumers():
+    m = Middleware()
+    m["disk.smartctl_args"] = CoroutineMock(return_value=["/dev/ada1"])
+    m["disk.smart_data"] = SmartDataDiskService(m).smart_data
+    SmartDataDiskService.smart_data_cache.clear()
+
+    data = {
+        "temperature": {"current": 35},
+        "ata_smart_attributes": {"table": [ata_attribute(164, "Unknown_Attribute", "322")]},
+        "ata_smart_self_test_log": {"standard": {"table": []}},
+    }
+    with patch("middlewared.plugins.disk_.smart_data.smartctl", CoroutineMock(
+        return_value=Mock(returncode=0, stdout=json.dumps(data)),
+    )) as smartctl:
+        assert await TemperatureDiskService(m).temperature("ada1", "NEVER") == 35
+        assert await SmartAttributesDiskService(m).smart_attributes("ada1") == data["ata_smart_attributes"]["table"]
+        assert await SmartAttributesDiskService(m).sata_dom_lifetime_left("ada1") is not None
+
+        smartctl.assert_called_once_with(["/dev/ada1", "-j", "-a", "-n", "never"], check=False, encoding="utf8",
+                                         errors="ignore")
+
+        await SmartDataDiskService(m).smart_data_invalidate("ada1")
+        await SmartDataDiskService(m).smart_data("ada1", {"max_age": 0})
+        assert smartctl.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test__disk_service__smart_data__standby():
+    m = Middleware()
+    m["disk.smartctl_args"] = CoroutineMock(return_value=["/dev/ada1"])
+    SmartDataDiskService.smart_data_cache.clear()
+
+    with patch("middlewared.plugins.disk_.smart_data.smartctl", CoroutineMock(
+        return_value=Mock(returncode=2, stdout=""),
+    )) as smartctl:
+        assert await SmartDataDiskService(m).smart_data("ada1", {"powermode": "STANDBY"}) is None
+        assert await SmartDataDiskService(m).smart_data("ada1", {"powermode": "STANDBY"}) is None
+        smartctl.assert_called_once()
+
+        # Caller that is fine with waking the disk up is not served the cached standby result
+        assert await SmartDataDiskService(m).smart_data("ada1", {"powermode": "NEVER"}) is None
+        assert smartctl.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test__disk_hotplug_coalescer__batches_added_disks():
+    m = Middleware()
+    m.loop = asyncio.get_event_loop()
+    m["disk.sync_batch"] = CoroutineMock()
+    m["disk.sync_all"] = CoroutineMock()
+    m["disk.sed_unlock"] = CoroutineMock()
+    m["disk.multipath_sync"] = CoroutineMock()
+    m["disk.swaps_configure"] = CoroutineMock()
+    m["alert.oneshot_delete"] = CoroutineMock()
+    m["disk.smart_data_invalidate"] = CoroutineMock()
+
+    coalescer = DiskHotplugCoalescer(m, quiet_period=0.1, max_delay=1)
+    for i in range(60):
+        coalescer.add(f"sd{i}")
+
+    await asyncio.sleep(0.3)
+
+    m["disk.sync_batch"].assert_called_once_with(sorted(f"sd{i}" for i in range(60)))
+    m["disk.sync_all"].assert_not_called()
+    m["disk.swaps_configure"].assert_not_called()
+    assert m["disk.sed_unlock"].call_count == 60
+    assert coalescer.stats["bursts"] == 1
+    assert coalescer.stats["coalesced"] == 59
+
+
+@pytest.mark.asyncio
+async def test__disk_hotplug_coalescer__removal_runs_single_sync_all():
+    m = Middleware()
+    m.loop = asyncio.get_event_loop()
+    sync_all_job = Mock(wait=CoroutineMock())
+    m["disk.sync_batch"] = CoroutineMock()
+    m["disk.sync_all"] = CoroutineMock(return_value=sync_all_job)
+    m["disk.sed_unlock"] = CoroutineMock()
+    m["disk.multipath_sync"] = CoroutineMock()
+    m["disk.swaps_configure"] = CoroutineMock()
+    m["alert.oneshot_delete"] = CoroutineMock()
+    m["disk.smart_data_invalidate"] = CoroutineMock()
+
+    coalescer = DiskHotplugCoalescer(m, quiet_period=0.1, max_delay=1)
+    for i in range(10):
+        coalescer.remove(f"sd{i}")
+
+    await asyncio.sleep(0.3)
+
+    m["disk.sync_all"].assert_called_once_with()
+    m["disk.sync_batch"].assert_not_called()
+    m["disk.swaps_configure"].assert_called_once_with()
+    assert coalescer.stats["coalesced"] == 9
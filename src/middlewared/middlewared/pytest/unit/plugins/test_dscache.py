@@ -0,0 +1,111 @@
+import grp
+import pwd
+
+import pytest
+
+from middlewared.plugins.cache_.dscache_store import DSCacheStore, group_entry, user_entry
+from middlewared.utils import filter_list
+
+
+def user(name, uid, **kwargs):
+    return user_entry(pwd.struct_passwd((name, "x", uid, uid, name.upper(), f"/home/{name}", "/bin/sh")), **kwargs)
+
+
+@pytest.fixture
+def store():
+    store = DSCacheStore()
+    store.update("ldap", "USERS", [user(f"user{i:03d}", 10000 + i) for i in range(200)], replace=True,
+                 id_base=100000000)
+    store.update("activedirectory", "USERS", [user("aduser", 20000, sid="S-1-5-21-1-2-3-1104")], replace=True,
+                 id_base=300000000)
+    return store
+
+
+def test__dscache_store__update__only_writes_changes(store):
+    users = store.query(["ldap"], "USERS")
+    assert [u["id"] for u in users] == list(range(100000000, 100000200))
+
+    new_users = [user(f"user{i:03d}", 10000 + i) for i in range(1, 200)] + [user("user200", 10200)]
+    new_users[0]["full_name"] = "Changed"
+    assert store.update("ldap", "USERS", new_users, replace=True, id_base=100000000) == (2, 1)
+
+    users = {u["username"]: u for u in store.query(["ldap"], "USERS")}
+    assert "user000" not in users
+    assert users["user001"]["full_name"] == "Changed"
+    # Existing entries keep their ids
+    assert users["user001"]["id"] == 100000001
+    assert users["user200"]["id"] == 100000200
+
+    assert store.update("ldap", "USERS", new_users, replace=True, id_base=100000000) == (0, 0)
+
+
+def test__dscache_store__update__incremental(store):
+    assert store.update("ldap", "USERS", [user("renamed", 10005)], delete=["user010", "missing"]) == (1, 2)
+
+    assert store.xids("ldap", "USERS")[10005] == "renamed"
+    assert 10010 not in store.xids("ldap", "USERS")
+    assert store.query(["ldap"], "USERS", [["username", "=", "user005"]]) == []
+    assert store.query(["ldap"], "USERS", [["uid", "=", 10005]], {"get": True})["username"] == "renamed"
+
+
+@pytest.mark.parametrize("filters,options", [
+    ([["username", "=", "user005"]], {}),
+    ([["username", "=", "aduser"]], {}),
+    ([["uid", "=", 10007]], {}),
+    ([["uid", "=", "10007"]], {}),
+    ([["uid", "in", [10001, 10003, 20000, 5]]], {}),
+    ([["uid", "in", []]], {}),
+    ([["username", "^", "user01"]], {}),
+    ([["username", "^", "user01"], ["uid", ">", 10015]], {}),
+    ([["sid", "=", "S-1-5-21-1-2-3-1104"]], {}),
+    ([["full_name", "=", "USER042"]], {}),
+    ([["OR", [["uid", "=", 10001], ["username", "=", "aduser"]]]], {}),
+    ([], {"limit": 10, "offset": 195}),
+    ([], {"order_by": ["-uid"], "limit": 5}),
+    ([["username", "^", "user1"]], {"count": True}),
+    ([["uid", ">=", 10100]], {"count": True}),
+    ([["username", "^", "user1"]], {"select": ["username"], "limit": 3}),
+    ([["username", "=", "user005"]], {"get": True}),
+])
+def test__dscache_store__query__same_as_filter_list(store, filters, options):
+    entries = sorted(store.query(["ldap", "activedirectory"], "USERS"), key=lambda u: u["username"])
+    assert len(entries) == 201
+
+    assert store.query(["ldap", "activedirectory"], "USERS", filters, options) == filter_list(entries, filters,
+                                                                                             options)
+
+
+def test__dscache_store__query__directory_services(store):
+    assert [u["username"] for u in store.query(["activedirectory"], "USERS")] == ["aduser"]
+    assert store.query([], "USERS", [], {"count": True}) == 0
+
+    store.clear("activedirectory")
+    assert store.query(["activedirectory"], "USERS") == []
+    assert len(store.query(["ldap"], "USERS")) == 200
+
+
+def test__dscache_store__groups():
+    store = DSCacheStore()
+    store.update("nis", "GROUPS", [
+        group_entry(grp.struct_group(("staff", "x", 5000, []))),
+        group_entry(grp.struct_group(("wheel2", "x", 5001, []))),
+    ], replace=True)
+
+    assert [g["gid"] for g in store.query(["nis"], "GROUPS", [["group", "=", "wheel2"]])] == [5001]
+    assert not store.is_filled("nis")
+
+    store.set_meta("nis", "filled", 1)
+    assert store.is_filled("nis")
+
+
+def test__dscache_store__persistent(tmp_path):
+    path = str(tmp_path / "dscache.sqlite")
+    store = DSCacheStore(path)
+    store.update("ldap", "USERS", [user("user", 10000)], replace=True)
+    store.set_meta("ldap", "modify_timestamp", "20200101000000Z")
+    store.checkpoint()
+    store.close()
+
+    store = DSCacheStore(path)
+    assert store.get_meta("ldap", "modify_timestamp") == "20200101000000Z"
+    assert store.query(["ldap"], "USERS", [["uid", "=", 10000]], {"get": True})["username"] == "user"
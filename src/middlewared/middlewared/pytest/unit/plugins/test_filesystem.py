@@ -0,0 +1,473 @@
+import errno
+import os
+import pathlib
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from middlewared.job import State
+from middlewared.plugins.filesystem import FilesystemService
+from middlewared.plugins.filesystem_ import posix1e_acl
+from middlewared.plugins.filesystem_.posix1e_acl import complete_acl, decode_acl, encode_acl, getacl, setacl
+from middlewared.plugins.filesystem_.recursive import RecursiveApply, RecursiveApplyAborted
+from middlewared.plugins.filesystem_.tail_follow import TailFollower, TailFollowRegistry, tail
+from middlewared.service_exception import CallError
+from middlewared.utils import osc
+
+
+def ace(tag, id, perms, default=False):
+    return {
+        "default": default,
+        "tag": tag,
+        "id": id,
+        "perms": {"READ": "r" in perms, "WRITE": "w" in perms, "EXECUTE": "x" in perms},
+    }
+
+
+# user::rwx, user:1000:r-x, group::r-x, mask::rwx, other::---
+XATTR = struct.pack(
+    "<I" + "HHI" * 5,
+    2,
+    0x01, 7, 0xFFFFFFFF,
+    0x02, 5, 1000,
+    0x04, 5, 0xFFFFFFFF,
+    0x10, 7, 0xFFFFFFFF,
+    0x20, 0, 0xFFFFFFFF,
+)
+ACL = [
+    ace("USER", -1, "rwx"),
+    ace("USER", 1000, "rx"),
+    ace("GROUP", -1, "rx"),
+    ace("MASK", -1, "rwx"),
+    ace("OTHER", -1, ""),
+]
+
+
+def test__decode_acl():
+    assert decode_acl(XATTR) == ACL
+
+
+def test__decode_acl__default():
+    assert decode_acl(XATTR, True) == [dict(entry, default=True) for entry in ACL]
+
+
+def test__encode_acl__sorts_entries():
+    assert encode_acl(list(reversed(ACL))) == XATTR
+
+
+@pytest.mark.parametrize("data", [b"", XATTR[:-1], struct.pack("<I", 1) + XATTR[4:]])
+def test__decode_acl__invalid(data):
+    with pytest.raises(ValueError):
+        decode_acl(data)
+
+
+def test__complete_acl__from_mode():
+    # Same as `setfacl -m u:1000:r-x` on a file with mode 0o750
+    assert sorted(complete_acl([ace("USER", 1000, "rx")], 0o100750), key=lambda e: e["tag"]) == sorted([
+        ace("USER", 1000, "rx"),
+        ace("USER", -1, "rwx"),
+        ace("GROUP", -1, "rx"),
+        ace("OTHER", -1, ""),
+        ace("MASK", -1, "rx"),
+    ], key=lambda e: e["tag"])
+
+
+def test__complete_acl__explicit_mask():
+    acl = [ace("USER_OBJ", -1, "rw"), ace("USER", 1000, "rwx"), ace("MASK", -1, "r")]
+
+    assert complete_acl(acl, 0o100640) == acl + [ace("GROUP", -1, "r"), ace("OTHER", -1, "")]
+
+
+def test__complete_acl__default():
+    acl = [ace("USER", -1, "rwx"), ace("GROUP", -1, "rx"), ace("OTHER", -1, "x"), ace("GROUP", 100, "rw", True)]
+
+    assert complete_acl(acl, 0o40700)[3:] == [
+        ace("GROUP", 100, "rw", True),
+        ace("USER", -1, "rwx", True),
+        ace("GROUP", -1, "rx", True),
+        ace("OTHER", -1, "x", True),
+        ace("MASK", -1, "rwx", True),
+    ]
+
+
+def test__setacl__incomplete_acl(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("")
+    path.chmod(0o640)
+
+    try:
+        setacl(str(path), [ace("USER", 1000, "rx")])
+    except OSError as e:
+        if e.errno == errno.EOPNOTSUPP:
+            pytest.skip("POSIX1e ACLs are not supported")
+        raise
+
+    assert sorted(getacl(str(path)), key=lambda e: e["tag"]) == sorted([
+        ace("USER", -1, "rw"),
+        ace("USER", 1000, "rx"),
+        ace("GROUP", -1, "r"),
+        ace("MASK", -1, "rx"),
+        ace("OTHER", -1, ""),
+    ], key=lambda e: e["tag"])
+
+
+benchmark = pytest.mark.skipif(not os.environ.get("BENCHMARK"), reason="Set BENCHMARK environment variable to run")
+
+
+# Number of directory entries listed by the `filesystem.listdir` benchmark
+BENCHMARK_ENTRIES = 100000
+
+
+@pytest.fixture
+def tmpfs_dir():
+    # /dev/shm is a tmpfs on Linux so that the benchmark measures the listing and not the disk
+    with tempfile.TemporaryDirectory(dir="/dev/shm" if os.path.isdir("/dev/shm") else None) as path:
+        yield path
+
+
+@benchmark
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="POSIX1e ACLs are read in-process on Linux only")
+def test__listdir__benchmark(tmpfs_dir):
+    for i in range(BENCHMARK_ENTRIES):
+        os.close(os.open(os.path.join(tmpfs_dir, f"file{i}"), os.O_CREAT | os.O_WRONLY, 0o644))
+
+    try:
+        os.setxattr(os.path.join(tmpfs_dir, "file0"), "system.posix_acl_access", XATTR)
+        extended = 1
+    except OSError as e:
+        if e.errno != errno.EOPNOTSUPP:
+            raise
+        extended = 0
+
+    forks = []
+
+    def counted(f):
+        def wrapper(*args, **kwargs):
+            forks.append(f)
+            return f(*args, **kwargs)
+        return wrapper
+
+    with patch.object(os, "fork", counted(os.fork)), \
+            patch.object(os, "posix_spawn", counted(os.posix_spawn)), \
+            patch.object(subprocess._posixsubprocess, "fork_exec", counted(subprocess._posixsubprocess.fork_exec)):
+        start = time.monotonic()
+        entries = FilesystemService.listdir.wraps(FilesystemService(Mock()), tmpfs_dir, [], {})
+        elapsed = time.monotonic() - start
+
+    report = f"Listed {len(entries)} entries with ACLs in {elapsed:.2f}s, {len(forks)} processes spawned"
+    assert forks == [], report
+    assert len(entries) == BENCHMARK_ENTRIES, report
+    assert sum(entry["acl"] for entry in entries) == extended
+
+
+def age_tree(paths):
+    # So that directories are journaled as processed (see `JOURNAL_RACY_NS`)
+    past = time.time() - 60
+    for path in paths:
+        os.utime(path, (past, past))
+
+
+def make_tree(root, depth=3, dirs=4, files=5):
+    paths = {str(root)}
+    for i in range(files):
+        path = root / f"file{i}"
+        path.write_text("")
+        paths.add(str(path))
+    if depth:
+        for i in range(dirs):
+            path = root / f"dir{i}"
+            path.mkdir()
+            paths |= make_tree(path, depth - 1, dirs, files)
+    return paths
+
+
+def test__recursive_apply(tmp_path):
+    paths = make_tree(tmp_path)
+    os.symlink("/etc", tmp_path / "link")
+
+    applied = []
+    lock = threading.Lock()
+
+    def callback(path, is_dir):
+        assert is_dir == os.path.isdir(path)
+        with lock:
+            applied.append(path)
+
+    progress = []
+    assert RecursiveApply(str(tmp_path), callback, progress=lambda *args: progress.append(args)).run() == len(paths)
+    assert sorted(applied) == sorted(paths)
+    assert progress[-1][0] == len(paths)
+
+
+def test__recursive_apply__chmod(tmp_path):
+    paths = make_tree(tmp_path)
+
+    RecursiveApply(str(tmp_path), lambda path, is_dir: os.chmod(path, 0o750)).run()
+
+    assert all(os.stat(path).st_mode & 0o777 == 0o750 for path in paths)
+
+
+@pytest.fixture
+def journal_dir(tmp_path):
+    with patch("middlewared.plugins.filesystem_.recursive.JOURNAL_DIR", str(tmp_path / "journal")):
+        yield tmp_path / "journal"
+
+
+def abort_and_resume(root, journal_dir, resume=True, before_resume=None):
+    age_tree(journal_dir.parent.rglob("*"))
+    applied = []
+    lock = threading.Lock()
+
+    def callback(path, is_dir):
+        with lock:
+            applied.append(path)
+
+    with pytest.raises(RecursiveApplyAborted):
+        RecursiveApply(
+            str(root), callback, workers=1, operation=["test"], aborted=lambda: len(applied) > 20, job_id=1,
+        ).run()
+
+    assert len(os.listdir(journal_dir)) == 1
+    interrupted = set(applied)
+    applied.clear()
+
+    if before_resume is not None:
+        before_resume()
+
+    RecursiveApply(str(root), callback, workers=1, operation=["test"], resume=resume, job_id=2).run()
+
+    assert os.listdir(journal_dir) == []
+    return interrupted, set(applied)
+
+
+def test__recursive_apply__abort_and_resume(tmp_path, journal_dir):
+    (tmp_path / "tree").mkdir()
+    paths = make_tree(tmp_path / "tree")
+
+    interrupted, resumed = abort_and_resume(tmp_path / "tree", journal_dir)
+
+    assert interrupted | resumed == paths
+    assert len(resumed) < len(paths)
+
+
+def test__recursive_apply__fresh_run_discards_journal(tmp_path, journal_dir):
+    (tmp_path / "tree").mkdir()
+    paths = make_tree(tmp_path / "tree")
+
+    interrupted, resumed = abort_and_resume(tmp_path / "tree", journal_dir, resume=False)
+
+    assert resumed == paths
+
+
+def test__recursive_apply__resume_processes_new_entries(tmp_path, journal_dir):
+    (tmp_path / "tree").mkdir()
+    paths = make_tree(tmp_path / "tree")
+    new_file = tmp_path / "tree" / "new_file"
+
+    interrupted, resumed = abort_and_resume(
+        tmp_path / "tree", journal_dir, before_resume=lambda: new_file.write_text(""),
+    )
+
+    assert str(new_file) in resumed
+    assert interrupted | resumed == paths | {str(new_file)}
+
+
+def test__recursive_apply__resume_different_tree(tmp_path, journal_dir):
+    (tmp_path / "tree").mkdir()
+    make_tree(tmp_path / "tree")
+    paths = set()
+
+    def replace():
+        # Old directory is kept so that its inode is not reused
+        os.rename(tmp_path / "tree", tmp_path / "old")
+        (tmp_path / "tree").mkdir()
+        paths.update(make_tree(tmp_path / "tree"))
+        age_tree(paths)
+
+    interrupted, resumed = abort_and_resume(tmp_path / "tree", journal_dir, before_resume=replace)
+
+    assert resumed == paths
+
+
+class AbortingJob:
+    """
+    Job that is aborted once `aborted()` has been polled `abort_after` times.
+    """
+
+    def __init__(self, id, abort_after=None):
+        self.id = id
+        self.abort_after = abort_after
+        self.polled = 0
+
+    @property
+    def state(self):
+        self.polled += 1
+        if self.abort_after is not None and self.polled > self.abort_after:
+            return State.ABORTED
+        return State.RUNNING
+
+    def set_progress(self, *args, **kwargs):
+        pass
+
+
+def resume_permission_change(tmpfs_dir, run, data, counted):
+    """
+    Aborts recursive permission change `run(service, job, data)`, creates a new file and resumes it. Returns paths
+    of the tree and the ones `counted` function (`(object, name)`) was called for when resuming.
+    """
+    tree = pathlib.Path(tmpfs_dir) / "tree"
+    tree.mkdir()
+    paths = make_tree(tree)
+    age_tree(paths)
+    data = dict(data, path=str(tree))
+
+    service = FilesystemService(Mock())
+    service.middleware.call_sync = Mock(return_value=True)
+    with patch.object(FilesystemService, "_common_perm_path_validate"):
+        with pytest.raises(CallError) as e:
+            run(service, AbortingJob(1, 10), data)
+        assert e.value.errno == errno.EINTR
+
+        (tree / "new_file").write_text("")
+        paths.add(str(tree / "new_file"))
+
+        calls = []
+        f = getattr(*counted)
+
+        def count(path, *args):
+            calls.append(path)
+            return f(path, *args)
+
+        with patch.object(*counted, count):
+            run(service, AbortingJob(2), dict(data, options=dict(data["options"], resume=True)))
+
+    return paths, calls
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Permissions are applied in-process on Linux only")
+def test__setperm__resume(tmpfs_dir, journal_dir):
+    paths, calls = resume_permission_change(tmpfs_dir, FilesystemService.setperm.wraps, {
+        "mode": "750", "uid": None, "gid": None,
+        "options": {"stripacl": True, "recursive": True, "traverse": False, "resume": False},
+    }, (os, "chmod"))
+
+    # Only what was not processed by the aborted job (and the root itself) is processed
+    assert 1 < len(calls) < len(paths)
+    assert str(pathlib.Path(tmpfs_dir) / "tree" / "new_file") in calls
+    assert {os.stat(path).st_mode & 0o777 for path in paths} == {0o750}
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="POSIX1e ACLs are applied in-process on Linux only")
+def test__setacl__resume(tmpfs_dir, journal_dir):
+    acl = [ace("USER", -1, "rwx"), ace("USER", 1000, "rx"), ace("GROUP", -1, "rx"), ace("OTHER", -1, "")]
+    dacl = acl + [dict(entry, default=True) for entry in acl]
+    try:
+        setacl(tmpfs_dir, dacl)
+    except OSError as e:
+        if e.errno == errno.EOPNOTSUPP:
+            pytest.skip("POSIX1e ACLs are not supported")
+        raise
+
+    with patch.object(osc, "IS_FREEBSD", False):
+        paths, calls = resume_permission_change(tmpfs_dir, FilesystemService.setacl_posix1e, {
+            "dacl": dacl, "options": {"stripacl": False, "recursive": True, "traverse": False, "resume": False},
+        }, (posix1e_acl, "setacl"))
+
+    assert 1 < len(calls) < len(paths)
+    assert str(pathlib.Path(tmpfs_dir) / "tree" / "new_file") in calls
+    assert all(ace("USER", 1000, "rx") in getacl(path) for path in paths)
+
+
+@benchmark
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Permissions are applied in-process on Linux only")
+def test__recursive_apply__benchmark(tmpfs_dir):
+    paths = make_tree(pathlib.Path(tmpfs_dir), depth=4, dirs=6, files=20)
+
+    def measure(f):
+        start = time.monotonic()
+        f()
+        return time.monotonic() - start
+
+    # (in-process, subprocess) seconds
+    results = {"chmod": (
+        measure(lambda: RecursiveApply(tmpfs_dir, lambda path, is_dir: os.chmod(path, 0o750)).run()),
+        measure(lambda: subprocess.run(["chmod", "-R", "755", tmpfs_dir], check=True)),
+    )}
+
+    if shutil.which("setfacl"):
+        acl = [ace("USER", -1, "rwx"), ace("USER", 1000, "rx"), ace("GROUP", -1, "rx"), ace("OTHER", -1, "")]
+        dacl = acl + [dict(entry, default=True) for entry in acl]
+        results["setacl"] = (
+            measure(lambda: RecursiveApply(
+                tmpfs_dir, lambda path, is_dir: setacl(path, dacl if is_dir else acl),
+            ).run()),
+            measure(lambda: subprocess.run(
+                ["setfacl", "-R", "-m", "u:1001:r-x,d:u:1001:r-x", tmpfs_dir], check=True,
+            )),
+        )
+
+    # In-process walk is expected to stay in the same ballpark as the C tools it replaced (while being able to report
+    # progress, be aborted and resumed)
+    report = ", ".join(
+        f"{name}: {in_process:.2f}s in-process, {sub:.2f}s subprocess" for name, (in_process, sub) in results.items()
+    )
+    assert all(in_process < sub * 3 for in_process, sub in results.values()), f"{len(paths)} entries, {report}"
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test__tail(tmp_path):
+    path = tmp_path / "log"
+    path.write_bytes(b"".join(b"line %d\n" % i for i in range(10000)))
+
+    with open(path, "rb") as f:
+        assert tail(f, os.path.getsize(path), 3) == b"line 9997\nline 9998\nline 9999\n"
+        assert tail(f, 14, 5) == b"line 0\nline 1\n"
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux-only")
+def test__tail_follow__multiplex_and_rotation(tmp_path):
+    path = tmp_path / "log"
+    path.write_text("old 1\nold 2\n")
+
+    followers = []
+
+    def follower_factory(path):
+        follower = TailFollower(path, timeout=0.05)
+        followers.append(follower)
+        return follower
+
+    registry = TailFollowRegistry(follower_factory)
+    received = [[], []]
+    callbacks = [received[0].append, received[1].append]
+    for callback in callbacks:
+        registry.subscribe(str(path), callback, 1)
+
+    assert len(followers) == 1
+    assert received == [["old 2\n"], ["old 2\n"]]
+
+    with open(path, "a") as f:
+        f.write("new 1\n")
+    wait_for(lambda: all("".join(r).endswith("new 1\n") for r in received))
+
+    os.rename(path, tmp_path / "log.1")
+    path.write_text("rotated 1\n")
+    wait_for(lambda: all("".join(r).endswith("rotated 1\n") for r in received))
+
+    for callback in callbacks:
+        registry.unsubscribe(str(path), callback)
+
+    assert registry.followers == {}
+    assert followers[0].stopped.is_set()
@@ -0,0 +1,185 @@
+import itertools
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from middlewared.plugins.kmip.zfs_keys import KMIPService
+from middlewared.pytest.unit.middleware import Middleware
+
+
+class FakeKmipServer:
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.objects = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.max_concurrent = 0
+        self.concurrent = 0
+
+    def client(self, **kwargs):
+        return FakeProxyKmipClient(self)
+
+    def operation(self):
+        with self.lock:
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        time.sleep(self.latency)
+        with self.lock:
+            self.concurrent -= 1
+
+
+class FakeProxyKmipClient:
+    def __init__(self, server):
+        self.server = server
+        self.busy = False
+
+    def __enter__(self):
+        self.server.connections += 1
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _operation(self):
+        # A connection must not be shared by concurrent operations
+        assert not self.busy
+        self.busy = True
+        try:
+            self.server.operation()
+        finally:
+            self.busy = False
+
+    def register(self, secret_data):
+        self._operation()
+        uid = str(next(self.server.ids))
+        self.server.objects[uid] = secret_data
+        return uid
+
+    def activate(self, uid):
+        self._operation()
+
+    def get(self, uid):
+        self._operation()
+        return self.server.objects[uid]
+
+    def revoke(self, reason, uid):
+        self._operation()
+
+    def destroy(self, uid):
+        self._operation()
+        self.server.objects.pop(uid)
+
+
+@pytest.fixture
+def kmip_server():
+    server = FakeKmipServer()
+    with patch("middlewared.plugins.kmip.connection.ProxyKmipClient", server.client):
+        yield server
+
+
+def kmip_service(datasets):
+    m = Middleware()
+    m.logger = Mock()
+    m["datastore.query"] = lambda name, filters=None: [ds.copy() for ds in datasets]
+    m["datastore.update_many"] = Mock()
+    m["zfs.dataset.query"] = m._query_filter([{"name": ds["name"]} for ds in datasets])
+    m["zfs.dataset.check_key"] = Mock(return_value=True)
+    m["kmip.connection_config"] = Mock(return_value={})
+    m["kmip.test_connection"] = Mock(return_value=True)
+    m["network.general.will_perform_activity"] = Mock()
+    return KMIPService(m)
+
+
+def test__push_zfs_keys(kmip_server):
+    kmip_server.latency = 0.001
+    datasets = [
+        {"id": i, "name": f"tank/ds{i}", "encryption_key": f"{i:064x}", "kmip_uid": None}
+        for i in range(1000)
+    ]
+    kmip = kmip_service(datasets)
+    job = Mock()
+
+    start = time.monotonic()
+    assert kmip.push_zfs_keys(job=job) == []
+    # register + activate for each of the datasets on 4 connections
+    assert time.monotonic() - start < 2 * 1000 * kmip_server.latency / 2
+
+    assert kmip_server.connections == 4
+    assert kmip_server.max_concurrent == 4
+
+    kmip.middleware["datastore.update_many"].assert_called_once()
+    updates = kmip.middleware["datastore.update_many"].call_args[0][1]
+    assert [id for id, data in updates] == list(range(1000))
+    for id, data in updates:
+        assert data["encryption_key"] is None
+        assert kmip_server.objects[data["kmip_uid"]].value.decode() == f"{id:064x}"
+
+    assert job.set_progress.call_count == 10
+    assert job.set_progress.call_args[0][0] == 100
+
+
+def test__push_zfs_keys__replaces_existing_key(kmip_server):
+    kmip = kmip_service([{"id": 1, "name": "tank/ds", "encryption_key": "new", "kmip_uid": None}])
+    kmip.push_zfs_keys()
+    old_uid = kmip.middleware["datastore.update_many"].call_args[0][1][0][1]["kmip_uid"]
+
+    kmip = kmip_service([{"id": 1, "name": "tank/ds", "encryption_key": "newer", "kmip_uid": old_uid}])
+    kmip.push_zfs_keys()
+
+    assert old_uid not in kmip_server.objects
+    assert [o.value for o in kmip_server.objects.values()] == [b"newer"]
+
+
+def test__push_zfs_keys__skips_removed_datasets(kmip_server):
+    kmip = kmip_service([{"id": 1, "name": "tank/ds", "encryption_key": "key", "kmip_uid": None}])
+    kmip.middleware["zfs.dataset.query"] = kmip.middleware._query_filter([])
+
+    assert kmip.push_zfs_keys() == []
+
+    assert kmip_server.connections == 0
+    kmip.middleware["datastore.update_many"].assert_not_called()
+
+
+def test__pull_zfs_keys(kmip_server):
+    datasets = [
+        {"id": i, "name": f"tank/ds{i}", "encryption_key": f"{i:064x}", "kmip_uid": None}
+        for i in range(250)
+    ]
+    kmip = kmip_service(datasets)
+    kmip.push_zfs_keys()
+    for id, data in kmip.middleware["datastore.update_many"].call_args[0][1]:
+        datasets[id].update(data)
+    kmip.zfs_keys = {}
+
+    kmip = kmip_service(datasets)
+    assert kmip.pull_zfs_keys() == []
+
+    kmip.middleware["datastore.update_many"].assert_called_once_with("storage.encrypteddataset", [
+        [i, {"encryption_key": f"{i:064x}", "kmip_uid": None}] for i in range(250)
+    ])
+    assert kmip_server.objects == {}
+
+
+def test__pull_zfs_keys__progress(kmip_server):
+    datasets = [
+        {"id": i, "name": f"tank/ds{i}", "encryption_key": f"{i:064x}", "kmip_uid": None}
+        for i in range(250)
+    ]
+    kmip = kmip_service(datasets)
+    kmip.push_zfs_keys()
+    for id, data in kmip.middleware["datastore.update_many"].call_args[0][1]:
+        datasets[id].update(data)
+    # Key that can't be retrieved is neither pulled nor destroyed
+    kmip_server.objects.pop(datasets[7]["kmip_uid"])
+
+    kmip = kmip_service(datasets)
+    job = Mock()
+    assert kmip.pull_zfs_keys(job=job) == ["tank/ds7"]
+
+    progress = [call[0][0] for call in job.set_progress.call_args_list]
+    assert progress == sorted(progress)
+    assert progress[-1] == 100
+    assert job.set_progress.call_args[0][1] == "Processed 499/499 ZFS key operations"
@@ -0,0 +1,193 @@
+import ctypes
+import ctypes.util
+import errno
+import functools
+import ipaddress
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import pytest
+
+if not sys.platform.startswith("linux"):
+    pytest.skip("Linux-only", allow_module_level=True)
+
+pyroute2 = pytest.importorskip("pyroute2")
+
+from middlewared.plugins.interface import netif_linux as netif  # noqa
+from middlewared.plugins.interface.netif_linux import netlink  # noqa
+
+CLONE_NEWNET = 0x40000000
+
+
+def in_netns(f):
+    """
+    Runs the test in a forked child process that has its own network namespace.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+
+        def target():
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            if libc.unshare(CLONE_NEWNET) != 0:
+                queue.put(("skip", f"Unable to create network namespace: {os.strerror(ctypes.get_errno())}"))
+                return
+
+            # Sockets inherited from the parent are bound to its namespace
+            netlink._available = netlink._iproute = netlink._ethtool = None
+            netlink.cache = netlink.NetlinkStateCache()
+            try:
+                f(*args, **kwargs)
+            except pyroute2.NetlinkError as e:
+                if e.code == errno.EOPNOTSUPP:
+                    queue.put(("skip", f"Not supported by the kernel: {e}"))
+                else:
+                    queue.put(("error", traceback.format_exc()))
+            except Exception:
+                queue.put(("error", traceback.format_exc()))
+            else:
+                queue.put(("ok", None))
+
+        p = ctx.Process(target=target)
+        p.start()
+        status, result = queue.get(timeout=60)
+        p.join()
+
+        if status == "skip":
+            pytest.skip(result)
+        assert status == "ok", result
+
+    return wrapper
+
+
+def add_veth(name, peer):
+    with netlink.iproute() as ip:
+        ip.link("add", ifname=name, kind="veth", peer=peer)
+
+
+@in_netns
+def test__netlink__list_interfaces():
+    add_veth("veth0", "veth1")
+
+    iface = netif.get_interface("veth0")
+    iface.mtu = 1400
+    iface.up()
+    iface.add_address(netif.InterfaceAddress(netif.AddressFamily.INET, ipaddress.IPv4Interface("10.1.1.1/24")))
+    iface.add_address(netif.InterfaceAddress(netif.AddressFamily.INET6, ipaddress.IPv6Interface("fd00::1/64")))
+
+    interfaces = netif.list_interfaces()
+    assert set(interfaces) == {"lo", "veth0", "veth1"}
+
+    state = interfaces["veth0"].__getstate__()
+    assert state["mtu"] == 1400
+    assert "UP" in state["flags"]
+    assert state["link_address"] == interfaces["veth0"]._netlink.address
+    assert [(a["type"], a["address"], a.get("netmask")) for a in state["aliases"]] == [
+        ("LINK", state["link_address"], None),
+        ("INET", "10.1.1.1", 24),
+        ("INET6", "fd00::1", 64),
+    ]
+
+    iface = interfaces["veth0"]
+    iface.remove_address(netif.InterfaceAddress(netif.AddressFamily.INET, ipaddress.IPv4Interface("10.1.1.1/24")))
+    assert [a.af for a in iface.addresses] == [netif.AddressFamily.LINK, netif.AddressFamily.INET6]
+
+    iface.down()
+    assert "UP" not in iface.__getstate__()["flags"]
+
+
+@in_netns
+def test__netlink__get_interface__missing():
+    with pytest.raises(KeyError):
+        netif.get_interface("veth0")
+
+
+@in_netns
+def test__netlink__routing_table():
+    add_veth("veth0", "veth1")
+
+    iface = netif.get_interface("veth0")
+    iface.up()
+    iface.add_address(netif.InterfaceAddress(netif.AddressFamily.INET, ipaddress.IPv4Interface("10.1.1.1/24")))
+
+    route = netif.Route("10.2.0.0", "255.255.0.0", "10.1.1.2", "veth0")
+    netif.RoutingTable().add(route)
+
+    assert route in netif.RoutingTable().routes
+
+    netif.RoutingTable().delete(route)
+    assert route not in netif.RoutingTable().routes
+
+
+@in_netns
+def test__netlink__bridge_members():
+    add_veth("veth0", "veth1")
+    netif.create_interface("br0")
+
+    bridge = netif.get_interface("br0")
+    bridge.add_member("veth0")
+    assert bridge.members == ["veth0"]
+
+    bridge.delete_member("veth0")
+    assert bridge.members == []
+
+    netif.destroy_interface("br0")
+    assert "br0" not in netif.list_interfaces()
+
+
+@in_netns
+def test__netlink__vlan():
+    add_veth("veth0", "veth1")
+    netif.create_vlan("vlan5", "veth0", 5)
+
+    vlan = netif.get_interface("vlan5")
+    assert (vlan.parent, vlan.tag) == ("veth0", 5)
+    assert vlan.__getstate__()["parent"] == "veth0"
+
+
+def snapshot(cache):
+    links = {name: netif.Interface(name, link).__getstate__() for name, link in cache.dump().items()}
+    routes, interfaces = cache.routes_with_interfaces()
+    return links, {netlink._route_key(msg) for msg in routes}, interfaces
+
+
+@in_netns
+def test__netlink_state_cache__converges():
+    # Changes are made by a different socket, so the cache can only learn about them from notifications
+    other = pyroute2.IPRoute()
+
+    def step(f, *args, **kwargs):
+        f(*args, **kwargs)
+
+        deadline = time.monotonic() + 1
+        while True:
+            actual = snapshot(netlink.cache)
+            expected = snapshot(netlink.NetlinkStateCache())
+            if actual == expected:
+                return actual
+
+            assert time.monotonic() < deadline, (actual, expected)
+            time.sleep(0.01)
+
+    step(lambda: None)
+    step(other.link, "add", ifname="veth0", kind="veth", peer="veth1")
+    idx = other.link_lookup(ifname="veth0")[0]
+    step(other.link, "set", index=idx, state="up", mtu=1400)
+    step(other.addr, "add", index=idx, address="10.1.1.1", prefixlen=24)
+    step(other.addr, "add", index=idx, address="fd00::1", prefixlen=64)
+    links, routes, interfaces = step(other.route, "add", dst="10.2.0.0/16", gateway="10.1.1.2")
+    assert links["veth0"]["mtu"] == 1400
+    assert any(key[5] == "10.2.0.0" for key in routes)
+
+    # Kernel does not notify about the route going away along with its address
+    links, routes, interfaces = step(other.addr, "del", index=idx, address="10.1.1.1", prefixlen=24)
+    assert not any(key[5] == "10.2.0.0" for key in routes)
+
+    step(other.link, "set", index=idx, ifname="veth2")
+    links, routes, interfaces = step(other.link, "del", index=idx)
+    assert set(links) == {"lo"}
+    assert netlink.cache.stats["seeds"] == 1
@@ -1,8 +1,14 @@
+import asyncio
 import textwrap
 
+from asynctest import CoroutineMock, Mock
 import pytest
 
-from middlewared.plugins.pool import parse_lsof
+from middlewared.plugins.pool import parse_lsof, PoolDatasetService, PoolService
+from middlewared.plugins.pool_.dataset_locked import LockedPathTrie, PoolDatasetService as LockedIndexService
+from middlewared.pytest.unit.middleware import Middleware
+from middlewared.service_exception import CallError
+from middlewared.utils import filter_list
 
 
 @pytest.mark.parametrize("lsof,dirs,result", [
@@ -41,3 +47,157 @@ from middlewared.plugins.pool import parse_lsof
 ])
 def test__parse_lsof(lsof, dirs, result):
     assert parse_lsof(lsof, dirs) == result
+
+
+def test__pool_extend__resolves_topology_in_bulk():
+    m = Middleware()
+    m["zfs.pool.query"] = Mock(return_value=[
+        {
+            "name": f"pool{i}",
+            "status": "ONLINE",
+            "scan": None,
+            "healthy": True,
+            "status_detail": None,
+            "groups": {
+                "data": [
+                    {
+                        "type": "mirror",
+                        "path": None,
+                        "guid": f"{i}0",
+                        "status": "ONLINE",
+                        "children": [
+                            {
+                                "type": "disk",
+                                "path": f"/dev/disk/by-partuuid/{i}{j}",
+                                "guid": f"{i}{j}",
+                                "status": "UNAVAIL" if j == 2 else "ONLINE",
+                                "children": [],
+                            }
+                            for j in range(1, 3)
+                        ],
+                    },
+                ],
+            },
+        }
+        for i in range(4)
+    ])
+    m["disk.label_to_dev_disk_cache"] = Mock(side_effect=lambda labels: {
+        label: {"dev": f"sd{label[-2:]}1", "disk": f"sd{label[-2:]}"} for label in labels
+    })
+    m["disk.disks_by_zfs_guids"] = Mock(side_effect=lambda guids: {guid: {"identifier": guid} for guid in guids})
+
+    service = PoolService(m)
+    context = service.pool_extend_context({})
+    pools = [service.pool_extend({"id": i, "name": f"pool{i}", "encrypt": 0}, context) for i in range(4)]
+
+    m["zfs.pool.query"].assert_called_once_with()
+    m["disk.label_to_dev_disk_cache"].assert_called_once()
+    m["disk.disks_by_zfs_guids"].assert_called_once()
+
+    vdev = pools[3]["topology"]["data"][0]
+    assert vdev["type"] == "MIRROR"
+    assert vdev["children"][0]["device"] == "sd311"
+    assert vdev["children"][0]["disk"] == "sd31"
+    assert vdev["children"][0]["unavail_disk"] is None
+    assert vdev["children"][1]["unavail_disk"] == {"identifier": "32"}
+
+
+@pytest.mark.parametrize("path,result", [
+    ("/mnt/tank/locked", "tank/locked"),
+    ("/mnt/tank/locked/", "tank/locked"),
+    ("/mnt/tank/locked/child/file", "tank/locked"),
+    ("/mnt/tank/locked2", None),
+    ("/mnt/tank", None),
+    ("/mnt/tank/unlocked/nested/locked/file", "tank/unlocked/nested/locked"),
+    ("/mnt/tank/legacy", None),
+])
+def test__locked_path_trie(path, result):
+    trie = LockedPathTrie([
+        {"id": "tank/locked", "mountpoint": "/mnt/tank/locked"},
+        {"id": "tank/unlocked/nested/locked", "mountpoint": "/mnt/tank/unlocked/nested/locked"},
+        {"id": "tank/legacy", "mountpoint": None},
+    ])
+
+    assert trie.lookup(path) == result
+
+
+def call_sync(method):
+    return lambda *args: asyncio.get_event_loop().run_until_complete(method(*args))
+
+
+def test__unlock__restarts_attachments(monkeypatch):
+    monkeypatch.setattr(LockedIndexService, "locked_index", LockedPathTrie([
+        {"id": "tank/enc", "mountpoint": "/mnt/tank/enc"},
+    ]))
+    monkeypatch.setattr(LockedIndexService, "locked_index_lock", None)
+
+    m = Middleware()
+    m.call_hook_sync = Mock()
+    locked_index = LockedIndexService(m)
+    m["pool.dataset.locked_index_remove"] = call_sync(locked_index.locked_index_remove)
+    m["pool.dataset.get_instance"] = Mock(return_value={
+        "id": "tank/enc", "name": "tank/enc", "locked": True, "encryption_root": "tank/enc",
+        "mountpoint": "/mnt/tank/enc",
+    })
+    m["zfs.dataset.load_key"] = Mock()
+    m["zfs.dataset.mount"] = Mock()
+    # Share locked state is derived from the locked datasets index
+    m["sharing.nfs.query"] = lambda filters: filter_list([{
+        "id": 1, "path": "/mnt/tank/enc/share", "enabled": True,
+        "locked": locked_index.path_in_locked_datasets("/mnt/tank/enc/share"),
+    }], filters)
+
+    class ShareDelegate:
+        start = CoroutineMock()
+
+        async def query(self, path, enabled, options=None):
+            return await m.call("sharing.nfs.query", [["enabled", "=", enabled], ["locked", "=", options["locked"]]])
+
+    pool_dataset = PoolDatasetService(m)
+    monkeypatch.setattr(PoolDatasetService, "attachment_delegates", [ShareDelegate()])
+    m["pool.dataset.restart_attachment_services_on_unlock"] = call_sync(
+        pool_dataset.restart_attachment_services_on_unlock
+    )
+    pool_dataset.query_encrypted_roots_keys = Mock(return_value={"tank/enc": "key"})
+    pool_dataset.query_encrypted_datasets = Mock(return_value={
+        "tank/enc": {"locked": True, "encryption_key": "key", "key_format": {"value": "PASSPHRASE"}},
+    })
+
+    assert pool_dataset.unlock(Mock(), "tank/enc", {}) == {"unlocked": ["tank/enc"], "failed": {}}
+
+    ShareDelegate.start.assert_called_once_with([
+        {"id": 1, "path": "/mnt/tank/enc/share", "enabled": True, "locked": False},
+    ])
+    assert LockedIndexService.locked_index.lookup("/mnt/tank/enc") is None
+
+
+def test__unlock__mount_failure_reindexes(monkeypatch):
+    monkeypatch.setattr(LockedIndexService, "locked_index", LockedPathTrie([
+        {"id": "tank/enc", "mountpoint": "/mnt/tank/enc"},
+        {"id": "tank/other", "mountpoint": "/mnt/tank/other"},
+    ]))
+    monkeypatch.setattr(LockedIndexService, "locked_index_lock", None)
+
+    m = Middleware()
+    m.call_hook_sync = Mock()
+    m["pool.dataset.locked_index_remove"] = call_sync(LockedIndexService(m).locked_index_remove)
+    m["pool.dataset.restart_attachment_services_on_unlock"] = Mock()
+    m["pool.dataset.get_instance"] = Mock(return_value={
+        "id": "tank/enc", "name": "tank/enc", "locked": True, "encryption_root": "tank/enc",
+        "mountpoint": "/mnt/tank/enc",
+    })
+    m["zfs.dataset.load_key"] = Mock()
+    m["zfs.dataset.mount"] = Mock(side_effect=CallError("busy"))
+
+    pool_dataset = PoolDatasetService(m)
+    pool_dataset.query_encrypted_roots_keys = Mock(return_value={"tank/enc": "key"})
+    pool_dataset.query_encrypted_datasets = Mock(return_value={
+        "tank/enc": {"locked": True, "encryption_key": "key", "key_format": {"value": "PASSPHRASE"}},
+    })
+
+    result = pool_dataset.unlock(Mock(), "tank/enc", {})
+
+    assert result["unlocked"] == []
+    assert result["failed"]["tank/enc"]["error"].startswith("Failed to mount dataset")
+    assert LockedIndexService.locked_index.lookup("/mnt/tank/enc") is None
+    assert LockedIndexService.locked_index.lookup("/mnt/tank/other") == "tank/other"
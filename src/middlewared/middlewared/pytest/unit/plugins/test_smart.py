@@ -1,21 +1,34 @@
-import textwrap
-
 import pytest
 
 from middlewared.plugins.smart import parse_smart_selftest_results
 
 
-def test__parse_smart_selftest_results__ataprint__1():
-    assert parse_smart_selftest_results(textwrap.dedent("""\
-        smartctl 6.6 2017-11-05 r4594 [FreeBSD 11.1-STABLE amd64] (local build)
-        Copyright (C) 2002-17, Bruce Allen, Christian Franke, www.smartmontools.org
+def ata_test(type, status, value, remaining_percent=None, lifetime=0, lba=None, passed=None):
+    status = {"value": value, "string": status}
+    if remaining_percent is not None:
+        status["remaining_percent"] = remaining_percent
+    if passed is not None:
+        status["passed"] = passed
+
+    test = {"type": {"string": type}, "status": status, "lifetime_hours": lifetime}
+    if lba is not None:
+        test["lba"] = lba
+    return test
 
-        === START OF READ SMART DATA SECTION ===
-        SMART Self-test log structure revision number 1
-        Num  Test_Description    Status                  Remaining  LifeTime(hours)  LBA_of_first_error
-        # 1  Short offline       Completed without error       00%     16590         -
-        # 2  Short offline       Completed without error       00%     16589         -
-    """)) == [
+
+def test__parse_smart_selftest_results__ataprint__1():
+    assert parse_smart_selftest_results({
+        "ata_smart_self_test_log": {
+            "standard": {
+                "revision": 1,
+                "table": [
+                    ata_test("Short offline", "Completed without error", 0, lifetime=16590, passed=True),
+                    ata_test("Short offline", "Completed without error", 0, lifetime=16589, passed=True),
+                ],
+                "count": 2,
+            },
+        },
+    }) == [
         {
             "num": 1,
             "description": "Short offline",
@@ -37,32 +50,35 @@ def test__parse_smart_selftest_results__ataprint__1():
     ]
 
 
-@pytest.mark.parametrize("line,subresult", [
-    # Longest possible error message
-    ("# 1  Extended offline    Completed: servo/seek failure 80%      2941         -", {
+@pytest.mark.parametrize("test,subresult", [
+    (ata_test("Extended offline", "Completed: servo/seek failure", 0x58, 80, 2941, passed=False), {
         "status": "FAILED",
         "status_verbose": "Completed: servo/seek failure",
         "remaining": 0.8,
     }),
+    (ata_test("Extended offline", "Completed: read failure", 0x79, 90, 2941, lba=123456, passed=False), {
+        "status": "FAILED",
+        "lba_of_first_error": "123456",
+    }),
     # Test in progress
-    ("# 1  Selective offline   Self-test routine in progress 90%       352         -", {
+    (ata_test("Selective offline", "Self-test routine in progress", 0xf9, 90, 352), {
         "status": "RUNNING",
+        "remaining": 0.9,
     })
 ])
-def test__parse_smart_selftest_results__ataprint(line, subresult):
-    hdr = "Num  Test_Description    Status                  Remaining  LifeTime(hours)  LBA_of_first_error"
-    assert {k: v for k, v in parse_smart_selftest_results(f"{hdr}\n{line}")[0].items() if k in subresult} == subresult
+def test__parse_smart_selftest_results__ataprint(test, subresult):
+    result = parse_smart_selftest_results({"ata_smart_self_test_log": {"standard": {"table": [test]}}})
+    assert {k: v for k, v in result[0].items() if k in subresult} == subresult
 
 
 def test__parse_smart_selftest_results__scsiprint__1():
-    assert parse_smart_selftest_results(textwrap.dedent("""\
-        smartctl version 5.37 [i686-pc-linux-gnu] Copyright (C) 2002-6 Bruce Allen
-        Home page is http://smartmontools.sourceforge.net/
-        SMART Self-test log
-        Num  Test              Status                 segment  LifeTime  LBA_first_err [SK ASC ASQ]
-             Description                              number   (hours)
-        # 1  Background long   Completed, segment failed   -    3943                 - [-   -    -]
-    """)) == [
+    assert parse_smart_selftest_results({
+        "scsi_self_test_0": {
+            "code": {"value": 2, "string": "Background long"},
+            "result": {"value": 7, "string": "Completed, segment failed"},
+            "power_on_time": {"hours": 3943, "aka": "accumulated_power_on_hours"},
+        },
+    }) == [
         {
             "num": 1,
             "description": "Background long",
@@ -73,3 +89,7 @@ def test__parse_smart_selftest_results__scsiprint__1():
             "lba_of_first_error": None,
         },
     ]
+
+
+def test__parse_smart_selftest_results__no_log():
+    assert parse_smart_selftest_results({"temperature": {"current": 30}}) is None
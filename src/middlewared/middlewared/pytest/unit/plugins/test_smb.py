@@ -0,0 +1,177 @@
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from middlewared.plugins.smb_.passdb import (
+    ACB_DISABLED, ACB_NORMAL, SMBService, passdb_diff, passdb_expected_entry,
+)
+from middlewared.pytest.unit.middleware import Middleware
+
+SAM_SID = "S-1-5-21-1-2-3"
+
+
+class FakeSamu:
+    def __init__(self):
+        self.username = None
+        self.user_sid = None
+        self.acct_ctrl = 0
+        self.nt_passwd = None
+        # Same as samba: password of a new account must be changed unless its last set time is set
+        self.pass_last_set_time = 0
+
+
+class FakePDB:
+    """
+    In-memory tdbsam passdb that counts write operations.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.writes = 0
+
+    def search_users(self, acct_flags):
+        return [{"account_name": username} for username in self.users]
+
+    def getsampwnam(self, username):
+        try:
+            return self.users[username]
+        except KeyError:
+            raise RuntimeError("NT_STATUS_NO_SUCH_USER")
+
+    def add_sam_account(self, samu):
+        self.writes += 1
+        self.users[samu.username] = samu
+
+    def update_sam_account(self, samu):
+        self.writes += 1
+        self.users[samu.username] = samu
+
+    def delete_sam_account(self, samu):
+        self.writes += 1
+        self.users.pop(samu.username)
+
+
+@pytest.fixture
+def pdb():
+    pdb = FakePDB()
+    passdb = Mock(samu=FakeSamu, get_global_sam_sid=Mock(return_value=SAM_SID))
+    security = Mock(dom_sid=lambda sid: sid)
+    with patch("middlewared.plugins.smb_.passdb.passdb", passdb), \
+            patch("middlewared.plugins.smb_.passdb.security", security):
+        yield pdb
+
+
+@pytest.fixture
+def smb(pdb):
+    m = Middleware()
+    rids = iter(range(5000, 10 ** 6))
+
+    def get_next_rid(count=1):
+        rid = next(rids)
+        for i in range(count - 1):
+            next(rids)
+        return rid
+
+    m["smb.get_next_rid"] = Mock(side_effect=get_next_rid)
+    service = SMBService(m)
+    service.passdb_open = Mock(return_value=pdb)
+    return service
+
+
+def user(username, nt_hash, locked=False):
+    return {
+        "username": username,
+        "smbhash": f"{username}:1000:XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX:{nt_hash}:[U          ]:LCT-00000000:",
+        "locked": locked,
+    }
+
+
+def expected_entries(count, changed=None):
+    return {
+        f"user{i}": passdb_expected_entry(user(f"user{i}", f"{i:032x}", i == changed))
+        for i in range(count)
+    }
+
+
+def test__passdb_expected_entry():
+    assert passdb_expected_entry(user("alice", "a" * 32, True)) == {"nt_hash": "A" * 32, "disabled": True}
+
+
+def test__passdb_expected_entry__invalid_hash():
+    assert passdb_expected_entry({"username": "alice", "smbhash": "*", "locked": False}) is None
+
+
+def test__passdb_diff():
+    entry = {"nt_hash": "A" * 32, "disabled": False}
+    assert passdb_diff(
+        {"new": entry, "same": entry, "changed": entry, "invalid": None},
+        {"same": entry, "changed": dict(entry, disabled=True), "invalid": entry, "stale": entry},
+    ) == (["new"], ["changed"], ["stale"])
+
+
+def test__passdb_diff__keep_stale():
+    assert passdb_diff({}, {"stale": {"nt_hash": "A" * 32, "disabled": False}}, False) == ([], [], [])
+
+
+def test__passdb_sync(smb, pdb):
+    assert smb.passdb_sync({"alice": {"nt_hash": "A" * 32, "disabled": True}}) == {
+        "added": 1, "updated": 0, "removed": 0,
+    }
+
+    samu = pdb.users["alice"]
+    assert samu.user_sid == f"{SAM_SID}-5000"
+    assert samu.acct_ctrl == ACB_NORMAL | ACB_DISABLED
+    assert samu.nt_passwd == b"\xaa" * 16
+    assert abs(samu.pass_last_set_time - time.time()) < 5
+
+    samu.pass_last_set_time = 1
+    assert smb.passdb_sync({"alice": {"nt_hash": "A" * 32, "disabled": False}}) == {
+        "added": 0, "updated": 1, "removed": 0,
+    }
+    # Password was not changed
+    assert samu.pass_last_set_time == 1
+
+    assert smb.passdb_sync({"alice": {"nt_hash": "B" * 32, "disabled": False}}) == {
+        "added": 0, "updated": 1, "removed": 0,
+    }
+    assert samu.acct_ctrl == ACB_NORMAL
+    assert samu.nt_passwd == b"\xbb" * 16
+    assert abs(samu.pass_last_set_time - time.time()) < 5
+
+    assert smb.passdb_sync({}) == {"added": 0, "updated": 0, "removed": 1}
+    assert pdb.users == {}
+
+
+def test__passdb_sync__single_user_does_not_remove_others(smb, pdb):
+    smb.passdb_sync(expected_entries(3))
+
+    assert smb.passdb_sync({"user0": {"nt_hash": "B" * 32, "disabled": False}}, False) == {
+        "added": 0, "updated": 1, "removed": 0,
+    }
+    assert set(pdb.users) == {"user0", "user1", "user2"}
+
+
+def test__passdb_sync__allocates_rids_in_one_block(smb, pdb):
+    smb.passdb_sync(expected_entries(100))
+
+    smb.middleware["smb.get_next_rid"].assert_called_once_with(100)
+    assert sorted(int(samu.user_sid.rsplit("-", 1)[1]) for samu in pdb.users.values()) == list(range(5000, 5100))
+
+
+def test__passdb_sync__10k_users(smb, pdb):
+    expected = expected_entries(10000)
+
+    smb.passdb_sync(expected)
+    assert pdb.writes == 10000
+
+    # Nothing changed, nothing is written
+    start = time.monotonic()
+    assert smb.passdb_sync(expected) == {"added": 0, "updated": 0, "removed": 0}
+    assert pdb.writes == 10000
+
+    # Only the changed record is written
+    assert smb.passdb_sync(expected_entries(10000, changed=1234)) == {"added": 0, "updated": 1, "removed": 0}
+    assert pdb.writes == 10001
+    assert pdb.users["user1234"].acct_ctrl & ACB_DISABLED
+    assert time.monotonic() - start < 2
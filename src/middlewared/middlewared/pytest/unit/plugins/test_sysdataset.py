@@ -0,0 +1,229 @@
+import json
+import os
+import sys
+import textwrap
+from unittest.mock import patch
+
+from asynctest import CoroutineMock, Mock
+import pytest
+
+from middlewared.plugins.sysdataset import SystemDatasetService, zfs_send_recv
+from middlewared.pytest.unit.middleware import Middleware
+from middlewared.service_exception import CallError
+
+FAKE_ZFS = textwrap.dedent("""\
+    import json
+    import os
+    import sys
+
+    args = sys.argv[1:]
+    if args[0] == "send":
+        if "missing" in args[-1]:
+            sys.stderr.write("dataset does not exist\\n")
+            sys.exit(1)
+        # Larger than pipe buffer
+        sys.stdout.write(json.dumps(args) + "\\n" + "x" * 1024 * 1024)
+    elif args[0] == "recv":
+        if "readonly" in args[-1]:
+            sys.stderr.write("pool is read-only\\n")
+            sys.exit(1)
+        header = sys.stdin.readline()
+        if not header:
+            sys.stderr.write("failed to read from stream\\n")
+            sys.exit(1)
+        with open(os.path.join(os.environ["FAKE_ZFS_DIR"], args[-1].replace("/", "_")), "w") as f:
+            f.write(json.dumps(args) + "\\n" + header)
+        assert len(sys.stdin.read()) == 1024 * 1024
+""")
+
+
+@pytest.fixture
+def fake_zfs(tmp_path, monkeypatch):
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    (bin / "zfs").write_text(f"#!{sys.executable}\n{FAKE_ZFS}")
+    (bin / "zfs").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_ZFS_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test__zfs_send_recv(fake_zfs):
+    zfs_send_recv("tank/.system/cores@migrate-full", "new/.system/cores")
+
+    recv_args, send_args = (fake_zfs / "new_.system_cores").read_text().splitlines()
+    assert json.loads(recv_args) == ["recv", "-F", "-u", "new/.system/cores"]
+    assert json.loads(send_args) == ["send", "tank/.system/cores@migrate-full"]
+
+
+def test__zfs_send_recv__incremental(fake_zfs):
+    zfs_send_recv("tank/.system@migrate-final", "new/.system", "migrate-full")
+
+    send_args = (fake_zfs / "new_.system").read_text().splitlines()[1]
+    assert json.loads(send_args) == ["send", "-i", "@migrate-full", "tank/.system@migrate-final"]
+
+
+def test__zfs_send_recv__send_error(fake_zfs):
+    with pytest.raises(CallError) as e:
+        zfs_send_recv("missing/.system@migrate-full", "new/.system")
+
+    assert e.value.errmsg == (
+        "Failed to replicate 'missing/.system@migrate-full' to 'new/.system': dataset does not exist\n"
+        "failed to read from stream"
+    )
+
+
+def test__zfs_send_recv__recv_error(fake_zfs):
+    with pytest.raises(CallError) as e:
+        zfs_send_recv("tank/.system@migrate-full", "readonly/.system")
+
+    assert e.value.errmsg.startswith("Failed to replicate 'tank/.system@migrate-full' to 'readonly/.system': ")
+    assert e.value.errmsg.endswith("pool is read-only")
+
+
+@pytest.fixture
+def sysdataset():
+    events = []
+
+    def record(name):
+        async def method(*args):
+            events.append((name,) + args)
+        return method
+
+    m = Middleware()
+    m["zfs.dataset.query"] = m._query_filter([{"id": "tank/.system"}])
+    m["zfs.dataset.delete"] = record("zfs.dataset.delete")
+    m["zfs.dataset.rename"] = record("zfs.dataset.rename")
+    m["zfs.snapshot.create"] = lambda data: events.append(("zfs.snapshot.create", data["name"]))
+    m["service.started"] = Mock(return_value=True)
+    for method in ["service.restart", "service.stop", "service.start", "dscache.close", "dscache.initialize",
+                   "cache.put", "cache.pop"]:
+        m[method] = record(method)
+
+    sysdataset = SystemDatasetService(m)
+    sysdataset.config = CoroutineMock(return_value={"uuid": "uuid", "path": "/var/db/system"})
+    for method in ["setup_datasets", "mount", "umount", "destroy_snapshots", "nfsv4link"]:
+        setattr(sysdataset, f"_SystemDatasetService__{method}", record(method))
+
+    def list_snapshots(dataset):
+        snapshot = [e[1] for e in events if e[0] == "zfs.snapshot.create"][-1]
+        return {
+            snapshot: {"tank/.system", "tank/.system/cores", "tank/.system/services"},
+            **({} if snapshot.endswith("-full") else {
+                snapshot.replace("-final", "-full"): {"tank/.system", "tank/.system/cores"},
+            }),
+        }
+
+    def zfs_send_recv(*args):
+        events.append(("zfs_send_recv",) + args)
+
+    with patch.multiple(
+        "middlewared.plugins.sysdataset",
+        list_snapshots=list_snapshots, zfs_send_recv=zfs_send_recv, osc=Mock(IS_LINUX=False),
+    ):
+        yield sysdataset, events
+
+
+@pytest.mark.asyncio
+async def test__migrate(sysdataset):
+    sysdataset, events = sysdataset
+    job = Mock()
+
+    await sysdataset.migrate("tank", "new", job)
+
+    snapshot = events[0][1].rsplit("-", 1)[0]
+    received = f"new/.system-{snapshot}"
+    assert events == [
+        # Services keep running while the bulk of the data is replicated
+        ("zfs.snapshot.create", f"{snapshot}-full"),
+        ("zfs_send_recv", f"tank/.system@{snapshot}-full", received, None),
+        ("zfs_send_recv", f"tank/.system/cores@{snapshot}-full", f"{received}/cores", None),
+        ("zfs_send_recv", f"tank/.system/services@{snapshot}-full", f"{received}/services", None),
+        ("service.stop", "cifs"),
+        ("service.stop", "collectd"),
+        ("service.stop", "rrdcached"),
+        ("service.stop", "syslogd"),
+        ("dscache.close",),
+        ("zfs.snapshot.create", f"{snapshot}-final"),
+        ("zfs_send_recv", f"tank/.system@{snapshot}-final", received, f"{snapshot}-full"),
+        ("zfs_send_recv", f"tank/.system/cores@{snapshot}-final", f"{received}/cores", f"{snapshot}-full"),
+        # Dataset that did not exist when the first snapshot was taken
+        ("zfs_send_recv", f"tank/.system/services@{snapshot}-final", f"{received}/services", None),
+        ("umount", "tank", "uuid"),
+        ("zfs.dataset.rename", received, {"new_name": "new/.system"}),
+        ("setup_datasets", "new", "uuid"),
+        ("mount", "new", "uuid"),
+        ("service.start", "syslogd"),
+        ("service.start", "rrdcached"),
+        ("service.start", "collectd"),
+        ("service.start", "cifs"),
+        ("dscache.initialize",),
+        ("zfs.dataset.delete", "tank/.system", {"recursive": True}),
+        ("destroy_snapshots", "new", [f"{snapshot}-full", f"{snapshot}-final"]),
+        ("nfsv4link", {"uuid": "uuid", "path": "/var/db/system"}),
+    ]
+
+    progress = [call[0][0] for call in job.set_progress.call_args_list]
+    assert progress == sorted(progress)
+    assert progress[-1] == 100
+
+
+@pytest.mark.asyncio
+async def test__migrate__replication_error(sysdataset):
+    sysdataset, events = sysdataset
+
+    async def replicate(*args):
+        raise CallError("Failed to receive")
+
+    sysdataset._SystemDatasetService__replicate = replicate
+
+    with pytest.raises(CallError):
+        await sysdataset.migrate("tank", "new", Mock())
+
+    # Services were not interrupted and the old system dataset is kept
+    assert [e[0] for e in events] == ["destroy_snapshots"]
+    assert events[0][1] == "tank"
+
+
+@pytest.mark.asyncio
+async def test__migrate__keeps_existing_system_dataset(sysdataset):
+    sysdataset, events = sysdataset
+    sysdataset.middleware["zfs.dataset.query"] = sysdataset.middleware._query_filter([
+        {"id": "tank/.system"}, {"id": "new/.system"},
+    ])
+
+    await sysdataset.migrate("tank", "new", Mock())
+
+    received = [e[2] for e in events if e[0] == "zfs_send_recv"][0]
+    assert received.startswith("new/.system-migrate-")
+    assert [e for e in events if e[0] == "zfs.dataset.rename"] == [
+        ("zfs.dataset.rename", "new/.system", {"new_name": f"{received}-previous"}),
+        ("zfs.dataset.rename", received, {"new_name": "new/.system"}),
+    ]
+    assert [e[1] for e in events if e[0] == "zfs.dataset.delete"] == ["tank/.system"]
+
+
+@pytest.mark.asyncio
+async def test__migrate__final_replication_error(sysdataset):
+    sysdataset, events = sysdataset
+    replicate = sysdataset._SystemDatasetService__replicate
+
+    async def failing_replicate(job, _from, target, snapshot, incremental_base, progress):
+        if incremental_base:
+            sysdataset.middleware["zfs.dataset.query"] = sysdataset.middleware._query_filter([
+                {"id": "tank/.system"}, {"id": "new/.system"}, {"id": target},
+            ])
+            raise CallError("Failed to receive")
+
+        await replicate(job, _from, target, snapshot, incremental_base, progress)
+
+    sysdataset._SystemDatasetService__replicate = failing_replicate
+
+    with pytest.raises(CallError):
+        await sysdataset.migrate("tank", "new", Mock())
+
+    received = [e[2] for e in events if e[0] == "zfs_send_recv"][0]
+    # Only the partially received dataset is removed
+    assert [e[1:] for e in events if e[0] == "zfs.dataset.delete"] == [(received, {"recursive": True})]
+    assert not [e for e in events if e[0] in ("zfs.dataset.rename", "umount", "mount")]
+    assert ("service.start", "syslogd") in events
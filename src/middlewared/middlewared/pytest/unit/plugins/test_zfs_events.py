@@ -0,0 +1,152 @@
+import asyncio
+from unittest.mock import patch
+
+from asynctest import CoroutineMock, Mock
+import pytest
+
+from middlewared.plugins.zfs_ import zfs_events
+from middlewared.plugins.zfs_.zfs_events import CACHE_POOLS_STATUSES, zfs_events_dispatcher
+from middlewared.pytest.unit.middleware import Middleware
+
+WINDOW = 0.05
+
+
+def statechange(pool, vdev, state):
+    return {
+        "class": "resource.fs.zfs.statechange",
+        "pool": pool,
+        "pool_guid": 4851237425617282183 if pool == "tank" else 1180463412876281711,
+        "pool_state": 0,
+        "vdev_path": f"/dev/{vdev}",
+        "vdev_state": state,
+        "vdev_laststate": 7 if state != 7 else 4,
+    }
+
+
+def sysevent(name, pool):
+    return {"class": f"sysevent.fs.zfs.{name}", "pool": pool, "pool_guid": 4851237425617282183}
+
+
+# A flapping disk on `tank` being resilvered
+RESILVER_STREAM = (
+    [sysevent("resilver_start", "tank")] +
+    [statechange("tank", "sdb1", 7 if i % 2 else 4) for i in range(200)] +
+    [statechange("boot-pool", "sda3", 7)] +
+    [sysevent("config_sync", "tank") for i in range(50)] +
+    [sysevent("resilver_finish", "tank")]
+)
+
+
+@pytest.fixture
+def middleware():
+    m = Middleware()
+    m.logger = Mock()
+    statuses = {"tank": {"status": "ONLINE"}, "data": {"status": "ONLINE"}}
+    m["cache.get"] = Mock(side_effect=lambda key: statuses)
+    m["cache.update"] = Mock()
+    m["cache.pop"] = Mock()
+    m["boot.pool_name"] = Mock(return_value="boot-pool")
+    m["zfs.pool.query"] = Mock(side_effect=lambda filters: [{"name": filters[0][2], "status": "DEGRADED"}])
+    m["disk.swaps_configure"] = CoroutineMock()
+    return m
+
+
+@pytest.fixture
+def dispatcher():
+    with patch.multiple(
+        "middlewared.plugins.zfs_.zfs_events",
+        STATECHANGE_WINDOW=WINDOW, SWAPS_CONFIGURE_WINDOW=WINDOW,
+        resilver_scrub_start=CoroutineMock(), resilver_scrub_stop_abort=CoroutineMock(),
+    ):
+        yield zfs_events_dispatcher()
+
+
+async def replay(dispatcher, middleware, stream):
+    for event in stream:
+        await dispatcher.dispatch(middleware, event)
+
+    await asyncio.sleep(WINDOW * 4)
+
+
+@pytest.mark.asyncio
+async def test__resilver_stream(dispatcher, middleware):
+    await replay(dispatcher, middleware, RESILVER_STREAM)
+
+    zfs_events.resilver_scrub_start.assert_called_once_with(middleware, "tank")
+    zfs_events.resilver_scrub_stop_abort.assert_called_once_with(middleware, "tank")
+
+    middleware["disk.swaps_configure"].assert_called_once_with()
+
+    # Only the pool that changed is queried, boot pool is not reported
+    middleware["zfs.pool.query"].assert_called_once_with([["name", "=", "tank"]])
+    # Expiration time of cached statuses is kept
+    middleware["cache.update"].assert_called_once_with(
+        CACHE_POOLS_STATUSES, {"tank": {"status": "DEGRADED"}, "data": {"status": "ONLINE"}},
+    )
+    middleware["cache.pop"].assert_not_called()
+
+    assert dispatcher.pending == {}
+
+
+@pytest.mark.asyncio
+async def test__swaps_configure_once_per_window(dispatcher, middleware):
+    await replay(dispatcher, middleware, [sysevent("pool_import", "tank"), sysevent("config_sync", "tank")])
+    await replay(dispatcher, middleware, [sysevent("pool_destroy", "data"), sysevent("config_sync", "data")])
+
+    assert middleware["disk.swaps_configure"].call_count == 2
+
+
+@pytest.mark.asyncio
+async def test__statechange_coalesced_per_pool(dispatcher, middleware):
+    await replay(dispatcher, middleware, [
+        statechange("tank", "sdb1", 4), statechange("data", "sdc1", 4), statechange("tank", "sdb1", 7),
+    ])
+
+    assert sorted(call[0][0][0][2] for call in middleware["zfs.pool.query"].call_args_list) == ["data", "tank"]
+
+
+@pytest.mark.asyncio
+async def test__statechange_without_cached_statuses(dispatcher, middleware):
+    middleware["cache.get"] = Mock(side_effect=KeyError(CACHE_POOLS_STATUSES))
+
+    await replay(dispatcher, middleware, [statechange("tank", "sdb1", 4)])
+
+    middleware["zfs.pool.query"].assert_not_called()
+    middleware["cache.update"].assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test__statechange_pool_gone(dispatcher, middleware):
+    middleware["zfs.pool.query"] = Mock(return_value=[])
+
+    await replay(dispatcher, middleware, [statechange("tank", "sdb1", 4)])
+
+    middleware["cache.pop"].assert_called_once_with(CACHE_POOLS_STATUSES)
+    middleware["cache.update"].assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test__statechange_new_pool(dispatcher, middleware):
+    await replay(dispatcher, middleware, [statechange("new", "sdd1", 7)])
+
+    middleware["cache.pop"].assert_called_once_with(CACHE_POOLS_STATUSES)
+    middleware["cache.update"].assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("event", ["pool_create", "pool_destroy", "pool_import"])
+async def test__pools_change_invalidates_statuses(dispatcher, middleware, event):
+    await replay(dispatcher, middleware, [sysevent(event, "new")])
+
+    middleware["cache.pop"].assert_called_once_with(CACHE_POOLS_STATUSES)
+
+
+@pytest.mark.asyncio
+async def test__handler_error_is_logged(dispatcher, middleware):
+    middleware["disk.swaps_configure"] = CoroutineMock(side_effect=ValueError())
+
+    await replay(dispatcher, middleware, [sysevent("config_sync", "tank")])
+    await replay(dispatcher, middleware, [sysevent("config_sync", "tank")])
+
+    assert middleware.logger.error.call_count == 2
+    assert middleware["disk.swaps_configure"].call_count == 2
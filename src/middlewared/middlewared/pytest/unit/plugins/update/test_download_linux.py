@@ -0,0 +1,176 @@
+import hashlib
+import http.server
+import json
+import os
+import re
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from middlewared.plugins.update_.download_linux import Download
+from middlewared.service_exception import CallError
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+CHECKSUM = hashlib.sha256(DATA).hexdigest()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+
+        offset = 0
+        status = 200
+        if "Range" in self.headers and self.headers.get("If-Range", server.etag) == server.etag:
+            offset = int(re.match(r"bytes=([0-9]+)-", self.headers["Range"]).group(1))
+            if offset >= len(server.data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(server.data) - offset))
+        self.send_header("ETag", server.etag)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {offset}-{len(server.data) - 1}/{len(server.data)}")
+        self.end_headers()
+
+        data = server.data[offset:]
+        if server.drops:
+            # Drop the connection mid-transfer
+            server.drops -= 1
+            data = data[:server.drop_after]
+            self.close_connection = True
+
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.data = DATA
+    server.etag = '"1"'
+    server.drops = 0
+    server.drop_after = 0
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_retry_interval():
+    with patch("middlewared.plugins.update_.download_linux.DOWNLOAD_RETRY_INTERVAL", 0):
+        yield
+
+
+def download(server, tmp_path, **kwargs):
+    return Download(
+        f"http://127.0.0.1:{server.server_address[1]}/update.sqsh", str(tmp_path / "update.sqsh"), CHECKSUM, **kwargs
+    )
+
+
+def test__download(server, tmp_path):
+    progress = []
+    download(server, tmp_path, progress_callback=lambda *args: progress.append(args)).run()
+
+    assert (tmp_path / "update.sqsh").read_bytes() == DATA
+    assert not (tmp_path / "update.sqsh.part").exists()
+    assert progress[-1][:2] == (len(DATA), len(DATA))
+
+
+def test__download__resumes_after_connection_drops(server, tmp_path):
+    server.drops = 3
+    server.drop_after = 1024 * 1024
+
+    download(server, tmp_path).run()
+
+    assert (tmp_path / "update.sqsh").read_bytes() == DATA
+    assert [r.get("Range") for r in server.requests] == [
+        None, "bytes=1048576-", "bytes=2097152-", "bytes=3145728-",
+    ]
+    assert all(r["If-Range"] == server.etag for r in server.requests[1:])
+
+
+def test__download__resumes_after_restart(server, tmp_path):
+    server.drops = 100
+    server.drop_after = 1024 * 1024
+
+    with patch("middlewared.plugins.update_.download_linux.DOWNLOAD_RETRIES", 0):
+        with pytest.raises(CallError):
+            download(server, tmp_path).run()
+
+    assert (tmp_path / "update.sqsh.part").stat().st_size == 1024 * 1024
+
+    server.drops = 0
+    download(server, tmp_path).run()
+
+    assert (tmp_path / "update.sqsh").read_bytes() == DATA
+    assert server.requests[-1]["Range"] == "bytes=1048576-"
+
+
+def test__download__restarts_if_file_changed(server, tmp_path):
+    server.drops = 1
+    server.drop_after = 1024 * 1024
+    with patch("middlewared.plugins.update_.download_linux.DOWNLOAD_RETRIES", 0):
+        with pytest.raises(CallError):
+            download(server, tmp_path).run()
+
+    server.etag = '"2"'
+    download(server, tmp_path).run()
+
+    assert (tmp_path / "update.sqsh").read_bytes() == DATA
+
+
+def test__download__invalid_checksum(server, tmp_path):
+    server.data = DATA[:-1] + b"!"
+
+    with pytest.raises(CallError) as e:
+        download(server, tmp_path).run()
+
+    assert "Invalid update file checksum" in e.value.errmsg
+    assert os.listdir(tmp_path) == []
+
+
+def test__download__bandwidth_limit(server, tmp_path):
+    server.data = DATA[:512 * 1024]
+    d = download(server, tmp_path, bandwidth_limit=1024 * 1024)
+    d.checksum = hashlib.sha256(server.data).hexdigest()
+
+    start = time.monotonic()
+    d.run()
+
+    assert time.monotonic() - start >= 0.45
+    assert d.chunk_size <= 512 * 1024
+
+
+def test__verify_existing(server, tmp_path):
+    d = download(server, tmp_path)
+    d.run()
+
+    with patch("middlewared.plugins.update_.download_linux.file_sha256") as file_sha256:
+        assert d.verify_existing()
+
+    file_sha256.assert_not_called()
+    assert json.loads((tmp_path / "update.sqsh.json").read_text())["complete"]
+
+
+def test__verify_existing__modified(server, tmp_path):
+    d = download(server, tmp_path)
+    d.run()
+    (tmp_path / "update.sqsh").write_bytes(b"corrupted")
+
+    assert not d.verify_existing()
+    assert not (tmp_path / "update.sqsh").exists()
@@ -0,0 +1,121 @@
+# -*- coding=utf-8 -*-
+import logging
+import time
+from unittest.mock import patch
+
+import pytest
+
+from middlewared.logger import ErrorProneRotatingFileHandler, LogWriter
+
+
+class SlowRotatingFileHandler(ErrorProneRotatingFileHandler):
+    def emit(self, record):
+        time.sleep(0.001)
+        super().emit(record)
+
+
+@pytest.fixture
+def log(tmp_path):
+    path = tmp_path / "test.log"
+    handler = SlowRotatingFileHandler(str(path), maxBytes=0, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(levelname)s %(name)s %(message)s"))
+
+    logger = logging.getLogger("middlewared.test_logger")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.handlers = [handler]
+
+    writer = LogWriter()
+    writer.attach(logger)
+    try:
+        yield logger, writer, lambda: path.read_text().splitlines()
+    finally:
+        writer.stop()
+        logger.handlers = []
+        handler.close()
+
+
+def test__log_writer__does_not_block(log):
+    logger, writer, lines = log
+
+    start = time.monotonic()
+    for i in range(1000):
+        logger.debug("Message %d", i)
+    # Writing these records takes at least a second
+    assert time.monotonic() - start < 0.5
+
+    writer.stop()
+
+    assert lines() == [f"DEBUG middlewared.test_logger Message {i}" for i in range(1000)]
+
+
+def test__log_writer__formats_records_when_emitted(log):
+    logger, writer, lines = log
+
+    args = {"key": "value"}
+    logger.info("Arguments %r", args)
+    args["key"] = "changed"
+    try:
+        raise ValueError("Error")
+    except ValueError:
+        logger.error("Failed", exc_info=True)
+    writer.stop()
+
+    assert lines()[0] == "INFO middlewared.test_logger Arguments {'key': 'value'}"
+    assert lines()[1] == "ERROR middlewared.test_logger Failed"
+    assert lines()[-1] == "ValueError: Error"
+
+
+def test__log_writer__coalesces_repeated_messages(log):
+    logger, writer, lines = log
+
+    for i in range(100):
+        logger.warning("Pool is degraded")
+    logger.warning("Pool is healthy")
+    for i in range(3):
+        logger.warning("Pool is degraded")
+    writer.stop()
+
+    assert lines() == [
+        "WARNING middlewared.test_logger Pool is degraded",
+        "WARNING middlewared.test_logger Last message repeated 99 times",
+        "WARNING middlewared.test_logger Pool is healthy",
+        "WARNING middlewared.test_logger Pool is degraded",
+        "WARNING middlewared.test_logger Last message repeated 2 times",
+    ]
+
+
+def test__log_writer__rate_limit(log):
+    logger, writer, lines = log
+
+    with patch("middlewared.logger.LOG_RATE_LIMIT", 1), patch("middlewared.logger.LOG_RATE_LIMIT_BURST", 10):
+        for i in range(100):
+            logger.debug("Message %d", i)
+        logger.error("Error")
+        writer.stop()
+
+    assert lines() == (
+        [f"DEBUG middlewared.test_logger Message {i}" for i in range(10)] +
+        ["ERROR middlewared.test_logger Error", "WARNING middlewared.test_logger 90 messages were suppressed because "
+                                                "of rate limit"]
+    )
+
+
+def test__log_writer__queue_full(log):
+    logger, writer, lines = log
+
+    with patch("middlewared.logger.LOG_QUEUE_SIZE", 10):
+        writer._reset()
+
+    # Writer thread is stuck
+    with patch.object(writer, "start"):
+        for i in range(15):
+            logger.info("Message %d", i)
+
+    writer.start()
+    writer.stop()
+
+    assert lines() == (
+        [f"INFO middlewared.test_logger Message {i}" for i in range(10)] +
+        ["WARNING middlewared.logger 5 messages were dropped because log queue was full"]
+    )
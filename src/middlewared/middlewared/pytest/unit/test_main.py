@@ -1,14 +1,20 @@
 # -*- coding=utf-8 -*-
+import ast
 import asyncio
+from collections import defaultdict
+import functools
 import json
 import logging
+import os
+import time
 from unittest.mock import Mock, patch
 
 from asyncmock import AsyncMock  # FIXME: python 3.8
 import pytest
 
-from middlewared.main import Application, Middleware
-from middlewared.service import accepts, job, CoreService, CRUDService
+import middlewared
+from middlewared.main import Application, CORE_PLUGINS, Middleware, plugins_setup_waves
+from middlewared.service import accepts, job, CallError, CoreService, CRUDService, Service
 from middlewared.plugins.datastore.read import DatastoreService
 from middlewared.schema import Dict, Str
 
@@ -84,3 +90,211 @@ async def test__job_service(caplog, method):
     result = json.loads(await fut)
 
     assert result["result"][0]["arguments"] == [{"password": "********"}]
+
+
+class LoadService(Service):
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    async def async_sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def fail(self):
+        raise CallError("Failed")
+
+
+@pytest.mark.asyncio
+async def test__metrics():
+    with patch("middlewared.main.multiprocessing"):
+        middleware = Middleware()
+    middleware.loop = asyncio.get_event_loop()
+    middleware.add_service(CoreService(middleware))
+    middleware.add_service(LoadService(middleware))
+
+    # Synthetic load: 4 connections running 10 calls each at once. Blocking calls are run in websocket thread pool
+    # that has 10 workers, so most of them have to wait for a free worker.
+    connections = 4
+    calls = [("load.sleep", [0.05])] * 8 + [("load.async_sleep", [0.05]), ("load.fail", [])]
+    responses = []
+    done = asyncio.Event()
+
+    async def send_str(data):
+        responses.append(json.loads(data))
+        if len(responses) == connections * len(calls):
+            done.set()
+
+    for i in range(connections):
+        application = Application(middleware, asyncio.get_event_loop(), Mock(), Mock(send_str=send_str))
+        application.authenticated = True
+        application.handshake = True
+        for j, (method, params) in enumerate(calls):
+            await application.on_message({"id": f"{i}-{j}", "msg": "method", "method": method, "params": params})
+
+    await asyncio.wait_for(done.wait(), 10)
+    middleware._sample_loop_lag(time.monotonic())
+
+    fut = asyncio.Future()
+    application.response.send_str = AsyncMock(side_effect=fut.set_result)
+    await application.on_message({"id": "metrics", "msg": "method", "method": "core.metrics", "params": []})
+    result = json.loads(await fut)["result"]
+
+    sleep = result["methods"]["load.sleep"]["ws"]
+    assert sleep["calls"] == 32
+    assert sleep["errors"] == 0
+    assert sleep["run"]["p50"] >= 0.045
+    assert sleep["queue_wait"]["count"] == 32
+    # 32 calls need at least 4 rounds of 10 workers
+    assert sleep["queue_wait"]["max"] >= 0.1
+
+    async_sleep = result["methods"]["load.async_sleep"]["loop"]
+    assert async_sleep["calls"] == 4
+    assert async_sleep["queue_wait"]["count"] == 0
+    assert async_sleep["run"]["max"] >= 0.045
+
+    assert result["methods"]["load.fail"]["ws"]["errors"] == 4
+    assert result["loop_lag"]["count"] == 1
+
+    text = middleware.metrics.prometheus()
+    assert 'middlewared_calls_total{method="load.sleep",executor="ws"} 32\n' in text
+
+
+@pytest.mark.asyncio
+async def test__send_event__fan_out():
+    with patch("middlewared.main.multiprocessing"):
+        middleware = Middleware()
+    middleware.loop = asyncio.get_event_loop()
+    for i in range(100):
+        middleware.event_register(f"test.event{i}", "Test event")
+
+    # 500 clients subscribed to 20 events each, 5 of them are also subscribed to all events
+    received = defaultdict(list)
+    applications = []
+    for i in range(500):
+        application = Application(middleware, asyncio.get_event_loop(), Mock(), Mock())
+        application._send = Mock()
+        application._send_str = Mock(side_effect=functools.partial(lambda i, data: received[i].append(data), i))
+        application.session_id = str(i)
+        application.on_open()
+        for j in range(20):
+            await application.subscribe(str(j), f"test.event{(i + j * 5) % 100}")
+        if i % 100 == 0:
+            await application.subscribe("all", "*")
+        applications.append(application)
+
+    with patch("middlewared.main.json.dumps", wraps=json.dumps) as dumps:
+        start = time.monotonic()
+        for n in range(1000):
+            middleware.send_event(f"test.event{n % 100}", "CHANGED", id=n, fields={"n": n})
+        elapsed = time.monotonic() - start
+
+    assert dumps.call_count == 1000
+    # Each event has 100 subscribers + wildcard subscribers that are not subscribed to it by name
+    assert sum(map(len, received.values())) == 1000 * 100 + sum(
+        1 for n in range(1000) for i in range(0, 500, 100) if (n % 100 - i) % 5 != 0
+    )
+    assert json.loads(received[1][0]) == {"msg": "changed", "collection": "test.event1", "id": 1,
+                                          "fields": {"n": 1}}
+    assert all(json.loads(data)["collection"] in {f"test.event{(1 + j * 5) % 100}" for j in range(20)}
+               for data in received[1])
+    # Dispatching to 100 clients should not depend on the total number of clients and subscriptions
+    assert elapsed < 5
+
+    await applications[1].unsubscribe("0")
+    await applications[1].on_close()
+    received.clear()
+    middleware.send_event("test.event1", "CHANGED", id=1)
+    assert 1 not in received
+    assert len(received) == 100 - 1 + 5
+
+
+def real_setup_funcs():
+    """
+    `(plugin, setup function, dependencies)` of the real plugin set without importing it. Setup functions only
+    sleep, as if they were waiting for system calls.
+    """
+    plugins_dir = os.path.join(os.path.dirname(middlewared.__file__), "plugins")
+    setup_funcs = []
+    for root, dirs, files in sorted(os.walk(plugins_dir)):
+        for file in sorted(files):
+            if not file.endswith(".py"):
+                continue
+
+            path = os.path.join(root, file)
+            with open(path) as f:
+                module = ast.parse(f.read())
+
+            if not any(isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == "setup"
+                       for node in module.body):
+                continue
+
+            dependencies = []
+            for node in module.body:
+                if isinstance(node, ast.Assign) and [t.id for t in node.targets] == ["SETUP_DEPENDENCIES"]:
+                    dependencies = ast.literal_eval(node.value)
+
+            async def setup(middleware):
+                await asyncio.sleep(0.02)
+
+            setup.__module__ = os.path.relpath(path, plugins_dir)
+            setup_funcs.append((os.path.relpath(path, plugins_dir).split("/")[0].replace(".py", ""), setup,
+                                dependencies))
+
+    return setup_funcs
+
+
+def test__plugins_setup_waves__real_plugins():
+    setup_funcs = real_setup_funcs()
+
+    waves = plugins_setup_waves(setup_funcs)
+
+    assert sum(map(len, waves)) == len(setup_funcs)
+    plugin_wave = {plugin: i for i, wave in enumerate(waves) for plugin, f in wave}
+    assert [plugin_wave[plugin] for plugin in CORE_PLUGINS] == list(range(len(CORE_PLUGINS)))
+    assert plugin_wave["zettarepl"] > plugin_wave["replication"]
+    assert all(plugin_wave[plugin] >= len(CORE_PLUGINS) for plugin in plugin_wave if plugin not in CORE_PLUGINS)
+
+
+def test__plugins_setup_waves__dependencies():
+    f = Mock()
+
+    assert plugins_setup_waves([
+        ("pool", f, ["network"]),
+        ("smb", f, ["pool", "not_installed"]),
+        ("network", f, []),
+        ("nfs", f, []),
+        ("datastore", f, []),
+    ]) == [
+        [("datastore", f)],
+        [("network", f), ("nfs", f)],
+        [("pool", f)],
+        [("smb", f)],
+    ]
+
+    with pytest.raises(RuntimeError) as e:
+        plugins_setup_waves([("a", f, ["b"]), ("b", f, ["a"])])
+    assert "Circular" in str(e.value)
+
+
+@pytest.mark.asyncio
+async def test__plugins_setup__boot_profile():
+    with patch("middlewared.main.multiprocessing"):
+        middleware = Middleware()
+    middleware.loop = asyncio.get_event_loop()
+    middleware._console_write = Mock()
+    middleware.add_service(CoreService(middleware))
+    setup_funcs = real_setup_funcs()
+
+    start = time.monotonic()
+    await middleware._Middleware__plugins_setup(setup_funcs)
+    elapsed = time.monotonic() - start
+
+    # Running them one after another would take 20 ms per setup function
+    sequential = 0.02 * len(setup_funcs)
+    assert elapsed < sequential / 2
+
+    profile = await middleware.call("core.boot_profile")
+    assert profile["setup"] == pytest.approx(elapsed, abs=0.05)
+    assert len(profile["setup_functions"]) == len(setup_funcs)
+    functions = {f["module"]: f for f in profile["setup_functions"]}
+    assert functions["zettarepl.py"]["start"] >= functions["replication.py"]["start"] + 0.02
+    assert all(0.02 <= f["duration"] < 1 for f in profile["setup_functions"])
@@ -0,0 +1,104 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+from middlewared.utils.connection_pool import ConnectionPool
+
+
+class Connection:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+
+def pool(**kwargs):
+    return ConnectionPool(Mock(), Mock(side_effect=lambda conn: setattr(conn, "closed", True)), (OSError,), **kwargs)
+
+
+def test__connection_pool__reuses_connection():
+    p = pool()
+    create = Mock(side_effect=lambda: Connection("a"))
+
+    with p.connection("host-a", create) as a1:
+        pass
+    with p.connection("host-a", create) as a2:
+        pass
+    with p.connection("host-b", lambda: Connection("b")) as b:
+        pass
+
+    assert a1 is a2
+    assert b is not a1
+    create.assert_called_once_with()
+    assert not a1.closed
+
+
+def test__connection_pool__concurrent_users_get_different_connections():
+    p = pool()
+
+    with p.connection("host", lambda: Connection("1")) as c1:
+        with p.connection("host", lambda: Connection("2")) as c2:
+            assert c1 is not c2
+
+    with p.connection("host", lambda: Connection("3")) as c3:
+        assert c3 in (c1, c2)
+
+
+def test__connection_pool__discards_broken_connection():
+    p = pool()
+
+    with pytest.raises(OSError):
+        with p.connection("host", lambda: Connection("1")) as c1:
+            raise OSError("Connection reset by peer")
+
+    assert c1.closed
+
+    # Other errors (i.e. remote command failure) do not affect the connection
+    with pytest.raises(ValueError):
+        with p.connection("host", lambda: Connection("2")) as c2:
+            raise ValueError()
+
+    with p.connection("host", lambda: Connection("3")) as c3:
+        assert c3 is c2
+
+
+def test__connection_pool__health_check():
+    p = pool(check_interval=10)
+
+    with patch("middlewared.utils.connection_pool.time.monotonic", return_value=1000):
+        with p.connection("host", lambda: Connection("1")) as c1:
+            pass
+
+    with patch("middlewared.utils.connection_pool.time.monotonic", return_value=1005):
+        with p.connection("host", lambda: Connection("2")) as c:
+            assert c is c1
+    p.check.assert_not_called()
+
+    p.check.side_effect = EOFError()
+    with patch("middlewared.utils.connection_pool.time.monotonic", return_value=1020):
+        with p.connection("host", lambda: Connection("3")) as c:
+            assert c.name == "3"
+    p.check.assert_called_once_with(c1)
+    assert c1.closed
+
+
+def test__connection_pool__expire():
+    p = pool(idle_timeout=300)
+
+    with patch("middlewared.utils.connection_pool.time.monotonic", return_value=1000):
+        with p.connection("host", lambda: Connection("1")) as c1:
+            pass
+
+    with patch("middlewared.utils.connection_pool.time.monotonic", return_value=1200):
+        with p.connection("other", lambda: Connection("2")) as c2:
+            pass
+
+    with patch("middlewared.utils.connection_pool.time.monotonic", return_value=1400):
+        p.expire()
+
+    assert c1.closed
+    assert not c2.closed
+    assert list(p.idle) == ["other"]
+
+    p.clear()
+    assert c2.closed
+    assert p.idle == {}
@@ -0,0 +1,50 @@
+from unittest.mock import patch
+
+from middlewared.utils.credential_cache import CredentialCache
+
+
+def test__credential_cache__hit():
+    cache = CredentialCache()
+    cache.put("user", "root", "password", "$6$hash")
+
+    assert cache.get("user", "root", "password", "$6$hash")
+    assert not cache.get("user", "root", "wrong", "$6$hash")
+    assert not cache.get("api_key", "root", "password", "$6$hash")
+
+
+def test__credential_cache__stored_hash_changed():
+    cache = CredentialCache()
+    cache.put("user", "root", "password", "$6$hash")
+
+    assert not cache.get("user", "root", "password", "$6$newhash")
+    assert not cache.get("user", "root", "password", "$6$hash")
+
+
+def test__credential_cache__expires():
+    cache = CredentialCache(ttl=60)
+    with patch("middlewared.utils.credential_cache.time.monotonic", return_value=1000):
+        cache.put("api_key", 1, "key", "$pbkdf2$hash")
+
+    with patch("middlewared.utils.credential_cache.time.monotonic", return_value=1059):
+        assert cache.get("api_key", 1, "key", "$pbkdf2$hash")
+
+    with patch("middlewared.utils.credential_cache.time.monotonic", return_value=1061):
+        assert not cache.get("api_key", 1, "key", "$pbkdf2$hash")
+
+
+def test__credential_cache__invalidate():
+    cache = CredentialCache()
+    cache.put("api_key", 1, "key1", "hash1")
+    cache.put("api_key", 2, "key2", "hash2")
+
+    cache.invalidate("api_key", 1)
+
+    assert not cache.get("api_key", 1, "key1", "hash1")
+    assert cache.get("api_key", 2, "key2", "hash2")
+
+
+def test__credential_cache__does_not_store_secrets():
+    cache = CredentialCache()
+    cache.put("user", "root", "password", "$6$hash")
+
+    assert "password" not in repr(cache.entries)
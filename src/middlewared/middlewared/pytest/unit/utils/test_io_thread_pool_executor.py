@@ -0,0 +1,97 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+import middlewared.logger  # noqa: F401 (adds `Logger.trace`)
+from middlewared.utils.io_thread_pool_executor import IoThreadPoolExecutor, IoThreadPoolFull
+
+
+def test__io_thread_pool_executor__bounded():
+    executor = IoThreadPoolExecutor("Test", 2, max_workers=20, pool_max_workers=10)
+    threads = threading.active_count()
+
+    max_threads = 0
+
+    def sleep(i):
+        nonlocal max_threads
+        max_threads = max(max_threads, threading.active_count() - threads)
+        time.sleep(0.001)
+        return i
+
+    futures = []
+    for i in range(10000):
+        pool = executor if i % 2 else executor.pool(f"service{i % 4}")
+        futures.append(pool.submit(sleep, i))
+
+    assert [f.result(30) for f in futures] == list(range(10000))
+    assert max_threads <= 20
+    assert executor.workers_count <= 20
+    assert executor.pool("service0").stats()["workers"] <= 10
+
+
+def test__io_thread_pool_executor__pools_do_not_starve_each_other():
+    executor = IoThreadPoolExecutor("Test", 0, max_workers=10, pool_max_workers=10)
+    event = threading.Event()
+    try:
+        # Flood of blocking calls takes all the threads
+        blocked = [executor.pool("filesystem").submit(event.wait) for i in range(100)]
+        assert executor.workers_count == 10
+
+        assert executor.pool("datastore").submit(lambda: "result").result(5) == "result"
+    finally:
+        event.set()
+
+    for f in blocked:
+        f.result(5)
+
+
+def test__io_thread_pool_executor__full():
+    executor = IoThreadPoolExecutor("Test", 0, max_workers=10, pool_max_workers=2, pool_max_queue_size=3)
+    event = threading.Event()
+    try:
+        futures = [executor.pool("filesystem").submit(event.wait) for i in range(5)]
+
+        with pytest.raises(IoThreadPoolFull):
+            executor.pool("filesystem").submit(event.wait)
+
+        for i in range(100):
+            if executor.pool("filesystem").stats()["free"] == 0:
+                break
+            time.sleep(0.01)
+        assert executor.pool("filesystem").stats() == {"workers": 2, "free": 0, "queued": 3}
+    finally:
+        event.set()
+
+    for f in futures:
+        f.result(5)
+
+
+def test__io_thread_pool_executor__idle_workers_exit():
+    with patch("middlewared.utils.io_thread_pool_executor.random.uniform", return_value=0.05):
+        executor = IoThreadPoolExecutor("Test", 1)
+        event = threading.Event()
+        futures = [executor.submit(event.wait) for i in range(5)]
+        assert executor.workers_count == 5
+
+        event.set()
+        for f in futures:
+            f.result(5)
+
+        for i in range(100):
+            if executor.workers_count == 1:
+                break
+            time.sleep(0.05)
+
+    assert executor.stats()["pools"]["default"] == {"workers": 1, "free": 1, "queued": 0}
+
+
+def test__io_thread_pool_executor__in_worker_thread():
+    executor = IoThreadPoolExecutor("Test", 0)
+    other = IoThreadPoolExecutor("Other", 0)
+
+    assert not executor.in_worker_thread()
+    assert executor.pool("service").submit(executor.in_worker_thread).result(5)
+    assert executor.submit(executor.pool("service").in_worker_thread).result(5)
+    assert not other.submit(executor.in_worker_thread).result(5)
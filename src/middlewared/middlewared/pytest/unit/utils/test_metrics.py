@@ -0,0 +1,87 @@
+import random
+from unittest.mock import patch
+
+import pytest
+
+from middlewared.utils.metrics import Histogram, MetricsRegistry
+
+
+def test__histogram__percentiles():
+    h = Histogram()
+    values = list(range(1, 10001))
+    random.shuffle(values)
+    for v in values:
+        h.record(v / 1000)
+
+    summary = h.summary()
+    assert summary["count"] == 10000
+    assert summary["max"] == 10
+    assert summary["mean"] == pytest.approx(5.0005)
+    for p, expected in [("p50", 5), ("p90", 9), ("p99", 9.9), ("p99.9", 9.99)]:
+        assert summary[p] == pytest.approx(expected, rel=1 / 16)
+
+
+def test__histogram__small_values_are_exact():
+    h = Histogram()
+    for v in [0, 1, 2, 3, 20]:
+        h.record(v / 1000000)
+
+    assert h.percentile(50) == 0.000002
+    assert h.percentile(100) == 0.00002
+    assert h.cumulative([0.000001, 0.00001, 1]) == [2, 4, 5]
+
+
+def test__histogram__empty():
+    assert Histogram().summary() == {"count": 0, "mean": 0, "max": 0, "p50": 0, "p90": 0, "p99": 0, "p99.9": 0}
+
+
+def test__metered_call():
+    registry = MetricsRegistry()
+
+    with patch("middlewared.utils.metrics.time.monotonic", side_effect=[100, 103, 104]):
+        with registry.call("pool.query", "thread") as call:
+            assert call.run(lambda x: x + 1, 1) == 2
+
+    with patch("middlewared.utils.metrics.time.monotonic", side_effect=[100, 100.5]):
+        with pytest.raises(ValueError):
+            with registry.call("pool.query", "loop"):
+                raise ValueError()
+
+    summary = registry.summary()["methods"]["pool.query"]
+    assert summary["thread"]["calls"] == 1
+    assert summary["thread"]["errors"] == 0
+    assert summary["thread"]["queue_wait"]["max"] == 3
+    assert summary["thread"]["run"]["max"] == 1
+    assert summary["loop"]["calls"] == 1
+    assert summary["loop"]["errors"] == 1
+    assert summary["loop"]["queue_wait"]["count"] == 0
+    assert summary["loop"]["run"]["max"] == 0.5
+
+
+def test__prometheus():
+    registry = MetricsRegistry()
+    registry.record_call("pool.query", "ws", 0.002, 0.2)
+    registry.record_call("pool.query", "ws", 0.002, 2, error=True)
+    registry.record_loop_lag(0.00005)
+
+    text = registry.prometheus()
+
+    assert 'middlewared_calls_total{method="pool.query",executor="ws"} 2\n' in text
+    assert 'middlewared_call_errors_total{method="pool.query",executor="ws"} 1\n' in text
+    assert 'middlewared_call_run_seconds_bucket{method="pool.query",executor="ws",le="0.5"} 1\n' in text
+    assert 'middlewared_call_run_seconds_bucket{method="pool.query",executor="ws",le="5"} 2\n' in text
+    assert 'middlewared_call_run_seconds_bucket{method="pool.query",executor="ws",le="+Inf"} 2\n' in text
+    assert 'middlewared_call_queue_wait_seconds_sum{method="pool.query",executor="ws"} 0.004\n' in text
+    assert 'middlewared_loop_lag_seconds_bucket{le="0.0001"} 1\n' in text
+    assert 'middlewared_loop_lag_seconds_count{} 1\n' in text
+
+
+def test__reset():
+    registry = MetricsRegistry()
+    registry.record_call("pool.query", "ws", 0.002, 0.2)
+    registry.record_loop_lag(0.1)
+
+    registry.reset()
+
+    assert registry.summary()["methods"] == {}
+    assert registry.summary()["loop_lag"]["count"] == 0
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import os
+import re
+import secrets
+import subprocess
+import time
+
+import aiohttp
+
+from middlewared.utils import Popen
+
+logger = logging.getLogger(__name__)
+
+RCD_START_TIMEOUT = 10
+# rclone picks a free port itself and reports it in this log message
+RC_ADDR = "127.0.0.1:0"
+RC_ADDR_RE = re.compile(r"Serving remote control on https?://([^/\s]+)")
+
+
+class RcloneRcError(Exception):
+    def __init__(self, error, status=None):
+        self.error = error
+        self.status = status
+        super().__init__(error)
+
+
+def connection_string(config, path=""):
+    """
+    Builds rclone on-the-fly remote (i.e. `:s3,access_key_id="...":bucket/path`) from remote `config` that has the
+    same keys as an rclone config file section.
+    """
+    params = "".join(f",{k}={quote(v)}" for k, v in config.items() if k != "type")
+    return f":{config['type']}{params}:{path}"
+
+
+def quote(value):
+    if isinstance(value, bool):
+        value = "true" if value else "false"
+
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+class RcloneRc:
+    """
+    Client for rclone remote control API served on `address`. If `address` is not known in advance, it is read from
+    rclone log (see `parse_address`).
+    """
+
+    def __init__(self, address, user, password):
+        self.address = address
+        self.user = user
+        self.password = password
+
+        self.session = None
+
+    @classmethod
+    def create(cls):
+        return cls(None, secrets.token_hex(16), secrets.token_hex(16))
+
+    def args(self):
+        return ["--rc-addr", RC_ADDR]
+
+    def env(self):
+        """
+        Credentials are passed in the environment so that they can't be seen in the process list.
+        """
+        return {"RCLONE_RC_USER": self.user, "RCLONE_RC_PASS": self.password}
+
+    def parse_address(self, line):
+        """
+        Reads the address remote control API is served on from the rclone log `line`.
+        """
+        if self.address is None:
+            if m := RC_ADDR_RE.search(line):
+                self.address = m.group(1)
+
+    async def call(self, command, params=None, secret=None):
+        """
+        Calls rc `command`. `secret` (i.e. a connection string with credentials) is removed from error messages.
+        """
+        if self.address is None:
+            raise RcloneRcError("rclone remote control server is not started yet")
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.user, self.password))
+
+        async with self.session.post(f"http://{self.address}/{command}", json=params or {}) as response:
+            result = await response.json(content_type=None)
+
+        if response.status != 200:
+            error = result.get("error") or f"rclone rc {command} failed with status {response.status}"
+            if secret:
+                error = error.replace(secret, "remote:")
+            raise RcloneRcError(error, response.status)
+
+        return result
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class RcloneRcd:
+    """
+    Long-lived `rclone rcd` process that serves remote operations (i.e. directory listing) for the middleware.
+
+    It is started on first use and restarted if it dies. Remotes are passed as connection strings so the daemon has no
+    configuration of its own, it only caches file system objects (and their authentication) between calls.
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.proc = None
+        self.rc = None
+
+    async def call(self, command, params=None, secret=None):
+        rc = await self._ensure_running()
+        try:
+            return await rc.call(command, params, secret)
+        except aiohttp.ClientError as e:
+            raise RcloneRcError(f"Error communicating with rclone: {e!r}")
+
+    async def _ensure_running(self):
+        async with self.lock:
+            if self.proc is not None and self.proc.returncode is None:
+                return self.rc
+
+            await self._stop()
+
+            rc = RcloneRc.create()
+            self.proc = await Popen(
+                ["rclone", "rcd", "--config", "/dev/null"] + rc.args(),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                env=dict(os.environ, **rc.env()),
+            )
+            asyncio.ensure_future(self._log_stderr(self.proc, rc))
+
+            deadline = time.monotonic() + RCD_START_TIMEOUT
+            while True:
+                try:
+                    await rc.call("rc/noop")
+                    break
+                except (aiohttp.ClientError, RcloneRcError):
+                    if self.proc.returncode is not None or time.monotonic() > deadline:
+                        await rc.close()
+                        await self._stop()
+                        raise RcloneRcError("rclone rcd failed to start")
+
+                    await asyncio.sleep(0.1)
+
+            self.rc = rc
+            return self.rc
+
+    async def _log_stderr(self, proc, rc):
+        while True:
+            line = await proc.stderr.readline()
+            if not line:
+                break
+
+            line = line.decode("utf-8", "ignore").rstrip()
+            rc.parse_address(line)
+            logger.debug("rclone rcd: %s", line)
+
+    async def stop(self):
+        async with self.lock:
+            await self._stop()
+
+    async def _stop(self):
+        if self.rc is not None:
+            await self.rc.close()
+            self.rc = None
+
+        if self.proc is not None:
+            if self.proc.returncode is None:
+                self.proc.terminate()
+                try:
+                    await asyncio.wait_for(self.proc.wait(), 5)
+                except asyncio.TimeoutError:
+                    self.proc.kill()
+                    await self.proc.wait()
+
+            self.proc = None
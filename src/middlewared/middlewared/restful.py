@@ -39,6 +39,13 @@ async def authenticate(middleware, req):
 
         if await middleware.call('api_key.authenticate', key) is None:
             raise web.HTTPUnauthorized()
+    elif auth.startswith('Token '):
+        # Clients issuing many requests can authenticate once, obtain a token with `auth.generate_token`
+        # and use it instead of having their credentials re-verified on every request.
+        token = auth.split(' ', 1)[1]
+
+        if not await middleware.call('auth.check_token', token):
+            raise web.HTTPUnauthorized()
     else:
         raise web.HTTPUnauthorized()
 
@@ -578,7 +578,7 @@ class SharingTaskService(CRUDService):
     @private
     async def sharing_task_extend_context(self, extra):
         return {
-            'locked_datasets': await self.middleware.call('zfs.dataset.locked_datasets'),
+            'locked_datasets': await self.middleware.call('pool.dataset.locked_datasets_cached'),
             'service_extend': (await self.middleware.call(self._config.datastore_extend_context, extra))
             if self._config.datastore_extend_context else {}
         }
@@ -592,9 +592,7 @@ class SharingTaskService(CRUDService):
 
     @private
     async def sharing_task_determine_locked(self, data, locked_datasets):
-        return await self.middleware.call(
-            'pool.dataset.path_in_locked_datasets', data[self.path_field], locked_datasets
-        )
+        return await self.middleware.call('pool.dataset.path_in_locked_datasets', data[self.path_field])
 
     @private
     async def sharing_task_extend(self, data, context):
@@ -754,6 +752,37 @@ class CoreService(Service):
             for i in self.middleware.get_wsclients().values()
         ], filters, options)
 
+    @accepts(Bool('reset', default=False))
+    async def metrics(self, reset):
+        """
+        Get method call and event loop latency metrics collected since middleware start (or since last `reset`).
+
+        For every method and executor it was run in (`loop`, `thread`, `ws` or `process`) returns number of calls,
+        number of calls that raised an exception and latency distribution (in seconds) of time spent waiting for a
+        free executor slot (`queue_wait`) and time spent running (`run`). `loop_lag` is the distribution of event
+        loop scheduling delay.
+
+        Same metrics are available in Prometheus text format at `/_metrics`.
+        """
+        summary = self.middleware.metrics.summary()
+        if reset:
+            self.middleware.metrics.reset()
+        return summary
+
+    @accepts()
+    def boot_profile(self):
+        """
+        Get middleware startup timings (in seconds).
+
+        `load` is time spent importing plugins, `setup` is wall time of running plugins setup functions. For every
+        setup function, `wave` is the group of setup functions it ran concurrently with, `start` is the time since the
+        first setup function started.
+        """
+        return {
+            **self.middleware.boot_profile,
+            'setup_functions': sorted(self.middleware.boot_profile['setup_functions'], key=lambda f: f['start']),
+        }
+
     @private
     def get_tasks(self):
         for task in asyncio.all_tasks(loop=self.middleware.loop):
@@ -0,0 +1,113 @@
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    Keyed pool of reusable connections (i.e. authenticated SSH sessions).
+
+    A connection is used by one caller at a time. Connections that were idle for more than `check_interval`
+    seconds are checked with `check` before being handed out again, connections idle for more than `idle_timeout`
+    seconds are closed by `expire`. Connection is discarded instead of being returned to the pool if its user
+    raises one of `discard_exceptions`.
+    """
+
+    def __init__(self, check, close, discard_exceptions=(Exception,), idle_timeout=300, check_interval=10,
+                 max_idle_per_key=4):
+        self.check = check
+        self.close = close
+        self.discard_exceptions = discard_exceptions
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.max_idle_per_key = max_idle_per_key
+
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.stats = {"created": 0, "reused": 0, "check_failed": 0, "discarded": 0, "expired": 0}
+
+    @contextlib.contextmanager
+    def connection(self, key, create):
+        """
+        Yields an idle connection for `key` or a new one created by calling `create()`.
+        """
+        conn = self.acquire(key, create)
+        try:
+            yield conn
+        except self.discard_exceptions:
+            self.discard(conn)
+            raise
+        except BaseException:
+            self.release(key, conn)
+            raise
+        else:
+            self.release(key, conn)
+
+    def acquire(self, key, create):
+        while True:
+            with self.lock:
+                try:
+                    conn, last_used = self.idle.get(key, []).pop()
+                except IndexError:
+                    break
+
+            if time.monotonic() - last_used > self.check_interval:
+                try:
+                    self.check(conn)
+                except Exception:
+                    self.stats["check_failed"] += 1
+                    self.discard(conn)
+                    continue
+
+            self.stats["reused"] += 1
+            return conn
+
+        self.stats["created"] += 1
+        return create()
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_key:
+                idle.append((conn, time.monotonic()))
+                return
+
+        self._close(conn)
+
+    def discard(self, conn):
+        self.stats["discarded"] += 1
+        self._close(conn)
+
+    def expire(self):
+        """
+        Closes connections that were idle for more than `idle_timeout` seconds.
+        """
+        expired = []
+        now = time.monotonic()
+        with self.lock:
+            for key, idle in list(self.idle.items()):
+                expired.extend(conn for conn, last_used in idle if now - last_used > self.idle_timeout)
+                idle[:] = [(conn, last_used) for conn, last_used in idle if now - last_used <= self.idle_timeout]
+                if not idle:
+                    self.idle.pop(key)
+
+        self.stats["expired"] += len(expired)
+        for conn in expired:
+            self._close(conn)
+
+    def clear(self):
+        with self.lock:
+            conns = [conn for idle in self.idle.values() for conn, last_used in idle]
+            self.idle.clear()
+
+        for conn in conns:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            self.close(conn)
+        except Exception:
+            logger.debug("Error closing pooled connection", exc_info=True)
@@ -0,0 +1,78 @@
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+# Password and API key hashes are deliberately slow to compute. They must never be verified on the event loop
+# and should not compete with regular threaded calls either.
+CREDENTIAL_VERIFY_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix='credential_verify',
+)
+
+
+class CredentialCache:
+    """
+    Short-lived, memory-only cache of successfully verified credentials.
+
+    Cleartext secrets are never stored: entries are keyed by a HMAC of the credential computed with a random
+    per-process key. Each entry remembers the stored hash it was verified against so that changing a password
+    or resetting an API key invalidates it even without an explicit `invalidate` call.
+    """
+
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.key = os.urandom(32)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _digest(self, kind, identity, secret):
+        return hmac.new(
+            self.key, b'\0'.join([kind.encode(), str(identity).encode(), secret.encode()]), hashlib.sha256,
+        ).digest()
+
+    def get(self, kind, identity, secret, stored_hash):
+        """
+        Returns `True` if `secret` was recently verified against `stored_hash`.
+        """
+        digest = self._digest(kind, identity, secret)
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return False
+
+            expires_at, entry_kind, entry_identity, entry_stored_hash = entry
+            if expires_at < time.monotonic() or not hmac.compare_digest(entry_stored_hash, stored_hash):
+                self.entries.pop(digest)
+                return False
+
+            return True
+
+    def put(self, kind, identity, secret, stored_hash):
+        digest = self._digest(kind, identity, secret)
+        now = time.monotonic()
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self._expire(now)
+                if len(self.entries) >= self.max_entries:
+                    self.entries.pop(next(iter(self.entries)))
+
+            self.entries[digest] = (now + self.ttl, kind, identity, stored_hash)
+
+    def invalidate(self, kind=None, identity=None):
+        with self.lock:
+            for digest, (expires_at, entry_kind, entry_identity, stored_hash) in list(self.entries.items()):
+                if kind is not None and entry_kind != kind:
+                    continue
+                if identity is not None and entry_identity != identity:
+                    continue
+
+                self.entries.pop(digest)
+
+    def _expire(self, now):
+        for digest, entry in list(self.entries.items()):
+            if entry[0] < now:
+                self.entries.pop(digest)
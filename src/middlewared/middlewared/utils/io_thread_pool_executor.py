@@ -9,6 +9,22 @@ import middlewared.utils.osc as osc
 
 logger = logging.getLogger(__name__)
 
+__all__ = ["IoThreadPoolExecutor", "IoThreadPoolFull"]
+
+# Hard ceiling of worker threads of an executor. Every pool is allowed to have at least one worker regardless of this
+# limit so that a flood of calls to one service can not prevent other services from running.
+MAX_WORKERS = 400
+# Worker thread ceiling for a single pool
+POOL_MAX_WORKERS = 100
+# Number of work items a pool can queue once it has reached its worker ceiling
+POOL_MAX_QUEUE_SIZE = 10000
+
+
+class IoThreadPoolFull(Exception):
+    """
+    Raised by `submit` when a pool has reached its worker ceiling and its queue is full.
+    """
+
 
 class WorkItem(object):
     def __init__(self, future, fn, args, kwargs):
@@ -32,9 +48,9 @@ class WorkItem(object):
 
 
 class Worker:
-    def __init__(self, name, executor):
+    def __init__(self, name, pool):
         self.name = name
-        self.executor = executor
+        self.pool = pool
 
         self.busy = False
 
@@ -43,9 +59,10 @@ class Worker:
 
     def _target(self):
         osc.set_thread_name(self.name)
+        self.pool.executor.local.executor = self.pool.executor
         try:
             while True:
-                work_item = self.executor.get_work_item(self)
+                work_item = self.pool.get_work_item(self)
                 if work_item is None:
                     return
 
@@ -54,78 +71,177 @@ class Worker:
         except Exception:
             logger.critical("Exception in worker", exc_info=True)
         finally:
-            self.executor.remove_worker(self)
+            self.pool.remove_worker(self)
 
     def __repr__(self):
         return f"<Worker {self.name}{' busy' if self.busy else ''}>"
 
 
-class IoThreadPoolExecutor(_base.Executor):
-    def __init__(self, thread_name_prefix, min_workers):
-        self.thread_name_prefix = thread_name_prefix
-        self.counter = itertools.count()
+class IoThreadPool(_base.Executor):
+    """
+    Pool of worker threads of `IoThreadPoolExecutor` that serves one class of calls (i.e. methods of one service).
 
-        self.work_queue = queue.Queue()
+    Workers are started on demand when there are no free workers and exit after being idle for a few seconds (unless
+    there are only `min_workers` free workers left).
+    """
 
+    def __init__(self, executor, name, min_workers, max_workers):
+        self.executor = executor
+        self.name = name
         self.min_workers = min_workers
-        self.workers = []
-        self.workers_busy_lock = threading.Lock()
-        for i in range(self.min_workers):
-            self._start_worker()
+        self.max_workers = max_workers
+        self.max_queue_size = executor.pool_max_queue_size
+
+        self.work_queue = queue.SimpleQueue()
+        self.workers = set()
+        # These are only modified while holding `executor.lock`
+        self.free = 0
+        self.queued = 0
+
+        with self.executor.lock:
+            for i in range(self.min_workers):
+                self._start_worker()
 
     def submit(self, fn, *args, **kwargs):
         future = _base.Future()
         work_item = WorkItem(future, fn, args, kwargs)
 
-        self.work_queue.put(work_item)
+        with self.executor.lock:
+            if self.queued >= self.free:
+                if self._can_start_worker():
+                    logger.trace("Starting new worker in namespace %r because there are no free workers",
+                                 self.prefix)
+                    self._start_worker()
+                elif self.queued - self.free >= self.max_queue_size:
+                    raise IoThreadPoolFull(f"Too many concurrent calls in {self.prefix!r} ({len(self.workers)} "
+                                           f"running, {self.queued} queued)")
 
-        start_worker = False
-        with self.workers_busy_lock:
-            if not any([not worker.busy for worker in self.workers]):
-                logger.trace("Starting new worker in namespace %r because there are no free workers",
-                             self.thread_name_prefix)
-                start_worker = True
-        if start_worker:
-            self._start_worker()
+            self.queued += 1
+            self.work_queue.put(work_item)
 
         return future
 
+    @property
+    def prefix(self):
+        if self.name is None:
+            return self.executor.thread_name_prefix
+
+        return f"{self.executor.thread_name_prefix}-{self.name}"
+
+    def _can_start_worker(self):
+        if not self.workers:
+            return True
+
+        return len(self.workers) < self.max_workers and self.executor.workers_count < self.executor.max_workers
+
     def _start_worker(self):
-        worker = Worker(f'{self.thread_name_prefix}-{next(self.counter)}', self)
-        self.workers.append(worker)
+        worker = Worker(f"{self.prefix}-{next(self.executor.counter)}", self)
+        self.workers.add(worker)
+        self.free += 1
+        self.executor.workers_count += 1
 
     def get_work_item(self, worker):
-        with self.workers_busy_lock:
-            worker.busy = False
+        with self.executor.lock:
+            if worker.busy:
+                worker.busy = False
+                self.free += 1
 
         while True:
             timeout = None
-            free_workers = sum([1 for worker in self.workers if not worker.busy])
-            if free_workers > self.min_workers:
+            if self.free > self.min_workers:
                 logger.trace("Will probably need to shutdown %r because there are %d free workers",
-                             worker, free_workers)
+                             worker, self.free)
                 timeout = random.uniform(4.0, 6.0)
 
             try:
                 work_item = self.work_queue.get(True, timeout)
             except queue.Empty:
-                with self.workers_busy_lock:
-                    free_workers = sum([1 for worker in self.workers if not worker.busy])
-                    if free_workers > self.min_workers:
-                        logger.trace("Shutting down %r because there are %d free workers", worker, free_workers)
-                        self.remove_worker(worker)
+                with self.executor.lock:
+                    # Do not leave queued work items without a worker
+                    if self.free > max(self.min_workers, self.queued):
+                        logger.trace("Shutting down %r because there are %d free workers", worker, self.free)
+                        self.free -= 1
+                        self._remove_worker(worker)
                         return None
 
                 # Else, other worker has been shut down and now the number of workers is correct, let's run another
                 # iteration of this (now, probably with infinite timeout)
             else:
-                with self.workers_busy_lock:
+                with self.executor.lock:
                     worker.busy = True
+                    self.free -= 1
+                    self.queued -= 1
 
                 return work_item
 
     def remove_worker(self, worker):
-        try:
+        with self.executor.lock:
+            if worker in self.workers:
+                if not worker.busy:
+                    self.free -= 1
+                self._remove_worker(worker)
+
+    def _remove_worker(self, worker):
+        if worker in self.workers:
             self.workers.remove(worker)
-        except ValueError:
-            pass
+            self.executor.workers_count -= 1
+
+    def in_worker_thread(self):
+        return self.executor.in_worker_thread()
+
+    def stats(self):
+        with self.executor.lock:
+            return {"workers": len(self.workers), "free": self.free, "queued": self.queued}
+
+
+class IoThreadPoolExecutor(_base.Executor):
+    """
+    Executor for blocking calls. Calls submitted to the executor itself run in its default pool, `pool(name)` returns a
+    separate pool (i.e. for a service) so that different classes of calls do not wait for each other.
+
+    The number of worker threads is limited by `max_workers` (for all pools) and `pool_max_workers` (for each pool
+    other than the default one).
+    Once a pool has reached its limit, calls are queued; when there are more than `pool_max_queue_size` calls queued,
+    `submit` raises `IoThreadPoolFull`.
+    """
+
+    def __init__(self, thread_name_prefix, min_workers, max_workers=MAX_WORKERS, pool_max_workers=POOL_MAX_WORKERS,
+                 pool_max_queue_size=POOL_MAX_QUEUE_SIZE):
+        self.thread_name_prefix = thread_name_prefix
+        self.counter = itertools.count()
+        self.max_workers = max_workers
+        self.pool_max_workers = pool_max_workers
+        self.pool_max_queue_size = pool_max_queue_size
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.workers_count = 0
+
+        self.default_pool = IoThreadPool(self, None, min_workers, max_workers)
+        self.pools = {}
+
+    def submit(self, fn, *args, **kwargs):
+        return self.default_pool.submit(fn, *args, **kwargs)
+
+    def pool(self, name):
+        try:
+            return self.pools[name]
+        except KeyError:
+            return self.pools.setdefault(name, IoThreadPool(self, name, 0, self.pool_max_workers))
+
+    @property
+    def workers(self):
+        with self.lock:
+            return list(itertools.chain(self.default_pool.workers, *[pool.workers for pool in self.pools.values()]))
+
+    def in_worker_thread(self):
+        return getattr(self.local, "executor", None) is self
+
+    def stats(self):
+        return {
+            "workers": self.workers_count,
+            "pools": {
+                name or "default": pool.stats()
+                for name, pool in [(None, self.default_pool)] + list(self.pools.items())
+            },
+        }
@@ -0,0 +1,241 @@
+import threading
+import time
+
+__all__ = ["Histogram", "MeteredCall", "MetricsRegistry", "timed_call", "EXECUTORS", "PERCENTILES"]
+
+# Executors a method call can be run in: event loop (coroutine methods), thread pools (`thread` for io threads and
+# service/method thread pools, `ws` for websocket connection thread pool) and the worker process pool.
+EXECUTORS = ("loop", "thread", "ws", "process")
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Each power of two is split into 2 ** SUB_BUCKET_BITS buckets, so the value reported for a bucket is within
+# 1 / 2 ** SUB_BUCKET_BITS (~6%) of any value recorded into it.
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+def timed_call(method, *args, **kwargs):
+    """
+    Calls `method` and returns `(start time, result)`. Used to measure how long a call has been queued in an executor
+    that does not share memory with us (i.e. a process pool; `time.monotonic` is system-wide).
+    """
+    return time.monotonic(), method(*args, **kwargs)
+
+
+def _bucket(value):
+    if value < 2 * SUB_BUCKETS:
+        return value
+
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def _bucket_value(index):
+    """
+    Middle of the value range covered by bucket `index`.
+    """
+    if index < 2 * SUB_BUCKETS:
+        return index
+
+    shift = index // SUB_BUCKETS - 1
+    mantissa = index % SUB_BUCKETS + SUB_BUCKETS
+    return (mantissa << shift) + ((1 << shift) - 1) / 2
+
+
+class Histogram:
+    """
+    HDR-style histogram of durations with microsecond resolution and constant relative error. Only non-empty buckets
+    are stored.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, seconds):
+        value = max(int(seconds * 1000000), 0)
+        index = _bucket(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        if not self.count:
+            return 0
+
+        # Rank of the requested value, 1-based
+        rank = max(int(self.count * percentile / 100 + 0.5), 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(_bucket_value(index), self.max) / 1000000
+
+        return self.max / 1000000
+
+    def cumulative(self, bounds):
+        """
+        Number of recorded values that are less than or equal to each of the `bounds` (in seconds).
+        """
+        result = []
+        items = sorted(self.buckets.items())
+        i = 0
+        seen = 0
+        for bound in bounds:
+            bound = bound * 1000000
+            while i < len(items) and _bucket_value(items[i][0]) <= bound:
+                seen += items[i][1]
+                i += 1
+            result.append(seen)
+
+        return result
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count / 1000000 if self.count else 0,
+            "max": self.max / 1000000,
+            **{f"p{p:g}": self.percentile(p) for p in PERCENTILES},
+        }
+
+
+class MeteredCall:
+    """
+    Measures a method call. Calls run in an executor should be wrapped with `run` (or have `started` set to the time
+    they were picked up by the executor) so that the time spent waiting for a free executor slot is known.
+    """
+
+    def __init__(self, registry, method, executor):
+        self.registry = registry
+        self.method = method
+        self.executor = executor
+        self.queued = time.monotonic()
+        self.started = None
+
+    def run(self, method, *args, **kwargs):
+        self.started = time.monotonic()
+        return method(*args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        now = time.monotonic()
+        if self.started is None:
+            queue_wait = None
+            run = now - self.queued
+        else:
+            queue_wait = self.started - self.queued
+            run = now - self.started
+
+        self.registry.record_call(self.method, self.executor, queue_wait, run, exc_type is not None)
+
+
+class MethodMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.queue_wait = Histogram()
+        self.run = Histogram()
+
+
+class MetricsRegistry:
+    """
+    Per-method call counts, error counts and latency histograms (split by the time the call has been waiting for a
+    free executor slot and the time it has been running) and event loop lag.
+    """
+
+    PROMETHEUS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.loop_lag = Histogram()
+        self.started = time.monotonic()
+
+    def call(self, method, executor):
+        return MeteredCall(self, method, executor)
+
+    def record_call(self, method, executor, queue_wait, run, error=False):
+        with self.lock:
+            key = (method, executor)
+            metrics = self.methods.get(key)
+            if metrics is None:
+                metrics = self.methods[key] = MethodMetrics()
+
+            metrics.calls += 1
+            if error:
+                metrics.errors += 1
+            if queue_wait is not None:
+                metrics.queue_wait.record(queue_wait)
+            metrics.run.record(run)
+
+    def record_loop_lag(self, lag):
+        with self.lock:
+            self.loop_lag.record(lag)
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+            self.loop_lag = Histogram()
+            self.started = time.monotonic()
+
+    def summary(self):
+        with self.lock:
+            methods = {}
+            for (method, executor), metrics in sorted(self.methods.items()):
+                methods.setdefault(method, {})[executor] = {
+                    "calls": metrics.calls,
+                    "errors": metrics.errors,
+                    "queue_wait": metrics.queue_wait.summary(),
+                    "run": metrics.run.summary(),
+                }
+
+            return {
+                "uptime": time.monotonic() - self.started,
+                "methods": methods,
+                "loop_lag": self.loop_lag.summary(),
+            }
+
+    def prometheus(self):
+        """
+        Metrics in Prometheus text exposition format.
+        """
+        lines = []
+
+        def histogram(name, help, items):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, h in items:
+                for bound, count in zip(self.PROMETHEUS_BUCKETS, h.cumulative(self.PROMETHEUS_BUCKETS)):
+                    lines.append(f"{name}_bucket{{{labels}le=\"{bound:g}\"}} {count}")
+                lines.append(f"{name}_bucket{{{labels}le=\"+Inf\"}} {h.count}")
+                lines.append(f"{name}_sum{{{labels.rstrip(',')}}} {h.sum / 1000000}")
+                lines.append(f"{name}_count{{{labels.rstrip(',')}}} {h.count}")
+
+        with self.lock:
+            methods = sorted(self.methods.items())
+            labels = [(f"method=\"{method}\",executor=\"{executor}\",", metrics) for (method, executor), metrics in
+                      methods]
+
+            for name, help, attr in [
+                ("middlewared_calls_total", "Method calls.", "calls"),
+                ("middlewared_call_errors_total", "Method calls that raised an exception.", "errors"),
+            ]:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} counter")
+                for label, metrics in labels:
+                    lines.append(f"{name}{{{label.rstrip(',')}}} {getattr(metrics, attr)}")
+
+            histogram("middlewared_call_queue_wait_seconds", "Time method calls waited for a free executor slot.",
+                      [(label, metrics.queue_wait) for label, metrics in labels])
+            histogram("middlewared_call_run_seconds", "Time method calls were running.",
+                      [(label, metrics.run) for label, metrics in labels])
+            histogram("middlewared_loop_lag_seconds", "Event loop scheduling lag.", [("", self.loop_lag)])
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import pytest
+import sys
+import os
+from pytest_dependency import depends
+apifolder = os.getcwd()
+sys.path.append(apifolder)
+from functions import GET, POST, PUT, SSH_TEST, wait_on_job
+from auto_config import ip, user, password, scale, ha
+
+pytestmark = pytest.mark.skipif(ha, reason='Skipping test for HA')
+
+file_pool = 'sysds_migrate'
+image = f'/tmp/{file_pool}.img'
+loop = '/dev/loop12'
+marker = '/var/db/system/migrate_test'
+device = {}
+
+
+def ssh(command):
+    results = SSH_TEST(command, user, password, ip)
+    assert results['result'] is True, results['output']
+    return results['output']
+
+
+def migrate(pool):
+    results = PUT('/systemdataset/', {'pool': pool})
+    assert results.status_code == 200, results.text
+    job_status = wait_on_job(results.json(), 300)
+    assert job_status['state'] == 'SUCCESS', str(job_status['results'])
+    assert GET('/systemdataset/').json()['pool'] == pool
+
+
+@pytest.mark.dependency(name='sysds_file_pool')
+def test_01_create_file_backed_pool(request):
+    depends(request, ['pool_04'], scope='session')
+    ssh(f'truncate -s 1G {image}')
+    if scale is True:
+        ssh(f'losetup {loop} {image}')
+        device['name'] = loop
+    else:
+        device['name'] = f'/dev/{ssh(f"mdconfig -a -t vnode -f {image}").strip()}'
+    ssh(f'zpool create -f {file_pool} {device["name"]} && zpool export {file_pool}')
+
+    results = GET('/pool/import_find/')
+    assert results.status_code == 200, results.text
+    job_status = wait_on_job(results.json(), 180)
+    assert job_status['state'] == 'SUCCESS', str(job_status['results'])
+    guid = [p['guid'] for p in job_status['results']['result'] if p['name'] == file_pool]
+    assert guid, str(job_status['results'])
+
+    results = POST('/pool/import_pool/', {'guid': guid[0]})
+    assert results.status_code == 200, results.text
+    job_status = wait_on_job(results.json(), 180)
+    assert job_status['state'] == 'SUCCESS', str(job_status['results'])
+
+
+def test_02_migrate_system_dataset_to_file_backed_pool(request):
+    depends(request, ['sysds_file_pool'])
+    global original_pool
+    original_pool = GET('/systemdataset/').json()['pool']
+    ssh(f'echo migrate > {marker}')
+
+    migrate(file_pool)
+
+    assert ssh(f'cat {marker}').strip() == 'migrate'
+    assert ssh(f'zfs list -H -o name {file_pool}/.system').strip() == f'{file_pool}/.system'
+    assert SSH_TEST(f'zfs list -H {original_pool}/.system', user, password, ip)['result'] is False
+    # Snapshots used for the migration are removed
+    assert ssh(f'zfs list -H -o name -t snapshot -r {file_pool}/.system').strip() == ''
+
+
+def test_03_services_are_running_after_migration(request):
+    depends(request, ['sysds_file_pool'])
+    for service in ['collectd', 'rrdcached']:
+        results = GET(f'/service/?service={service}')
+        assert results.json()[0]['state'] == 'RUNNING', results.text
+
+
+def test_04_migrate_system_dataset_back(request):
+    depends(request, ['sysds_file_pool'])
+    migrate(original_pool)
+
+    assert ssh(f'cat {marker}').strip() == 'migrate'
+    assert SSH_TEST(f'zfs list -H {file_pool}/.system', user, password, ip)['result'] is False
+    ssh(f'rm {marker}')
+
+
+def test_05_destroy_file_backed_pool(request):
+    depends(request, ['sysds_file_pool'])
+    pool_id = GET(f'/pool/?name={file_pool}').json()[0]['id']
+    results = POST(f'/pool/id/{pool_id}/export/', {'destroy': True})
+    assert results.status_code == 200, results.text
+    job_status = wait_on_job(results.json(), 180)
+    assert job_status['state'] == 'SUCCESS', str(job_status['results'])
+
+    if scale is True:
+        ssh(f'losetup -d {loop}')
+    else:
+        ssh(f'mdconfig -d -u {device["name"]}')
+    ssh(f'rm {image}')